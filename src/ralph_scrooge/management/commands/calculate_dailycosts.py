@@ -22,6 +22,7 @@ from ralph_scrooge.models import (
 from ralph_scrooge.rest_api.public.v0_10.service_environment_costs import (
     date_range,
 )
+from ralph_scrooge.utils.tasks import export_snapshots
 
 logger = logging.getLogger(__name__)
 yesterday = date.today() - timedelta(days=1)
@@ -198,3 +199,8 @@ class Command(BaseCommand):
                 options['pricing_service_names'],
                 options['force'],
             )
+        # calculated costs are exported to snapshots (if configured)
+        try:
+            export_snapshots()
+        except Exception as e:
+            logger.exception(e)
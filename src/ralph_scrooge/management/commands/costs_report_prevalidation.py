@@ -9,6 +9,7 @@ from django.core.management.base import BaseCommand
 
 from ralph_scrooge.utils.common import validate_date as valid_date
 from ralph_scrooge.plugins.validations import (
+    DataForReportRangeValidator,
     DataForReportValidationError,
     DataForReportValidator
 )
@@ -16,7 +17,8 @@ from ralph_scrooge.plugins.validations import (
 
 class Command(BaseCommand):
     """
-    Validate data for costs report for particular date.
+    Validate data for costs report for particular date (or every day between
+    date and date end).
     """
     def add_arguments(self, parser):
         parser.add_argument(
@@ -25,11 +27,29 @@ class Command(BaseCommand):
             dest='date',
             required=True,
         )
+        parser.add_argument(
+            '--date-end',
+            type=valid_date,
+            dest='date_end',
+            help="Last day of a date range to validate (starting at '--date')"
+        )
 
     def handle(self, *args, **options):
+        if options['date_end']:
+            self._validate_range(options['date'], options['date_end'])
+            return
         validator = DataForReportValidator(options['date'])
         try:
             validator.validate()
         except DataForReportValidationError as e:
             for error in e.errors:
                 self.stdout.write(error)
+
+    def _validate_range(self, start, end):
+        validator = DataForReportRangeValidator(start, end)
+        try:
+            validator.validate()
+        except DataForReportValidationError as e:
+            for day, errors in e.errors.items():
+                for error in errors:
+                    self.stdout.write('{:%Y-%m-%d}: {}'.format(day, error))
@@ -20,6 +20,7 @@ from django.template.loader import render_to_string
 
 from ralph_scrooge.models import (
     DailyUsage,
+    ServiceEnvironmentUsageAnomaly,
     ServiceUsageTypes,
     UsageAnomalyAck,
     UsageType,
@@ -30,6 +31,7 @@ from ralph_scrooge.rest_api.public.v0_10.service_environment_costs import (
     date_range,
 )
 from ralph_scrooge.utils.common import validate_date
+from ralph_scrooge.utils.usage_anomalies import update_usage_anomaly_stats
 
 
 class UnknownUsageTypeUploadFreqError(Exception):
@@ -49,7 +51,9 @@ def get_usage_types(symbols):
     given as an empty list, fetch all UsageTypes instead.
     """
     if symbols:
-        uts = UsageType.objects.filter(symbol__in=symbols).order_by('symbol')
+        uts = UsageType.objects.filter(
+            symbol__in=symbols
+        ).order_by('symbol').prefetch_related('owners')
         known_symbols = [ut.symbol for ut in uts]
         unknown_symbols = []
         for s in symbols:
@@ -61,7 +65,7 @@ def get_usage_types(symbols):
                 .format(", ".join(unknown_symbols))
             )
     else:
-        uts = UsageType.objects.order_by('symbol')
+        uts = UsageType.objects.order_by('symbol').prefetch_related('owners')
     return uts
 
 
@@ -90,31 +94,90 @@ def get_negative_month_range(end_date, months=1, align_to_month=False):
     return date_range(start_date, end_date)
 
 
+def _get_window_start(end_date, align_to_month=False):
+    """Return the first day of the monthly range ending at `end_date` (see
+    `get_negative_month_range`).
+    """
+    return get_negative_month_range(
+        end_date + a_day, align_to_month=align_to_month
+    ).next()
+
+
+class UsageValues(object):
+    """Dense (usage types x days) matrix of daily usages values - every row
+    holds sums of values of single UsageType for consecutive days from
+    `start_date` to `end_date` (inclusive), or None for days without usages.
+    """
+
+    def __init__(self, usage_types, start_date, end_date):
+        self.usage_types = list(usage_types)
+        self.start_date = start_date
+        self.end_date = end_date
+        self.days = list(date_range(start_date, end_date + a_day))
+        self.values = [[None] * len(self.days) for ut in self.usage_types]
+        self._rows = {ut.id: i for i, ut in enumerate(self.usage_types)}
+
+    @classmethod
+    def from_dict(cls, usage_values, end_date):
+        """Build matrix from dict of values per day for every UsageType."""
+        result = cls(
+            usage_values.keys(),
+            _get_window_start(end_date, align_to_month=True),
+            end_date
+        )
+        for usage_type, values in usage_values.items():
+            for date, value in values.items():
+                if result.start_date <= date <= end_date:
+                    result.set(usage_type.id, date, value)
+        return result
+
+    def column(self, date):
+        return (date - self.start_date).days
+
+    def set(self, usage_type_id, date, value):
+        """Set value for UsageType and day (ignored for UsageTypes not
+        present in matrix).
+        """
+        row = self._rows.get(usage_type_id)
+        if row is not None:
+            self.values[row][self.column(date)] = value
+
+    def get_mask(self, ranges):
+        """Return list of flags (for every day) if day is in any of (start,
+        end) `ranges`.
+        """
+        mask = [False] * len(self.days)
+        for start, end in ranges:
+            first = max(self.column(start), 0)
+            last = min(self.column(end) + 1, len(self.days))
+            if first < last:
+                mask[first:last] = [True] * (last - first)
+        return mask
+
+
 def _get_usage_values_for_month(usage_types, end_date):
     """Aggregate values of `usage_types` per day within a month range
     designated by (`end_date` - 1 month, `end_date`), where `end_date` is not
     included. If there are no values for given UsageType/day, it will be
-    omitted.
+    None in the result (see `UsageValues`).
     An exception to this "end_date - 1 month" rule are usage types with
     `upload_frequency` set to `monthly` - in that case, the aforementioned
     range is extended to the beginning of the month (e.g. '2016-12-01' instead
-    of '2016-12-10' for `start_date`.
+    of '2016-12-10' for `start_date`), hence values are fetched for the
+    extended range (for all usage types, using single grouped query - values
+    of UsageTypes other than `usage_types` are ignored).
     """
-    results = {}
-    start_date = get_negative_month_range(end_date + a_day).next()
-    for ut in usage_types:
-        if ut.upload_freq == UsageTypeUploadFreq.monthly.id:
-            start_date = get_negative_month_range(
-                end_date + a_day, align_to_month=True
-            ).next()
-        results[ut] = {}
-        daily_usages = dict(
-            DailyUsage.objects.filter(
-                date__gte=start_date, date__lte=end_date, type=ut
-            ).values_list('date').annotate(Sum('value'))
-        )
-        results[ut].update(daily_usages)
-    return results
+    result = UsageValues(
+        usage_types,
+        _get_window_start(end_date, align_to_month=True),
+        end_date,
+    )
+    for type_id, date, value in DailyUsage.objects.filter(
+        date__gte=result.start_date,
+        date__lte=end_date,
+    ).values_list('type', 'date').annotate(Sum('value')).order_by():
+        result.set(type_id, date, value)
+    return result
 
 
 def _get_max_expected_date(usage_type, date):
@@ -145,7 +208,8 @@ def _get_max_expected_date(usage_type, date):
 
 
 def _detect_missing_values(usage_values, end_date):
-    """Find missing dates in `usage_values` within a month range given by
+    """Find missing dates in `usage_values` (`UsageValues` or dict of values
+    per day for every UsageType) within a month range given by
     `get_negative_month_range` and return them as a dict keyed by UsageTypes,
     where values are lists of those missing dates.
 
@@ -153,49 +217,58 @@ def _detect_missing_values(usage_values, end_date):
     UsageTypeUploadFreq are filtered out from the final dict. Similarly with
     dates that don't belong to ranges taken from Pricing Service(s) divisions.
     """
-    def is_active_for_date(date, active_ranges):
-        for r in active_ranges:
-            if date >= r['start'] and date <= r['end']:
-                return True
-        return False
-
+    if not isinstance(usage_values, UsageValues):
+        usage_values = UsageValues.from_dict(usage_values, end_date)
+
+    active_ranges = defaultdict(list)
+    for type_id, start, end in ServiceUsageTypes.objects.values_list(
+        'usage_type_id', 'start', 'end'
+    ):
+        active_ranges[type_id].append((start, end))
+
+    first_column = usage_values.column(_get_window_start(end_date))
+    first_monthly_column = usage_values.column(
+        _get_window_start(end_date, align_to_month=True)
+    )
+    max_dates = {}
     missing_values = {}
-    for usage_type in usage_values.keys():
-        max_date = _get_max_expected_date(usage_type, end_date)
-        freq_name = UsageTypeUploadFreq.from_id(usage_type.upload_freq).name
-        if freq_name == 'monthly':
-            date_range = get_negative_month_range(
-                end_date + a_day, align_to_month=True
+    for usage_type, row in zip(usage_values.usage_types, usage_values.values):
+        if usage_type.upload_freq not in max_dates:
+            max_dates[usage_type.upload_freq] = _get_max_expected_date(
+                usage_type, end_date
             )
-        else:
-            date_range = get_negative_month_range(end_date + a_day)
-
-        active_ranges = ServiceUsageTypes.objects.filter(
-            usage_type=usage_type
-        ).values('start', 'end')
-
-        for date in date_range:
-            if not is_active_for_date(date, active_ranges):
-                continue
-            if (usage_values[usage_type].get(date) is None and
-                    not date > max_date):
-                if missing_values.get(usage_type) is None:
-                    missing_values[usage_type] = []
-                missing_values[usage_type].append(date)
+        freq_name = UsageTypeUploadFreq.from_id(usage_type.upload_freq).name
+        first = (
+            first_monthly_column if freq_name == 'monthly' else first_column
+        )
+        last = max(
+            usage_values.column(max_dates[usage_type.upload_freq]) + 1, first
+        )
+        active = usage_values.get_mask(active_ranges[usage_type.id])
+        missing = [
+            date for date, is_active, value in zip(
+                usage_values.days[first:last],
+                active[first:last],
+                row[first:last],
+            ) if is_active and value is None
+        ]
+        if missing:
+            missing_values[usage_type] = missing
     return missing_values
 
 
 def _detect_unusual_changes(usage_values, end_date):
-    """Having `usage_values` like:
+    """Having `usage_values` like (see `UsageValues`; dict of values per day
+    for every UsageType is accepted too):
 
     {<UsageType: some usage 1>: {datetime.date(2016, 10, 5): 10.00,
                                  datetime.date(2016, 10, 6): 15.00,
                                  datetime.date(2016, 10, 7): 99.00},
      <UsageType: some usage 2>: { ... }}
 
-    ...iterate over them and compare values in each pair of adjoining days. If
-    such change is bigger than usage_type.change_tolerance, record it as a
-    change that has to be reported, e.g.:
+    ...compare values in each pair of adjoining days. If such change is bigger
+    than usage_type.change_tolerance, record it as a change that has to be
+    reported, e.g.:
 
     {<UsageType: some usage 1>: (datetime.date(2016, 10, 6),
                                  datetime.date(2016, 10, 7),
@@ -211,35 +284,24 @@ def _detect_unusual_changes(usage_values, end_date):
         ch = (val2 - val1) / val1 if val1 else 0
         return round(ch, 2)
 
-    def group_by_type(changes):
-        """Having a list of tuples like:
-        (<UsageType>, datetime.date, datetime.date, float, float, float)
-        ...group them in a dict by <UsageType>, removing <UsageType> element
-        from all tuples.
-        """
-        changes_by_type = {}
-        for c in changes:
-            if changes_by_type.get(c[0]) is None:
-                changes_by_type[c[0]] = []
-            changes_by_type[c[0]].append(tuple(c[1:]))
-        return changes_by_type
-
-    changes = []
-    delta = datetime.timedelta(days=1)
-    for usage_type in usage_values.keys():
-        for date in get_negative_month_range(end_date + a_day):
-            next_date = date + delta
-            if (usage_values[usage_type].get(date) is None or
-                    usage_values[usage_type].get(next_date) is None):
-                continue
-            uv1 = usage_values[usage_type][date]
-            uv2 = usage_values[usage_type][next_date]
-            relative_change = get_relative_change(uv1, uv2)
-            if abs(relative_change) > usage_type.change_tolerance:
-                changes.append(
-                    (usage_type, date, next_date, uv1, uv2, relative_change)
-                )
-    grouped_changes = group_by_type(changes)
+    if not isinstance(usage_values, UsageValues):
+        usage_values = UsageValues.from_dict(usage_values, end_date)
+
+    first = usage_values.column(_get_window_start(end_date))
+    days = usage_values.days[first:]
+    grouped_changes = {}
+    for usage_type, row in zip(usage_values.usage_types, usage_values.values):
+        values = row[first:]
+        changes = [
+            (date, date + a_day, uv1, uv2, get_relative_change(uv1, uv2))
+            for date, uv1, uv2 in zip(days, values, values[1:])
+            if uv1 is not None and uv2 is not None
+        ]
+        changes = [
+            ch for ch in changes if abs(ch[4]) > usage_type.change_tolerance
+        ]
+        if changes:
+            grouped_changes[usage_type] = changes
     return grouped_changes
 
 
@@ -251,6 +313,87 @@ def _detect_anomalies(usage_types, end_date):
     return (missing_values, unusual_changes)
 
 
+def _detect_service_environment_anomalies(
+    usage_types, end_date, dry_run=False
+):
+    """Update (incremental) statistics of usages per UsageType and service
+    environment (see `ralph_scrooge.utils.usage_anomalies`) and return
+    not acknowledged anomalies detected by them within a month range (ending
+    at `end_date`) as a dict keyed by UsageTypes:
+
+    {<UsageType: some usage 1>: [<ServiceEnvironmentUsageAnomaly>, ...]}
+
+    When `dry_run` is set to True, statistics are not saved (anomalies of
+    not processed usages are only added to the result).
+    """
+    window_start = _get_window_start(end_date)
+    new_anomalies = update_usage_anomaly_stats(
+        end_date, usage_types, dry_run=dry_run
+    )
+    usage_types_by_id = {ut.id: ut for ut in usage_types}
+    acks = set(
+        UsageAnomalyAck.objects.filter(
+            anomaly_date__gte=window_start,
+            anomaly_date__lte=end_date,
+        ).values_list('type_id', 'anomaly_date')
+    )
+    se_anomalies = list(ServiceEnvironmentUsageAnomaly.objects.filter(
+        date__gte=window_start,
+        date__lte=end_date,
+    ).select_related(
+        'service_environment__service',
+        'service_environment__environment',
+    ))
+    if dry_run:
+        se_anomalies.extend(a for a in new_anomalies if a.date >= window_start)
+    anomalies = defaultdict(list)
+    for anomaly in sorted(se_anomalies, key=lambda a: (a.date, -a.deviation)):
+        usage_type = usage_types_by_id.get(anomaly.type_id)
+        if (
+            usage_type is None or
+            (anomaly.type_id, anomaly.date) in acks
+        ):
+            continue
+        anomalies[usage_type].append(anomaly)
+    return dict(anomalies)
+
+
+def _add_service_environment_anomalies(anomalies, se_anomalies):
+    """Add `se_anomalies` (see `_detect_service_environment_anomalies`) to
+    `anomalies` grouped by owner (see `_group_anomalies_by_owner`), under
+    `service_environment_anomalies` key, as a list of tuples sorted by date
+    and UsageType name:
+
+    [
+        (datetime.date, UsageType, ServiceEnvironment, float, float, float),
+        ...
+    ]
+
+    (the last three values are: usage value, expected value and deviation
+    from it in standard deviations).
+    """
+    for owner in anomalies.keys():
+        anomalies[owner]['service_environment_anomalies'] = []
+    for usage_type, ut_anomalies in se_anomalies.items():
+        for owner in usage_type.owners.all():
+            owner_anomalies = anomalies.setdefault(owner, {
+                'missing_values': {},
+                'unusual_changes': {},
+                'service_environment_anomalies': [],
+            })
+            owner_anomalies['service_environment_anomalies'].extend(
+                (
+                    a.date, usage_type, a.service_environment, a.value,
+                    a.expected, a.deviation,
+                ) for a in ut_anomalies
+            )
+    for owner in anomalies.keys():
+        anomalies[owner]['service_environment_anomalies'].sort(
+            key=lambda a: (a[0], a[1].name)
+        )
+    return anomalies
+
+
 def _postprocess_for_report(usage_types, missing_values, unusual_changes):
     """Post-process the output of `_detect_anomalies` in order to facilitate
     composing final e-mails with anomaly reports.
@@ -267,14 +410,20 @@ def _filter_out_ack(unusual_changes):
     given UsageType(s).
     """
     unusual_changes_ = {}
-    for ut in unusual_changes.keys():
-        ut_changes = unusual_changes[ut]
-        acks = set(
-            UsageAnomalyAck.objects.filter(
-                type=ut, anomaly_date__in=[ch[0] for ch in ut_changes]
-            ).values_list('anomaly_date', flat=True)
-        )
-        without_acks = [ch for ch in ut_changes if ch[0] not in acks]
+    if not unusual_changes:
+        return unusual_changes_
+    acks = set(
+        UsageAnomalyAck.objects.filter(
+            anomaly_date__in=set(
+                ch[0] for changes in unusual_changes.values()
+                for ch in changes
+            ),
+        ).values_list('type_id', 'anomaly_date')
+    )
+    for ut, ut_changes in unusual_changes.items():
+        without_acks = [
+            ch for ch in ut_changes if (ut.id, ch[0]) not in acks
+        ]
         if without_acks:
             unusual_changes_[ut] = without_acks
     return unusual_changes_
@@ -461,6 +610,9 @@ def _send_notifications(anomalies):
             'recipient': recipient,
             'unusual_changes': anomalies_['unusual_changes'],
             'missing_values': anomalies_['missing_values'],
+            'service_environment_anomalies': anomalies_.get(
+                'service_environment_anomalies'
+            ),
             'reply_to_address': settings.EMAIL_NOTIFICATIONS_REPLY_TO,
             'base_mail_url': settings.BASE_MAIL_URL,
         }
@@ -496,6 +648,14 @@ def pprint_anomalies(anomalies):
                     "{} | {} | {} | {: >14.2f} | {: >14.2f} | {: >+8.2%}"
                     .format(*ch)
                 )
+        se_anomalies = anomalies_.get('service_environment_anomalies')
+        if se_anomalies:
+            print('\nUnusual usages of service environments:')
+            for a in se_anomalies:
+                print(
+                    "{} | {} | {} | {: >14.2f} | {: >14.2f} | {: >+8.2f}"
+                    .format(*a)
+                )
 
 
 class Command(BaseCommand):
@@ -527,7 +687,10 @@ class Command(BaseCommand):
             dest='dry_run',
             action='store_true',
             default=False,
-            help="Don't send any notifications"
+            help=(
+                "Don't send any notifications (and don't save usage anomaly "
+                "statistics)."
+            )
         )
 
     def handle(self, usage_symbols, end_date, dry_run, *args, **options):
@@ -536,7 +699,10 @@ class Command(BaseCommand):
             "Performing anomalies detection up until {}...".format(end_date)
         )
         if dry_run:
-            logger.info("Running in dry run mode, no e-mails will be sent.")
+            logger.info(
+                "Running in dry run mode, no e-mails will be sent (and "
+                "usage anomaly statistics won't be saved)."
+            )
 
         usage_types = get_usage_types(usage_symbols)
         missing_values, unusual_changes = _detect_anomalies(
@@ -545,6 +711,12 @@ class Command(BaseCommand):
         anomalies = _postprocess_for_report(
             usage_types, missing_values, unusual_changes
         )
+        anomalies = _add_service_environment_anomalies(
+            anomalies,
+            _detect_service_environment_anomalies(
+                usage_types, end_date, dry_run
+            ),
+        )
 
         if not anomalies:
             logger.info("No anomalies detected.")
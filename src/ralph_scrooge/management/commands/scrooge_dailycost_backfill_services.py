@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+from django.utils.translation import ugettext_lazy as _
+
+from ralph_scrooge.management.commands.calculate_dailycosts import valid_date
+from ralph_scrooge.utils.tasks import backfill_dailycosts_services
+
+
+class Command(BaseCommand):
+    help = (
+        'Set service and environment of daily costs which don\'t have it set '
+        '(day by day, in chunks). Run it after migration 0018 and enable '
+        'DAILY_COST_FILTER_BY_SERVICE when it\'s finished'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--date-start',
+            dest='date_start',
+            type=valid_date,
+            help=_(
+                "First day of costs to backfill (defaults to the first day "
+                "of costs without service)"
+            )
+        )
+        parser.add_argument(
+            '--date-end',
+            dest='date_end',
+            type=valid_date,
+            help=_(
+                "Last day of costs to backfill (defaults to the last day "
+                "of costs without service)"
+            )
+        )
+
+        parser.add_argument(
+            '--chunk-size',
+            dest='chunk_size',
+            type=int,
+            help=_(
+                "Number of costs updated by single query (defaults to "
+                "DAILY_COST_BACKFILL_CHUNK_SIZE)"
+            )
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write('Backfilling services of daily costs...\n')
+        updated = backfill_dailycosts_services(
+            options.get('date_start'), options.get('date_end'),
+            options.get('chunk_size'),
+        )
+        self.stdout.write('Done ({} costs updated)\n'.format(updated))
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Index advisor for the hottest queries of costs calculation, reports and
+costs API - runs EXPLAIN for every of them against the current database and
+reports full scans of large tables (daily costs, usages and pricing
+objects), so missing (or not used) indexes could be detected ex. in CI,
+using database with fixtures.
+
+Exits with error when any full scan is found.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import datetime
+import re
+from collections import OrderedDict
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Sum
+
+from ralph_scrooge.management.commands.calculate_dailycosts import valid_date
+from ralph_scrooge.models import (
+    DailyCost,
+    DailyPricingObject,
+    DailyUsage,
+)
+from ralph_scrooge.plugins.cost.usage_type import UsageTypeBasePlugin
+
+WATCHED_TABLES = (
+    DailyCost._meta.db_table,
+    DailyPricingObject._meta.db_table,
+    DailyUsage._meta.db_table,
+)
+# ids used in queries - they don't have to exist in the database
+ID = 1
+
+
+def _get_hot_queries(date):
+    """
+    Returns querysets of the hottest queries (by name) for given date (or
+    month ending at given date, when query is done for period).
+    """
+    start = date - datetime.timedelta(days=30)
+    plugin = UsageTypeBasePlugin()
+    return OrderedDict([
+        ('cost: daily usages of usage type', (
+            plugin._get_daily_usages_in_period(
+                usage_type=ID, start=start, end=date
+            )
+        )),
+        ('cost: daily usages of usage type in warehouse', (
+            plugin._get_daily_usages_in_period(
+                usage_type=ID, start=start, end=date, warehouse=ID
+            )
+        )),
+        ('cost: daily usages of usage type of service environments', (
+            plugin._get_daily_usages_in_period(
+                usage_type=ID, date=date, service_environments=[ID]
+            )
+        )),
+        ('cost: usages of pricing service usage types', (
+            DailyUsage.objects.filter(date=date, type__in=[ID]).values_list(
+                'type',
+                'daily_pricing_object__pricing_object',
+                'service_environment',
+            ).annotate(usage=Sum('value')).order_by()
+        )),
+        ('cost: dependent services', (
+            DailyUsage.objects.filter(
+                type__usage_type='SU',
+                service_environment__in=[ID],
+                date=date,
+            ).values_list('type', flat=True).distinct()
+        )),
+        ('report: usages per service environment', (
+            DailyUsage.objects.filter(
+                date__gte=start, date__lte=date, type=ID,
+            ).values('service_environment_id', 'date').annotate(
+                total=Sum('value'),
+            )
+        )),
+        ('anomalies: usages per usage type', (
+            DailyUsage.objects.filter(
+                date__gte=start, date__lte=date,
+            ).values_list('type', 'date').annotate(Sum('value')).order_by()
+        )),
+        ('api: service environment costs', (
+            DailyCost.objects_tree.filter(
+                service=ID,
+                date__gte=start,
+                date__lte=date,
+                forecast=False,
+                depth__lte=1,
+            ).values(
+                'date', 'depth', 'path', 'type__symbol', 'type__name'
+            ).annotate(
+                cost_sum=Sum('cost'), value_sum=Sum('value')
+            ).order_by('depth')
+        )),
+        ('api: pricing object costs', (
+            DailyCost.objects.filter(
+                service=ID,
+                environment=ID,
+                date__gte=start,
+                date__lte=date,
+                forecast=False,
+            ).values_list(
+                'pricing_object_id', 'type__name'
+            ).annotate(Sum('value')).annotate(Sum('cost'))
+        )),
+    ])
+
+
+def _explain_sqlite(cursor, sql, params):
+    cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+    plan = [row[-1] for row in cursor.fetchall()]
+    full_scans = []
+    for line in plan:
+        match = re.match(r'SCAN (?:TABLE )?(\w+)', line)
+        if match:
+            full_scans.append(match.group(1))
+    return plan, full_scans
+
+
+def _explain_mysql(cursor, sql, params):
+    cursor.execute('EXPLAIN ' + sql, params)
+    columns = [c[0] for c in cursor.description]
+    rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+    plan = [
+        ', '.join('{}={}'.format(c, row[c]) for c in columns) for row in rows
+    ]
+    full_scans = [row['table'] for row in rows if row['type'] == 'ALL']
+    return plan, full_scans
+
+
+def _explain_postgresql(cursor, sql, params):
+    # without it, sequential scan is chosen for small (ex. fixtures) tables
+    # even if there is a matching index
+    with transaction.atomic():
+        cursor.execute('SET LOCAL enable_seqscan = off')
+        cursor.execute('EXPLAIN ' + sql, params)
+        plan = [row[0] for row in cursor.fetchall()]
+    full_scans = []
+    for line in plan:
+        match = re.search(r'Seq Scan on (\w+)', line)
+        if match:
+            full_scans.append(match.group(1))
+    return plan, full_scans
+
+
+EXPLAIN_FUNCTIONS = {
+    'sqlite': _explain_sqlite,
+    'mysql': _explain_mysql,
+    'postgresql': _explain_postgresql,
+}
+
+
+def explain(queryset):
+    """
+    Returns execution plan (list of lines) of queryset and list of watched
+    tables which are fully scanned in it.
+    """
+    try:
+        explain_func = EXPLAIN_FUNCTIONS[connection.vendor]
+    except KeyError:
+        raise CommandError(
+            'Database {} is not supported'.format(connection.vendor)
+        )
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        plan, full_scans = explain_func(cursor, sql, params)
+    return plan, [t for t in full_scans if t in WATCHED_TABLES]
+
+
+class Command(BaseCommand):
+    """Run EXPLAIN for the hottest queries and report full scans."""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--date',
+            type=valid_date,
+            dest='date',
+            default=datetime.date.today(),
+            help="Date used in queries (defaults to today)",
+        )
+
+    def handle(self, *args, **options):
+        failed = []
+        for name, queryset in _get_hot_queries(options['date']).items():
+            plan, full_scans = explain(queryset)
+            if full_scans:
+                failed.append(name)
+                self.stdout.write('{}: FULL SCAN of {}'.format(
+                    name, ', '.join(full_scans)
+                ))
+            else:
+                self.stdout.write('{}: OK'.format(name))
+            if full_scans or options['verbosity'] > 1:
+                for line in plan:
+                    self.stdout.write('    {}'.format(line))
+        if failed:
+            raise CommandError(
+                'Full scans found in {} queries'.format(len(failed))
+            )
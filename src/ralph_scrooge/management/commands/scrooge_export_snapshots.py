@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ralph_scrooge.utils.common import validate_date as valid_date
+from ralph_scrooge.utils.snapshots import (
+    export_snapshot,
+    SNAPSHOTS,
+    SnapshotError,
+)
+
+
+class Command(BaseCommand):
+    """
+    Export daily costs (first two levels of costs tree) and daily usages to
+    monthly columnar snapshots. Only dates which were not exported yet are
+    exported (unless --rebuild is passed), so this command could be executed
+    periodically (ex. daily from cron).
+    """
+    help = 'Export daily costs and usages to columnar snapshots'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--path',
+            dest='path',
+            default=None,
+            help='Snapshots directory (default: settings.SNAPSHOTS_PATH)',
+        )
+        parser.add_argument(
+            '--kind',
+            dest='kinds',
+            action='append',
+            choices=list(SNAPSHOTS),
+            help='Kind of snapshot to export (default: all)',
+        )
+        parser.add_argument(
+            '--start',
+            type=valid_date,
+            dest='start',
+            default=None,
+        )
+        parser.add_argument(
+            '--end',
+            type=valid_date,
+            dest='end',
+            default=None,
+        )
+        parser.add_argument(
+            '--rebuild',
+            action='store_true',
+            dest='rebuild',
+            default=False,
+            help='Rebuild snapshots of processed months from scratch',
+        )
+
+    def handle(self, *args, **options):
+        for kind in options['kinds'] or SNAPSHOTS:
+            try:
+                count = export_snapshot(
+                    kind,
+                    path=options['path'],
+                    start=options['start'],
+                    end=options['end'],
+                    rebuild=options['rebuild'],
+                )
+            except SnapshotError as e:
+                raise CommandError(str(e))
+            self.stdout.write('{}: {} rows exported'.format(kind, count))
@@ -5,6 +5,7 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import json
 import logging
 import math
 import textwrap
@@ -14,6 +15,7 @@ from collections import OrderedDict
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db.models import Count, Q, Sum
 
 from ralph_scrooge.models import UsageType, DailyUsage
 
@@ -72,6 +74,25 @@ class Command(BaseCommand):
             default=None,
             help="Date to compare",
         )
+        parser.add_argument(
+            '--base-end',
+            dest='base_end',
+            default=None,
+            help="Last day of base date range (starting at base date)",
+        )
+        parser.add_argument(
+            '--compare-end',
+            dest='compare_end',
+            default=None,
+            help="Last day of compared date range (starting at compare date)",
+        )
+        parser.add_argument(
+            '--json',
+            dest='json',
+            action='store_true',
+            default=False,
+            help="Print statistics (all of them) as JSON",
+        )
 
     def _draw_statistics(self, statistics, flags, base_date, compare_date):
         '''
@@ -113,6 +134,24 @@ class Command(BaseCommand):
                 '{0} - {1}'.format(base_date, compare_date),
             )
 
+    def _print_json(self, statistics, base, compare):
+        '''
+        Print statistics data as JSON (with dates ranges)
+
+        :param dict statistics: dict with generated statistics data
+        :param tuple base: base dates range
+        :param tuple compare: compare dates range
+        '''
+        def format_range(dates):
+            return [d.strftime('%Y-%m-%d') for d in dates]
+
+        data = OrderedDict([
+            ('base_range', format_range(base)),
+            ('compare_range', format_range(compare)),
+        ])
+        data.update(sorted(statistics.items()))
+        self.stdout.write(json.dumps(data, indent=2))
+
     def handle(self, base, compare, *args, **options):
         '''
         Generate/rebuild dates, generate flags and data dicts and print it
@@ -126,6 +165,23 @@ class Command(BaseCommand):
 
         base = to_date(base) if base else date.today() - timedelta(days=1)
         compare = to_date(compare) if compare else base - timedelta(days=1)
+        base_end = to_date(options['base_end']) if options.get(
+            'base_end'
+        ) else base
+        compare_end = to_date(options['compare_end']) if options.get(
+            'compare_end'
+        ) else compare
+
+        statistics = self.compare_days(base, compare, base_end, compare_end)
+        if options.get('json'):
+            self._print_json(
+                statistics, (base, base_end), (compare, compare_end)
+            )
+            return
+        if base_end != base:
+            base = '{0} - {1}'.format(base, base_end)
+        if compare_end != compare:
+            compare = '{0} - {1}'.format(compare, compare_end)
 
         flags = ['only_errors', 'only_warnings', 'only_base', 'only_compare']
         flag_settings = {'show_all': True}
@@ -135,7 +191,7 @@ class Command(BaseCommand):
                 flag_settings['show_all'] = False
 
         self._draw_statistics(
-            self.compare_days(base, compare),
+            statistics,
             flag_settings,
             base,
             compare,
@@ -165,15 +221,54 @@ class Command(BaseCommand):
         usages count
         :rtype dict:
         """
+        return self.get_ranges_statistics([(date, date)])[0][0]
 
-        results = OrderedDict()
-        for usage in UsageType.objects.order_by('name'):
+    def get_ranges_statistics(self, ranges):
+        """
+        Get usages count and sum of usages values (in UsageName:Count and
+        UsageName:Sum format) for every dates range (both dates inclusive),
+        using single query grouped by date and usage type.
+
+        :param list ranges: list of (start, end) dates
+        :returns list: (counts, sums) tuple of dicts for every dates range
+        :rtype list:
+        """
+        usage_types = list(UsageType.objects.order_by('name'))
+        results = []
+        for _ in ranges:
+            results.append((
+                OrderedDict((ut.name, 0) for ut in usage_types),
+                OrderedDict((ut.name, 0) for ut in usage_types),
+            ))
+        names = {ut.id: ut.name for ut in usage_types}
+        dates_filter = Q()
+        for start, end in ranges:
+            dates_filter |= Q(date__gte=start, date__lte=end)
+        # only active usage types are listed (usages of inactive ones are
+        # skipped)
+        for day, type_id, count, value in DailyUsage.objects.filter(
+            dates_filter,
+            type__in=names.keys(),
+        ).values_list('date', 'type').annotate(
+            Count('id'), Sum('value'),
+        ).order_by():
+            for (start, end), (counts, sums) in zip(ranges, results):
+                if start <= day <= end:
+                    counts[names[type_id]] += count
+                    sums[names[type_id]] += value or 0
+
+        # usage types with custom count function
+        for usage in usage_types:
             func = getattr(
-                self,
-                "get_{0}_usages_count".format(usage.name),
-                self.get_standard_usages_count,
+                self, "get_{0}_usages_count".format(usage.name), None
             )
-            results[usage.name] = func(date, usage)
+            if func is None:
+                continue
+            for (start, end), (counts, sums) in zip(ranges, results):
+                counts[usage.name] = sum(
+                    func(start + timedelta(days=i), usage)
+                    for i in range((end - start).days + 1)
+                )
         return results
 
     def compare_data(self, base_data, compare_data):
@@ -224,19 +319,31 @@ class Command(BaseCommand):
                 results[key] = differences_data[key]
         return results
 
-    def compare_days(self, base_date, compare_date):
+    def compare_days(
+        self, base_date, compare_date, base_end=None, compare_end=None
+    ):
         '''
-        Compare data from two given dates and try find errors or warnings
+        Compare data from two given dates (or dates ranges, when ends of
+        ranges are given) and try find errors or warnings
 
         :param datetime base_date: first (higher) date
         :param datetime compare_date: compare (lower) date
-        :param int percent: Percent for defining the warning limits
-        :returns dict: Statistics data
+        :param datetime base_end: last day of base dates range
+        :param datetime compare_end: last day of compare dates range
+        :returns dict: Statistics data (usages counts and sums of values)
         :rtype dict:
         '''
+        (base, base_sums), (compare, compare_sums) = (
+            self.get_ranges_statistics([
+                (base_date, base_end or base_date),
+                (compare_date, compare_end or compare_date),
+            ])
+        )
         results = {
-            'base': self.get_statistics(base_date),
-            'compare': self.get_statistics(compare_date),
+            'base': base,
+            'compare': compare,
+            'base_sums': base_sums,
+            'compare_sums': compare_sums,
         }
         results['differences'] = self.compare_data(
             results['base'],
@@ -15,6 +15,7 @@ from django.conf import settings
 
 from ralph_scrooge.models import SyncStatus
 from ralph_scrooge.plugins import plugin_runner
+from ralph_scrooge.utils.usage_anomalies import refresh_usage_anomaly_stats
 
 
 logger = logging.getLogger(__name__)
@@ -158,3 +159,5 @@ class Command(BaseCommand):
         else:
             for r in run_plugins(today, [run_only], run_only=True):
                 pass
+        # collected usages are included in usage anomaly statistics
+        refresh_usage_anomaly_stats(today)
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-19 12:36
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ralph_scrooge', '0014_dailycosts_partitioning'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UsagesUpload',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, verbose_name='date created')),
+                ('modified', models.DateTimeField(default=django.utils.timezone.now, verbose_name='last modified')),
+                ('cache_version', models.PositiveIntegerField(default=0, editable=False, verbose_name='cache version')),
+                ('payload', models.TextField(verbose_name='payload')),
+                ('payload_hash', models.CharField(db_index=True, max_length=64, verbose_name='payload hash')),
+                ('in_flight_hash', models.CharField(blank=True, editable=False, max_length=64, null=True, unique=True, verbose_name='in flight payload hash')),
+                ('status', models.PositiveIntegerField(choices=[(1, 'queued'), (2, 'running'), (3, 'finished'), (4, 'failed')], default=1, verbose_name='status')),
+                ('job_id', models.CharField(blank=True, default='', max_length=64, verbose_name='job id')),
+                ('result', models.TextField(blank=True, default='', help_text='Result of processing (JSON).', verbose_name='result')),
+            ],
+            options={
+                'verbose_name': 'usages upload',
+                'verbose_name_plural': 'usages uploads',
+            },
+        ),
+    ]
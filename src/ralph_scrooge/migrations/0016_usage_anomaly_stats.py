@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-19 13:09
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ralph_scrooge', '0015_usagesupload'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ServiceEnvironmentUsageAnomaly',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='date')),
+                ('value', models.FloatField(verbose_name='value')),
+                ('expected', models.FloatField(verbose_name='expected value')),
+                ('deviation', models.FloatField(help_text='Difference from expected value in standard deviations', verbose_name='deviation')),
+                ('service_environment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='ralph_scrooge.ServiceEnvironment')),
+                ('type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='ralph_scrooge.UsageType')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UsageAnomalyStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_date', models.DateField(verbose_name='last date')),
+                ('mean', models.FloatField(default=0, verbose_name='mean')),
+                ('variance', models.FloatField(default=0, verbose_name='variance')),
+                ('count', models.PositiveIntegerField(default=0, verbose_name='count')),
+                ('service_environment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='ralph_scrooge.ServiceEnvironment')),
+                ('type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='ralph_scrooge.UsageType')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='usageanomalystats',
+            unique_together=set([('type', 'service_environment')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='serviceenvironmentusageanomaly',
+            unique_together=set([('type', 'service_environment', 'date')]),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-19 13:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ralph_scrooge', '0016_usage_anomaly_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='costdatestatus',
+            name='generation',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='generation'),
+        ),
+    ]
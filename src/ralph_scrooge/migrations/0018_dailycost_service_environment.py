@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-19 13:25
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ralph_scrooge', '0017_costdatestatus_generation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dailycost',
+            name='environment',
+            field=models.ForeignKey(blank=True, db_constraint=False, editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='daily_costs', to='ralph_scrooge.Environment', verbose_name='environment'),
+        ),
+        migrations.AddField(
+            model_name='dailycost',
+            name='service',
+            field=models.ForeignKey(blank=True, db_constraint=False, editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='daily_costs', to='ralph_scrooge.Service', verbose_name='service'),
+        ),
+        migrations.AlterIndexTogether(
+            name='dailycost',
+            index_together=set([('service', 'date', 'forecast', 'depth')]),
+        ),
+    ]
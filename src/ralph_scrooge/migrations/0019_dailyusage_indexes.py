@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-19 13:28
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ralph_scrooge', '0018_dailycost_service_environment'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='dailyusage',
+            index_together=set([('type', 'date', 'warehouse'), ('type', 'date', 'service_environment'), ('date', 'type')]),
+        ),
+    ]
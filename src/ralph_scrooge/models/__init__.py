@@ -65,9 +65,13 @@ from ralph_scrooge.models.team import (
 
 from ralph_scrooge.models.usage import (
     DailyUsage,
+    ServiceEnvironmentUsageAnomaly,
     UsagePrice,
     UsageType,
     UsageAnomalyAck,
+    UsageAnomalyStats,
+    UsagesUpload,
+    UsagesUploadStatus,
     UsageTypeUploadFreq,
 )
 
@@ -110,6 +114,7 @@ __all__ = [
     'Service',
     'ServiceEnvironment',
     'ServiceOwnership',
+    'ServiceEnvironmentUsageAnomaly',
     'ServiceUsageTypes',
     'Statement',
     'SupportCost',
@@ -123,6 +128,9 @@ __all__ = [
     'TenantInfo',
     'UsageType',
     'UsageAnomalyAck',
+    'UsageAnomalyStats',
+    'UsagesUpload',
+    'UsagesUploadStatus',
     'UsageTypeUploadFreq',
     'UsagePrice',
     'VIPInfo',
@@ -5,6 +5,7 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+from django.conf import settings
 from django.db import models as db
 from django.utils.translation import ugettext_lazy as _
 
@@ -25,6 +26,10 @@ class DailyCost(MultiPathNode, db.Model):
     table with foreign keys, all foreign keys are ForeignKey django fields to
     allow to use all Django foreign key features (ex. filtering by __), but
     database foreign keys are removed in migration.
+
+    Service and environment (of service environment) are denormalized, to
+    filter costs of service (environment) without joining service
+    environments table.
     """
     _path_field = 'type_id'
     objects = DailyCostManager.from_queryset(MultiPathNodeQuerySet)()
@@ -46,6 +51,24 @@ class DailyCost(MultiPathNode, db.Model):
         verbose_name=_('service environment'),
         db_constraint=False,
     )
+    service = db.ForeignKey(
+        'Service',
+        null=True,
+        blank=True,
+        related_name='daily_costs',
+        verbose_name=_('service'),
+        db_constraint=False,
+        editable=False,
+    )
+    environment = db.ForeignKey(
+        'Environment',
+        null=True,
+        blank=True,
+        related_name='daily_costs',
+        verbose_name=_('environment'),
+        db_constraint=False,
+        editable=False,
+    )
     type = db.ForeignKey(
         'BaseUsage',
         null=False,
@@ -81,6 +104,9 @@ class DailyCost(MultiPathNode, db.Model):
         verbose_name = _("daily cost")
         verbose_name_plural = _("daily costs")
         app_label = 'ralph_scrooge'
+        index_together = [
+            ('service', 'date', 'forecast', 'depth'),
+        ]
 
     def __unicode__(self):
         return '{} - {} ({})'.format(
@@ -89,12 +115,88 @@ class DailyCost(MultiPathNode, db.Model):
             self.date,
         )
 
+    def save(self, *args, **kwargs):
+        if self.service_environment_id and (
+            self.service_id is None or self.environment_id is None
+        ):
+            self.service_id = self.service_environment.service_id
+            self.environment_id = self.service_environment.environment_id
+        super(DailyCost, self).save(*args, **kwargs)
+
+    @classmethod
+    def get_service_filters(cls, service_id, environment_id=None):
+        """
+        Returns filters of costs of service (and optionally environment) - by
+        denormalized service and environment (using (service, date, forecast,
+        depth) index) if DAILY_COST_FILTER_BY_SERVICE is enabled, otherwise
+        by service environment (costs saved before migration 0018 don't have
+        service and environment until they are backfilled).
+        """
+        if settings.DAILY_COST_FILTER_BY_SERVICE:
+            filters = {'service_id': service_id}
+            if environment_id:
+                filters['environment_id'] = environment_id
+        else:
+            filters = {'service_environment__service_id': service_id}
+            if environment_id:
+                filters['service_environment__environment_id'] = (
+                    environment_id
+                )
+        return filters
+
     @classmethod
     def _are_params_valid(self, params):
         if 'cost' in params:
             return params['cost'] != 0
         return True
 
+    @classmethod
+    def _build_tree(cls, tree, parent=None, **global_params):
+        result = super(DailyCost, cls)._build_tree(
+            tree, parent, **global_params
+        )
+        # fill service and environment once, for the whole tree
+        if parent is None:
+            result = cls._set_service_and_environment(result)
+        return result
+
+    @classmethod
+    def _set_service_and_environment(cls, daily_costs):
+        """
+        Set (denormalized) service and environment of daily costs (namedtuples)
+        which don't have it set, according to their service environment.
+        """
+        missing = set(
+            dc.service_environment_id for dc in daily_costs
+            if dc.service_environment_id and (
+                dc.service_id is None or dc.environment_id is None
+            )
+        )
+        if not missing:
+            return daily_costs
+        service_environment_model = cls._meta.get_field(
+            'service_environment'
+        ).related_model
+        services_and_environments = {
+            se_id: (service_id, environment_id)
+            for se_id, service_id, environment_id in (
+                service_environment_model.objects.filter(
+                    id__in=missing
+                ).values_list('id', 'service_id', 'environment_id')
+            )
+        }
+        result = []
+        for dc in daily_costs:
+            if dc.service_environment_id in services_and_environments:
+                service_id, environment_id = services_and_environments[
+                    dc.service_environment_id
+                ]
+                dc = dc._replace(
+                    service_id=service_id, environment_id=environment_id,
+                )
+            result.append(dc)
+        return result
+
 
 class CostDateStatus(db.Model):
     date = db.DateField(
@@ -121,6 +223,12 @@ class CostDateStatus(db.Model):
         default=False,
         editable=False,
     )
+    # incremented every time costs of this day are (re)calculated
+    generation = db.PositiveIntegerField(
+        verbose_name=_("generation"),
+        default=0,
+        editable=False,
+    )
 
     class Meta:
         verbose_name = _("cost date status")
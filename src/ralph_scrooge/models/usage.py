@@ -19,6 +19,7 @@ from ralph_scrooge.models.base import (
     BaseUsageManager,
     BaseUsageType,
 )
+from ralph_scrooge.utils.models import TimeTrackable
 
 PRICE_DIGITS = 16
 PRICE_PLACES = 6
@@ -43,6 +44,14 @@ class UsageTypeUploadFreq(Choices):
     )
 
 
+class UsagesUploadStatus(Choices):
+    _ = Choices.Choice
+    queued = _('queued')
+    running = _('running')
+    finished = _('finished')
+    failed = _('failed')
+
+
 class UsageType(BaseUsage):
     """
     Model contains usage types
@@ -185,6 +194,47 @@ class UsageAnomalyAck(db.Model):
         )
 
 
+class UsageAnomalyStats(db.Model):
+    """
+    Rolling statistics (exponentially weighted moving average and variance)
+    of daily usages of single UsageType by single service environment,
+    updated incrementally with every day of usages (see
+    `ralph_scrooge.utils.usage_anomalies`).
+    """
+    type = db.ForeignKey(UsageType)
+    service_environment = db.ForeignKey('ServiceEnvironment')
+    last_date = db.DateField(verbose_name=_("last date"))
+    mean = db.FloatField(verbose_name=_("mean"), default=0)
+    variance = db.FloatField(verbose_name=_("variance"), default=0)
+    count = db.PositiveIntegerField(verbose_name=_("count"), default=0)
+
+    class Meta:
+        app_label = 'ralph_scrooge'
+        unique_together = ('type', 'service_environment')
+
+
+class ServiceEnvironmentUsageAnomaly(db.Model):
+    """
+    Daily usage (of UsageType by service environment) which is an outlier
+    comparing to rolling statistics (see `UsageAnomalyStats`) of previous
+    days. Could be acknowledged (for the whole UsageType) using
+    `UsageAnomalyAck`.
+    """
+    type = db.ForeignKey(UsageType)
+    service_environment = db.ForeignKey('ServiceEnvironment')
+    date = db.DateField(verbose_name=_("date"))
+    value = db.FloatField(verbose_name=_("value"))
+    expected = db.FloatField(verbose_name=_("expected value"))
+    deviation = db.FloatField(
+        verbose_name=_("deviation"),
+        help_text=_("Difference from expected value in standard deviations"),
+    )
+
+    class Meta:
+        app_label = 'ralph_scrooge'
+        unique_together = ('type', 'service_environment', 'date')
+
+
 class UsagePrice(db.Model):
     """
     Model contains usages price information
@@ -287,8 +337,15 @@ class DailyUsage(db.Model):
         verbose_name = _("daily usage")
         verbose_name_plural = _("daily usages")
         app_label = 'ralph_scrooge'
-        # TODO: after migration to Django>=1.5 add index_together on
-        # type_id, date and warehouse_id (see migration 0019 for details)
+        # usages are filtered by type and date (period) and optionally by
+        # warehouse or service environment (ex. in costs plugins and reports)
+        # or only by date (ex. in anomalies detection and statistics); see
+        # also `scrooge_explain_queries` command
+        index_together = [
+            ('type', 'date', 'warehouse'),
+            ('type', 'date', 'service_environment'),
+            ('date', 'type'),
+        ]
 
     def __unicode__(self):
         return '{0}/{1} ({2}) {3}'.format(
@@ -297,3 +354,67 @@ class DailyUsage(db.Model):
             self.date,
             self.value,
         )
+
+
+class UsagesUpload(TimeTrackable):
+    """
+    Pricing service usages uploaded asynchronously - raw payload is saved
+    and processed later on RQ worker. Identical payloads are recognized by
+    the hash of their content (uploading the same payload again, while the
+    previous upload is still queued or running, returns that upload instead
+    of processing it once more).
+
+    Hash of queued or running upload is saved also as (unique)
+    `in_flight_hash`, so there is at most one upload of the same payload in
+    progress, even if identical payloads are uploaded concurrently.
+    """
+    payload = db.TextField(verbose_name=_("payload"))
+    payload_hash = db.CharField(
+        verbose_name=_("payload hash"),
+        max_length=64,
+        db_index=True,
+    )
+    in_flight_hash = db.CharField(
+        verbose_name=_("in flight payload hash"),
+        max_length=64,
+        null=True,
+        blank=True,
+        unique=True,
+        editable=False,
+    )
+    status = db.PositiveIntegerField(
+        verbose_name=_("status"),
+        choices=UsagesUploadStatus(),
+        default=UsagesUploadStatus.queued.id,
+    )
+    job_id = db.CharField(
+        verbose_name=_("job id"),
+        max_length=64,
+        blank=True,
+        default='',
+    )
+    result = db.TextField(
+        verbose_name=_("result"),
+        help_text=_("Result of processing (JSON)."),
+        blank=True,
+        default='',
+    )
+
+    class Meta:
+        verbose_name = _("usages upload")
+        verbose_name_plural = _("usages uploads")
+        app_label = 'ralph_scrooge'
+
+    def __unicode__(self):
+        return '{} ({})'.format(
+            self.payload_hash, UsagesUploadStatus.from_id(self.status)
+        )
+
+    def save(self, *args, **kwargs):
+        if self.status in (
+            UsagesUploadStatus.queued.id, UsagesUploadStatus.running.id
+        ):
+            self.in_flight_hash = self.payload_hash
+        else:
+            self.in_flight_hash = None
+        super(UsagesUpload, self).save(*args, **kwargs)
@@ -21,6 +21,7 @@ from ralph_scrooge.models import (
     UsageType,
     Warehouse
 )
+from ralph_scrooge.utils.daily_usages import delete_daily_usages
 
 
 logger = logging.getLogger(__name__)
@@ -185,10 +186,9 @@ class OpenStackBasePlugin(object):
         Remove previously saved records for given date from DB.
         """
         logger.debug('Clearing previous records for {}'.format(date))
-        DailyUsage.objects.filter(
-            type__symbol__startswith=self.metric_tmpl.format(''),
-            date=date,
-        ).delete()
+        delete_daily_usages(date, date, UsageType.objects_admin.filter(
+            symbol__startswith=self.metric_tmpl.format(''),
+        ).values_list('id', flat=True))
 
     def run_plugin(self, sites, today, **kwargs):
         """
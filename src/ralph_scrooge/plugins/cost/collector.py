@@ -11,6 +11,7 @@ from dateutil import rrule
 
 from django.conf import settings
 from django.db import connection
+from django.db.models import F
 
 from ralph_scrooge.models import (
     CostDateStatus,
@@ -27,6 +28,9 @@ from ralph_scrooge.plugins.cost.base import (
     NoPriceCostError,
     MultiplePriceCostError,
 )
+from ralph_scrooge.plugins.cost.pricing_service import (
+    pricing_services_costs_table,
+)
 from ralph_scrooge.plugins.validations import DataForReportValidator
 from ralph_scrooge.utils.common import memoize, AttributeDict
 
@@ -157,11 +161,17 @@ class Collector(object):
         if settings.ENABLE_DATA_FOR_REPORT_VALIDATION and perform_validation:
             logger.info('Performing validation of data for costs calculation.')
             DataForReportValidator(date, forecast=forecast).validate()
-        costs = self._collect_costs(
-            date=date,
-            forecast=forecast,
-            plugins=plugins,
-        )
+        # pricing services costs are calculated once and shared between
+        # collected plugins (when all plugins are collected, they are
+        # evaluated upfront, in order of their dependencies)
+        with pricing_services_costs_table(
+            date, forecast, evaluate=plugins is None
+        ):
+            costs = self._collect_costs(
+                date=date,
+                forecast=forecast,
+                plugins=plugins,
+            )
         logger.info('Costs calculated for date {}'.format(date))
         return costs
 
@@ -211,14 +221,28 @@ class Collector(object):
         save it in database.
         """
         logger.info('Creating daily costs instances for {}'.format(date))
+        # (denormalized) service and environment of every service environment
+        services_and_environments = {
+            se_id: (service_id, environment_id)
+            for se_id, service_id, environment_id in (
+                ServiceEnvironment.objects.values_list(
+                    'id', 'service_id', 'environment_id'
+                )
+            )
+        }
         daily_costs = []
         for service_environment, se_costs in costs.iteritems():
+            service_id, environment_id = services_and_environments.get(
+                service_environment, (None, None)
+            )
             # use _build_tree directly, to collect DailyCosts for all services
             # and save all at the end
             daily_costs.extend(DailyCost._build_tree(
                 tree=se_costs,
                 date=date,
                 service_environment_id=service_environment,
+                service_id=service_id,
+                environment_id=environment_id,
                 forecast=forecast,
             ))
         return daily_costs
@@ -238,7 +262,7 @@ class Collector(object):
     def _update_status(self, date, forecast):
         """
         Update status for given date that costs were caculated (including
-        forecast flag).
+        forecast flag) and increment its generation (costs version).
         """
         # update status to created
         status, created = CostDateStatus.objects.get_or_create(date=date)
@@ -246,6 +270,7 @@ class Collector(object):
             status.forecast_calculated = True
         else:
             status.calculated = True
+        status.generation = F('generation') + 1
         status.save()
 
     def _update_status_period(self, start, end, forecast):
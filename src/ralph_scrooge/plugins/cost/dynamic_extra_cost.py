@@ -6,10 +6,11 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import logging
+from operator import attrgetter
 
 from ralph_scrooge.models import DynamicExtraCost
 from ralph_scrooge.plugins.base import register
-from ralph_scrooge.plugins.cost.base import NoPriceCostError
+from ralph_scrooge.plugins.cost.intervals import IntervalIndex
 from ralph_scrooge.plugins.cost.pricing_service import PricingServiceBasePlugin
 from ralph_scrooge.utils.common import memoize
 
@@ -22,6 +23,19 @@ class DynamicExtraCostPlugin(PricingServiceBasePlugin):
         service_costs = self.costs(*args, **kwargs)
         return self._get_total_costs_from_costs(service_costs)
 
+    @memoize(skip_first=True)
+    def _get_dynamic_extra_costs_index(self):
+        """
+        Returns index of all dynamic extra costs (by dynamic extra cost type
+        id).
+        """
+        return IntervalIndex(
+            DynamicExtraCost.objects.all(),
+            key=attrgetter('dynamic_extra_cost_type_id'),
+            unique=True,
+            name='dynamic extra costs',
+        )
+
     @memoize(skip_first=True)
     def _costs(
         self,
@@ -52,22 +66,16 @@ class DynamicExtraCostPlugin(PricingServiceBasePlugin):
         )
 
     def _get_costs(self, date, dynamic_extra_cost_type, forecast, **kwargs):
-        try:
-            cost = dynamic_extra_cost_type.costs.get(
-                end__gte=date,
-                start__lte=date,
-            )
-        except DynamicExtraCost.DoesNotExist:
-            raise NoPriceCostError()
-        else:
-
-            daily_cost = (
-                (cost.forecast_cost if forecast else cost.cost) /
-                ((cost.end - cost.start).days + 1)
-            )
-            return {
-                dynamic_extra_cost_type.id: (daily_cost, None)
-            }
+        cost = self._get_dynamic_extra_costs_index().get(
+            dynamic_extra_cost_type.id, date
+        )
+        daily_cost = (
+            (cost.forecast_cost if forecast else cost.cost) /
+            ((cost.end - cost.start).days + 1)
+        )
+        return {
+            dynamic_extra_cost_type.id: (daily_cost, None)
+        }
 
     def _get_percentage(self, date, dynamic_extra_cost_type):
         """
@@ -7,10 +7,12 @@ from __future__ import unicode_literals
 
 import logging
 from collections import defaultdict
+from operator import attrgetter
 
 from ralph_scrooge.models import ExtraCost
 from ralph_scrooge.plugins.base import register
 from ralph_scrooge.plugins.cost.base import BaseCostPlugin
+from ralph_scrooge.plugins.cost.intervals import IntervalIndex
 from ralph_scrooge.utils.common import memoize
 
 logger = logging.getLogger(__name__)
@@ -23,6 +25,16 @@ class ExtraCostPlugin(BaseCostPlugin):
     cost model.
     """
 
+    @memoize(skip_first=True)
+    def _get_extra_costs_index(self):
+        """
+        Returns index of all extra costs (by extra cost type id).
+        """
+        return IntervalIndex(
+            ExtraCost.objects.all(),
+            key=attrgetter('extra_cost_type_id'),
+        )
+
     @memoize(skip_first=True)
     def _costs(
         self,
@@ -52,10 +64,8 @@ class ExtraCostPlugin(BaseCostPlugin):
         logger.info("Calculating extra costs: {0}".format(
             extra_cost_type.name,
         ))
-        extra_costs = ExtraCost.objects.filter(
-            end__gte=date,
-            start__lte=date,
-            extra_cost_type=extra_cost_type,
+        extra_costs = self._get_extra_costs_index().find(
+            extra_cost_type.id, date
         )
 
         usages = defaultdict(list)
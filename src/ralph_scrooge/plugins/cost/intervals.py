@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory index of date-ranged definitions (ex. usage prices, team costs).
+
+Instead of querying database (start <= date <= end) for every usage type,
+warehouse, team etc., all definitions are fetched once and indexed by key
+(ex. usage type id). For every key, the time axis is split into segments
+(between consecutive starts and ends of definitions), each of them holding
+definitions active in it, so finding definitions active at given date is a
+single binary search.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import datetime
+import logging
+from bisect import bisect_right
+from collections import defaultdict
+
+from ralph_scrooge.plugins.cost.base import (
+    MultiplePriceCostError,
+    NoPriceCostError,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class IntervalIndex(object):
+    """
+    Index of objects with `start` and `end` dates (both inclusive), grouped
+    by `key` function. Objects without start or end are skipped.
+
+    When `unique` is True, intervals of the same key are not expected to
+    overlap - overlapping ones are detected (and reported once) while
+    building the index and `get` resolves them deterministically - the
+    latest started interval (then the latest ending, then the latest
+    created) is returned. Otherwise `get` raises `MultiplePriceCostError`
+    for dates covered by more than one interval.
+    """
+    def __init__(self, objects, key, unique=False, name=None):
+        self.unique = unique
+        self.name = name or 'intervals'
+        self._breakpoints = {}
+        self._segments = {}
+        # key -> overlapping objects
+        self.overlaps = {}
+        grouped = defaultdict(list)
+        for obj in objects:
+            if obj.start is None or obj.end is None:
+                continue
+            grouped[key(obj)].append(obj)
+        for k, key_objects in grouped.iteritems():
+            self._build(k, key_objects)
+        if self.unique:
+            for k, overlapping in sorted(self.overlaps.items()):
+                logger.warning(
+                    'Overlapping {} for {}: {} (the latest started is '
+                    'used)'.format(self.name, k, ', '.join(
+                        '{} - {}'.format(obj.start, obj.end)
+                        for obj in overlapping
+                    ))
+                )
+
+    @property
+    def overlapping_keys(self):
+        return set(self.overlaps)
+
+    def _build(self, key, objects):
+        starting = defaultdict(list)
+        ending = defaultdict(list)
+        # objects active in segment are ordered by start, end (and pk, to
+        # resolve overlaps deterministically)
+        for obj in sorted(objects, key=lambda o: (
+            o.start, o.end, getattr(o, 'pk', None)
+        )):
+            starting[obj.start].append(obj)
+            # end is inclusive - object is not active since the next day
+            if obj.end < datetime.date.max:
+                ending[obj.end + datetime.timedelta(days=1)].append(obj)
+        breakpoints = []
+        segments = []
+        active = []
+        for point in sorted(set(starting) | set(ending)):
+            ended = set(id(obj) for obj in ending[point])
+            active = [
+                obj for obj in active if id(obj) not in ended
+            ] + starting[point]
+            if len(active) > 1:
+                overlapping = self.overlaps.setdefault(key, [])
+                overlapping.extend(
+                    obj for obj in active
+                    if not any(obj is o for o in overlapping)
+                )
+            breakpoints.append(point)
+            segments.append(tuple(active))
+        self._breakpoints[key] = breakpoints
+        self._segments[key] = segments
+
+    def keys(self):
+        return self._breakpoints.keys()
+
+    def find(self, key, date):
+        """
+        Returns list of objects (for key) active at date.
+        """
+        breakpoints = self._breakpoints.get(key)
+        if not breakpoints:
+            return []
+        index = bisect_right(breakpoints, date) - 1
+        if index < 0:
+            return []
+        return list(self._segments[key][index])
+
+    def get(self, key, date):
+        """
+        Returns single object (for key) active at date. Raises
+        `NoPriceCostError` if there is no such object or (for not unique
+        index) `MultiplePriceCostError` if there is more than one.
+        """
+        objects = self.find(key, date)
+        if not objects:
+            raise NoPriceCostError()
+        if len(objects) > 1:
+            if not self.unique:
+                raise MultiplePriceCostError()
+            # overlap already reported while building the index
+            return objects[-1]
+        return objects[0]
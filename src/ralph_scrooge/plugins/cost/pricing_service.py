@@ -5,29 +5,154 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import cPickle as pickle
 import logging
 import itertools
+import threading
 from collections import defaultdict
+from contextlib import contextmanager
 from decimal import Decimal as D
 
 from django.conf import settings
 from django.db.models import Sum
 
 from ralph_scrooge.models import (
+    DailyUsage,
     DynamicExtraCostType,
     ExtraCostType,
+    ServiceEnvironment,
     Team,
     UsageType,
 )
 from ralph_scrooge.plugins import plugin_runner as plugin_runner
 from ralph_scrooge.plugins.base import register
-from ralph_scrooge.plugins.cost.base import BaseCostPlugin
+from ralph_scrooge.plugins.cost.base import (
+    BaseCostPlugin,
+    MultiplePriceCostError,
+    NoPriceCostError,
+)
 from ralph_scrooge.utils.common import memoize
+from ralph_scrooge.utils.cycle_detector import (
+    _get_pricing_services_graph,
+    get_topological_order,
+)
 
 
 logger = logging.getLogger(__name__)
 
 
+class PricingServicesCostsTable(object):
+    """
+    Per-day table of pricing services costs.
+
+    Pricing services dependency graph is evaluated once, in topological order
+    (pricing service is evaluated after all pricing services charging it), and
+    costs of every pricing service - total costs hierarchy (see
+    `_get_pricing_service_costs`) and costs per service environment (see
+    `_costs`) - are stored in the table. Both collector and dependent pricing
+    services read costs from it, so they don't rely on (limited) memoize
+    cache to not calculate the same pricing service costs many times.
+
+    Active tables are stored per thread, so costs calculated concurrently (in
+    other threads) don't use (and fill) the same table.
+    """
+    _local = threading.local()
+
+    def __init__(self, date, forecast):
+        self.date = date
+        self.forecast = forecast
+        self._rows = {}
+
+    @classmethod
+    def _get_active_tables(cls):
+        if not hasattr(cls._local, 'tables'):
+            cls._local.tables = {}
+        return cls._local.tables
+
+    @classmethod
+    def get_active(cls, date, forecast):
+        """
+        Returns table for date and forecast (if costs for them are currently
+        calculated in this thread) or None.
+        """
+        return cls._get_active_tables().get((date, forecast))
+
+    @contextmanager
+    def activate(self):
+        """
+        Make table active (in this thread) while in context.
+        """
+        tables = self._get_active_tables()
+        key = (self.date, self.forecast)
+        previous = tables.get(key)
+        tables[key] = self
+        try:
+            yield self
+        finally:
+            if previous is None:
+                del tables[key]
+            else:
+                tables[key] = previous
+
+    def get_or_calculate(self, key, func):
+        """
+        Returns value stored in table for key. If there is no such value,
+        it's calculated using func (and stored in table).
+        """
+        if key not in self._rows:
+            self._rows[key] = func()
+        return self._rows[key]
+
+    def evaluate(self):
+        """
+        Calculate costs of pricing services in topological order of
+        dependency graph. Pricing services in cycles are left to be calculated
+        on demand.
+        """
+        graph = _get_pricing_services_graph(self.date)
+        ordered, unordered = get_topological_order(graph)
+        if unordered:
+            logger.warning(
+                'Pricing services costs could not be ordered: {}'.format(
+                    ', '.join([ps.name for ps in unordered])
+                )
+            )
+        for pricing_service in ordered:
+            try:
+                plugin_runner.run_plugin(
+                    'scrooge_costs',
+                    pricing_service.get_plugin_name(),
+                    type='costs',
+                    pricing_service=pricing_service,
+                    date=self.date,
+                    forecast=self.forecast,
+                )
+            except (
+                KeyError,
+                AttributeError,
+                NoPriceCostError,
+                MultiplePriceCostError,
+            ):
+                # error will be reported when costs are collected
+                logger.warning(
+                    'Invalid call for {0} costs'.format(pricing_service.name)
+                )
+
+
+@contextmanager
+def pricing_services_costs_table(date, forecast, evaluate=True):
+    """
+    Use pricing services costs table (see `PricingServicesCostsTable`) for
+    date while in context. If evaluate is True, costs of all pricing services
+    are calculated upfront (otherwise only on demand).
+    """
+    table = PricingServicesCostsTable(date, forecast)
+    with table.activate():
+        if evaluate:
+            table.evaluate()
+        yield table
+
+
 class PricingServiceBasePlugin(BaseCostPlugin):
     """
     Base plugin for all pricing services in report. Provides 2 main methods:
@@ -90,6 +215,19 @@ class PricingServiceBasePlugin(BaseCostPlugin):
             2.3) sum service_environments costs of pricing_service usage types
                  (eventually total cost)
         """
+        table = PricingServicesCostsTable.get_active(date, forecast)
+        if table is not None:
+            # other params are part of the key too (like in memoize)
+            return table.get_or_calculate(
+                (
+                    'costs', self.func_name, pricing_service.id,
+                    pickle.dumps(kwargs),
+                ),
+                lambda: self._calculate_costs(pricing_service, date, forecast)
+            )
+        return self._calculate_costs(pricing_service, date, forecast)
+
+    def _calculate_costs(self, pricing_service, date, forecast):
         logger.info("Calculating pricing service costs: {0}".format(
             pricing_service.name,
         ))
@@ -237,41 +375,87 @@ class PricingServiceBasePlugin(BaseCostPlugin):
                 ...
             }
         """
-        usages = defaultdict(list)
-        total_usages = []
-        percentage = []
         result = defaultdict(list)
         self.pricing_service = pricing_service
-
-        for service_usage_type in service_usage_types:
-            service_excluded = excluded_services.union(
-                service_usage_type.usage_type.excluded_services.all()
+        service_usage_types = list(service_usage_types)
+        usage_types_ids = [sut.usage_type_id for sut in service_usage_types]
+        excluded_service_environments = (
+            self._get_excluded_service_environments(
+                usage_types_ids, excluded_services
             )
-            usages_per_po = self._get_usages_per_pricing_object(
-                usage_type=service_usage_type.usage_type,
-                date=date,
-                excluded_services=service_excluded,
-            ).values_list(
-                'daily_pricing_object__pricing_object',
-                'service_environment',
-            ).annotate(usage=Sum('value'))
-            for pricing_object, se, usage in usages_per_po:
-                usages[(pricing_object, se)].append(usage)
-
-            total_usages.append(self._get_total_usage(
-                usage_type=service_usage_type.usage_type,
-                date=date,
-                excluded_services=service_excluded,
-            ))
-            percentage.append(service_usage_type.percent)
+        )
+        # usages of all usage types in single query; totals are calculated
+        # from the same rows
+        usages = defaultdict(dict)
+        total_usages = defaultdict(float)
+        for type_id, pricing_object, se, usage in DailyUsage.objects.filter(
+            date=date,
+            type__in=usage_types_ids,
+        ).values_list(
+            'type',
+            'daily_pricing_object__pricing_object',
+            'service_environment',
+        ).annotate(usage=Sum('value')).order_by():
+            if se in excluded_service_environments[type_id]:
+                continue
+            usages[(pricing_object, se)][type_id] = usage
+            total_usages[type_id] += usage
         # create hierarchy basing on usages
         for (po, se), po_usages in usages.items():
-            po_usages_info = zip(po_usages, total_usages, percentage)
+            po_usages_info = [
+                (
+                    po_usages[sut.usage_type_id],
+                    total_usages[sut.usage_type_id],
+                    sut.percent,
+                )
+                for sut in service_usage_types
+                if sut.usage_type_id in po_usages
+            ]
             result[se].extend(
                 self._add_hierarchy_costs(po, po_usages_info, costs_hierarchy)
             )
         return result
 
+    def _get_excluded_service_environments(
+        self,
+        usage_types_ids,
+        excluded_services,
+    ):
+        """
+        Returns ids of service environments excluded from usages of every
+        usage type - belonging to services excluded from pricing service
+        (`excluded_services`) or from usage type.
+
+        :rtype: dict (key: usage type id, value: set of service environments
+            ids)
+        """
+        excluded_services_ids = set(s.id for s in excluded_services)
+        usage_types_excluded_services = defaultdict(set)
+        for usage_type_id, service_id in (
+            UsageType.excluded_services.through.objects.filter(
+                usagetype__in=usage_types_ids,
+            ).values_list('usagetype', 'service')
+        ):
+            usage_types_excluded_services[usage_type_id].add(service_id)
+
+        services_ids = excluded_services_ids.union(
+            *usage_types_excluded_services.values()
+        )
+        service_environments = defaultdict(set)
+        for service_id, se_id in ServiceEnvironment.objects.filter(
+            service__in=services_ids,
+        ).values_list('service', 'id'):
+            service_environments[service_id].add(se_id)
+
+        result = {}
+        for usage_type_id in usage_types_ids:
+            result[usage_type_id] = set()
+            for service_id in excluded_services_ids.union(
+                usage_types_excluded_services[usage_type_id]
+            ):
+                result[usage_type_id].update(service_environments[service_id])
+        return result
+
     @memoize(skip_first=True)
     def _get_pricing_service_costs(
         self,
@@ -321,6 +505,24 @@ class PricingServiceBasePlugin(BaseCostPlugin):
                 )
             }
         """
+        table = PricingServicesCostsTable.get_active(date, forecast)
+        if table is not None:
+            return table.get_or_calculate(
+                ('total', self.func_name, pricing_service.id),
+                lambda: self._calculate_pricing_service_costs(
+                    date, pricing_service, forecast
+                )
+            )
+        return self._calculate_pricing_service_costs(
+            date, pricing_service, forecast
+        )
+
+    def _calculate_pricing_service_costs(
+        self,
+        date,
+        pricing_service,
+        forecast,
+    ):
         service_environments = pricing_service.service_environments
         # total cost of base usage types for service_environments providing
         # this pricing_service
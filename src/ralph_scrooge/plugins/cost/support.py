@@ -6,29 +6,21 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import logging
-from collections import defaultdict, namedtuple
+from collections import defaultdict
 
-from ralph_scrooge.models import ExtraCostType, SupportCost
+from ralph_scrooge.models import (
+    DailyPricingObject,
+    ExtraCostType,
+    SupportCost,
+)
 from ralph_scrooge.plugins.base import register
 from ralph_scrooge.plugins.cost.base import BaseCostPlugin
+from ralph_scrooge.plugins.cost.intervals import IntervalIndex
 from ralph_scrooge.utils.common import memoize
 
 logger = logging.getLogger(__name__)
 
 
-SupportRecord = namedtuple(
-    'SupportRecord',
-    [
-        'service_environment_id',
-        'pricing_object_id',
-        'cost',
-        'forecast_cost',
-        'start',
-        'end',
-    ]
-)
-
-
 @register(chain='scrooge_costs')
 class SupportPlugin(BaseCostPlugin):
     """
@@ -36,6 +28,32 @@ class SupportPlugin(BaseCostPlugin):
     cost model.
     """
 
+    @memoize(skip_first=True)
+    def _get_supports_index(self):
+        """
+        Returns index of all supports costs.
+        """
+        return IntervalIndex(
+            SupportCost.objects.only(
+                'pricing_object_id', 'cost', 'forecast_cost', 'start', 'end',
+            ),
+            key=lambda support: None,
+        )
+
+    def _get_supported_service_environments(self, date):
+        """
+        Returns service environments of pricing objects with supports at
+        given date.
+
+        :rtype: dict (key: pricing object id, value: service environment id)
+        """
+        return dict(DailyPricingObject.objects.filter(
+            date=date,
+            pricing_object__supportcost__isnull=False,
+        ).values_list(
+            'pricing_object_id', 'service_environment_id'
+        ).distinct())
+
     @memoize(skip_first=True)
     def _costs(
         self,
@@ -64,21 +82,15 @@ class SupportPlugin(BaseCostPlugin):
         logger.info("Calculating supports costs")
         support_type = ExtraCostType.objects.get(pk=2)  # from fixture
         usages = defaultdict(list)
-        supports = SupportCost.objects.filter(
-            end__gte=date,
-            start__lte=date,
-            pricing_object__daily_pricing_objects__date=date,
-        ).values_list(
-            'pricing_object__daily_pricing_objects__service_environment_id',
-            'pricing_object_id',
-            'cost',
-            'forecast_cost',
-            'start',
-            'end',
-        )
-        for support in map(SupportRecord._make, list(supports)):
+        supports = self._get_supports_index().find(None, date)
+        if not supports:
+            return usages
+        service_environments = self._get_supported_service_environments(date)
+        for support in supports:
+            if support.pricing_object_id not in service_environments:
+                continue
             cost = support.forecast_cost if forecast else support.cost
-            usages[support.service_environment_id].append({
+            usages[service_environments[support.pricing_object_id]].append({
                 'cost': (cost / (
                     (support.end - support.start).days + 1)
                 ),
@@ -52,6 +52,7 @@ from __future__ import unicode_literals
 import logging
 from collections import defaultdict
 from decimal import Decimal as D
+from operator import attrgetter
 
 from django.db.models import Sum, Count
 from ralph_scrooge.utils.common import memoize
@@ -67,15 +68,42 @@ from ralph_scrooge.models import (
     UsageType,
 )
 from ralph_scrooge.plugins.base import register
-from ralph_scrooge.plugins.cost.base import (
-    BaseCostPlugin,
-    NoPriceCostError
-)
+from ralph_scrooge.plugins.cost.base import BaseCostPlugin
+from ralph_scrooge.plugins.cost.intervals import IntervalIndex
 
 logger = logging.getLogger(__name__)
 PERCENT_PRECISION = 4
 
 
+class ResourceCountIndex(object):
+    """
+    Count of single resource (ex. assets) per service environment for single
+    day. Counts (and total) without any set of excluded service environments
+    are derived from it in memory (total by subtraction), so single query per
+    day is enough for all teams.
+    """
+    def __init__(self, counts):
+        self.counts = dict(counts)
+        self.total = sum(self.counts.values())
+
+    def get_counts(self, excluded_service_environments=()):
+        excluded = _get_ids(excluded_service_environments)
+        return {
+            se_id: count for (se_id, count) in self.counts.iteritems()
+            if se_id not in excluded
+        }
+
+    def get_total(self, excluded_service_environments=()):
+        return self.total - sum(
+            self.counts.get(se_id, 0)
+            for se_id in _get_ids(excluded_service_environments)
+        )
+
+
+def _get_ids(service_environments):
+    return set(getattr(se, 'id', se) for se in service_environments)
+
+
 @register(chain='scrooge_costs')
 class TeamPlugin(BaseCostPlugin):
     @memoize(skip_first=True)
@@ -86,34 +114,63 @@ class TeamPlugin(BaseCostPlugin):
         logger.info("Calculating team costs: {0}".format(team.name))
         return self._get_team_cost_per_service_environment(team, **kwargs)
 
-    def _get_team_cost_per_service_environment(self, team, *args, **kwargs):
+    def _get_team_cost_per_service_environment(
+        self,
+        team,
+        date,
+        forecast=False,
+        daily_cost=None,
+        **kwargs
+    ):
         """
-        Call proper function to calculate team cost, based on team billing type
+        Calculates team cost per service environment by scaling (memoized)
+        team shares by team daily cost. If daily_cost is passed, it's used
+        instead of calculated daily cost from total cost.
         """
-        functions = {
-            TeamBillingType.time: (
-                self._get_team_time_cost_per_service_environment
-            ),
-            TeamBillingType.distribute: (
-                self._get_team_distributed_cost_per_service_environment
-            ),
-            TeamBillingType.assets_cores: (
-                self._get_team_assets_cores_cost_per_service_environment
-            ),
-            TeamBillingType.assets: (
-                self._get_team_assets_cost_per_service_environment
-            ),
-            TeamBillingType.average: (
-                self._get_team_average_cost_per_service_environment
-            ),
+        if team.billing_type not in self._get_team_shares_functions():
+            logger.warning('No handle method for billing type {0}'.format(
+                team.billing_type
+            ))
+            return {}
+        team_cost_days, daily_cost, team_cost = self._get_team_daily_cost(
+            team,
+            date,
+            forecast,
+            daily_cost,
+        )
+        result = defaultdict(list)
+        for service_environment, share in self._get_team_shares(
+            team=team,
+            date=date,
+        ).items():
+            result[service_environment].append({
+                'cost': D(daily_cost) * share,
+                'type': team,
+                'percent': share,
+            })
+        return result
+
+    def _get_team_shares_functions(self):
+        return {
+            TeamBillingType.time: self._get_team_time_shares,
+            TeamBillingType.distribute: self._get_team_distributed_shares,
+            TeamBillingType.assets_cores: self._get_team_assets_cores_shares,
+            TeamBillingType.assets: self._get_team_assets_shares,
+            TeamBillingType.average: self._get_team_average_shares,
         }
-        func = functions.get(team.billing_type)
-        if func:
-            return func(team=team, *args, **kwargs)
-        logger.warning('No handle method for billing type {0}'.format(
-            team.billing_type
-        ))
-        return {}
+
+    @memoize(skip_first=True)
+    def _get_team_shares(self, team, date):
+        """
+        Returns shares of team cost per service environment (as fraction of
+        team daily cost), calculated according to team billing type. Shares
+        don't depend on daily cost (or forecast), so they're calculated once
+        per team and day and every cost of team is just scaled shares.
+
+        :rtype: dict (key: service environment id, value: share (Decimal))
+        """
+        func = self._get_team_shares_functions()[team.billing_type]
+        return func(team=team, date=date)
 
     @memoize(skip_first=True)
     def _get_teams(self):
@@ -150,17 +207,72 @@ class TeamPlugin(BaseCostPlugin):
 
         :rtype: dict (key: team id, value: members count)
         """
-        team_costs = TeamCost.objects.filter(
-            start__lte=date,
-            end__gte=date,
-            team__in=teams,
-        )
+        teams_costs = self._get_teams_costs_index()
         result = {}
-        for team_cost in team_costs:
-            result[team_cost.team.id] = team_cost.members_count
+        for team in teams:
+            for team_cost in teams_costs.find(team.id, date):
+                result[team.id] = team_cost.members_count
         return result
 
     @memoize(skip_first=True)
+    def _get_teams_excluded_service_environments(self):
+        """
+        Returns ids of service environments of services excluded from every
+        team (in two queries for all teams).
+
+        :rtype: dict (key: team id, value: frozenset of service environments
+            ids)
+        """
+        service_environments = defaultdict(set)
+        for service_id, se_id in ServiceEnvironment.objects.values_list(
+            'service_id', 'id'
+        ):
+            service_environments[service_id].add(se_id)
+        result = defaultdict(set)
+        for team_id, service_id in (
+            TeamModel.excluded_services.through.objects.values_list(
+                'team_id', 'service_id'
+            )
+        ):
+            result[team_id] |= service_environments[service_id]
+        return {
+            team_id: frozenset(se_ids) for team_id, se_ids in result.items()
+        }
+
+    @memoize(skip_first=True)
+    def _get_assets_count_index(self, date):
+        """
+        Returns assets count per service environment (all of them) for given
+        day.
+
+        :rtype: ResourceCountIndex
+        """
+        return ResourceCountIndex(DailyPricingObject.objects.filter(
+            date=date,
+            pricing_object__type=PRICING_OBJECT_TYPES.ASSET,
+        ).exclude(
+            service_environment__isnull=True
+        ).values('service_environment').annotate(
+            count=Count('id')
+        ).values_list('service_environment', 'count'))
+
+    @memoize(skip_first=True)
+    def _get_cores_count_index(self, date):
+        """
+        Returns cores count per service environment (all of them) for given
+        day.
+
+        :rtype: ResourceCountIndex
+        """
+        return ResourceCountIndex(DailyUsage.objects.filter(
+            type=self._get_cores_usage_type(),
+            date=date,
+        ).exclude(
+            service_environment__isnull=True
+        ).values('service_environment').annotate(
+            count=Sum('value')
+        ).values_list('service_environment', 'count'))
+
     def _get_assets_count_by_service_environment(
         self,
         date,
@@ -173,23 +285,10 @@ class TeamPlugin(BaseCostPlugin):
 
         :rtype: dict (key: service_environment, value: assets count)
         """
-        assets_query = DailyPricingObject.objects.filter(
-            date=date,
-            pricing_object__type=PRICING_OBJECT_TYPES.ASSET,
-        ).exclude(
-            service_environment__isnull=True
-        ).exclude(
-            service_environment__in=excluded_service_environments,
-        )
-        count = assets_query.values('service_environment').annotate(
-            count=Count('id')
+        return self._get_assets_count_index(date).get_counts(
+            excluded_service_environments
         )
-        result = dict([
-            (dc['service_environment'], dc['count']) for dc in count
-        ])
-        return result
 
-    @memoize(skip_first=True)
     def _get_total_assets_count(
         self,
         date,
@@ -201,15 +300,9 @@ class TeamPlugin(BaseCostPlugin):
 
         :rtype: int
         """
-        assets_query = DailyPricingObject.objects.filter(
-            date=date,
-            pricing_object__type=PRICING_OBJECT_TYPES.ASSET,
-        ).exclude(
-            service_environment__isnull=True
-        ).exclude(
-            service_environment__in=excluded_service_environments,
+        return self._get_assets_count_index(date).get_total(
+            excluded_service_environments
         )
-        return assets_query.aggregate(count=Count('id')).get('count', 0)
 
     def _get_cores_usage_type(self):
         """
@@ -219,7 +312,6 @@ class TeamPlugin(BaseCostPlugin):
             symbol="physical_cpu_cores",
         )[0]
 
-    @memoize(skip_first=True)
     def _get_cores_count_by_service_environment(
         self,
         date,
@@ -232,23 +324,10 @@ class TeamPlugin(BaseCostPlugin):
 
         :rtype: dict (key: service_environment, value: cores count)
         """
-        cores_query = DailyUsage.objects.filter(
-            type=self._get_cores_usage_type(),
-            date=date,
-        ).exclude(
-            service_environment__isnull=True
-        ).exclude(
-            service_environment__in=excluded_service_environments,
-        )
-        count = cores_query.values('service_environment').annotate(
-            count=Sum('value')
+        return self._get_cores_count_index(date).get_counts(
+            excluded_service_environments
         )
-        result = dict([
-            (cc['service_environment'], cc['count']) for cc in count
-        ])
-        return result
 
-    @memoize(skip_first=True)
     def _get_total_cores_count(
         self,
         date,
@@ -260,23 +339,24 @@ class TeamPlugin(BaseCostPlugin):
 
         :rtype: int
         """
-        cores_query = DailyUsage.objects.filter(
-            type=self._get_cores_usage_type(),
-            date=date,
-        ).exclude(
-            service_environment__isnull=True
-        ).exclude(
-            service_environment__in=excluded_service_environments,
+        return self._get_cores_count_index(date).get_total(
+            excluded_service_environments
+        )
+
+    @memoize(skip_first=True)
+    def _get_teams_costs_index(self):
+        """
+        Returns index of costs of all teams (by team id).
+        """
+        return IntervalIndex(
+            TeamCost.objects.all(),
+            key=attrgetter('team_id'),
+            unique=True,
+            name='teams costs',
         )
-        return cores_query.aggregate(
-            cores_count=Sum('value')
-        ).get('cores_count', 0)
 
     def _get_team_daily_cost(self, team, date, forecast, daily_cost=None):
-        try:
-            team_cost = team.teamcost_set.get(start__lte=date, end__gte=date)
-        except TeamCost.DoesNotExist:
-            raise NoPriceCostError()
+        team_cost = self._get_teams_costs_index().get(team.id, date)
 
         # calculate daily cost if not provided
         team_cost_days = (team_cost.end - team_cost.start).days + 1
@@ -286,24 +366,10 @@ class TeamPlugin(BaseCostPlugin):
 
         return team_cost_days, daily_cost, team_cost
 
-    def _get_team_time_cost_per_service_environment(
-        self,
-        team,
-        date,
-        forecast=False,
-        daily_cost=None,
-        **kwargs
-    ):
+    def _get_team_time_shares(self, team, date):
         """
-        Calculates cost of teams, that are billed by spent time for each
-        service environment. If daily_cost is passed, it's used instead of
-        calculated daily cost from total cost.
-
-        Main idea:
-        for every period in which cost is defined for team
-            for every not-overlaping daterange of percent per team
-                calculate cost of team time per service environment in this
-                period of time
+        Calculates shares of teams, that are billed by spent time for each
+        service environment.
 
         Notice that:
         * total cost is treated as sum of equal daily cost (assumed, that in
@@ -311,74 +377,42 @@ class TeamPlugin(BaseCostPlugin):
         * assumed, that in period of time percent of time spent to service
             environment is equal for each day
         """
-
-        result = defaultdict(list)
         team_cost_days, daily_cost, team_cost = self._get_team_daily_cost(
             team,
             date,
-            forecast,
-            daily_cost,
+            forecast=False,
         )
-
-        percentage = dict(team_cost.percentage.values_list(
+        percentage = team_cost.percentage.values_list(
             'service_environment__id',
             'percent',
-        ))
-        for service_environment, percent in percentage.items():
-            result[service_environment].append({
-                'cost': D(daily_cost) * D(percent) / 100,
-                'type': team,
-                'percent': D(percent) / 100,
-            })
-
-        return result
+        )
+        return {
+            service_environment: D(percent) / 100
+            for service_environment, percent in percentage
+        }
 
-    def _get_team_func_cost_per_service_environment(
-        self,
-        team,
-        date,
-        forecast=False,
-        daily_cost=None,
-        funcs=None,
-        **kwargs
-    ):
+    def _get_team_func_shares(self, team, date, funcs=None):
         """
-        Calculates cost of used resources (i.e. assets, cores) for each
-        service environment in period of time. If daily_cost is passed, it's
-        used instead of calculated daily cost from total cost.
-
-        Main idea:
-        for every period in which cost is defined for team:
-            calculate daily cost
-            for every resource:
-                get total count of resource usage per service_environment
-                calculate service_environment cost based od cost in period of
-                 time andresource usage
+        Calculates shares of used resources (i.e. assets, cores) for each
+        service environment.
 
-        Passed functions (funcs) should be 3-elements tuple:
+        Passed functions (funcs) should be 2-elements tuple:
         (
             resource_usage_per_service_environment_function,
             resource_total_usage_function,
-            result_dict_key (to store usages of service_environment)
         ).
 
         Notice that:
         * if there is more than one funcs (resources), that total cost is
             distributed in equal parts to all resources (1/n)
         """
-        result = defaultdict(list)
         funcs = funcs or []
-        excluded_service_environments = ServiceEnvironment.objects.filter(
-            service__in=team.excluded_services.all(),
-        )
-
-        team_cost_days, daily_cost, team_cost = self._get_team_daily_cost(
-            team,
-            date,
-            forecast,
-            daily_cost,
+        excluded_service_environments = (
+            self._get_teams_excluded_service_environments().get(
+                team.id, frozenset()
+            )
         )
-        service_environments_costs = defaultdict(D)
+        shares = defaultdict(D)
         for count_func, total_count_func in funcs:
             count_per_service_environment = count_func(
                 date,
@@ -388,33 +422,20 @@ class TeamPlugin(BaseCostPlugin):
                 date,
                 excluded_service_environments=excluded_service_environments,
             )
-            # if there is more than one resource, calculate 1/n of total
-            # cost
-            cost_part = D(daily_cost) / len(funcs)
             for se, count in count_per_service_environment.items():
                 percent = D(count) / D(total) if total else D(0)
-                service_environments_costs[se] += D(cost_part * percent)
-
-        for service_environment, cost in service_environments_costs.items():
-            result[service_environment].append({
-                'cost': cost,
-                'type': team,
-                'percent': D(cost) / D(daily_cost) if daily_cost else 0,
-            })
+                # if there is more than one resource, calculate 1/n of total
+                # share
+                shares[se] += percent / len(funcs)
+        return dict(shares)
 
-        return result
-
-    def _get_team_assets_cores_cost_per_service_environment(
-        self,
-        team,
-        *args,
-        **kwargs
-    ):
+    def _get_team_assets_cores_shares(self, team, date):
         """
-        Calculates costs of assets and cores usage per service_environment.
+        Calculates shares of assets and cores usage per service_environment.
         """
-        return self._get_team_func_cost_per_service_environment(
+        return self._get_team_func_shares(
             team=team,
+            date=date,
             funcs=(
                 (
                     self._get_assets_count_by_service_environment,
@@ -425,146 +446,69 @@ class TeamPlugin(BaseCostPlugin):
                     self._get_total_cores_count,
                 ),
             ),
-            *args,
-            **kwargs
         )
 
-    def _get_team_assets_cost_per_service_environment(
-        self,
-        team,
-        *args,
-        **kwargs
-    ):
+    def _get_team_assets_shares(self, team, date):
         """
-        Calculates costs of assets usage per service_environment.
+        Calculates shares of assets usage per service_environment.
         """
-        return self._get_team_func_cost_per_service_environment(
+        return self._get_team_func_shares(
             team=team,
+            date=date,
             funcs=(
                 (
                     self._get_assets_count_by_service_environment,
                     self._get_total_assets_count,
                 ),
             ),
-            *args,
-            **kwargs
         )
 
-    def _get_team_distributed_cost_per_service_environment(
-        self,
-        team,
-        date,
-        forecast=False,
-        **kwargs
-    ):
+    def _get_team_distributed_shares(self, team, date):
         """
-        Calculates cost of team, which cost is based on service_environment
+        Calculates shares of team, which cost is based on service_environment
         cost for other teams (proprotionally to members count of other teams).
 
-        Main idea:
-        for every period on which cost is defined for team
-            for every period of not-distributed teams members count in main
-            period
-                for every not-distributed team
-                    get team members count in period and it's % among all teams
-                    calculate % of distributed team total cost (daily)
-                    calculate cost for this team for all service_environments,
-                    proportionally to team cost (usage)
-
-        Not distributed team cost is calculated using functions defined for
-        such calculations. First of all, daily cost of distributed team is
-        calculated. Then, based on not distributed team members count, daily
-        cost of that team is calculated (distributed_team_daily_cost *
-        not_distributed_team_members_count / total_members). Then such daily
-        cost is passed to function for not distributed team and used to
-        calculate (part of) cost of distributed team.
+        Share of every not-distributed team (proportional to its members count
+        among all not-distributed teams) is multiplied by its own shares of
+        service environments and summed.
         """
-
-        result = defaultdict(list)
         teams = self._get_teams_not_distributes_to_others()
         teams_by_id = dict([(t.id, t) for t in teams])
-
-        team_cost_days, daily_cost, team_cost = self._get_team_daily_cost(
-            team,
-            date,
-            forecast,
-        )
         teams_members = self._get_teams_members_count(date, teams)
         total_members = sum(teams_members.values())
 
-        service_environments_costs = defaultdict(D)
-
+        shares = defaultdict(D)
         for team_id, members_count in teams_members.items():
-            dependent_team = teams_by_id[team_id]
-            daily_team_cost = float(daily_cost) * members_count / total_members
-            for sei in self._costs(
-                team=dependent_team,
+            team_share = D(members_count) / D(total_members)
+            for se, share in self._get_team_shares(
+                team=teams_by_id[team_id],
                 date=date,
-                daily_cost=daily_team_cost,
-                forecast=forecast,
             ).items():
-                service_environments_costs[sei[0]] += sum(
-                    s['cost'] for s in sei[1]
-                )
-
-        for service_environment, cost in service_environments_costs.items():
-            se_info = {
-                'type': team,
-                'cost': cost,
-                'percent': cost / daily_cost
-            }
-            result[service_environment].append(se_info)
+                shares[se] += team_share * share
+        return dict(shares)
 
-        return result
-
-    def _get_team_average_cost_per_service_environment(
-        self,
-        team,
-        date,
-        forecast=False,
-        **kwargs
-    ):
+    def _get_team_average_shares(self, team, date):
         """
-        Calculates team cost according to average of percents of other teams
-        costs per service_environments.
+        Calculates team shares according to average of shares of other teams
+        per service_environments.
 
         For every dependent team (every other, that has billing type different
-        than AVERAGE), in period of time for which cost is defined for current
-        team, there are costs and percentage division calculated for such a
-        dependent team. Calculated percentage division is then added to service
-        environment 'counter' and at the end, total cost of current team is
-        distributed according to service_environments 'counters' (of percent).
+        than AVERAGE), its shares are added to service environment 'counter'
+        and at the end, shares of current team are average of service
+        environments 'counters'.
         """
-        result = defaultdict(list)
         teams = self._get_teams_not_average()
-        team_cost_days, daily_cost, team_cost = self._get_team_daily_cost(
-            team,
-            date,
-            forecast,
-        )
-
-        # calculate costs and percent of other teams per
-        # service_environment
         service_environment_percent = defaultdict(D)
         total_percent = len(teams)
-
         for dependent_team in teams:
-            seis = self._costs(
+            # make sure that cost of dependent team is defined
+            self._get_team_daily_cost(dependent_team, date, forecast=False)
+            for se, share in self._get_team_shares(
                 team=dependent_team,
                 date=date,
-                forecast=forecast,
-            )
-            for sei in seis.items():
-                se = sei[0]
-                percent = sei[1][0]['percent']
-                service_environment_percent[se] += percent
-        # distribute cost of current team according to calculated percent
-        for se, percent in service_environment_percent.iteritems():
-            percent_scaled = percent / total_percent
-            result[se].append({
-                'cost': daily_cost * percent_scaled,
-                'percent': percent_scaled,
-                'type': team,
-            })
-
-        return result
+            ).items():
+                service_environment_percent[se] += share
+        return {
+            se: percent / total_percent
+            for se, percent in service_environment_percent.iteritems()
+        }
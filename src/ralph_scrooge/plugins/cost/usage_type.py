@@ -8,14 +8,12 @@ from __future__ import unicode_literals
 import logging
 from collections import defaultdict
 from decimal import Decimal as D
+from operator import attrgetter
 
 from ralph_scrooge.models import UsagePrice
 from ralph_scrooge.plugins.base import register
-from ralph_scrooge.plugins.cost.base import (
-    BaseCostPlugin,
-    NoPriceCostError,
-    MultiplePriceCostError,
-)
+from ralph_scrooge.plugins.cost.base import BaseCostPlugin
+from ralph_scrooge.plugins.cost.intervals import IntervalIndex
 from ralph_scrooge.utils.common import memoize
 
 
@@ -23,6 +21,23 @@ logger = logging.getLogger(__name__)
 
 
 class UsageTypeBasePlugin(BaseCostPlugin):
+    @memoize(skip_first=True)
+    def _get_usage_prices_indexes(self):
+        """
+        Returns indexes of all usage prices - by usage type and by usage type
+        and warehouse.
+        """
+        usage_prices = list(UsagePrice.objects.select_related('type'))
+        return (
+            IntervalIndex(usage_prices, key=attrgetter('type_id')),
+            IntervalIndex(
+                usage_prices,
+                key=attrgetter('type_id', 'warehouse_id'),
+                unique=True,
+                name='usage prices',
+            ),
+        )
+
     @memoize(skip_first=True)
     def _get_price_per_unit(
         self,
@@ -42,18 +57,13 @@ class UsageTypeBasePlugin(BaseCostPlugin):
         :param Warehouse warehouse: warehouse to check
         :returns tuple: total usage for usage price period, price per unit
         """
-        usage_price = usage_type.usageprice_set.filter(
-            end__gte=date,
-            start__lte=date,
-        )
+        by_type, by_type_and_warehouse = self._get_usage_prices_indexes()
         if usage_type.by_warehouse and warehouse:
-            usage_price = usage_price.filter(warehouse=warehouse)
-        try:
-            usage_price = usage_price.get()
-        except UsagePrice.DoesNotExist:
-            raise NoPriceCostError()
-        except UsagePrice.MultipleObjectsReturned:
-            raise MultiplePriceCostError()
+            usage_price = by_type_and_warehouse.get(
+                (usage_type.id, warehouse.id), date
+            )
+        else:
+            usage_price = by_type.get(usage_type.id, date)
 
         if usage_type.by_cost:
             price = self._get_price_from_cost(
@@ -5,6 +5,9 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import datetime
+from collections import defaultdict, OrderedDict
+
 from django.conf import settings
 from django.db.models import Q, Sum
 
@@ -12,6 +15,8 @@ from ralph_scrooge.utils.cycle_detector import detect_cycles
 from ralph_scrooge.models import (
     CostDateStatus,
     DailyUsage,
+    DynamicExtraCost,
+    DynamicExtraCostDivision,
     DynamicExtraCostType,
     PricingService,
     PricingServicePlugin,
@@ -34,6 +39,14 @@ class DataForReportValidationError(Exception):
         super(DataForReportValidationError, self).__init__(message)
 
 
+def _get_cycles_error(cycles):
+    cycles_ = []
+    for c in cycles:
+        c_str = '->'.join(map(lambda ps: ps.symbol, c))
+        cycles_.append(c_str)
+    return 'cycle(s) detected: \n{}'.format('\n'.join(cycles_))
+
+
 class DataForReportValidator(object):
 
     def __init__(self, date, forecast=False):
@@ -258,13 +271,7 @@ class DataForReportValidator(object):
         """
         cycles = detect_cycles(self.date)
         if cycles:
-            cycles_ = []
-            for c in cycles:
-                c_str = '->'.join(map(lambda ps: ps.symbol, c))
-                cycles_.append(c_str)
-            self.errors.append(
-                'cycle(s) detected: \n{}'.format('\n'.join(cycles_))
-            )
+            self.errors.append(_get_cycles_error(cycles))
 
     def validate(self):
         self._check_dynamic_extra_costs()
@@ -281,3 +288,350 @@ class DataForReportValidator(object):
                 'Errors detected for day {:%Y-%m-%d}'.format(self.date),
                 errors=self.errors
             )
+
+
+class DataForReportRangeValidator(object):
+    """
+    Performs the same checks as `DataForReportValidator` (with the same errors)
+    for every day between start and end (inclusive), but data for the whole
+    range (usages, prices, costs, divisions etc.) is fetched once, using
+    grouped queries, instead of querying it separately for every day.
+    """
+
+    def __init__(self, start, end, forecast=False):
+        self.start = start
+        self.end = end
+        self.forecast = forecast
+        self.days = [
+            start + datetime.timedelta(days=i)
+            for i in range((end - start).days + 1)
+        ]
+        self.errors = OrderedDict((day, []) for day in self.days)
+
+        self.active_teams = list(Team.objects.filter(active=True))
+        self._uploaded_usage_types = None
+        self._active_usage_types = None
+
+    def _get_range_filter(self, prefix=''):
+        return {
+            prefix + 'start__lte': self.end,
+            prefix + 'end__gte': self.start,
+        }
+
+    def _get_days(self, start, end):
+        """Returns days of validated range between start and end."""
+        return [day for day in self.days if start <= day <= end]
+
+    def _get_uploaded_usage_types(self):
+        """
+        Returns ids of usage types with any usage saved for every day.
+        """
+        if self._uploaded_usage_types is None:
+            self._uploaded_usage_types = defaultdict(set)
+            for day, type_id in DailyUsage.objects.filter(
+                date__gte=self.start,
+                date__lte=self.end,
+            ).values_list('date', 'type_id').distinct():
+                self._uploaded_usage_types[day].add(type_id)
+        return self._uploaded_usage_types
+
+    def _find_missing_uploads(self, day, usage_types):
+        """Helper method for finding UsageType(s) without uploads."""
+        existing_usage_types = self._get_uploaded_usage_types()[day]
+        return [ut for ut in usage_types if ut.id not in existing_usage_types]
+
+    def _get_active_usage_types(self, day):
+        """
+        Returns active usage types for day (equivalent of
+        `DataForReportValidator.active_usage_types`).
+        """
+        if self._active_usage_types is None:
+            usage_types = list(UsageType.objects.filter(
+                Q(usage_type='BU') |
+                (
+                    Q(services__active=True) &
+                    Q(usage_type='SU') &
+                    Q(service_division__start__lte=self.end) &
+                    Q(service_division__end__gte=self.start)
+                ),
+                active=True
+            ).distinct())
+            # `services` and `service_division` share the same join in
+            # `DataForReportValidator` query, so active pricing service and
+            # division of the day have to be the same ServiceUsageTypes
+            service_usage_types = defaultdict(set)
+            for ut_id, start, end in ServiceUsageTypes.objects.filter(
+                pricing_service__active=True,
+                usage_type__usage_type='SU',
+                **self._get_range_filter()
+            ).values_list('usage_type_id', 'start', 'end'):
+                for d in self._get_days(start, end):
+                    service_usage_types[d].add(ut_id)
+            self._active_usage_types = {
+                d: [
+                    ut for ut in usage_types
+                    if ut.usage_type == 'BU' or ut.id in service_usage_types[d]
+                ] for d in self.days
+            }
+        return self._active_usage_types[day]
+
+    def _check_dynamic_extra_costs(self):
+        cost_field = 'cost' if not self.forecast else 'forecast_cost'
+        dects = list(DynamicExtraCostType.objects.all())
+
+        costs = defaultdict(int)
+        for dect_id, start, end, cost in DynamicExtraCost.objects.filter(
+            dynamic_extra_cost_type__in=dects,
+            **self._get_range_filter()
+        ).values_list(
+            'dynamic_extra_cost_type_id', 'start', 'end', cost_field
+        ):
+            for day in self._get_days(start, end):
+                costs[(dect_id, day)] += cost or 0
+
+        divisions_percent = dict(
+            DynamicExtraCostDivision.objects.values_list(
+                'dynamic_extra_cost_type_id'
+            ).annotate(s=Sum('percent')).order_by()
+        )
+        divisions_symbols = defaultdict(set)
+        for dect_id, symbol in DynamicExtraCostDivision.objects.values_list(
+            'dynamic_extra_cost_type_id', 'usage_type__symbol'
+        ):
+            divisions_symbols[dect_id].add(symbol)
+        divisions_usage_types = list(UsageType.objects.filter(
+            symbol__in=set().union(*divisions_symbols.values())
+        ))
+
+        for dect in dects:
+            sum_perc = divisions_percent.get(dect.id) or 0
+            uts = [
+                ut for ut in divisions_usage_types
+                if ut.symbol in divisions_symbols[dect.id]
+            ]
+            for day in self.days:
+                if not costs[(dect.id, day)]:
+                    self.errors[day].append(
+                        'no extra {}cost(s) defined for dynamic extra cost '
+                        'type "{}"'.format(
+                            'forecast ' if self.forecast else '',
+                            dect.name
+                        )
+                    )
+                if abs(sum_perc - 100) > settings.PERCENT_DIFF_EPSILON:
+                    self.errors[day].append(
+                        'divisions for dynamic extra cost type "{}" does not '
+                        'sum up to 100% (it\'s {}%)'
+                        .format(dect.name, sum_perc)
+                    )
+                for ut in self._find_missing_uploads(day, uts):
+                    self.errors[day].append(
+                        'no usage(s) uploaded for usage type "{}", which is '
+                        'linked to dynamic extra cost type "{}"'
+                        .format(ut.name, dect.name)
+                    )
+
+    def _check_for_required_costs_and_prices(self):
+        cost_field = 'cost' if not self.forecast else 'forecast_cost'
+        price_field = 'price' if not self.forecast else 'forecast_price'
+        pricing_services = list(PricingService.objects.filter(
+            active=True,
+            plugin_type=PricingServicePlugin.pricing_service_fixed_price_plugin,  # noqa: E501
+        ).prefetch_related('usage_types'))
+        costs = defaultdict(int)
+        prices = defaultdict(int)
+        for type_id, start, end, cost, price in UsagePrice.objects.filter(
+            type__in=set(
+                ut.id for ps in pricing_services for ut in ps.usage_types.all()
+            ),
+            **self._get_range_filter()
+        ).values_list('type_id', 'start', 'end', cost_field, price_field):
+            for day in self._get_days(start, end):
+                costs[(type_id, day)] += cost or 0
+                prices[(type_id, day)] += price or 0
+
+        for ps in pricing_services:
+            for ut in ps.usage_types.all():
+                for day in self.days:
+                    if not (costs[(ut.id, day)] or prices[(ut.id, day)]):
+                        self.errors[day].append(
+                            'no {}cost(s) or price(s) defined for usage type '
+                            '"{}"'.format(
+                                'forecast ' if self.forecast else '', ut.name
+                            )
+                        )
+
+    def _check_for_usage_prices_by_warehouse(self):
+        num_active_warehouses = Warehouse.objects.filter(
+            show_in_report=True
+        ).count()
+        usage_types = [
+            ut for ut in self._get_active_usage_types(self.start)
+            if ut.usage_type == 'BU' and ut.by_warehouse
+        ]
+        warehouses = defaultdict(set)
+        for type_id, warehouse_id, start, end in UsagePrice.objects.filter(
+            type__in=usage_types,
+            warehouse__show_in_report=True,
+            **self._get_range_filter()
+        ).values_list('type_id', 'warehouse_id', 'start', 'end'):
+            for day in self._get_days(start, end):
+                warehouses[(type_id, day)].add(warehouse_id)
+
+        for day in self.days:
+            for ut in usage_types:
+                num_warehouses = len(warehouses[(ut.id, day)])
+                if num_warehouses != num_active_warehouses:
+                    self.errors[day].append(
+                        'no usage price(s) for {} of {} active warehouse(s) '
+                        'defined for usage type "{}"'.format(
+                            num_active_warehouses - num_warehouses,
+                            num_active_warehouses,
+                            ut.name,
+                        )
+                    )
+
+    def _check_team_costs(self):
+        if self.forecast:
+            cost_field = 'forecast_cost'
+        else:
+            cost_field = 'cost'
+        costs = defaultdict(int)
+        for team_id, start, end, cost in TeamCost.objects.filter(
+            team__in=self.active_teams,
+            **self._get_range_filter()
+        ).values_list('team_id', 'start', 'end', cost_field):
+            for day in self._get_days(start, end):
+                costs[(team_id, day)] += cost or 0
+
+        for team in self.active_teams:
+            for day in self.days:
+                if not costs[(team.id, day)]:
+                    self.errors[day].append(
+                        'no {}(s) defined (or there are costs equal 0) '
+                        'for team "{}"'.format(
+                            ' '.join(cost_field.split('_')), team.name
+                        )
+                    )
+
+    def _check_team_time_allocations(self):
+        teams = [
+            team for team in self.active_teams
+            if team.billing_type == TeamBillingType.time.id
+        ]
+        percents = defaultdict(int)
+        for team_id, start, end, percent in (
+            TeamServiceEnvironmentPercent.objects.filter(
+                team_cost__team__in=teams,
+                **self._get_range_filter('team_cost__')
+            ).values_list(
+                'team_cost__team_id',
+                'team_cost__start',
+                'team_cost__end',
+                'percent',
+            )
+        ):
+            for day in self._get_days(start, end):
+                percents[(team_id, day)] += percent
+
+        for team in teams:
+            for day in self.days:
+                sum_ = percents[(team.id, day)]
+                if abs(sum_ - 100) > settings.PERCENT_DIFF_EPSILON:
+                    self.errors[day].append(
+                        'time allocated for team "{}" does not sum up to 100% '
+                        '(it\'s {}%)'
+                        .format(team.name, sum_)
+                    )
+
+    def _check_usage_types(self):
+        for day in self.days:
+            uts = [
+                ut for ut in self._get_active_usage_types(day)
+                if not ut.allow_no_daily_usage
+            ]
+            for ut in self._find_missing_uploads(day, uts):
+                self.errors[day].append(
+                    'no usage(s) uploaded for usage type "{}"'.format(ut.name)
+                )
+
+    def _check_usage_types_percent(self):
+        pricing_services = list(
+            PricingService.objects.filter(active=True).exclude(
+                plugin_type=PricingServicePlugin.pricing_service_fixed_price_plugin  # noqa: E501
+            )
+        )
+        percents = {}
+        for ps_id, start, end, percent in ServiceUsageTypes.objects.filter(
+            pricing_service__in=pricing_services,
+            usage_type__active=True,
+            **self._get_range_filter()
+        ).values_list('pricing_service_id', 'start', 'end', 'percent'):
+            for day in self._get_days(start, end):
+                key = (ps_id, day)
+                percents[key] = percents.get(key, 0) + percent
+
+        for ps in pricing_services:
+            for day in self.days:
+                percent_sum = percents.get((ps.id, day))
+                if percent_sum is None:
+                    self.errors[day].append(
+                        'no usage types for pricing service "{}"'.format(
+                            ps.name
+                        )
+                    )
+                elif abs(percent_sum - 100) > settings.PERCENT_DIFF_EPSILON:
+                    self.errors[day].append(
+                        'usage types for pricing service "{}" does not sum up '
+                        'to 100% (it\'s {}%)'.format(ps.name, percent_sum)
+                    )
+
+    def _check_for_accepted_costs(self):
+        accepted_days = set(CostDateStatus.objects.filter(
+            date__gte=self.start,
+            date__lte=self.end,
+            **{'forecast_accepted' if self.forecast else 'accepted': True}
+        ).values_list('date', flat=True))
+        for day in self.days:
+            if day in accepted_days:
+                self.errors[day].append('costs already accepted')
+
+    def _check_for_cycles(self):
+        # if there is no cycle in graph for the whole range, there is no cycle
+        # in graph of any single day
+        if not detect_cycles(self.start, self.end):
+            return
+        for day in self.days:
+            cycles = detect_cycles(day)
+            if cycles:
+                self.errors[day].append(_get_cycles_error(cycles))
+
+    def get_errors(self):
+        """
+        Returns (ordered) dict with list of errors for every day.
+        """
+        self.errors = OrderedDict((day, []) for day in self.days)
+        self._check_dynamic_extra_costs()
+        self._check_for_required_costs_and_prices()
+        self._check_for_usage_prices_by_warehouse()
+        self._check_team_costs()
+        self._check_team_time_allocations()
+        self._check_usage_types()
+        self._check_usage_types_percent()
+        self._check_for_accepted_costs()
+        self._check_for_cycles()
+        return self.errors
+
+    def validate(self):
+        errors = OrderedDict(
+            (day, day_errors)
+            for day, day_errors in self.get_errors().items()
+            if day_errors
+        )
+        if errors:
+            raise DataForReportValidationError(
+                'Errors detected for days {:%Y-%m-%d} - {:%Y-%m-%d}'.format(
+                    self.start, self.end
+                ),
+                errors=errors
+            )
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Conditional requests (ETag / If-None-Match) and server-side cache of costs
+responses.
+
+Costs change only when they are recalculated (which increments `generation`
+of CostDateStatus of recalculated day) or accepted, so version of costs in
+dates range could be derived from CostDateStatus rows in that range. Names
+(and symbols) of usage types, services and environments presented with costs
+could change without recalculation, so they are part of the version too.
+ETag of the response is a hash of the request (path and params) and that
+version - when it matches `If-None-Match` header of GET (or HEAD) request,
+304 is returned without fetching any costs. Otherwise response data is
+fetched from cache (keyed by ETag) or calculated (and cached).
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Count, Max
+from rest_framework.response import Response
+from rest_framework.status import HTTP_200_OK, HTTP_304_NOT_MODIFIED
+
+from ralph_scrooge.models import (
+    BaseUsage,
+    CostDateStatus,
+    Environment,
+    Service,
+)
+from ralph_scrooge.utils.common import get_cache_name
+
+CACHE_NAME = get_cache_name('scrooge_costs_responses')
+
+
+def get_costs_version(start, end):
+    """
+    Returns version of costs between start and end (inclusive) - hash of
+    statuses (and generations) of every day in that range.
+    """
+    statuses = CostDateStatus.objects.filter(
+        date__gte=start,
+        date__lte=end,
+    ).order_by('date').values_list(
+        'date',
+        'calculated',
+        'forecast_calculated',
+        'accepted',
+        'forecast_accepted',
+        'generation',
+    )
+    return hashlib.sha1(
+        ';'.join(
+            '{:%Y-%m-%d}:{}:{}:{}:{}:{}'.format(*s) for s in statuses
+        ).encode('utf-8')
+    ).hexdigest()
+
+
+def get_names_version():
+    """
+    Returns version of names (and symbols) of usage types, services and
+    environments - hash of all of them (services are versioned by the last
+    modification, as there could be a lot of them).
+    """
+    usage_types = BaseUsage.objects_admin.order_by('id').values_list(
+        'id', 'name', 'symbol', 'active', 'divide_by', 'rounding',
+    )
+    environments = Environment.objects.order_by('id').values_list(
+        'id', 'name',
+    )
+    services = Service.objects.aggregate(Count('id'), Max('modified'))
+    return hashlib.sha1(
+        json.dumps(
+            [list(usage_types), list(environments), services],
+            sort_keys=True,
+            default=str,
+        ).encode('utf-8')
+    ).hexdigest()
+
+
+def get_request_key(request):
+    """
+    Returns key identifying the request - its path with query string (and
+    data for requests other than GET).
+    """
+    key = request.get_full_path()
+    if request.method != 'GET':
+        key += json.dumps(request.data, sort_keys=True)
+    return key
+
+
+def _get_etag(request, start, end):
+    return '"{}"'.format(hashlib.sha1('{}|{}|{}'.format(
+        get_request_key(request),
+        get_costs_version(start, end),
+        get_names_version(),
+    ).encode('utf-8')).hexdigest())
+
+
+def _etag_matches(request, etag):
+    # 304 is defined only for GET and HEAD requests
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if not if_none_match:
+        return False
+    etags = [
+        e.strip().replace('W/', '', 1) for e in if_none_match.split(',')
+    ]
+    return '*' in etags or etag in etags
+
+
+def conditional_costs_response(request, start, end, get_response):
+    """
+    Returns response (from `get_response` callable, called without any
+    params) for request of costs between start and end, with ETag derived
+    from costs version. If the ETag matches `If-None-Match` header (of GET or
+    HEAD request), 304 is returned (without calling `get_response`). Data of
+    successful responses is cached (for `COSTS_RESPONSE_CACHE_TIMEOUT`
+    seconds; set it to 0 to disable caching) under the same ETag.
+    """
+    etag = _get_etag(request, start, end)
+    if _etag_matches(request, etag):
+        response = Response(status=HTTP_304_NOT_MODIFIED)
+        response['ETag'] = etag
+        return response
+    cache = caches[CACHE_NAME]
+    cache_key = 'costs_response:{}'.format(etag.strip('"'))
+    timeout = settings.COSTS_RESPONSE_CACHE_TIMEOUT
+    data = cache.get(cache_key) if timeout else None
+    if data is not None:
+        response = Response(data)
+    else:
+        response = get_response()
+        if response.status_code != HTTP_200_OK:
+            return response
+        if timeout:
+            cache.set(cache_key, response.data, timeout)
+    response['ETag'] = etag
+    return response
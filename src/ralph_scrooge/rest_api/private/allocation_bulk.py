@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+"""
+Batched upsert of allocations (prices, extra costs and team costs).
+
+Existing objects of allocated month are preloaded (keyed by their natural
+key, ex. team for team costs) with single query. Then creates, updates and
+deletes are computed in memory and applied in bulk - `bulk_create`, single
+`UPDATE` (using `CASE`) per chunk of changed objects and `DELETE` per chunk
+of removed ones. Unchanged objects are not touched at all.
+
+Allocation admin tables are cached under keys derived from versions (of
+the month and of listed types), which are bumped when allocations are
+saved - by bulk upserts (explicitly) or by model instances (by signals).
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.db.models import Case, Value, When
+from django.db.models.signals import post_delete, post_save
+
+from ralph_scrooge.models import (
+    DynamicExtraCost,
+    DynamicExtraCostType,
+    ExtraCost,
+    ExtraCostType,
+    Team,
+    TeamCost,
+    UsagePrice,
+    UsageType,
+    Warehouse,
+)
+from ralph_scrooge.rest_api.public.v0_9.bulk_pricing_service_usages import (
+    _chunks,
+)
+from ralph_scrooge.utils.common import get_cache_name
+
+logger = logging.getLogger(__name__)
+
+ALLOCATION_ADMIN_CACHE_NAME = get_cache_name('scrooge_allocation_admin')
+# allocations of single month (cache of the month is invalidated on change)
+MONTHLY_ALLOCATION_MODELS = (DynamicExtraCost, ExtraCost, TeamCost, UsagePrice)
+# types listed in allocation admin of every month (the whole cache is
+# invalidated on change)
+ALLOCATION_TYPE_MODELS = (
+    DynamicExtraCostType, ExtraCostType, Team, UsageType, Warehouse,
+)
+
+# number of objects updated by single UPDATE - every object adds two params
+# per field (SQLite limits number of variables in single query to 999)
+UPDATE_CHUNK_SIZE = 100
+
+
+def get_batch_size(model):
+    """
+    Returns batch size for bulk create of allocations -
+    ALLOCATION_BULK_CREATE_BATCH_SIZE limited by database backend (ex. SQLite
+    limit of variables per query).
+    """
+    return min(
+        settings.ALLOCATION_BULK_CREATE_BATCH_SIZE,
+        max(connection.ops.bulk_batch_size(
+            [f for f in model._meta.concrete_fields if not f.primary_key], []
+        ), 1)
+    )
+
+
+def _get_version(cache, key):
+    """
+    Returns version stored in cache under key. Missing version is
+    initialized with current time, so keys derived from it don't match keys
+    derived from evicted one.
+    """
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, int(time.time() * 1000), None)
+        version = cache.get(key, 0)
+    return version
+
+
+def _bump_version(cache, key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        _get_version(cache, key)
+
+
+def _get_month_version_key(first_day):
+    # not formatted with strftime - it doesn't support years before 1900
+    # in Python 2 (ex. `date.min` used as start of some prices)
+    return 'allocation_admin_version:{:04d}-{:02d}'.format(
+        first_day.year, first_day.month
+    )
+
+
+def get_allocation_admin_cache_key(first_day):
+    """
+    Returns cache key of allocation admin tables of month starting at
+    first_day - it's derived from versions of the month and of the types
+    (bumped on every change), so changed tables are never fetched from cache.
+    """
+    cache = caches[ALLOCATION_ADMIN_CACHE_NAME]
+    return 'allocation_admin:{}:{}:{:04d}-{:02d}'.format(
+        _get_version(cache, 'allocation_admin_version'),
+        _get_version(cache, _get_month_version_key(first_day)),
+        first_day.year,
+        first_day.month,
+    )
+
+
+def invalidate_allocation_admin_cache(first_day=None):
+    """
+    Invalidates cached allocation admin tables of month starting at
+    first_day (or of all months, if it's not passed) by bumping its version.
+    Version is bumped again after commit of current transaction, so tables
+    fetched (and cached) in the meantime are not used.
+    """
+    cache = caches[ALLOCATION_ADMIN_CACHE_NAME]
+    if first_day is None:
+        key = 'allocation_admin_version'
+    else:
+        key = _get_month_version_key(first_day)
+    _bump_version(cache, key)
+    transaction.on_commit(lambda: _bump_version(cache, key))
+
+
+def _invalidate_month(sender, instance, **kwargs):
+    # allocation admin lists only allocations starting at the first day of
+    # the month, so others (ex. prices valid "forever") don't change it
+    if instance.start.day == 1:
+        invalidate_allocation_admin_cache(instance.start)
+
+
+def _invalidate_all(sender, instance, **kwargs):
+    invalidate_allocation_admin_cache()
+
+
+# changes made outside of allocation admin (ex. in Django admin)
+for signal in (post_save, post_delete):
+    for model in MONTHLY_ALLOCATION_MODELS:
+        signal.connect(_invalidate_month, sender=model)
+    for model in ALLOCATION_TYPE_MODELS:
+        signal.connect(_invalidate_all, sender=model)
+
+
+class AllocationError(Exception):
+    """
+    Error of saved allocation. `errors` contains messages of all (row-level)
+    errors found in saved rows.
+    """
+    def __init__(self, message, errors=None):
+        super(AllocationError, self).__init__(message)
+        self.errors = errors or [message]
+
+
+class RowErrors(object):
+    """
+    Collects row-level errors of saved allocation (instead of failing on
+    the first invalid row).
+    """
+    def __init__(self):
+        self.errors = []
+
+    def add(self, row_index, error_class, message):
+        self.errors.append((row_index, error_class, message))
+
+    def raise_if_any(self):
+        """
+        Raises error of class of the first collected error, with messages of
+        all of them.
+        """
+        if not self.errors:
+            return
+        messages = [
+            'Row {}: {}'.format(row_index + 1, message)
+            for row_index, _, message in self.errors
+        ]
+        raise self.errors[0][1]('\n'.join(messages), errors=messages)
+
+
+class BulkUpsert(object):
+    """
+    Collects creates, updates and deletes of objects of single model and
+    applies them in bulk. Objects are identified by values of `key_fields`
+    (could be just `id`); `value_fields` are saved.
+
+    Usage:
+        upsert = BulkUpsert(TeamCost, ('team_id',), ('cost',))
+        upsert.load(
+            TeamCost.objects.filter(start=start, end=end),
+            delete_missing=True,
+        )
+        values = upsert.clean(cost=row['cost'])  # raises ValidationError
+        upsert.add((row['team_id'],), values, start=start, end=end)
+        upsert.save()
+    """
+    def __init__(self, model, key_fields, value_fields):
+        self.model = model
+        self.key_fields = tuple(key_fields)
+        self.value_fields = tuple(value_fields)
+        # key -> (pk, tuple of values)
+        self.existing = {}
+        self._deletable = set()
+        self._touched = set()
+        self._to_create = []
+        self._to_update = {}
+
+    def load(self, queryset, delete_missing=False):
+        """
+        Preloads existing objects from queryset (could be called multiple
+        times). If delete_missing is True, loaded objects which will not be
+        added, are deleted on save.
+        """
+        key_len = len(self.key_fields)
+        for row in queryset.order_by('pk').values_list(
+            'pk', *(self.key_fields + self.value_fields)
+        ):
+            self.existing.setdefault(
+                row[1:key_len + 1], (row[0], row[key_len + 1:])
+            )
+            if delete_missing:
+                self._deletable.add(row[0])
+
+    def clean(self, **values):
+        """
+        Converts values of value fields to Python types. Raises
+        ValidationError (with name of the field in message) if any of them is
+        invalid.
+        """
+        result = {}
+        for field_name in self.value_fields:
+            field = self.model._meta.get_field(field_name)
+            try:
+                value = field.to_python(values.get(field_name))
+                if value is None and not field.null:
+                    raise ValidationError(field.error_messages['null'])
+            except ValidationError as e:
+                raise ValidationError('{}: {}'.format(
+                    field_name, ' '.join(e.messages)
+                ))
+            result[field_name] = value
+        return result
+
+    def add(self, key, values, **defaults):
+        """
+        Schedules update of existing object with key (only if any of its
+        values changed) or create of new one (with key fields, values and
+        defaults). Objects with key None are always created. Returns pk of
+        existing object (or None).
+        """
+        if key is not None and key in self.existing:
+            pk, old_values = self.existing[key]
+            self._touched.add(pk)
+            if any(
+                values[field] != old
+                for field, old in zip(self.value_fields, old_values)
+            ):
+                self._to_update[pk] = values
+            return pk
+        fields = dict(zip(self.key_fields, key or ()))
+        fields.update(defaults)
+        fields.update(values)
+        self._to_create.append(self.model(**fields))
+        return None
+
+    def _update(self):
+        pks = sorted(self._to_update)
+        for chunk in _chunks(pks, UPDATE_CHUNK_SIZE):
+            updates = {}
+            for field_name in self.value_fields:
+                field = self.model._meta.get_field(field_name)
+                updates[field_name] = Case(
+                    *[When(pk=pk, then=Value(
+                        self._to_update[pk][field_name], output_field=field,
+                    )) for pk in chunk],
+                    output_field=field
+                )
+            self.model.objects.filter(pk__in=chunk).update(**updates)
+        return len(pks)
+
+    def _delete(self):
+        pks = sorted(self._deletable - self._touched)
+        for chunk in _chunks(pks):
+            self.model.objects.filter(pk__in=chunk).delete()
+        return len(pks)
+
+    def save(self):
+        """
+        Applies scheduled changes. Returns dict with number of created,
+        updated and deleted objects.
+        """
+        self.model.objects.bulk_create(
+            self._to_create,
+            batch_size=get_batch_size(self.model),
+        )
+        result = {
+            'created': len(self._to_create),
+            'updated': self._update(),
+            'deleted': self._delete(),
+        }
+        logger.debug('{}: {created} created, {updated} updated, {deleted} '
+                     'deleted'.format(self.model.__name__, **result))
+        return result
@@ -6,15 +6,32 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+from collections import defaultdict
 from decimal import Decimal as D
 
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ValidationError
 from django.db import transaction
 from rest_framework.views import APIView
 from rest_framework.response import Response
 
 from ralph_scrooge.rest_api.common import get_dates
+from ralph_scrooge.rest_api.private.allocation_bulk import (
+    ALLOCATION_ADMIN_CACHE_NAME,
+    AllocationError,
+    BulkUpsert,
+    get_allocation_admin_cache_key,
+    invalidate_allocation_admin_cache,
+    RowErrors,
+)
 from ralph_scrooge.rest_api.private.allocationclient import (
+    _to_int,
     get_allocation_from_file,
+    get_service_environments_by_ids,
+)
+from ralph_scrooge.rest_api.public.v0_9.bulk_pricing_service_usages import (
+    _chunks,
 )
 from ralph_scrooge.models import (
     DynamicExtraCost,
@@ -30,67 +47,85 @@ from ralph_scrooge.models import (
 )
 
 
-class NoUsageTypeError(Exception):
+class NoUsageTypeError(AllocationError):
+    pass
+
+
+class NoDynamicExtraCostTypeError(AllocationError):
     pass
 
 
-class NoDynamicExtraCostTypeError(Exception):
+class TeamDoesNotExistError(AllocationError):
     pass
 
 
-class TeamDoesNotExistError(Exception):
+class NoExtraCostTypeError(AllocationError):
     pass
 
 
-class NoExtraCostTypeError(Exception):
+class NoExtraCostError(AllocationError):
     pass
 
 
-class NoExtraCostError(Exception):
+class ServiceEnvironmentDoesNotExistError(AllocationError):
     pass
 
 
-class ServiceEnvironmentDoesNotExistError(Exception):
+class NoWarehouseError(AllocationError):
     pass
 
 
+class InvalidValueError(AllocationError):
+    pass
+
+
+def _get_ids(rows, field):
+    """
+    Returns set of (integer) ids of objects referenced by rows in field
+    (ex. `{'type': {'id': 1, 'name': 'abc'}}`).
+    """
+    return set(
+        _to_int(row[field]['id']) for row in rows if field in row
+    ) - {None}
+
+
 class AllocationAdminContent(APIView):
     def _get_extra_costs(self, start, end):
+        extra_costs_by_type = defaultdict(list)
+        for extra_cost in ExtraCost.objects.filter(
+            start=start,
+            end=end,
+        ).select_related('service_environment').order_by('id'):
+            extra_costs_by_type[extra_cost.extra_cost_type_id].append({
+                'id': extra_cost.id,
+                'cost': round(extra_cost.cost, 2),
+                'forecast_cost': round(extra_cost.forecast_cost, 2),
+                'service': extra_cost.service_environment.service_id,
+                'env': extra_cost.service_environment.environment_id
+            })
         rows = []
         for extra_cost_type in ExtraCostType.objects.all():
-            extra_costs = []
-            for extra_cost in ExtraCost.objects.filter(
-                extra_cost_type=extra_cost_type,
-                start=start,
-                end=end,
-            ).select_related('service_environment'):
-                extra_costs.append({
-                    'id': extra_cost.id,
-                    'cost': round(extra_cost.cost, 2),
-                    'forecast_cost': round(extra_cost.forecast_cost, 2),
-                    'service': extra_cost.service_environment.service_id,
-                    'env': extra_cost.service_environment.environment_id
-                })
             rows.append({
                 'extra_cost_type': {
                     'id': extra_cost_type.id,
                     'name': extra_cost_type.name,
                 },
-                'extra_costs': extra_costs
+                'extra_costs': extra_costs_by_type[extra_cost_type.id]
             })
         return rows
 
     def _get_dynamic_extra_costs(self, start, end):
+        costs = {}
+        for type_id, cost, forecast_cost in DynamicExtraCost.objects.filter(
+            start=start,
+            end=end,
+        ).values_list('dynamic_extra_cost_type', 'cost', 'forecast_cost'):
+            costs.setdefault(type_id, (cost, forecast_cost))
         rows = []
         for dynamic_extra_cost_type in DynamicExtraCostType.objects.all():
-            try:
-                cost, forecast_cost = DynamicExtraCost.objects.filter(
-                    dynamic_extra_cost_type=dynamic_extra_cost_type,
-                    start=start,
-                    end=end,
-                ).values_list('cost', 'forecast_cost')[0]
-            except IndexError:
-                cost, forecast_cost = D(0), D(0)
+            cost, forecast_cost = costs.get(
+                dynamic_extra_cost_type.id, (D(0), D(0))
+            )
             rows.append({
                 'dynamic_extra_cost_type': {
                     'id': dynamic_extra_cost_type.id,
@@ -102,16 +137,17 @@ class AllocationAdminContent(APIView):
         return rows
 
     def _get_team_costs(self, start, end):
+        team_costs = {}
+        for team_id, members, cost, forecast_cost in TeamCost.objects.filter(
+            start=start,
+            end=end,
+        ).values_list('team', 'members_count', 'cost', 'forecast_cost'):
+            team_costs.setdefault(team_id, (members, cost, forecast_cost))
         rows = []
         for team in Team.objects.all():
-            try:
-                members, cost, forecast_cost = TeamCost.objects.filter(
-                    team=team,
-                    start=start,
-                    end=end,
-                ).values_list('members_count', 'cost', 'forecast_cost')[0]
-            except IndexError:
-                members, cost, forecast_cost = 0, D(0), D(0)
+            members, cost, forecast_cost = team_costs.get(
+                team.id, (0, D(0), D(0))
+            )
             rows.append({
                 'team': {
                     'id': team.id,
@@ -124,23 +160,31 @@ class AllocationAdminContent(APIView):
         return rows
 
     def _get_base_usages(self, start, end):
-        rows = []
-        warehouses = Warehouse.objects.filter(
-            show_in_report=True,
-        )
-        for usage_type in UsageType.objects.filter(
+        usage_types = list(UsageType.objects.filter(
             usage_type='BU',
             is_manually_type=True,
+        ))
+        warehouses = list(Warehouse.objects.filter(
+            show_in_report=True,
+        )) if any(ut.by_warehouse for ut in usage_types) else []
+        # prices keyed by usage type (any warehouse) and by (usage type,
+        # warehouse) - the first one (in default ordering) is used
+        prices = {}
+        for type_id, warehouse_id, cost, forecast_cost in (
+            UsagePrice.objects.filter(
+                type__in=usage_types,
+                start=start,
+                end=end,
+            ).values_list('type', 'warehouse', 'cost', 'forecast_cost')
         ):
+            prices.setdefault(type_id, (cost, forecast_cost))
+            prices.setdefault((type_id, warehouse_id), (cost, forecast_cost))
+        rows = []
+        for usage_type in usage_types:
             if not usage_type.by_warehouse:
-                try:
-                    cost, forecast_cost = UsagePrice.objects.filter(
-                        type=usage_type,
-                        start=start,
-                        end=end,
-                    ).values_list('cost', 'forecast_cost')[0]
-                except IndexError:
-                    cost, forecast_cost = D(0), D(0)
+                cost, forecast_cost = prices.get(
+                    usage_type.id, (D(0), D(0))
+                )
                 rows.append({
                     'type': {
                         'id': usage_type.id,
@@ -151,15 +195,9 @@ class AllocationAdminContent(APIView):
                 })
             else:
                 for warehouse in warehouses:
-                    try:
-                        cost, forecast_cost = UsagePrice.objects.filter(
-                            type=usage_type,
-                            start=start,
-                            end=end,
-                            warehouse=warehouse,
-                        ).values_list('cost', 'forecast_cost')[0]
-                    except IndexError:
-                        cost, forecast_cost = D(0), D(0)
+                    cost, forecast_cost = prices.get(
+                        (usage_type.id, warehouse.id), (D(0), D(0))
+                    )
                     rows.append({
                         'type': {
                             'id': usage_type.id,
@@ -174,8 +212,7 @@ class AllocationAdminContent(APIView):
                     })
         return rows
 
-    def get(self, request, month, year, format=None):
-        first_day, last_day, days_in_month = get_dates(year, month)
+    def _get_tables(self, first_day, last_day):
         base_usages = self._get_base_usages(first_day, last_day)
         team_costs = self._get_team_costs(first_day, last_day)
         dynamic_extra_costs = self._get_dynamic_extra_costs(
@@ -183,7 +220,7 @@ class AllocationAdminContent(APIView):
             last_day,
         )
         extra_costs = self._get_extra_costs(first_day, last_day)
-        return Response({
+        return {
             'baseusages': {
                 'name': 'Base Usages',
                 'rows': base_usages,
@@ -204,150 +241,217 @@ class AllocationAdminContent(APIView):
                 'rows': extra_costs,
                 'template': 'tabextracostsadmin.html',
             },
-        })
+        }
+
+    def get(self, request, month, year, format=None):
+        first_day, last_day, days_in_month = get_dates(year, month)
+        cache = caches[ALLOCATION_ADMIN_CACHE_NAME]
+        cache_key = get_allocation_admin_cache_key(first_day)
+        timeout = settings.ALLOCATION_ADMIN_CACHE_TIMEOUT
+        data = cache.get(cache_key) if timeout else None
+        if data is None:
+            data = self._get_tables(first_day, last_day)
+            if timeout:
+                cache.set(cache_key, data, timeout)
+        return Response(data)
 
     def _save_base_usages(self, start, end, post_data):
-        for row in post_data['rows']:
-            try:
-                usage_type = UsageType.objects_admin.get(id=row['type']['id'])
-            except UsageType.DoesNotExist:
-                raise NoUsageTypeError(
+        rows = post_data['rows']
+        usage_types = set(UsageType.objects_admin.filter(
+            id__in=_get_ids(rows, 'type'),
+        ).values_list('id', flat=True))
+        warehouses = set(Warehouse.objects.filter(
+            id__in=_get_ids(rows, 'warehouse'),
+        ).values_list('id', flat=True))
+        upsert = BulkUpsert(
+            UsagePrice, ('type_id', 'warehouse_id'), ('cost', 'forecast_cost')
+        )
+        upsert.load(UsagePrice.objects.filter(
+            start=start, end=end, type__in=usage_types,
+        ))
+        errors = RowErrors()
+        for index, row in enumerate(rows):
+            type_id = _to_int(row['type']['id'])
+            if type_id not in usage_types:
+                errors.add(index, NoUsageTypeError, (
                     'No usage type with id {0}'.format(row['type']['id'])
-                )
-
-            params = {
-                "type": usage_type,
-                "start": start,
-                "end": end,
-            }
+                ))
+                continue
+            warehouse_id = None
             if 'warehouse' in row:
-                params.update({"warehouse": Warehouse.objects.get(
-                    id=row['warehouse']['id']
-                )})
-
-            usage_price = UsagePrice.objects.get_or_create(**params)[0]
-            usage_price.cost = row.get('cost', 0)
-            usage_price.forecast_cost = row.get('forecast_cost', 0)
-            usage_price.save()
+                warehouse_id = _to_int(row['warehouse']['id'])
+                if warehouse_id not in warehouses:
+                    errors.add(index, NoWarehouseError, (
+                        'No warehouse with id {0}'.format(
+                            row['warehouse']['id']
+                        )
+                    ))
+                    continue
+            try:
+                values = upsert.clean(
+                    cost=row.get('cost', 0),
+                    forecast_cost=row.get('forecast_cost', 0),
+                )
+            except ValidationError as e:
+                errors.add(index, InvalidValueError, e.messages[0])
+                continue
+            upsert.add((type_id, warehouse_id), values, start=start, end=end)
+        errors.raise_if_any()
+        upsert.save()
 
     def _save_extra_costs(self, start, end, post_data, from_csv=False):
-        saved_costs = []
-        extra_cost_type = None
+        extra_cost_types = set(ExtraCostType.objects_admin.filter(
+            id__in=_get_ids(post_data['rows'], 'extra_cost_type'),
+        ).values_list('id', flat=True))
+        ec_rows = [
+            ec_row for row in post_data['rows']
+            for ec_row in row['extra_costs']
+        ]
+        service_environments = get_service_environments_by_ids(
+            (_to_int(ec_row['service']), _to_int(ec_row['env']))
+            for ec_row in ec_rows
+            if ec_row.get('service') and ec_row.get('env') and
+            not isinstance(ec_row['service'], ServiceEnvironment)
+        )
+
+        upsert = BulkUpsert(ExtraCost, ('id',), ('cost', 'forecast_cost'))
+        scope = ExtraCost.objects.filter(start=start, end=end)
+        if from_csv and post_data['rows']:
+            scope = scope.filter(extra_cost_type=_to_int(
+                post_data['rows'][-1]['extra_cost_type']['id']
+            ))
+        # extra costs missing in the form are deleted
+        upsert.load(scope, delete_missing=True)
+        # extra costs (of other month) could be updated by id as well
+        ids = set(
+            _to_int(ec_row['id']) for ec_row in ec_rows if 'id' in ec_row
+        ) - set(key[0] for key in upsert.existing)
+        for chunk in _chunks(ids - {None}):
+            upsert.load(ExtraCost.objects.filter(id__in=chunk))
+
+        errors = RowErrors()
         for row in post_data['rows']:
-            try:
-                extra_cost_type = ExtraCostType.objects_admin.get(
-                    id=row['extra_cost_type']['id'],
-                )
-            except ExtraCostType.DoesNotExist:
+            extra_cost_type_id = _to_int(row['extra_cost_type']['id'])
+            if extra_cost_type_id not in extra_cost_types:
                 raise NoExtraCostTypeError(
                     'No extra cost type with id {0}'.format(
                         row['extra_cost_type']['id']
                     )
                 )
-            for ec_row in row['extra_costs']:
-                if ('service' in ec_row and
-                        'env' in ec_row and
-                        ec_row['service'] and
-                        ec_row['env']):
-                    if isinstance(ec_row['service'], ServiceEnvironment):
-                        service_environment = ec_row['service']
-                    else:
-                        try:
-                            service_environment = ServiceEnvironment.objects.get(  # noqa
-                                service_id=ec_row['service'],
-                                environment_id=ec_row['env']
-                            )
-                        except ServiceEnvironment.DoesNotExist:
-                            raise ServiceEnvironmentDoesNotExistError((
+            for index, ec_row in enumerate(row['extra_costs']):
+                if not (ec_row.get('service') and ec_row.get('env')):
+                    continue
+                if isinstance(ec_row['service'], ServiceEnvironment):
+                    service_environment = ec_row['service']
+                else:
+                    service_environment = service_environments.get(
+                        (_to_int(ec_row['service']), _to_int(ec_row['env']))
+                    )
+                    if service_environment is None:
+                        errors.add(
+                            index, ServiceEnvironmentDoesNotExistError, (
                                 'Service environment does not exist for '
                                 'service with ID {0} and environment with '
                                 'ID {1}'
-                            ).format(
-                                ec_row['service'],
-                                ec_row['env']
-                            ))
-                    if 'id' in ec_row:
-                        try:
-                            extra_cost = ExtraCost.objects.get(
-                                id=ec_row['id']
-                            )
-                        except ExtraCost.DoesNotExist:
-                            raise NoExtraCostError(
-                                'Extra cost with id {0}'
-                                ' does not exist'.format(
-                                    ec_row['id']
-                                )
-                            )
-                        extra_cost.cost = ec_row['cost']
-                        extra_cost.forecast_cost = ec_row['forecast_cost']
-                        extra_cost.save()
-                    else:
-                        extra_cost = ExtraCost.objects.create(
-                            extra_cost_type=extra_cost_type,
-                            service_environment=service_environment,
-                            start=start,
-                            end=end,
-                            cost=ec_row['cost'],
-                            forecast_cost=ec_row['forecast_cost']
+                            ).format(ec_row['service'], ec_row['env'])
                         )
-                    saved_costs.append(extra_cost.id)
-
-        filter_kwargs = {'start': start, 'end': end}
-        if from_csv and extra_cost_type:
-            filter_kwargs.update({'extra_cost_type': extra_cost_type})
-
-        # delete extra costs that were missing in the form
-        ExtraCost.objects.filter(
-            **filter_kwargs
-        ).exclude(
-            pk__in=saved_costs
-        ).delete()
+                        continue
+                try:
+                    values = upsert.clean(
+                        cost=ec_row.get('cost'),
+                        forecast_cost=ec_row.get('forecast_cost', 0),
+                    )
+                except ValidationError as e:
+                    errors.add(index, InvalidValueError, e.messages[0])
+                    continue
+                if 'id' in ec_row:
+                    key = (_to_int(ec_row['id']),)
+                    if key not in upsert.existing:
+                        errors.add(index, NoExtraCostError, (
+                            'Extra cost with id {0} does not exist'.format(
+                                ec_row['id']
+                            )
+                        ))
+                        continue
+                else:
+                    key = None
+                upsert.add(
+                    key,
+                    values,
+                    extra_cost_type_id=extra_cost_type_id,
+                    service_environment=service_environment,
+                    start=start,
+                    end=end,
+                )
+        errors.raise_if_any()
+        upsert.save()
 
     def _save_dynamic_extra_costs(self, start, end, post_data):
-        for row in post_data['rows']:
-            try:
-                dynamic_extra_cost_type =\
-                    DynamicExtraCostType.objects_admin.get(
-                        id=row['dynamic_extra_cost_type']['id'],
-                    )
-            except DynamicExtraCostType.DoesNotExist:
-                raise NoDynamicExtraCostTypeError(
+        rows = post_data['rows']
+        dynamic_extra_cost_types = set(
+            DynamicExtraCostType.objects_admin.filter(
+                id__in=_get_ids(rows, 'dynamic_extra_cost_type'),
+            ).values_list('id', flat=True)
+        )
+        upsert = BulkUpsert(
+            DynamicExtraCost,
+            ('dynamic_extra_cost_type_id',),
+            ('cost', 'forecast_cost'),
+        )
+        upsert.load(DynamicExtraCost.objects.filter(start=start, end=end))
+        errors = RowErrors()
+        for index, row in enumerate(rows):
+            type_id = _to_int(row['dynamic_extra_cost_type']['id'])
+            if type_id not in dynamic_extra_cost_types:
+                errors.add(index, NoDynamicExtraCostTypeError, (
                     'No dynamic extra cost type with id {0}'.format(
                         row['dynamic_extra_cost_type']['id']
                     )
+                ))
+                continue
+            try:
+                values = upsert.clean(
+                    cost=row.get('cost'),
+                    forecast_cost=row.get('forecast_cost'),
                 )
-            dynamic_extra_cost = DynamicExtraCost.objects.get_or_create(
-                dynamic_extra_cost_type=dynamic_extra_cost_type,
-                start=start,
-                end=end,
-                defaults=dict(
-                    cost=row['cost'],
-                    forecast_cost=row['forecast_cost']
-                )
-            )[0]
-            dynamic_extra_cost.cost = row['cost']
-            dynamic_extra_cost.forecast_cost = row['forecast_cost']
-            dynamic_extra_cost.save()
+            except ValidationError as e:
+                errors.add(index, InvalidValueError, e.messages[0])
+                continue
+            upsert.add((type_id,), values, start=start, end=end)
+        errors.raise_if_any()
+        upsert.save()
 
     def _save_team_costs(self, start, end, post_data):
-        for row in post_data['rows']:
-            try:
-                team = Team.objects.get(id=row['team']['id'])
-            except Team.DoesNotExist:
-                raise TeamDoesNotExistError(
-                    "Team with id {0} does not exist".format(
+        rows = post_data['rows']
+        teams = set(Team.objects.filter(
+            id__in=_get_ids(rows, 'team'),
+        ).values_list('id', flat=True))
+        upsert = BulkUpsert(
+            TeamCost, ('team_id',), ('cost', 'forecast_cost', 'members_count')
+        )
+        upsert.load(TeamCost.objects.filter(start=start, end=end))
+        errors = RowErrors()
+        for index, row in enumerate(rows):
+            team_id = _to_int(row['team']['id'])
+            if team_id not in teams:
+                errors.add(index, TeamDoesNotExistError, (
+                    'Team with id {0} does not exist'.format(
                         row['team']['id']
                     )
+                ))
+                continue
+            try:
+                values = upsert.clean(
+                    cost=row.get('cost'),
+                    forecast_cost=row.get('forecast_cost'),
+                    members_count=row.get('members'),
                 )
-            team_cost = TeamCost.objects.get_or_create(
-                team=team,
-                start=start,
-                end=end,
-            )[0]
-            team_cost.cost = row['cost']
-            team_cost.forecast_cost = row['forecast_cost']
-            team_cost.members_count = row['members']
-            team_cost.save()
+            except ValidationError as e:
+                errors.add(index, InvalidValueError, e.messages[0])
+                continue
+            upsert.add((team_id,), values, start=start, end=end)
+        errors.raise_if_any()
+        upsert.save()
 
     @transaction.atomic
     def post(self, request, year, month, allocate_type, *args, **kwargs):
@@ -372,12 +476,24 @@ class AllocationAdminContent(APIView):
             post_data = request.data
 
         first_day, last_day, days_in_month = get_dates(year, month)
-        if allocate_type == 'baseusages':
-            self._save_base_usages(first_day, last_day, post_data)
-        if allocate_type == 'extracosts':
-            self._save_extra_costs(first_day, last_day, post_data, from_csv)
-        if allocate_type == 'dynamicextracosts':
-            self._save_dynamic_extra_costs(first_day, last_day, post_data)
-        if allocate_type == 'teamcosts':
-            self._save_team_costs(first_day, last_day, post_data)
+        invalidate_allocation_admin_cache(first_day)
+        try:
+            if allocate_type == 'baseusages':
+                self._save_base_usages(first_day, last_day, post_data)
+            if allocate_type == 'extracosts':
+                self._save_extra_costs(
+                    first_day, last_day, post_data, from_csv
+                )
+            if allocate_type == 'dynamicextracosts':
+                self._save_dynamic_extra_costs(
+                    first_day, last_day, post_data
+                )
+            if allocate_type == 'teamcosts':
+                self._save_team_costs(first_day, last_day, post_data)
+        except AllocationError as e:
+            # errors of imported file are reported the same way as errors
+            # of parsing it
+            if not from_csv:
+                raise
+            return Response({'status': False, 'errors': e.errors})
         return Response({"status": True})
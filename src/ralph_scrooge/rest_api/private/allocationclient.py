@@ -10,6 +10,7 @@ from rest_framework.exceptions import APIException
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from collections import defaultdict, OrderedDict
 from datetime import date, timedelta
 from dateutil.relativedelta import relativedelta
 
@@ -18,9 +19,12 @@ from django.utils.translation import ugettext_lazy as _
 
 from ralph_scrooge.rest_api.common import get_dates
 from ralph_scrooge.models import (
+    DailyPricingObject,
     DailyUsage,
     ExtraCost,
     ExtraCostType,
+    PRICING_OBJECT_TYPES,
+    PricingObject,
     PricingService,
     Service,
     ServiceEnvironment,
@@ -31,6 +35,14 @@ from ralph_scrooge.models import (
     UsageType,
 )
 from ralph_scrooge.csvutil import parse_csv
+from ralph_scrooge.rest_api.private.allocation_bulk import (
+    get_batch_size,
+    invalidate_allocation_admin_cache,
+)
+from ralph_scrooge.rest_api.public.v0_9.bulk_pricing_service_usages import (
+    _chunks,
+)
+from ralph_scrooge.utils.daily_usages import delete_daily_usages
 
 
 class CannotDetermineValidServiceUsageTypeError(APIException):
@@ -38,10 +50,65 @@ class CannotDetermineValidServiceUsageTypeError(APIException):
     default_detail = 'Cannot determine valid (single!) service usage type'
 
 
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _get_service_environment_key(row):
+    """
+    Returns key used to find service environment of CSV row - ('pk', id)
+    or (service lookup, service uid or name, environment name).
+    """
+    if row.get('service_env_id'):
+        return ('pk', _to_int(row['service_env_id']))
+    if row.get('service_uid'):
+        return ('service__ci_uid', row['service_uid'], row['environment'])
+    return ('service__name', row['service_name'], row['environment'])
+
+
+def _get_service_environments_by_keys(keys):
+    """
+    Returns dict with list of service environments for every key (see
+    `_get_service_environment_key`). Service environments are queried in
+    chunks (of keys with the same lookup).
+    """
+    keys_by_lookup = defaultdict(set)
+    for key in keys:
+        keys_by_lookup[key[0]].add(key)
+    result = defaultdict(list)
+    for lookup, lookup_keys in keys_by_lookup.items():
+        queryset = ServiceEnvironment.objects.select_related(
+            'service', 'environment'
+        )
+        if lookup != 'pk':
+            queryset = queryset.filter(
+                environment__name__in=set(k[2] for k in lookup_keys)
+            )
+        for chunk in _chunks(set(
+            k[1] for k in lookup_keys if k[1] is not None
+        )):
+            for se in queryset.filter(**{'{}__in'.format(lookup): chunk}):
+                if lookup == 'pk':
+                    key = (lookup, se.pk)
+                else:
+                    key = (
+                        lookup,
+                        getattr(se.service, lookup.split('__')[1]),
+                        se.environment.name,
+                    )
+                if key in lookup_keys:
+                    result[key].append(se)
+    return result
+
+
 def get_allocation_from_file(file, allocation_admin=False):
     """
     Parse CSV files from Python File object (file())
-    It then search ServiceEnvironment based on the values in the service field.
+    It then search ServiceEnvironment based on the values in the service field
+    (all of them are fetched with few queries, in chunks).
     Returns list of usages (compatible with JSON sent by Scroge GUI)
 
     Args:
@@ -87,37 +154,27 @@ def get_allocation_from_file(file, allocation_admin=False):
     if errors:
         return ({}, errors)
 
-    for row in data_results:
-        query = {}
-        if row.get('service_env_id'):
-            query['pk'] = row['service_env_id']
+    keys = [_get_service_environment_key(row) for row in data_results]
+    service_environments = _get_service_environments_by_keys(keys)
+    for index, (row, key) in enumerate(zip(data_results, keys)):
+        found = service_environments.get(key, [])
+        if len(found) == 1:
+            service_env = found[0]
         else:
-            if row.get('service_uid'):
-                query['service__ci_uid'] = row['service_uid']
-            else:
-                query['service__name'] = row['service_name']
-
-            query['environment__name'] = row['environment']
-
-        try:
-            service_env = ServiceEnvironment.objects.get(**query)
-        except ServiceEnvironment.DoesNotExist:
             if row.get('service_env_id'):
-                errors.append(
-                    'Service environment not found for ID: {}'.format(
-                        row.get('service_env_id')
-                    )
+                error = 'Service environment not found for ID: {}'.format(
+                    row.get('service_env_id')
                 )
             else:
-                errors.append(
-                    (
-                        'Service environment not found for service: {},'
-                        ' environment: {}'
-                    ).format(
-                        row.get('service_uid', row.get('service_name')),
-                        row.get('environment')
-                    )
+                error = (
+                    '{} for service: {}, environment: {}'
+                ).format(
+                    'Multiple service environments found' if found else
+                    'Service environment not found',
+                    row.get('service_uid', row.get('service_name')),
+                    row.get('environment')
                 )
+            errors.append('Row {}: {}'.format(index + 1, error))
             service_env = ''
 
         row_data = {
@@ -135,6 +192,111 @@ def get_allocation_from_file(file, allocation_admin=False):
     return (file_results, errors)
 
 
+def get_service_environments_by_ids(pairs):
+    """
+    Returns dict of service environments keyed by (service id, environment
+    id), for passed pairs of (integer) ids. Service environments are queried
+    in chunks (of services).
+    """
+    pairs = set(pairs)
+    environments = set(p[1] for p in pairs)
+    result = {}
+    for chunk in _chunks(set(p[0] for p in pairs)):
+        for se in ServiceEnvironment.objects.filter(
+            service__id__in=chunk,
+            environment__id__in=environments,
+        ):
+            key = (se.service_id, se.environment_id)
+            if key in pairs:
+                result[key] = se
+    return result
+
+
+def get_service_environments(rows):
+    """
+    Resolves service environments of rows (with `service` and `env` ids or
+    with service environment already set in `service`, as returned by
+    `get_allocation_from_file`) using `get_service_environments_by_ids`.
+
+    Returns list of service environments (in order of rows) and list of
+    errors (for rows, which service environment was not found).
+    """
+    keys = [
+        None if isinstance(row['service'], ServiceEnvironment) else
+        (_to_int(row['service']), _to_int(row['env']))
+        for row in rows
+    ]
+    service_environments = get_service_environments_by_ids(
+        key for key in keys if key is not None and None not in key
+    )
+    result = []
+    errors = []
+    for row, key in zip(rows, keys):
+        if key is None:
+            result.append(row['service'])
+        elif key in service_environments:
+            result.append(service_environments[key])
+        else:
+            errors.append(
+                (
+                    'Service environment not found for service: {},'
+                    ' environment: {}'
+                ).format(row['service'], row['env'])
+            )
+    return result, errors
+
+
+def get_dummy_daily_pricing_objects(service_environments, start, end):
+    """
+    Returns dict of ids of daily pricing objects of dummy pricing objects of
+    service environments, for every day between start and end (inclusive),
+    keyed by (service environment id, date). Missing daily pricing objects
+    are created in bulk.
+    """
+    se_by_id = {se.id: se for se in service_environments}
+    dummy_pricing_objects = {}
+    for chunk in _chunks(se_by_id.keys()):
+        for se_id, po_id in PricingObject.objects.filter(
+            service_environment__in=chunk,
+            type_id=PRICING_OBJECT_TYPES.DUMMY,
+        ).order_by('id').values_list('service_environment_id', 'id'):
+            dummy_pricing_objects.setdefault(se_id, po_id)
+    for se_id in set(se_by_id) - set(dummy_pricing_objects):
+        dummy_pricing_objects[se_id] = se_by_id[se_id].dummy_pricing_object.id
+
+    def fetch():
+        return {
+            (se_id, day): dpo_id
+            for chunk in _chunks(dummy_pricing_objects.values())
+            for se_id, day, dpo_id in DailyPricingObject.objects.filter(
+                pricing_object__in=chunk,
+                date__gte=start,
+                date__lte=end,
+            ).values_list('service_environment_id', 'date', 'id')
+        }
+    daily_pricing_objects = fetch()
+    days = [
+        start + timedelta(days=i) for i in xrange((end - start).days + 1)
+    ]
+    missing = [
+        DailyPricingObject(
+            date=day,
+            pricing_object_id=po_id,
+            service_environment_id=se_id,
+        )
+        for se_id, po_id in dummy_pricing_objects.items()
+        for day in days
+        if (se_id, day) not in daily_pricing_objects
+    ]
+    if missing:
+        DailyPricingObject.objects.bulk_create(
+            missing, batch_size=get_batch_size(DailyPricingObject)
+        )
+        # bulk_create doesn't set ids (except PostgreSQL)
+        daily_pricing_objects = fetch()
+    return daily_pricing_objects
+
+
 class AllocationClientService(APIView):
     def _get_service_usage_type(
         self,
@@ -252,11 +414,7 @@ class AllocationClientService(APIView):
         first_day,
         last_day,
     ):
-        DailyUsage.objects.filter(
-            date__gte=first_day,
-            date__lte=last_day,
-            type=usage_type,
-        ).delete()
+        delete_daily_usages(first_day, last_day, [usage_type])
 
     def get(self, request, year, month, service, env, *args, **kwargs):
         first_day, last_day, days_in_month = get_dates(year, month)
@@ -305,6 +463,14 @@ class AllocationClientService(APIView):
 
         first_day, last_day, days_in_month = get_dates(year, month)
         if kwargs.get('allocate_type') == 'servicedivision':
+            service_environments, errors = get_service_environments(
+                post_data['rows']
+            )
+            if errors:
+                return Response({'status': False, 'errors': errors})
+            daily_pricing_objects = get_dummy_daily_pricing_objects(
+                set(service_environments), first_day, last_day
+            )
             service_usage_type = self._get_service_usage_type(
                 service,
                 year,
@@ -316,28 +482,28 @@ class AllocationClientService(APIView):
                 first_day,
                 last_day,
             )
-            for row in post_data['rows']:
-                if isinstance(row['service'], ServiceEnvironment):
-                    service_environment = row['service']
-                else:
-                    service_environment = ServiceEnvironment.objects.get(
-                        service__id=row['service'],
-                        environment__id=row['env']
-                    )
+            daily_usages = []
+            for row, service_environment in zip(
+                post_data['rows'], service_environments
+            ):
                 for day in xrange(days_in_month):
                     iter_date = first_day + timedelta(days=day)
-                    dpo = (
-                        service_environment.dummy_pricing_object
-                        .get_daily_pricing_object(iter_date)
-                    )
-                    DailyUsage.objects.create(
+                    daily_usages.append(DailyUsage(
                         date=iter_date,
                         service_environment=service_environment,
-                        daily_pricing_object=dpo,
+                        daily_pricing_object_id=daily_pricing_objects[
+                            (service_environment.id, iter_date)
+                        ],
                         value=row['value'],
                         type=service_usage_type.usage_type,
-                    )
+                    ))
+            DailyUsage.objects.bulk_create(
+                daily_usages,
+                batch_size=get_batch_size(DailyUsage),
+            )
         if kwargs.get('allocate_type') == 'serviceextracost':
+            # extra costs are listed in allocation admin too
+            invalidate_allocation_admin_cache(first_day)
             service_environment = ServiceEnvironment.objects.get(
                 service__id=service,
                 environment__id=env,
@@ -416,6 +582,11 @@ class AllocationClientPerTeam(APIView):
             team = Team.objects.get(id=team)
         except Team.DoesNotExist:
             return {'status': False, 'message': 'Team Does Not Exist.'}
+        service_environments, errors = get_service_environments(
+            post_data['rows']
+        )
+        if errors:
+            return Response({'status': False, 'errors': errors})
         TeamServiceEnvironmentPercent.objects.filter(
             team_cost__team=team,
             team_cost__start=first_day,
@@ -426,22 +597,22 @@ class AllocationClientPerTeam(APIView):
             start=first_day,
             end=last_day,
         )[0]
-        for row in post_data['rows']:
-            if isinstance(row['service'], ServiceEnvironment):
-                service_environment = row['service']
-            else:
-                service_environment = ServiceEnvironment.objects.get(
-                    service__id=row.get('service'),
-                    environment__id=row.get('env')
-                )
-            tsep = TeamServiceEnvironmentPercent.objects.get_or_create(
-                team_cost=team_cost,
-                service_environment=service_environment,
-                defaults=dict(
-                    percent=row.get('value'),
+        # last row wins for duplicated service environments
+        percents = OrderedDict()
+        for row, service_environment in zip(
+            post_data['rows'], service_environments
+        ):
+            percents[service_environment.id] = row.get('value')
+        TeamServiceEnvironmentPercent.objects.bulk_create(
+            [
+                TeamServiceEnvironmentPercent(
+                    team_cost=team_cost,
+                    service_environment_id=se_id,
+                    percent=percent,
                 )
-            )[0]
-            tsep.percent = row.get('value')
-            tsep.save()
+                for se_id, percent in percents.items()
+            ],
+            batch_size=get_batch_size(TeamServiceEnvironmentPercent),
+        )
 
         return Response({"status": True})
@@ -6,13 +6,16 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import re
 from datetime import date
 
 from django.apps import apps
 from django.conf import settings
+from django.db.models import Count
 from django.db.models.fields import FieldDoesNotExist
 from django.db.models.fields.related import ForeignObjectRel, RelatedField
 from django.template.defaultfilters import slugify
+from rest_framework.exceptions import ParseError
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
@@ -20,21 +23,44 @@ from ralph_scrooge.models import (
     DailyPricingObject,
     PricingObjectType,
 )
+from ralph_scrooge.utils.cache import memoize
+
+FILTER_PARAM_REGEX = re.compile(r'^filter_(\d+)$')
 
 
 class ComponentsContent(APIView):
     """
     A view that returns the contents for 'components' tables.
+
+    Rows of every type are ordered by id and could be paginated (separately
+    for every type) using `limit` query param - `next` of type is then the
+    id of the last returned row (or null, if there are no more of them) and
+    the next page of single type could be fetched using `type` (slug) and
+    `after` (`next` of previous page) params. Rows could be filtered by
+    columns (`filter_<column number>=<text>`, case insensitive containment).
+    With `counts=1` only numbers of rows (`count`) of every type are
+    returned (without rows).
     """
 
     default_model = 'ralph_scrooge.models.DailyPricingObject'
+    schema_setting = 'COMPONENTS_TABLE_SCHEMA'
 
     def get_types(self):
         """
-        Returns Pricing Object Types defined in COMPONENTS_TABLE_SCHEMA.
+        Returns Pricing Object Types defined in schema setting
+        (COMPONENTS_TABLE_SCHEMA).
         """
         return PricingObjectType.objects.filter(
-            name__in=settings.COMPONENTS_TABLE_SCHEMA.keys()
+            name__in=getattr(settings, self.schema_setting).keys()
+        )
+
+    def get_schema(self, single_type):
+        """
+        Returns django fields and headers of single type (see
+        `process_schema`).
+        """
+        return self.process_schema(
+            getattr(settings, self.schema_setting)[single_type.name]
         )
 
     def get_daily_pricing_objects(
@@ -113,10 +139,14 @@ class ComponentsContent(APIView):
         """
         Analyzes the schema creating field list and header list
         """
+        return self._process_schema(schema, self.default_model)
+
+    @memoize(skip_first=True, update_interval=None)
+    def _process_schema(self, schema, default_model):
         # get pricing object (sub)model
         app_label, _models, model_name = schema.get(
             'model',
-            self.default_model,
+            default_model,
         ).split('.')
         model = apps.get_model(app_label, model_name)
         # parse headers according to 'fields' list in COMPONENTS_TABLE_SCHEMA
@@ -132,23 +162,64 @@ class ComponentsContent(APIView):
             if isinstance(field, (tuple, list)):
                 field = field[0]
             django_fields.append(field.replace('.', '__'))
-        return django_fields, headers
+        # result is cached - fields shouldn't be modified
+        return tuple(django_fields), headers
+
+    def filter_by_columns(self, query, django_fields, filters):
+        """
+        Filters query by values of columns (column number -> text). If any of
+        columns doesn't exist, nothing is returned.
+        """
+        for column, text in filters.items():
+            if column >= len(django_fields):
+                return query.none()
+            query = query.filter(
+                **{'{}__icontains'.format(django_fields[column]): text}
+            )
+        return query
 
-    def process_single_type(self, single_type, daily_pricing_objects):
+    def paginate(self, query, fields, after=None, limit=None):
+        """
+        Returns values of fields of rows of query (ordered by id, with id as
+        the first value) - all of them or `limit` of them with id greater
+        than `after`. Second returned value is id of the last returned row if
+        there are more rows (or None).
+        """
+        query = query.order_by('id')
+        if after is not None:
+            query = query.filter(id__gt=after)
+        query = query.values_list('id', *fields)
+        if limit is None:
+            return list(query), None
+        rows = list(query[:limit + 1])
+        if len(rows) > limit:
+            return rows[:limit], rows[limit - 1][0]
+        return rows, None
+
+    def process_single_type(
+        self, single_type, daily_pricing_objects, after=None, limit=None,
+        filters=None,
+    ):
         """
         Processing of single Pricing Object Type - returns information about
         single pricing object type component.
         """
-        values = []
         # single type name must be in COMPONENTS_TABLE_SCHEMA in regular flow
         # (function called from components_content)
-        django_fields, headers = self.process_schema(
-            settings.COMPONENTS_TABLE_SCHEMA[single_type.name]
+        django_fields, headers = self.get_schema(single_type)
+        rows, next_after = self.paginate(
+            self.filter_by_columns(
+                daily_pricing_objects.filter(pricing_object__type=single_type),
+                django_fields,
+                filters or {},
+            ),
+            django_fields,
+            after,
+            limit,
         )
-        for dpo in daily_pricing_objects.filter(
-            pricing_object__type=single_type,
-        ).values_list(*django_fields):
-            value = {str(x[0]): x[1] for x in enumerate(dpo)}
+        values = []
+        for row in rows:
+            value = {str(x[0]): x[1] for x in enumerate(row[1:])}
             values.append(value)
         return {
             "name": single_type.name,
@@ -157,13 +228,76 @@ class ComponentsContent(APIView):
             "value": values,
             "schema": headers,
             "color": single_type.color,
+            "next": next_after,
         }
 
+    def process_counts(self, types, daily_pricing_objects, filters=None):
+        """
+        Returns information about pricing object types components with
+        number of rows of every type instead of rows (counted using single
+        grouped query, if rows are not filtered).
+        """
+        if filters:
+            counts = {
+                t.id: self.filter_by_columns(
+                    daily_pricing_objects.filter(pricing_object__type=t),
+                    self.get_schema(t)[0],
+                    filters,
+                ).count() for t in types
+            }
+        else:
+            counts = dict(daily_pricing_objects.values_list(
+                'pricing_object__type'
+            ).annotate(Count('id')).order_by())
+        return [{
+            "name": single_type.name,
+            "icon_class": single_type.icon_class,
+            "slug": slugify(single_type.name),
+            "schema": self.get_schema(single_type)[1],
+            "color": single_type.color,
+            "count": counts.get(single_type.id, 0),
+        } for single_type in types]
+
+    def _parse_int_param(self, request, param, min_value=None):
+        value = request.query_params.get(param)
+        if value is None:
+            return None
+        try:
+            value = int(value)
+        except ValueError:
+            value = None
+        if value is None or (min_value is not None and value < min_value):
+            raise ParseError('Invalid value for {} param'.format(param))
+        return value
+
+    def _parse_filters(self, request):
+        filters = {}
+        for param, text in request.query_params.items():
+            match = FILTER_PARAM_REGEX.match(param)
+            if match:
+                filters[int(match.group(1))] = text
+        return filters
+
+    def _get_selected_types(self, request):
+        type_slug = request.query_params.get('type')
+        return [
+            t for t in self.get_types()
+            if type_slug is None or slugify(t.name) == type_slug
+        ]
+
     def get(self, request, *args, **kwargs):
         daily_pricing_objects = self.get_daily_pricing_objects(*args, **kwargs)
+        types = self._get_selected_types(request)
+        filters = self._parse_filters(request)
+        if str(request.query_params.get('counts')) in ('1', 'true'):
+            return Response(
+                self.process_counts(types, daily_pricing_objects, filters)
+            )
+        limit = self._parse_int_param(request, 'limit', min_value=1)
+        after = self._parse_int_param(request, 'after')
         results = []
-        for single_type in self.get_types():
+        for single_type in types:
             results.append(self.process_single_type(
-                single_type, daily_pricing_objects
+                single_type, daily_pricing_objects, after, limit, filters
             ))
         return Response(results if results else [])
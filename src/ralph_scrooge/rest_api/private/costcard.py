@@ -20,6 +20,7 @@ from ralph_scrooge.models import (
     ServiceEnvironment,
 )
 from ralph_scrooge.rest_api.common import get_dates
+from ralph_scrooge.rest_api.conditional import conditional_costs_response
 
 
 class CostCardContent(APIView):
@@ -37,6 +38,16 @@ class CostCardContent(APIView):
         :returns object: json response
         """
         first_day, last_day, days_in_month = get_dates(year, month)
+        return conditional_costs_response(
+            request,
+            first_day,
+            last_day,
+            lambda: self._get_costs(
+                request, service, env, first_day, last_day
+            ),
+        )
+
+    def _get_costs(self, request, service, env, first_day, last_day):
         try:
             service_environment = ServiceEnvironment.objects.get(
                 service__id=service,
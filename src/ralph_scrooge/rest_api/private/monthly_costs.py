@@ -21,7 +21,10 @@ from rest_framework.response import Response
 
 from ralph_scrooge.models import CostDateStatus
 from ralph_scrooge.plugins.cost.collector import Collector
-from ralph_scrooge.plugins.validations import DataForReportValidationError
+from ralph_scrooge.plugins.validations import (
+    DataForReportRangeValidator,
+    DataForReportValidationError,
+)
 from ralph_scrooge.rest_api.private.serializers import MonthlyCostsSerializer
 from ralph_scrooge.utils.common import get_cache_name, get_queue_name
 from ralph_scrooge.utils.worker_job import WorkerJob, _get_cache_key
@@ -194,11 +197,13 @@ class MonthlyCosts(APIView, WorkerJob):
         statuses = {}
         processed_results = []  # list of DailyCost instances for whole period
         logger.info('Recalculating costs from {} to {}'.format(start, end))
+        validation_errors = cls._validate(start, end, forecast)
         while progress < 100:
             progress, statuses, results = cls._check_subjobs(
                 statuses,
                 start=start,
                 end=end,
+                validation_errors=validation_errors,
                 forecast=forecast,
                 **kwargs
             )
@@ -217,7 +222,23 @@ class MonthlyCosts(APIView, WorkerJob):
         yield 100, statuses
 
     @classmethod
-    def _check_subjobs(cls, statuses, start, end, **kwargs):
+    def _validate(cls, start, end, forecast):
+        """
+        Validate data for costs report for every day between start and end at
+        once (instead of validating every day in its subtask).
+
+        :returns: list of validation errors for every day
+        :rtype: dict
+        """
+        if not settings.ENABLE_DATA_FOR_REPORT_VALIDATION:
+            return {}
+        logger.info('Performing validation of data for costs calculation.')
+        return DataForReportRangeValidator(start, end, forecast).get_errors()
+
+    @classmethod
+    def _check_subjobs(
+        cls, statuses, start, end, validation_errors=None, **kwargs
+    ):
         """
         Check subjobs (jobs for single day) statuses.
 
@@ -228,17 +249,29 @@ class MonthlyCosts(APIView, WorkerJob):
         :type start: datetime.date
         :param end: end date
         :type end: datetime.date
+        :param validation_errors: list of validation errors for every day
+            (data is already validated - subtasks don't validate it again)
+        :type validation_errors: dict
         """
         days = (end - start).days + 1
         step = 100.0 / days
         total_progress = 0
         results = {}
+        if validation_errors is not None:
+            kwargs['perform_validation'] = False
         for day in rrule.rrule(rrule.DAILY, dtstart=start, until=end):
             # if day is in statuses, it was already calculated - do not check
             # it again
             if day in statuses:
                 total_progress += step
                 continue
+            day_errors = (validation_errors or {}).get(day.date())
+            if day_errors:
+                logger.error('Errors detected for day {:%Y-%m-%d}'.format(day))
+                total_progress += step
+                statuses[day] = False
+                cls._save_validation_errors(day, day_errors)
+                continue
             dcj = DailyCostsJob()
             progress, success, job, result = dcj.run_on_worker(
                 day=day, **kwargs
@@ -248,18 +281,22 @@ class MonthlyCosts(APIView, WorkerJob):
                 statuses[day] = success
             if result:
                 results[day] = result['collector_result']
-                job = get_current_job()
                 # Pass errors from sub-job(s) to master job.
-                if not job.meta.get('validation_errors'):
-                    job.meta['validation_errors'] = {}
-                job.meta['validation_errors'][day] = result['validation_errors']  # noqa: E501
-                job.save()
+                cls._save_validation_errors(day, result['validation_errors'])
         # clear cache if all done
         if len(statuses) == days:
             cls.forget_cache(start, end, **kwargs)
             total_progress = 100
         return total_progress, statuses, results
 
+    @classmethod
+    def _save_validation_errors(cls, day, errors):
+        job = get_current_job()
+        if not job.meta.get('validation_errors'):
+            job.meta['validation_errors'] = {}
+        job.meta['validation_errors'][day] = errors
+        job.save()
+
 
 class DailyCostsJob(WorkerJob):
     """
@@ -273,7 +310,7 @@ class DailyCostsJob(WorkerJob):
     _return_job_meta = True
 
     @classmethod
-    def run(cls, day, forecast):
+    def run(cls, day, forecast, perform_validation=True):
         """
         Run collecting costs for one day.
         """
@@ -281,7 +318,9 @@ class DailyCostsJob(WorkerJob):
         result = {}
         validation_errors = []
         try:
-            result = collector.process(day, forecast, perform_validation=True)
+            result = collector.process(
+                day, forecast, perform_validation=perform_validation
+            )
             success = True
         except DataForReportValidationError as e:
             logger.exception(e)
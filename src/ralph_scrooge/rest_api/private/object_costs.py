@@ -6,85 +6,119 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
-from django.conf import settings
 from django.db.models import Sum, Q
 from django.template.defaultfilters import slugify
 from rest_framework.response import Response
 
+from ralph_scrooge.rest_api.conditional import conditional_costs_response
 from ralph_scrooge.rest_api.private.components import ComponentsContent
 from ralph_scrooge.models import (
     DailyCost,
+    DailyPricingObject,
     PricingObject,
     CostDateStatus,
-    PricingObjectType,
     PRICING_OBJECT_TYPES,
 )
 
 
 class ObjectCostsContent(ComponentsContent):
-    """A view returning pricing data per pricing object"""
+    """
+    A view returning pricing data per pricing object.
+
+    Pricing objects of every type are listed in order of their ids and could
+    be paginated (separately for every type) using `limit` query param -
+    `next` of type is then the id of the last returned pricing object (or
+    null, if there are no more of them) and the next page of single type
+    could be fetched using `type` (slug) and `after` (`next` of previous page)
+    params.
+
+    Costs of pricing objects (`__nested`) of all types are fetched using
+    single grouped query. They could be omitted (`nested=0`) and fetched
+    later on demand for single pricing object (`pricing_object=<id>`).
+    Pricing objects could be filtered by columns, as in `ComponentsContent`.
+    """
 
     default_model = 'ralph_scrooge.models.PricingObject'
+    schema_setting = 'PRICING_OBJECTS_COSTS_TABLE_SCHEMA'
+    nested_schema = {k: v for k, v in enumerate(['Name', 'Value', 'Cost'])}
 
-    def get_types(self):
+    def _get_daily_costs(self, start_date, end_date, service, env=None):
         """
-        Returns Pricing Object Types defined in COMPONENTS_TABLE_SCHEMA.
+        Returns accepted (not forecast) daily costs of service (and optionally
+        environment) between start_date and end_date.
         """
-        return PricingObjectType.objects.filter(
-            name__in=settings.PRICING_OBJECTS_COSTS_TABLE_SCHEMA.keys()
-        )
-
-    def get_daily_pricing_objects(
-            self, start_date, end_date, service, env=None
-    ):
-        query = PricingObject.objects.filter(
-            daily_pricing_objects__service_environment__service__id=service,
-            daily_pricing_objects__date__gte=start_date,
-            daily_pricing_objects__date__lte=end_date,
-        )
-        if env:
-            query = query.filter(
-                daily_pricing_objects__service_environment__environment__id=env
-            )
-        query = query.distinct()
-        query_daily_cost = DailyCost.objects.filter(
-            pricing_object_id__in=query.values_list('id', flat=True),
+        query = DailyCost.objects.filter(
             forecast=False,
             date__in=CostDateStatus.objects.filter(
                 accepted=True,
                 date__gte=start_date,
                 date__lte=end_date
             ).values_list('date', flat=True),
-            service_environment__service__id=service
+            **DailyCost.get_service_filters(service, env)
+        )
+        return query
+
+    def get_pricing_objects(
+        self, single_type, fields, start_date, end_date, service, env=None,
+        after=None, limit=None, filters=None,
+    ):
+        """
+        Returns values of fields of pricing objects of single type used by
+        service (and optionally environment) between start_date and end_date
+        (see `paginate`).
+        """
+        daily_pricing_objects = DailyPricingObject.objects.filter(
+            service_environment__service__id=service,
+            date__gte=start_date,
+            date__lte=end_date,
         )
         if env:
-            query_daily_cost = query_daily_cost.filter(
-                service_environment__environment_id=env
+            daily_pricing_objects = daily_pricing_objects.filter(
+                service_environment__environment__id=env
             )
-        query_daily_cost = query_daily_cost.values_list(
+        query = PricingObject.objects.filter(
+            type=single_type,
+            id__in=daily_pricing_objects.values('pricing_object_id'),
+        )
+        return self.paginate(
+            self.filter_by_columns(query, fields, filters or {}),
+            fields,
+            after,
+            limit,
+        )
+
+    def get_nested_costs(
+        self, start_date, end_date, service, env=None, types=None,
+        pricing_objects=None,
+    ):
+        """
+        Returns costs (name of cost type, value and cost) per pricing object
+        (of one of types or one of pricing objects ids) using single query
+        grouped by pricing object and cost type.
+        """
+        query = self._get_daily_costs(start_date, end_date, service, env)
+        if types is not None:
+            query = query.filter(pricing_object__type__in=types)
+        if pricing_objects is not None:
+            query = query.filter(pricing_object_id__in=pricing_objects)
+        nested_costs = {}
+        for pricing_object_id, type_name, value, cost in query.values_list(
             'pricing_object_id', 'type__name'
-        ).annotate(Sum('value')).annotate(Sum('cost'))
-        daily_costs = {}
-        for cost in query_daily_cost:
-            daily_costs.setdefault(cost[0], []).append(cost)
-        return (query, daily_costs)
+        ).annotate(Sum('value')).annotate(Sum('cost')).order_by():
+            nested_costs.setdefault(pricing_object_id, []).append(
+                {'0': type_name, '1': value, '2': cost}
+            )
+        return nested_costs
 
-    def process_single_type(self, single_type, data):
+    def process_single_type(
+        self, single_type, headers, pricing_objects, nested_costs, next_after
+    ):
         """Appends some extra data to every row"""
-        query_pricing_object, daily_costs = data
         values = []
-        django_fields, headers = self.process_schema(
-            settings.PRICING_OBJECTS_COSTS_TABLE_SCHEMA[single_type.name]
-        )
-        django_fields.insert(0, 'id')
-        for po in query_pricing_object.filter(
-            type=single_type,
-        ).values_list(*django_fields):
+        for po in pricing_objects:
             value = {k: v for k, v in enumerate(po[1:])}
-            value['__nested'] = [
-                {str(k): v for k, v in enumerate(daily_cost[1:])}
-                for daily_cost in daily_costs.get(po[0], [])
-            ]
+            if nested_costs is not None:
+                value['__nested'] = nested_costs.get(po[0], [])
             values.append(value)
         return {
             'name': single_type.name,
@@ -92,32 +126,21 @@ class ObjectCostsContent(ComponentsContent):
             'slug': slugify(single_type.name),
             'value': values,
             'schema': headers,
-            'nested_schema': {k: v for k, v in enumerate(
-                ['Name', 'Value', 'Cost'])
-            },
+            'nested_schema': self.nested_schema,
             'color': single_type.color,
+            'next': next_after,
         }
 
     def _get_rest_of_costs(self, start_date, end_date, service, env=None):
-        query_daily_cost = DailyCost.objects.filter(
+        query_daily_cost = self._get_daily_costs(
+            start_date, end_date, service, env
+        ).filter(
             Q(pricing_object_id=None) |
             Q(pricing_object__type_id__in=[
                 PRICING_OBJECT_TYPES.UNKNOWN,
                 PRICING_OBJECT_TYPES.DUMMY
             ]),  # Dummy and unknown
-            forecast=False,
-            date__in=CostDateStatus.objects.filter(
-                accepted=True,
-                date__gte=start_date,
-                date__lte=end_date
-            ).values_list('date', flat=True),
-            service_environment__service__id=service
-        )
-        if env:
-            query_daily_cost = query_daily_cost.filter(
-                service_environment__environment_id=env
-            )
-        query_daily_cost = query_daily_cost.values_list(
+        ).values_list(
             'type__name'
         ).annotate(Sum('value')).annotate(Sum('cost'))
         daily_costs = []
@@ -133,13 +156,49 @@ class ObjectCostsContent(ComponentsContent):
         }
 
     def get(self, request, *args, **kwargs):
-        daily_pricing_objects = self.get_daily_pricing_objects(*args, **kwargs)
-        results = []
-        for single_type in self.get_types():
-            results.append(self.process_single_type(
-                single_type, daily_pricing_objects
-            ))
-        results.append(self._get_rest_of_costs(
-            *args, **kwargs
-        ))
-        return Response(results if results else [])
+        return conditional_costs_response(
+            request,
+            kwargs['start_date'],
+            kwargs['end_date'],
+            lambda: self._get_costs(request, *args, **kwargs),
+        )
+
+    def _get_costs(self, request, *args, **kwargs):
+        pricing_object = self._parse_int_param(request, 'pricing_object')
+        if pricing_object is not None:
+            return Response(self.get_nested_costs(
+                pricing_objects=[pricing_object], *args, **kwargs
+            ).get(pricing_object, []))
+
+        limit = self._parse_int_param(request, 'limit', min_value=1)
+        after = self._parse_int_param(request, 'after')
+        filters = self._parse_filters(request)
+        types = self._get_selected_types(request)
+        pages = []
+        for single_type in types:
+            fields, headers = self.get_schema(single_type)
+            pricing_objects, next_after = self.get_pricing_objects(
+                single_type, fields, after=after, limit=limit,
+                filters=filters, *args, **kwargs
+            )
+            pages.append((single_type, headers, pricing_objects, next_after))
+
+        nested_costs = None
+        if str(request.query_params.get('nested', '1')) in ('1', 'true'):
+            nested_costs = self.get_nested_costs(
+                types=types,
+                pricing_objects=[
+                    po[0] for page in pages for po in page[2]
+                ] if limit is not None else None,
+                *args, **kwargs
+            )
+        results = [
+            self.process_single_type(
+                single_type, headers, pricing_objects, nested_costs,
+                next_after,
+            )
+            for single_type, headers, pricing_objects, next_after in pages
+        ]
+        if 'type' not in request.query_params:
+            results.append(self._get_rest_of_costs(*args, **kwargs))
+        return Response(results)
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk variant of service environment costs.
+
+Instead of calculating costs of every service environment in separate
+request (which requires few queries per service environment), costs of many
+services (or service environments) are calculated at once - services,
+service environments and permissions to them are resolved with a handful of
+`__in` queries and costs of all of them are fetched using single query
+grouped by service environment (splitted into chunks if there are too many
+service environments). Response is streamed (costs are serialized service by
+service) and errors (unknown service, no permission) are reported per item of
+`services` list.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+from collections import defaultdict, OrderedDict
+
+from django.db.models import Sum
+from django.http import StreamingHttpResponse
+from rest_framework import serializers
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.serializers import Serializer
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework.views import APIView
+
+from ralph_scrooge.models import DailyCost, Service, ServiceEnvironment
+from ralph_scrooge.rest_api.public.auth import IsServiceOwner
+from ralph_scrooge.rest_api.public.v0_9.bulk_pricing_service_usages import (
+    _chunks,
+    _values_list_in,
+)
+from ralph_scrooge.rest_api.public.v0_10.service_environment_costs import (
+    CostsQueryDeserializer,
+    ServiceEnvironmentDailyCostsSerializer,
+    ServiceEnvironmentMonthlyCostsSerializer,
+    _build_cost_trees,
+    _get_filtered_dates,
+    _get_final_result,
+    _group_by_date,
+)
+from ralph_scrooge.utils.security import get_owned_services_uids
+
+PERMISSION_ERROR = 'You do not have permission to perform this action.'
+
+
+class ServiceEnvironmentKeyDeserializer(Serializer):
+    service_uid = serializers.CharField()
+    environment = serializers.CharField(required=False)
+
+
+class BulkServiceEnvironmentCostsDeserializer(CostsQueryDeserializer):
+    services = ServiceEnvironmentKeyDeserializer(many=True)
+
+    def validate_services(self, value):
+        if not value:
+            raise serializers.ValidationError('This list may not be empty.')
+        return value
+
+
+def _sum_safe(value1, value2):
+    if value1 is None:
+        return value2
+    if value2 is None:
+        return value1
+    return value1 + value2
+
+
+def fetch_costs_bulk(
+        service_environments_groups,
+        types,
+        date_from,
+        date_to,
+        group_by,
+        accepted_only=False,
+        forecast=False,
+):
+    """Equivalent of calling `fetch_costs` for every group of service
+    environments (ids) from `service_environments_groups` (ex. single service
+    environment or all environments of service), but costs of all of them are
+    fetched using single query grouped by service environment (and date,
+    path and type), which is summarized per group in Python.
+
+    Costs are fetched immediately, while results (in the same format as the
+    result of `fetch_costs`) are returned lazily (generator), in the order
+    of `service_environments_groups`.
+    """
+    filtered_dates = _get_filtered_dates(
+        date_from, date_to, accepted_only, forecast
+    )
+    groups_by_service_environment = defaultdict(list)
+    for index, group in enumerate(service_environments_groups):
+        for service_environment_id in set(group):
+            groups_by_service_environment[service_environment_id].append(
+                index
+            )
+
+    # (date, depth, path, type symbol, type name) -> [cost, value] for every
+    # group
+    aggregated_costs = [
+        defaultdict(lambda: [None, None]) for _ in service_environments_groups
+    ]
+    selector = None
+    for chunk in _chunks(groups_by_service_environment.keys()):
+        qs, selector = _group_by_date(
+            DailyCost.objects_tree.filter(
+                date__in=filtered_dates,
+                depth__lte=1,
+                forecast=forecast,
+                service_environment__in=chunk,
+            ),
+            group_by,
+        )
+        for row in qs.values(
+            'service_environment', selector, 'depth', 'path', 'type__symbol',
+            'type__name',
+        ).annotate(
+            cost_sum=Sum('cost'), value_sum=Sum('value')
+        ).order_by():
+            key = (
+                row[selector], row['depth'], row['path'], row['type__symbol'],
+                row['type__name'],
+            )
+            for index in groups_by_service_environment[
+                row['service_environment']
+            ]:
+                sums = aggregated_costs[index][key]
+                sums[0] = _sum_safe(sums[0], row['cost_sum'])
+                sums[1] = _sum_safe(sums[1], row['value_sum'])
+
+    filtered_dates = set(filtered_dates)
+
+    def get_results():
+        for group_costs in aggregated_costs:
+            rows = []
+            for key, (cost, value) in sorted(
+                group_costs.items(), key=lambda item: item[0][1]
+            ):
+                date_, depth, path, type_symbol, type_name = key
+                rows.append({
+                    selector: date_,
+                    'depth': depth,
+                    'path': path,
+                    'type__symbol': type_symbol,
+                    'type__name': type_name,
+                    'cost_sum': cost,
+                    'value_sum': value,
+                })
+            total_costs, cost_trees = _build_cost_trees(rows, selector, types)
+            yield _get_final_result(
+                total_costs,
+                cost_trees,
+                date_from,
+                date_to,
+                group_by,
+                filtered_dates,
+            )
+    return get_results()
+
+
+def _resolve_service_environments(services, owned_services_uids):
+    """Returns group of service environments ids (or error, if service
+    environment does not exist or user doesn't have permission to it) for
+    every item of `services` (dicts with `service_uid` and optional
+    `environment`). When `environment` is not given, all environments of
+    service are taken into account.
+    """
+    services_uids = set(s['service_uid'] for s in services)
+    existing_services_uids = set(
+        uid for (uid,) in _values_list_in(
+            Service.objects.all(), 'ci_uid', services_uids, 'ci_uid'
+        )
+    )
+    service_environments = {}
+    service_environments_by_service = defaultdict(list)
+    for se_id, uid, env in _values_list_in(
+        ServiceEnvironment.objects.all(),
+        'service__ci_uid',
+        services_uids,
+        'id',
+        'service__ci_uid',
+        'environment__name',
+    ):
+        service_environments[(uid, env)] = se_id
+        service_environments_by_service[uid].append(se_id)
+
+    result = []
+    for service in services:
+        service_uid = service['service_uid']
+        env = service.get('environment')
+        if service_uid not in owned_services_uids:
+            result.append((None, PERMISSION_ERROR))
+        elif not env:
+            if service_uid in existing_services_uids:
+                result.append(
+                    (service_environments_by_service[service_uid], None)
+                )
+            else:
+                result.append((None, (
+                    'service with UID "{}" does not exist.'.format(
+                        service_uid
+                    )
+                )))
+        elif (service_uid, env) in service_environments:
+            result.append(([service_environments[(service_uid, env)]], None))
+        else:
+            result.append((None, (
+                'service environment for service with UID "{}" and '
+                'environment "{}" does not exist.'.format(service_uid, env)
+            )))
+    return result
+
+
+def _stream_results(services, resolved, costs, serializer_class):
+    """Yields JSON (`{"results": [...]}`) chunk by chunk - costs (or errors)
+    of single service per chunk.
+    """
+    yield '{"results": ['
+    for index, (service, (group, error)) in enumerate(
+        zip(services, resolved)
+    ):
+        item = OrderedDict([
+            ('service_uid', service['service_uid']),
+            ('environment', service.get('environment')),
+        ])
+        if error:
+            item['errors'] = [error]
+        else:
+            item.update(serializer_class(next(costs)).data)
+        yield '{}{}'.format(
+            ',' if index else '', json.dumps(item, cls=JSONEncoder)
+        )
+    yield ']}'
+
+
+class BulkServiceEnvironmentCosts(APIView):
+    """Costs (the same as returned by `ServiceEnvironmentCosts`) of many
+    services (or service environments) at once. Every service is checked
+    (and rejected, if needed) individually - errors are returned in `errors`
+    field of particular service.
+    """
+    authentication_classes = (TokenAuthentication,)
+    permission_classes = (IsAuthenticated, IsServiceOwner)
+
+    def post(self, request, *args, **kwargs):
+        deserializer = BulkServiceEnvironmentCostsDeserializer(
+            data=request.data
+        )
+        if not deserializer.is_valid():
+            return Response(deserializer.errors, status=400)
+        services = deserializer.validated_data['services']
+        group_by = deserializer.validated_data['group_by']
+        resolved = _resolve_service_environments(
+            services,
+            get_owned_services_uids(
+                request.user, set(s['service_uid'] for s in services)
+            ),
+        )
+        costs = fetch_costs_bulk(
+            [group for group, error in resolved if not error],
+            deserializer.validated_data['types'],
+            deserializer.validated_data['date_from'],
+            deserializer.validated_data['date_to'],
+            group_by,
+            deserializer.validated_data['accepted_only'],
+            deserializer.validated_data['forecast'],
+        )
+        if group_by == 'month':
+            serializer_class = ServiceEnvironmentMonthlyCostsSerializer
+        else:
+            serializer_class = ServiceEnvironmentDailyCostsSerializer
+        return StreamingHttpResponse(
+            _stream_results(services, resolved, costs, serializer_class),
+            content_type='application/json',
+        )
@@ -6,9 +6,9 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import datetime
-from copy import deepcopy
 
 from dateutil.relativedelta import relativedelta
+from django.conf import settings
 from django.db.models import Sum
 from django.db.models.functions import TruncMonth
 from rest_framework import serializers
@@ -26,6 +26,7 @@ from ralph_scrooge.models import (
     ServiceEnvironment,
     UsageType,
 )
+from ralph_scrooge.rest_api.conditional import conditional_costs_response
 from ralph_scrooge.rest_api.public.auth import IsServiceOwner
 from ralph_scrooge.utils.cache import memoize
 
@@ -47,9 +48,8 @@ def get_valid_types():
     )
 
 
-class ServiceEnvironmentCostsDeserializer(Serializer):
-    service_uid = serializers.CharField()
-    environment = serializers.CharField(required=False)
+class CostsQueryDeserializer(Serializer):
+    """Common params of costs queries (dates range, grouping, types etc.)."""
     date_from = serializers.DateField()
     date_to = serializers.DateField()
     group_by = serializers.ChoiceField(choices=GROUP_BY_CHOICES)
@@ -82,15 +82,37 @@ class ServiceEnvironmentCostsDeserializer(Serializer):
             raise serializers.ValidationError(err)
         return types_validated
 
-    def validate(self, attrs):
-        errors = []
-
+    def _validate_query(self, attrs, errors):
         # Validate correctness of date range.
         date_from = attrs.get('date_from')
         date_to = attrs.get('date_to')
         if date_from > date_to:
             errors.append("'date_from' should be less or equal to 'date_to'")
 
+        # Since `types` field is not required, but we want some default values
+        # in case it's not provided, we have to do that here (`validate_types`
+        # will only catch `types == []` case, but not the one where this field
+        # is completely omitted).
+        if attrs.get('types') is None:
+            attrs['types'] = get_valid_types()
+
+    def validate(self, attrs):
+        errors = []
+        self._validate_query(attrs, errors)
+        if errors:
+            err_msg = '{}.'.format('; '.join(errors))
+            raise serializers.ValidationError(err_msg)
+        return attrs
+
+
+class ServiceEnvironmentCostsDeserializer(CostsQueryDeserializer):
+    service_uid = serializers.CharField()
+    environment = serializers.CharField(required=False)
+
+    def validate(self, attrs):
+        errors = []
+        self._validate_query(attrs, errors)
+
         service_uid = attrs.get('service_uid')
         env = attrs.get('environment')
         if not env:
@@ -121,13 +143,6 @@ class ServiceEnvironmentCostsDeserializer(Serializer):
             else:
                 attrs['_service_environment'] = service_env
 
-        # Since `types` field is not required, but we want some default values
-        # in case it's not provided, we have to do that here (`validate_types`
-        # will only catch `types == []` case, but not the one where this field
-        # is completely omitted).
-        if attrs.get('types') is None:
-            attrs['types'] = get_valid_types()
-
         if errors:
             err_msg = '{}.'.format('; '.join(errors))
             raise serializers.ValidationError(err_msg)
@@ -191,44 +206,6 @@ def round_safe(value, precision):
     return round(value, precision)
 
 
-def _get_total_costs(qs, date_selector):
-    """Sums `cost` fields by time period given as `date_selector` (i.e. "day",
-    "month"), in queryset given as `qs`.
-
-    Please note that "other" costs (i.e. not associated with those that are
-    selected explicitly via `type` field in HTTP request) are also taken into
-    account here (hence name "total costs")!
-    """
-    total_costs = {}
-    results = qs.filter(depth=0).values(date_selector).annotate(
-        Sum('cost')
-    ).order_by(date_selector)
-    for r in results:
-        total_costs[r[date_selector]] = r['cost__sum']
-    return total_costs
-
-
-def _round_recursive(usages_and_costs):
-    """Performs rounding of values in `cost` and `usage_value` fields. And
-    because `usages_and_costs` dict can be actually a tree (costs having
-    subcosts), it does that in a recursive manner.
-    """
-    rounded = {}
-    if usages_and_costs is not None:
-        for k, v in usages_and_costs.iteritems():
-            rounded[k] = v
-            rounded[k].update({
-                'cost': round_safe(v['cost'], USAGE_COST_NUM_DIGITS),
-                'usage_value': round_safe(
-                    v['usage_value'], USAGE_VALUE_NUM_DIGITS
-                ),
-            })
-            subcosts = v.get('subcosts')
-            if subcosts is not None:
-                rounded[k]['subcosts'] = _round_recursive(subcosts)
-    return rounded
-
-
 def fetch_costs(
         service_env,
         service,
@@ -308,18 +285,9 @@ def fetch_costs(
     and `usage_values` is controlled by `USAGE_COST_NUM_DIGITS` and
     `USAGE_VALUE_NUM_DIGITS` defined in this module.
     """
-    date_range_query_params = {
-        'date__gte': date_from,
-        'date__lte': date_to,
-    }
-    if accepted_only and forecast:
-        date_range_query_params['forecast_accepted'] = True
-    elif accepted_only:
-        date_range_query_params['accepted'] = True
-    filtered_dates = CostDateStatus.objects.filter(
-        **date_range_query_params
-    ).values_list('date', flat=True)
-
+    filtered_dates = _get_filtered_dates(
+        date_from, date_to, accepted_only, forecast
+    )
     query_params = {
         'date__in': filtered_dates,
         'depth__lte': 1,
@@ -327,26 +295,24 @@ def fetch_costs(
     }
     if service_env:
         query_params['service_environment'] = service_env
+        # narrowed by (denormalized) service to use (service, date,
+        # forecast, depth) index
+        if settings.DAILY_COST_FILTER_BY_SERVICE:
+            query_params['service'] = service_env.service_id
     elif service:
-        query_params['service_environment__service'] = service
+        query_params.update(DailyCost.get_service_filters(service.id))
     else:
         # This shouldn't happen.
         return {'service_environment_costs': []}
-    initial_qs = DailyCost.objects_tree.filter(**query_params)
-
-    if group_by == 'month':
-        selector = 'month'
-        initial_qs = initial_qs.annotate(month=TruncMonth('date'))
-    else:
-        selector = 'date'
-
-    total_costs = _get_total_costs(initial_qs, selector)
+    initial_qs, selector = _group_by_date(
+        DailyCost.objects_tree.filter(**query_params), group_by
+    )
 
     aggregated_costs = initial_qs.values(
-        selector, 'path', 'type__symbol', 'type__name'
+        selector, 'depth', 'path', 'type__symbol', 'type__name'
     ).annotate(
         cost_sum=Sum('cost'), value_sum=Sum('value')
-    )
+    ).order_by('depth')
 
     # Post-process aggregated costs, as they are in form of "raw", flat
     # records from DB, but in reality, costs and subcosts are trees, so we need
@@ -354,12 +320,60 @@ def fetch_costs(
     # single, "general" query and then post-process it in Python), because
     # otherwise, re-creating such tree structure would require at least a
     # couple of separate queries, which would have negative impact on
-    # performance.
-    cost_trees = _create_trees(aggregated_costs, selector)
-    cost_trees_ = _replace_path_with_type_symbol(cost_trees)
-    cost_trees_filtered = _filter_by_types(cost_trees_, types)
+    # performance. Total costs (of all types) are calculated from the same
+    # records.
+    total_costs, cost_trees = _build_cost_trees(
+        aggregated_costs, selector, types
+    )
+    return _get_final_result(
+        total_costs,
+        cost_trees,
+        date_from,
+        date_to,
+        group_by,
+        filtered_dates,
+    )
+
 
-    # Assembly the final result (i.e., the dict that will be returned as JSON).
+def _get_filtered_dates(date_from, date_to, accepted_only, forecast):
+    """Returns (lazy) queryset with dates (between `date_from` and `date_to`)
+    of costs that could be returned (i.e. accepted, if `accepted_only` is
+    set).
+    """
+    date_range_query_params = {
+        'date__gte': date_from,
+        'date__lte': date_to,
+    }
+    if accepted_only and forecast:
+        date_range_query_params['forecast_accepted'] = True
+    elif accepted_only:
+        date_range_query_params['accepted'] = True
+    return CostDateStatus.objects.filter(
+        **date_range_query_params
+    ).values_list('date', flat=True)
+
+
+def _group_by_date(qs, group_by):
+    """Returns `qs` (annotated with month, if needed) and name of the field
+    which should be used to group costs by `group_by` period.
+    """
+    if group_by == 'month':
+        return qs.annotate(month=TruncMonth('date')), 'month'
+    return qs, 'date'
+
+
+def _get_final_result(
+        total_costs,
+        cost_trees,
+        date_from,
+        date_to,
+        group_by,
+        filtered_dates,
+):
+    """Assembly the final result (i.e., the dict that will be returned as
+    JSON) of `fetch_costs` from total costs and cost trees (see
+    `_build_cost_trees`) for every day/month.
+    """
     final_result = {
         'service_environment_costs': []
     }
@@ -397,43 +411,45 @@ def fetch_costs(
             'total_cost': round_safe(
                 total_cost_for_date, USAGE_COST_NUM_DIGITS
             ),
-            'costs': _round_recursive(cost_trees_filtered.get(date_, {})),
+            'costs': cost_trees.get(date_, {}),
         }
         final_result['service_environment_costs'].append(costs_for_date)
     return final_result
 
 
-def _create_trees(aggregated_costs, date_selector):
-    """From `aggregated_costs`, where each record (`ac`) has the following
-    (flat) structure:
+def _build_cost_trees(aggregated_costs, date_selector, types):
+    """Build cost trees (and total costs) for every date in a single pass over
+    `aggregated_costs`, where each record (`ac`) has the following (flat)
+    structure:
 
-    date (as `date` or `month` - depending on `date_selector`, which may be
-        "day" or "month" - in the former case it will be `date`, and `month`
-        in the latter), e.g. datetime.datetime(2016, 10, 7, 0, 0)
+    date (as `date` or `month` - depending on `date_selector`), e.g.
+        datetime.date(2016, 10, 7)
+    depth (as `depth`), e.g. 1
     path (as `path`), e.g. '484/483'
     base usage type symbol (as `type__symbol`), e.g. 'subtype2'
+    base usage type name (as `type__name`), e.g. 'Subtype 2'
     cost (as `cost_sum`), e.g. Decimal('222.00')
     usage value (as `value_sum`), e.g. 2.0
 
-    ...create a dict `cost_trees`, where each entry is a tree with the
-    following form:
+    Records have to be ordered by depth (all parent costs have to be
+    processed before any subcosts). Returns a tuple of dicts - total costs
+    (sum of costs with depth 0, regardless of their types) and cost trees
+    for every date, where each tree has the following form (only top-level
+    costs of `types` are included, costs and values are rounded):
 
     datetime.date(2016, 10, 7): {
-        '484': {
-            '_type_symbol': 'type1',
-            'cost': Decimal('333.00'),
+        'type1': {
+            'cost': 333.0,
             'usage_value': 0.0,
             'type': 'Type 1',
-            'subcosts': {  #  subcosts are optional
-                '484/482': {
-                    '_type_symbol': 'subtype1',
-                    'cost': Decimal('111.00'),
+            'subcosts': {
+                'subtype1': {
+                    'cost': 111.0,
                     'usage_value': 1.0,
                     'type': 'Subtype 1'
                 },
-                '484/483': {
-                    '_type_symbol': 'subtype2',
-                    'cost': Decimal('222.00'),
+                'subtype2': {
+                    'cost': 222.0,
                     'usage_value': 2.0,
                     'type': 'Subtype 2'
                 }
@@ -444,84 +460,44 @@ def _create_trees(aggregated_costs, date_selector):
     The pairing between costs and subcosts is done via the `path` component
     (e.g. a cost with '484/483' is a subcost of '484').
     """
+    types_symbols = set(t.symbol for t in types)
+    total_costs = {}
     cost_trees = {}
-    # We need to process all parent costs before processing any subcosts -
-    # hence order by `depth` here.
-    for ac in aggregated_costs.order_by('depth'):
+    # (date, path) -> subcosts of (selected) top-level cost
+    subcosts_by_path = {}
+    for ac in aggregated_costs:
         date_ = ac[date_selector]
-        d = {
-            ac['path']: {
-                # `_type_symbol` is just a temporary key, that is removed later
-                # in the process, so anyone dealing with this code shouldn't
-                # rely on it (hence it starts with `_`).
-                '_type_symbol': ac['type__symbol'],
-                'cost': ac['cost_sum'],
-                'usage_value': ac['value_sum'],
+        if ac['depth'] == 0:
+            total_costs[date_] = total_costs.get(date_, 0) + (
+                ac['cost_sum'] or 0
+            )
+            if ac['type__symbol'] not in types_symbols:
+                continue
+            subcosts = {}
+            subcosts_by_path[(date_, ac['path'])] = subcosts
+            cost_trees.setdefault(date_, {})[ac['type__symbol']] = {
+                'cost': round_safe(ac['cost_sum'], USAGE_COST_NUM_DIGITS),
+                'usage_value': round_safe(
+                    ac['value_sum'], USAGE_VALUE_NUM_DIGITS
+                ),
                 'type': ac['type__name'],
+                'subcosts': subcosts,
             }
-        }
-        if "/" in ac['path']:
-            parent = ac['path'].split("/")[0]
-            if cost_trees[date_].get(parent) is None:
-                cost_trees[date_][parent] = {'subcosts': d}
-            else:
-                if cost_trees[date_][parent].get('subcosts') is None:
-                    cost_trees[date_][parent]['subcosts'] = d
-                else:
-                    cost_trees[date_][parent]['subcosts'].update(d)
-        else:
-            d[ac['path']].update({'subcosts': {}})
-            if cost_trees.get(date_) is None:
-                cost_trees[date_] = d
-            else:
-                cost_trees[date_].update(d)
-    return cost_trees
-
-
-def _replace_path_with_type_symbol(cost_trees):
-    """Having a dict with cost trees (for the description of its structure
-    see `_create_trees` function`), replace `path` components (e.g. '484',
-    '484/482', '484/483') with the contents of the `_type_symbol` field and
-    finally remove that field.
-    So in the case described in `create_trees`, '484' will become 'type1',
-    '484/482' will become 'subtype1' and '484/483' will be 'subtype2'.
-    """
-    cost_trees_ = {}
-    tmp_dict = {}
-    for k, v in cost_trees.items():
-        if k == 'subcosts':
-            for kk, vv in v.items():
-                type_symbol = vv.pop('_type_symbol')
-                d = {type_symbol: vv}
-                if tmp_dict.get(k) is not None:
-                    tmp_dict[k].update(d)
-                else:
-                    tmp_dict[k] = d
-        elif type(v) == dict:
-            for kk, vv in v.items():
-                type_symbol = vv.pop('_type_symbol')
-                d = {type_symbol: _replace_path_with_type_symbol(vv)}
-                if cost_trees_.get(k) is not None:
-                    cost_trees_[k].update(d)
-                else:
-                    cost_trees_[k] = d
         else:
-            tmp_dict[k] = v
-    cost_trees_.update(tmp_dict)
-    return cost_trees_
-
-
-def _filter_by_types(cost_trees, types):
-    """Makes a copy of `cost_trees` and filters out top-level costs from it
-    if their types are not in `types`.
-    """
-    cost_trees_ = deepcopy(cost_trees)
-    types_ = [t.symbol for t in types]
-    for date_, parent_cost in cost_trees_.iteritems():
-        for type_ in parent_cost.keys():
-            if type_ not in types_:
-                del parent_cost[type_]
-    return cost_trees_
+            subcosts = subcosts_by_path.get(
+                (date_, ac['path'].split(DailyCost._path_link, 1)[0])
+            )
+            # parent cost is not of selected types
+            if subcosts is None:
+                continue
+            subcosts[ac['type__symbol']] = {
+                'cost': round_safe(ac['cost_sum'], USAGE_COST_NUM_DIGITS),
+                'usage_value': round_safe(
+                    ac['value_sum'], USAGE_VALUE_NUM_DIGITS
+                ),
+                'type': ac['type__name'],
+            }
+    return total_costs, cost_trees
 
 
 class ServiceEnvironmentCosts(APIView):
@@ -540,22 +516,24 @@ class ServiceEnvironmentCosts(APIView):
             accepted_only = deserializer.validated_data['accepted_only']
             forecast = deserializer.validated_data['forecast']
 
-            costs = fetch_costs(
-                service_env,
-                service,
-                types,
-                date_from,
-                date_to,
-                group_by,
-                accepted_only,
-                forecast,
-            )
-            if group_by == 'day':
-                return Response(
-                    ServiceEnvironmentDailyCostsSerializer(costs).data
-                )
-            elif group_by == 'month':
-                return Response(
-                    ServiceEnvironmentMonthlyCostsSerializer(costs).data
+            def get_response():
+                costs = fetch_costs(
+                    service_env,
+                    service,
+                    types,
+                    date_from,
+                    date_to,
+                    group_by,
+                    accepted_only,
+                    forecast,
                 )
+                if group_by == 'month':
+                    serializer_class = ServiceEnvironmentMonthlyCostsSerializer
+                else:
+                    serializer_class = ServiceEnvironmentDailyCostsSerializer
+                return Response(serializer_class(costs).data)
+
+            return conditional_costs_response(
+                request, date_from, date_to, get_response
+            )
         return Response(deserializer.errors, status=400)
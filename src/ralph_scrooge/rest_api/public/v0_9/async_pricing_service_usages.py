@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Asynchronous variant of pricing service usages upload.
+
+Uploaded payload is saved (as UsagesUpload) and processed (validation, save
+and costs recalculation) on RQ worker. Client receives id of the upload,
+which could be used to check its status. Uploading the same payload again
+while the previous upload is still queued or running (ex. when client is
+retrying after timeout) doesn't create new job - status of that upload is
+returned instead (uploads in progress are unique by payload hash, so it holds
+for concurrent uploads too). Once processed (or failed), the payload is
+processed once again when uploaded, so the latest upload always wins.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import hashlib
+import json
+import logging
+
+from django.core.urlresolvers import reverse
+from django.db import IntegrityError, transaction
+from rest_framework import status
+from rest_framework.decorators import (
+    api_view,
+    authentication_classes,
+    permission_classes,
+)
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rq.exceptions import NoSuchJobError
+
+from ralph_scrooge.models import UsagesUpload, UsagesUploadStatus
+from ralph_scrooge.rest_api.public.auth import TastyPieLikeTokenAuthentication
+from ralph_scrooge.rest_api.public.v0_9.bulk_pricing_service_usages import (
+    BulkPricingServiceUsageDeserializer,
+    BulkUsagesLoader,
+)
+from ralph_scrooge.rest_api.public.v0_9.pricing_service_usages import (
+    _recalculate_costs,
+)
+from ralph_scrooge.utils.common import get_cache_name, get_queue_name
+from ralph_scrooge.utils.usage_anomalies import refresh_usage_anomaly_stats
+from ralph_scrooge.utils.worker_job import WorkerJob
+
+logger = logging.getLogger(__name__)
+
+
+def get_payload_hash(payload):
+    """
+    Returns hash of (JSON-serializable) payload - the same for payloads with
+    the same content (regardless of the order of keys).
+    """
+    return hashlib.sha256(
+        json.dumps(payload, sort_keys=True, separators=(',', ':'))
+    ).hexdigest()
+
+
+def _set_status(upload, upload_status, result=None):
+    upload.status = upload_status.id
+    if result is not None:
+        upload.result = json.dumps(result)
+    upload.save()
+
+
+class UsagesUploadJob(WorkerJob):
+    """
+    Process (validate, save and recalculate costs) uploaded usages on worker.
+    """
+    queue_name = get_queue_name('scrooge_usages', 'default')
+    cache_name = get_cache_name('scrooge_usages', 'default')
+    cache_section = 'scrooge_usages'
+    _return_job_meta = True
+
+    @classmethod
+    def run(cls, upload_id, **kwargs):
+        upload = UsagesUpload.objects.get(id=upload_id)
+        _set_status(upload, UsagesUploadStatus.running)
+        yield 10, None
+        deserializer = BulkPricingServiceUsageDeserializer(
+            data=json.loads(upload.payload)
+        )
+        result = {}
+        upload_status = UsagesUploadStatus.failed
+        try:
+            if not deserializer.is_valid():
+                result['errors'] = deserializer.errors
+            else:
+                ps_usage = deserializer.validated_data
+                loader = BulkUsagesLoader(ps_usage)
+                if not loader.validate():
+                    result['errors'] = {'usages': loader.errors}
+                else:
+                    yield 30, None
+                    with transaction.atomic():
+                        result['saved'] = loader.save()
+                        result['ignored'] = loader.ignored
+                        yield 50, None
+                        _recalculate_costs(
+                            ps_usage['pricing_service'], ps_usage['date']
+                        )
+                    upload_status = UsagesUploadStatus.finished
+                    refresh_usage_anomaly_stats(
+                        loader.date, loader.usage_types_ids
+                    )
+        except Exception as e:
+            logger.exception(e)
+            result['errors'] = {'non_field_errors': [str(e)]}
+        _set_status(upload, upload_status, result)
+        yield 100, result
+
+
+def _get_status_response(upload, **kwargs):
+    response = {
+        'id': upload.id,
+        'status': UsagesUploadStatus.from_id(upload.status).name,
+        'status_url': reverse(
+            'pricing_service_usages_upload_status_v10',
+            kwargs={'upload_id': upload.id}
+        ),
+        'result': json.loads(upload.result) if upload.result else None,
+    }
+    return Response(response, **kwargs)
+
+
+def _get_or_create_upload(payload_hash, payload):
+    """
+    Returns upload of payload (with payload_hash) which is in progress or
+    creates new one (if there is no such upload) - with flag if it was
+    created.
+
+    There is no check before creating the upload - when identical upload is
+    in progress (even if it's created concurrently), unique `in_flight_hash`
+    is violated and that upload is returned instead.
+    """
+    while True:
+        try:
+            with transaction.atomic():
+                return UsagesUpload.objects.create(
+                    payload_hash=payload_hash,
+                    payload=json.dumps(payload),
+                ), True
+        except IntegrityError:
+            upload = UsagesUpload.objects.filter(
+                in_flight_hash=payload_hash
+            ).first()
+            # otherwise the upload was finished in the meantime
+            if upload is not None:
+                return upload, False
+
+
+@api_view(['POST'])
+@authentication_classes((TastyPieLikeTokenAuthentication,))
+@permission_classes((IsAuthenticated,))
+def create_pricing_service_usages_async(request, *args, **kwargs):
+    """
+    Save usages (the same data as for `create_pricing_service_usages`) to
+    process them asynchronously. Returns id of the upload (and url to check
+    its status).
+    """
+    payload_hash = get_payload_hash(request.data)
+    upload, created = _get_or_create_upload(payload_hash, request.data)
+    if not created:
+        logger.info('Usages upload {} is already in progress ({})'.format(
+            upload.id, payload_hash
+        ))
+        return _get_status_response(upload, status=status.HTTP_200_OK)
+
+    # make sure that (possibly stale) cached result of a previous job for
+    # upload with the same id (ex. after database reset) is not returned
+    # instead of running a new job
+    UsagesUploadJob._clear_cache(upload_id=upload.id)
+    job = UsagesUploadJob().run_on_worker(upload_id=upload.id)[2]
+    # with dummy cache job is run inline and there is no RQ job (upload is
+    # already finished or failed then)
+    if job:
+        UsagesUpload.objects.filter(id=upload.id).update(job_id=job.id)
+    upload.refresh_from_db()
+    return _get_status_response(upload, status=status.HTTP_202_ACCEPTED)
+
+
+@api_view(['GET'])
+@authentication_classes((TastyPieLikeTokenAuthentication,))
+@permission_classes((IsAuthenticated,))
+def pricing_service_usages_upload_status(request, upload_id, *args, **kwargs):
+    try:
+        upload = UsagesUpload.objects.get(id=upload_id)
+    except UsagesUpload.DoesNotExist:
+        return Response(
+            {'error': 'Upload with ID {} does not exist.'.format(upload_id)},
+            status=status.HTTP_404_NOT_FOUND,
+        )
+    if upload.job_id and upload.status in (
+        UsagesUploadStatus.queued.id, UsagesUploadStatus.running.id
+    ):
+        # check if job wasn't killed (ex. with worker)
+        try:
+            job = UsagesUploadJob().get_rq_job(upload.job_id)
+        except NoSuchJobError:
+            job = None
+        if job is None or job.is_failed:
+            _set_status(upload, UsagesUploadStatus.failed, {
+                'errors': {'non_field_errors': ['Job failed']}
+            })
+    return _get_status_response(upload)
@@ -0,0 +1,495 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk variant of pricing service usages upload.
+
+Instead of validating (and saving) every usage separately (which requires
+few queries per usage), all symbols, pricing objects and service
+environments used in uploaded usages are collected first and resolved with
+a handful of `__in` queries. Missing daily pricing objects are created in
+bulk as well. Errors are reported per row (item of `usages` list).
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import logging
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection, transaction
+from rest_framework import serializers, status
+from rest_framework.decorators import (
+    api_view,
+    authentication_classes,
+    permission_classes,
+)
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.serializers import Serializer
+
+from ralph_scrooge.models import (
+    DailyPricingObject,
+    DailyUsage,
+    PRICING_OBJECT_TYPES,
+    PricingObject,
+    PricingService,
+    ServiceEnvironment,
+    UsageType,
+)
+from ralph_scrooge.rest_api.public.auth import TastyPieLikeTokenAuthentication
+from ralph_scrooge.rest_api.public.v0_9.pricing_service_usages import (
+    UsagesDeserializer,
+    _recalculate_costs,
+    remove_previous_daily_usages,
+)
+from ralph_scrooge.utils.usage_anomalies import refresh_usage_anomaly_stats
+
+logger = logging.getLogger(__name__)
+
+# max number of params passed to single `__in` query (SQLite limits number of
+# variables in single query to 999)
+IN_QUERY_CHUNK_SIZE = 500
+SERVICE_FIELDS = ('service', 'service_id', 'service_uid')
+DAILY_USAGE_COLUMNS = (
+    'date',
+    'service_environment',
+    'daily_pricing_object',
+    'value',
+    'type',
+    'remarks',
+    'warehouse',
+)
+
+
+def _chunks(values, size=IN_QUERY_CHUNK_SIZE):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def _values_list_in(queryset, field, values, *fields):
+    """
+    Returns values_list (with passed fields) of queryset filtered by
+    `field__in=values`. Query is splitted into chunks if there is too many
+    values.
+    """
+    for chunk in _chunks(values):
+        for row in queryset.filter(
+            **{'{}__in'.format(field): chunk}
+        ).values_list(*fields):
+            yield row
+
+
+class BulkPricingServiceUsageDeserializer(Serializer):
+    """
+    Validates only "outer" part of uploaded pricing service usage - rows
+    (`usages`) are validated in bulk by `BulkUsagesLoader`.
+    """
+    pricing_service = serializers.CharField(required=True)
+    date = serializers.DateField(required=True)
+    overwrite = serializers.ChoiceField(
+        choices=('no', 'delete_all_previous', 'values_only'),
+        required=False,
+        default='no',
+    )
+    ignore_unknown_services = serializers.BooleanField(
+        required=False, default=False
+    )
+    usages = serializers.ListField(required=True)
+
+    def validate_usages(self, value):
+        if not value:
+            raise serializers.ValidationError("This field cannot be empty.")
+        return value
+
+    def validate_pricing_service(self, value):
+        if not PricingService.objects.filter(name=value).exists():
+            raise serializers.ValidationError(
+                "Unknown service name: {}".format(value)
+            )
+        return value
+
+
+class BulkUsagesLoader(object):
+    """
+    Validates and saves usages (rows) of pricing service usage in bulk.
+
+    Usage:
+        loader = BulkUsagesLoader(validated_data)
+        if loader.validate():
+            loader.save()
+        else:
+            errors = loader.errors  # list of {'row': <index>, 'errors': []}
+    """
+    def __init__(self, pricing_service_usage):
+        self.pricing_service_usage = pricing_service_usage
+        self.date = pricing_service_usage['date']
+        self.rows = pricing_service_usage['usages']
+        self.ignore_unknown_services = pricing_service_usage.get(
+            'ignore_unknown_services', False
+        )
+        self.errors = []
+        self.ignored = []
+        # (row index, pricing object id, [(usage type id, value, remarks)])
+        self._resolved_rows = []
+
+    @property
+    def usage_types_ids(self):
+        """
+        Ids of usage types of (validated) usages.
+        """
+        return set(
+            usage[0] for r in self._resolved_rows for usage in r[2]
+        )
+
+    def _add_error(self, row_index, errors):
+        self.errors.append({'row': row_index, 'errors': errors})
+
+    def _parse_usages(self, usages, errors):
+        """
+        Validate inner usages of single row. Returns list of
+        (symbol, value, remarks).
+        """
+        if not isinstance(usages, list) or not usages:
+            errors.append('usages: This field cannot be empty.')
+            return []
+        result = []
+        for usage in usages:
+            if not isinstance(usage, dict) or not usage.get('symbol'):
+                errors.append('usages: symbol is required')
+                continue
+            try:
+                value = float(usage.get('value'))
+            except (TypeError, ValueError):
+                errors.append('usages: invalid value for symbol "{}"'.format(
+                    usage['symbol']
+                ))
+                continue
+            result.append((
+                usage['symbol'], value, usage.get('remarks') or ''
+            ))
+        return result
+
+    def _get_service_key(self, row):
+        """
+        Returns (service field, service value, environment name) used to
+        find service environment for row.
+        """
+        for field in SERVICE_FIELDS:
+            if row.get(field):
+                return (field, row[field], row.get('environment'))
+        return ('service', None, row.get('environment'))
+
+    def _resolve_usage_types(self, symbols):
+        return dict(_values_list_in(
+            UsageType.objects_admin, 'symbol', symbols, 'symbol', 'id'
+        ))
+
+    def _resolve_pricing_objects(self, names):
+        result = defaultdict(list)
+        for name, po_id in _values_list_in(
+            PricingObject.objects.all(), 'name', names, 'name', 'id'
+        ):
+            result[name].append(po_id)
+        return result
+
+    def _resolve_service_environments(self, keys):
+        """
+        Returns dict with list of ids of service environments for every
+        (service field, service value, environment name) key.
+        """
+        lookups = {
+            'service': 'service__name',
+            'service_id': 'service_id',
+            'service_uid': 'service__ci_uid',
+        }
+        keys_by_field = defaultdict(set)
+        for key in keys:
+            keys_by_field[key[0]].add(key)
+        result = defaultdict(list)
+        for field, field_keys in keys_by_field.items():
+            environments = set(k[2] for k in field_keys)
+            queryset = ServiceEnvironment.objects.filter(
+                environment__name__in=environments
+            )
+            for service_value, env_name, se_id in _values_list_in(
+                queryset,
+                lookups[field],
+                set(k[1] for k in field_keys),
+                lookups[field],
+                'environment__name',
+                'id',
+            ):
+                if field == 'service_id':
+                    # service_id could be passed as string
+                    keys_to_check = [(field, service_value, env_name), (
+                        field, '{}'.format(service_value), env_name
+                    )]
+                else:
+                    keys_to_check = [(field, service_value, env_name)]
+                for key in keys_to_check:
+                    if key in field_keys:
+                        result[key].append(se_id)
+        return result
+
+    def _get_dummy_pricing_objects(self, service_environments_ids):
+        """
+        Returns dummy pricing object id for every passed service environment
+        (missing dummy pricing objects are created).
+        """
+        result = dict(_values_list_in(
+            PricingObject.objects.filter(type_id=PRICING_OBJECT_TYPES.DUMMY),
+            'service_environment_id',
+            service_environments_ids,
+            'service_environment_id',
+            'id',
+        ))
+        for se in ServiceEnvironment.objects.filter(
+            id__in=set(service_environments_ids) - set(result)
+        ):
+            result[se.id] = se.dummy_pricing_object.id
+        return result
+
+    def validate(self):
+        """
+        Validate all rows and resolve symbols, pricing objects and service
+        environments. Returns True if there are no errors.
+        """
+        parsed_rows = []
+        symbols = set()
+        pricing_objects_names = set()
+        services_keys = set()
+        for index, row in enumerate(self.rows):
+            errors = []
+            if not isinstance(row, dict):
+                self._add_error(index, ['Invalid data.'])
+                continue
+            usages = self._parse_usages(row.get('usages'), errors)
+            try:
+                UsagesDeserializer.check_fields_combination(row)
+            except serializers.ValidationError as e:
+                errors.extend(e.detail)
+            if errors:
+                self._add_error(index, errors)
+                continue
+            symbols.update(u[0] for u in usages)
+            if row.get('pricing_object'):
+                pricing_objects_names.add(row['pricing_object'])
+                key = None
+            else:
+                key = self._get_service_key(row)
+                services_keys.add(key)
+            parsed_rows.append((index, row, key, usages))
+
+        usage_types = self._resolve_usage_types(symbols)
+        pricing_objects = self._resolve_pricing_objects(pricing_objects_names)
+        service_environments = self._resolve_service_environments(
+            services_keys
+        )
+        dummy_pricing_objects = self._get_dummy_pricing_objects(set(
+            se_ids[0] for se_ids in service_environments.values()
+            if len(se_ids) == 1
+        ))
+
+        for index, row, key, usages in parsed_rows:
+            errors = [
+                'usage type for symbol "{}" does not exist'.format(symbol)
+                for symbol in sorted(set(
+                    u[0] for u in usages if u[0] not in usage_types
+                ))
+            ]
+            pricing_object_id = None
+            if key is None:
+                po_ids = pricing_objects.get(row['pricing_object'], [])
+                if len(po_ids) == 1:
+                    pricing_object_id = po_ids[0]
+                else:
+                    errors.append('pricing_object {} {}'.format(
+                        row['pricing_object'],
+                        'is ambiguous' if po_ids else 'does not exist',
+                    ))
+            else:
+                se_ids = service_environments.get(key, [])
+                if len(se_ids) == 1:
+                    pricing_object_id = dummy_pricing_objects[se_ids[0]]
+                else:
+                    error = (
+                        "service environment does not exist ({}={}, "
+                        "environment={})" if not se_ids else
+                        "multiple service environments returned, while "
+                        "there should be only one ({}={}, environment={})"
+                    ).format(*key)
+                    # rows with unknown symbols are never ignored (as in
+                    # `create_pricing_service_usages`)
+                    if self.ignore_unknown_services and not errors:
+                        self.ignored.append({'row': index, 'error': error})
+                        continue
+                    errors.append(error)
+            if errors:
+                self._add_error(index, errors)
+                continue
+            self._resolved_rows.append((index, pricing_object_id, [
+                (usage_types[symbol], value, remarks)
+                for symbol, value, remarks in usages
+            ]))
+        self.errors.sort(key=lambda e: e['row'])
+        return not self.errors
+
+    def _get_daily_pricing_objects(self, pricing_objects_ids):
+        """
+        Returns dict with (daily pricing object id, service environment id)
+        for every pricing object. Missing daily pricing objects are created
+        (in bulk, if possible).
+        """
+        def fetch(ids):
+            return {
+                po_id: (dpo_id, se_id)
+                for po_id, dpo_id, se_id in _values_list_in(
+                    DailyPricingObject.objects.filter(date=self.date),
+                    'pricing_object_id',
+                    ids,
+                    'pricing_object_id',
+                    'id',
+                    'service_environment_id',
+                )
+            }
+        result = fetch(pricing_objects_ids)
+        missing = set(pricing_objects_ids) - set(result)
+        if not missing:
+            return result
+        # pricing objects with details (ex. assets) have their own daily
+        # pricing objects (with details too) - they have to be created
+        # separately
+        for model in _get_pricing_objects_models_with_details():
+            for chunk in _chunks(missing):
+                for obj in model.objects.filter(id__in=chunk):
+                    obj.get_daily_pricing_object(self.date)
+                    missing.discard(obj.id)
+        DailyPricingObject.objects.bulk_create([
+            DailyPricingObject(
+                date=self.date,
+                pricing_object_id=po_id,
+                service_environment_id=se_id,
+            ) for po_id, se_id in _values_list_in(
+                PricingObject.objects.all(),
+                'id',
+                missing,
+                'id',
+                'service_environment_id',
+            )
+        ], batch_size=_get_batch_size(DailyPricingObject))
+        result.update(fetch(set(pricing_objects_ids) - set(result)))
+        return result
+
+    @transaction.atomic
+    def save(self):
+        """
+        Save validated usages (previous usages are removed first, according
+        to `overwrite` option). Returns number of saved usages.
+        """
+        daily_pricing_objects = self._get_daily_pricing_objects(
+            set(r[1] for r in self._resolved_rows)
+        )
+        date = connection.ops.adapt_datefield_value(self.date)
+        warehouse_id = DailyUsage._meta.get_field('warehouse').get_default()
+        daily_usages = []
+        usages_daily_pricing_objects = defaultdict(list)
+        for index, pricing_object_id, usages in self._resolved_rows:
+            dpo_id, se_id = daily_pricing_objects[pricing_object_id]
+            for usage_type_id, value, remarks in usages:
+                daily_usages.append((
+                    date, se_id, dpo_id, value, usage_type_id, remarks,
+                    warehouse_id,
+                ))
+                usages_daily_pricing_objects[usage_type_id].append(dpo_id)
+        remove_previous_daily_usages(
+            self.pricing_service_usage.get('overwrite', 'no'),
+            self.date,
+            usages_daily_pricing_objects,
+        )
+        _insert_daily_usages(daily_usages)
+        return len(daily_usages)
+
+
+def _insert_daily_usages(daily_usages):
+    """
+    Insert daily usages (tuples with values of DAILY_USAGE_COLUMNS) using
+    plain INSERT (executemany) - it's much faster than `bulk_create`, which
+    requires model instance (and preparing every value of it) for each row.
+    """
+    qn = connection.ops.quote_name
+    sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+        qn(DailyUsage._meta.db_table),
+        ', '.join(
+            qn(DailyUsage._meta.get_field(f).column)
+            for f in DAILY_USAGE_COLUMNS
+        ),
+        ', '.join(['%s'] * len(DAILY_USAGE_COLUMNS)),
+    )
+    cursor = connection.cursor()
+    for chunk in _chunks(
+        daily_usages, settings.DAILY_USAGE_CREATE_BATCH_SIZE
+    ):
+        cursor.executemany(sql, chunk)
+
+
+def _get_batch_size(model):
+    """
+    Returns batch size for bulk create - DAILY_USAGE_CREATE_BATCH_SIZE limited
+    by database backend (ex. SQLite limit of variables per query).
+    """
+    return min(
+        settings.DAILY_USAGE_CREATE_BATCH_SIZE,
+        max(connection.ops.bulk_batch_size(
+            [f for f in model._meta.concrete_fields if not f.primary_key], []
+        ), 1)
+    )
+
+
+def _get_pricing_objects_models_with_details():
+    """
+    Returns subclasses of PricingObject, which are creating their own daily
+    pricing objects.
+    """
+    result = []
+    subclasses = list(PricingObject.__subclasses__())
+    while subclasses:
+        model = subclasses.pop()
+        subclasses.extend(model.__subclasses__())
+        if (
+            model.get_daily_pricing_object.__func__ is not
+            PricingObject.get_daily_pricing_object.__func__
+        ):
+            result.append(model)
+    return result
+
+
+@api_view(['POST'])
+@authentication_classes((TastyPieLikeTokenAuthentication,))
+@permission_classes((IsAuthenticated,))
+def create_pricing_service_usages_bulk(request, *args, **kwargs):
+    """
+    Bulk variant of `create_pricing_service_usages` (accepts the same data).
+    Invalid rows are reported as a list of
+    `{"row": <index in usages>, "errors": [...]}` - nothing is saved then.
+    """
+    deserializer = BulkPricingServiceUsageDeserializer(data=request.data)
+    if not deserializer.is_valid():
+        return Response(
+            deserializer.errors, status=status.HTTP_400_BAD_REQUEST
+        )
+    ps_usage = deserializer.validated_data
+    loader = BulkUsagesLoader(ps_usage)
+    if not loader.validate():
+        return Response(
+            {'usages': loader.errors}, status=status.HTTP_400_BAD_REQUEST
+        )
+    with transaction.atomic():
+        saved = loader.save()
+        _recalculate_costs(ps_usage['pricing_service'], ps_usage['date'])
+    refresh_usage_anomaly_stats(loader.date, loader.usage_types_ids)
+    return Response(
+        {'saved': saved, 'ignored': loader.ignored},
+        status=status.HTTP_201_CREATED,
+    )
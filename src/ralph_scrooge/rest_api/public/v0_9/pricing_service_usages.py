@@ -5,13 +5,14 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import json
 import logging
 from collections import defaultdict
 from datetime import datetime
 
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import transaction
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from rest_framework import status
 from rest_framework import serializers
 from rest_framework.decorators import (
@@ -26,7 +27,6 @@ from rest_framework.serializers import Serializer
 from ralph_scrooge.models import (
     CostDateStatus,
     DailyUsage,
-    PRICING_OBJECT_TYPES,
     PricingObject,
     PricingService,
     PricingServicePlugin,
@@ -36,6 +36,11 @@ from ralph_scrooge.models import (
 )
 from ralph_scrooge.plugins.cost.collector import Collector
 from ralph_scrooge.rest_api.public.auth import TastyPieLikeTokenAuthentication
+from ralph_scrooge.utils.daily_usages import (
+    delete_daily_usages,
+    delete_daily_usages_by_keys,
+)
+from ralph_scrooge.utils.usage_anomalies import refresh_usage_anomaly_stats
 
 logger = logging.getLogger(__name__)
 
@@ -43,6 +48,9 @@ logger = logging.getLogger(__name__)
 # `ignore_unknown_services` is set to true
 IGNORE_USAGE_PRICING_OBJECT = object()
 
+# number of daily pricing objects which usages are fetched at once
+USAGES_CHUNK_SIZE = 1000
+
 
 # TODO(xor-xor): Consider some better naming for dicts in this hierarchy:
 # pricing_service_usage -> usages -> usage
@@ -157,14 +165,18 @@ class UsagesDeserializer(UsagesSerializer):
                 raise serializers.ValidationError(msg)
         return value
 
-    def validate(self, attrs):
+    @staticmethod
+    def check_fields_combination(attrs):
+        """
+        Raises ValidationError if attrs contain invalid combination of
+        fields (of pricing object, service and environment).
+        """
         pricing_obj = attrs.get('pricing_object')
         service = attrs.get('service')
         service_id = attrs.get('service_id')
         service_uid = attrs.get('service_uid')
         env = attrs.get('environment')
         err = None
-        # check for the invalid combinations of fields
         if pricing_obj and any((service, service_id, service_uid, env)):
             err = (
                 "pricing_object shouldn't be used with any of: service, "
@@ -185,6 +197,11 @@ class UsagesDeserializer(UsagesSerializer):
             msg = "Invalid combination of fields: {}.".format(err)
             raise serializers.ValidationError(msg)
 
+    def validate(self, attrs):
+        # check for the invalid combinations of fields
+        self.check_fields_combination(attrs)
+        pricing_obj = attrs.get('pricing_object')
+
         # If we don't have pricing_object now, we can get it indirectly by
         # fetching proper service environment and then dummy pricing object
         # that is associated with it.
@@ -305,6 +322,20 @@ class PricingServiceUsageDeserializer(PricingServiceUsageSerializer):
 def list_pricing_service_usages(
         request, usages_date, pricing_service_id, *args, **kwargs
 ):
+    """
+    Returns usages of pricing service for given day.
+
+    Supported (optional) query params:
+    * `service_uid` - return only usages of given service
+    * `limit` - return at most `limit` pricing objects (with all of their
+      usages); response contains additionally `next` key with cursor for
+      the next page (or null if it's the last one)
+    * `after` - cursor (returned previously in `next`) - return only pricing
+      objects after it
+    * `stream` - if set (ex. `stream=1`), usages are streamed as
+      newline-delimited JSON (one pricing object per line) instead of
+      building single JSON document
+    """
     err_msg = None
     service = None
     try:
@@ -334,75 +365,161 @@ def list_pricing_service_usages(
             .format(usages_date)
         )
 
+    pagination = {}
+    for param in ('limit', 'after'):
+        value = request.GET.get(param)
+        if value is None:
+            continue
+        try:
+            pagination[param] = int(value)
+            if pagination[param] < (1 if param == 'limit' else 0):
+                raise ValueError()
+        except ValueError:
+            err_msg = 'Invalid {}: {}.'.format(param, value)
+
     if err_msg is not None:
         return Response({'error': err_msg}, status=status.HTTP_400_BAD_REQUEST)
 
-    usages = get_usages(usages_date, pricing_service, service)
-    return Response(PricingServiceUsageSerializer(usages).data)
+    if request.GET.get('stream'):
+        return StreamingHttpResponse(
+            (
+                json.dumps(usages) + '\n'
+                for _, usages in iter_usages(
+                    usages_date, pricing_service, service, **pagination
+                )
+            ),
+            content_type='application/x-ndjson',
+        )
+    usages = get_usages(usages_date, pricing_service, service, **pagination)
+    result = PricingServiceUsageSerializer(usages).data
+    if 'limit' in pagination:
+        result['next'] = usages['next']
+    return Response(result)
 
 
-def get_usages(usages_date, pricing_service, filter_by_service=None):
+def get_usages(
+    usages_date, pricing_service, filter_by_service=None, after=None,
+    limit=None,
+):
     """Create pricing service usage dict (i.e. the most "outer" one when
     looking at the JSON returned with the HTTP response), and fill it with
-    the usages by going through these steps:
-    1) For every usage type associated with given pricing service, fetch
-       daily usages for a given date (`usages_date`) and store them in a dict
-       keyed by daily pricing object, where the value is a list of tulpes
-       (symbol, value, remarks) designating the actual usages (i.e. the most
-       "inner" ones).
-    2) By iterating over the structure from the previous step, wrap the "inner"
-       usages into a structure containing the information re: the service and
-       environment (or the pricing object).
-    3) The list dicts from the previous step are finally added into a top-level
-       (the most "outer" one) dict, under the "usages" key.
+    the usages of every daily pricing object (see `iter_usages`) under the
+    "usages" key.
 
     This function by default return a usages from all services.
     The `filter_by_service` argument allows to filter usages only to service
     passed in this argument.
+
+    When `limit` is passed, at most `limit` daily pricing objects (after
+    `after` id) are returned - the id of the last one is saved under "next"
+    key (it's None when there is nothing more to fetch).
     """
     ps = new_pricing_service_usage(
         pricing_service=pricing_service.name,
         pricing_service_id=pricing_service.id,
         date=usages_date,
     )
-    usages_dict = defaultdict(list)
-
-    for usage_type in pricing_service.get_usage_types_for_date(usages_date):
-        _kwargs_filter = {'date': usages_date}
-        if filter_by_service:
-            _kwargs_filter['service_environment__service'] = filter_by_service
-        daily_usages = usage_type.dailyusage_set.filter(
-            **_kwargs_filter
-        ).select_related(
-            'service_environment',
-            'service_environment__service',
-            'service_environment__environment',
-            'daily_pricing_object'
+    dpo_id = None
+    for dpo_id, usages in iter_usages(
+        usages_date, pricing_service, filter_by_service, after, limit
+    ):
+        ps['usages'].append(usages)
+    ps['next'] = None
+    if limit and len(ps['usages']) == limit:
+        ps['next'] = dpo_id
+    return ps
+
+
+def iter_usages(
+    usages_date, pricing_service, filter_by_service=None, after=None,
+    limit=None,
+):
+    """Yield (daily pricing object id, usages) pairs, where usages is a dict
+    with the "inner" usages (symbol, value, remarks) and the information re:
+    the service and environment (and the pricing object), for every daily
+    pricing object having usages of any usage type associated with given
+    pricing service on a given date (`usages_date`).
+
+    Daily pricing objects are ordered by id and fetched in chunks using
+    keyset pagination (on daily pricing object id) - every chunk is fetched
+    using two queries (ids of daily pricing objects and then their usages)
+    without instantiating any model. `after` and `limit` allows to fetch only
+    part of the usages.
+    """
+    usage_types_ids = list(
+        pricing_service.get_usage_types_for_date(
+            usages_date
+        ).values_list('id', flat=True)
+    )
+    daily_usages = DailyUsage.objects.filter(
+        date=usages_date,
+        type_id__in=usage_types_ids,
+    )
+    if filter_by_service:
+        daily_usages = daily_usages.filter(
+            service_environment__service=filter_by_service
         )
-        for daily_usage in daily_usages:
-            usages_dict[daily_usage.daily_pricing_object].append(
-                (
-                    daily_usage.type.symbol,
-                    daily_usage.value,
-                    daily_usage.remarks
-                )
+    remaining = limit
+    while remaining is None or remaining > 0:
+        chunk_size = USAGES_CHUNK_SIZE
+        if remaining is not None:
+            chunk_size = min(chunk_size, remaining)
+            remaining -= chunk_size
+        dpo_ids_query = daily_usages.order_by('daily_pricing_object_id')
+        if after is not None:
+            dpo_ids_query = dpo_ids_query.filter(
+                daily_pricing_object_id__gt=after
             )
-
-    for dpo, uu in usages_dict.iteritems():
-        se = dpo.service_environment
-        usages = new_usages(
-            service=se.service.name,
-            service_id=se.service.id,
-            service_uid=se.service.ci_uid,
-            environment=se.environment.name,
+        dpo_ids = list(dpo_ids_query.values_list(
+            'daily_pricing_object_id', flat=True
+        ).distinct()[:chunk_size])
+        if not dpo_ids:
+            break
+        for usages in _get_usages_for_daily_pricing_objects(
+            daily_usages, dpo_ids
+        ):
+            yield usages
+        if len(dpo_ids) < chunk_size:
+            break
+        after = dpo_ids[-1]
+
+
+def _get_usages_for_daily_pricing_objects(daily_usages, dpo_ids):
+    current_dpo_id = usages = None
+    for (
+        dpo_id, service_name, service_id, service_uid, env_name,
+        pricing_object_name, symbol, value, remarks
+    ) in daily_usages.filter(
+        daily_pricing_object_id__in=dpo_ids,
+    ).order_by(
+        'daily_pricing_object_id', 'id'
+    ).values_list(
+        'daily_pricing_object_id',
+        'daily_pricing_object__service_environment__service__name',
+        'daily_pricing_object__service_environment__service_id',
+        'daily_pricing_object__service_environment__service__ci_uid',
+        'daily_pricing_object__service_environment__environment__name',
+        'daily_pricing_object__pricing_object__name',
+        'type__symbol',
+        'value',
+        'remarks',
+    ):
+        if dpo_id != current_dpo_id:
+            if usages is not None:
+                yield current_dpo_id, usages
+            current_dpo_id = dpo_id
+            usages = new_usages(
+                service=service_name,
+                service_id=service_id,
+                service_uid=service_uid,
+                environment=env_name,
+                pricing_object=pricing_object_name,
+            )
+        usages['usages'].append(
+            new_usage(symbol=symbol, value=value, remarks=remarks)
         )
-        if dpo.pricing_object != PRICING_OBJECT_TYPES.DUMMY:
-            usages['pricing_object'] = dpo.pricing_object.name
-        usages['usages'] = [
-            new_usage(symbol=u[0], value=u[1], remarks=u[2]) for u in uu
-        ]
-        ps['usages'].append(usages)
-    return ps
+    if usages is not None:
+        yield current_dpo_id, usages
 
 
 @api_view(['POST'])
@@ -411,11 +528,26 @@ def get_usages(usages_date, pricing_service, filter_by_service=None):
 def create_pricing_service_usages(request, *args, **kwargs):
     deserializer = PricingServiceUsageDeserializer(data=request.data)
     if deserializer.is_valid():
-        _save_usages_and_recalculate_costs(deserializer.validated_data)
+        ps_usage = deserializer.validated_data
+        _save_usages_and_recalculate_costs(ps_usage)
+        refresh_usage_anomaly_stats(
+            ps_usage['date'], get_usage_types_ids(ps_usage)
+        )
         return HttpResponse(status=201)
     return Response(deserializer.errors, status=400)
 
 
+def get_usage_types_ids(ps_usage):
+    """
+    Returns ids of usage types of (validated) pricing service usages.
+    """
+    return list(UsageType.objects_admin.filter(symbol__in=set(
+        usage['symbol']
+        for pricing_object_usages in ps_usage['usages']
+        for usage in pricing_object_usages['usages']
+    )).values_list('id', flat=True))
+
+
 @transaction.atomic
 def _save_usages_and_recalculate_costs(ps_usage):
     save_usages(ps_usage)
@@ -524,12 +656,13 @@ def remove_previous_daily_usages(overwrite, date, usages_dp_objs):
     docs for our REST API. Please note, that 'no' variant is deliberately
     ignored here, because that's default behavior.
     """
-    if overwrite in ('values_only', 'delete_all_previous'):
+    if overwrite == 'values_only':
         logger.debug('Remove previous values ({})'.format(overwrite))
-        for ut, dp_objs in usages_dp_objs.iteritems():
-            previous_usages = DailyUsage.objects.filter(date=date, type=ut)
-            if overwrite == 'values_only':
-                previous_usages = previous_usages.filter(
-                    daily_pricing_object__in=dp_objs
-                )
-            previous_usages.delete()
+        delete_daily_usages_by_keys(
+            (date, ut, dp_obj)
+            for ut, dp_objs in usages_dp_objs.iteritems()
+            for dp_obj in dp_objs
+        )
+    elif overwrite == 'delete_all_previous':
+        logger.debug('Remove previous values ({})'.format(overwrite))
+        delete_daily_usages(date, date, usages_dp_objs.keys())
@@ -197,8 +197,28 @@ ADDITIONAL_PRICING_OBJECT_TYPES = {}
 
 SAVE_ONLY_FIRST_DEPTH_COSTS = True
 DAILY_COST_CREATE_BATCH_SIZE = 10000
+DAILY_USAGE_CREATE_BATCH_SIZE = 2000
+DAILY_USAGE_DELETE_BATCH_SIZE = 1000
+# number of daily costs updated by single query of
+# scrooge_dailycost_backfill_services command
+DAILY_COST_BACKFILL_CHUNK_SIZE = 5000
+# filter costs of service (environment) by denormalized service and
+# environment of daily cost (using index) instead of joining service
+# environments - enable it only when costs saved before migration 0018 are
+# backfilled using scrooge_dailycost_backfill_services command
+DAILY_COST_FILTER_BY_SERVICE = False
+# above this number of (date, type, daily pricing object) keys, usages are
+# deleted using join with temporary table (instead of IN clauses)
+DAILY_USAGE_DELETE_TEMP_TABLE_THRESHOLD = 20000
+# size of batches of rows inserted (using bulk_create) when allocations are
+# saved
+ALLOCATION_BULK_CREATE_BATCH_SIZE = 2000
 SCROOGE_COSTS_MASTER_SLEEP = 1
 
+# Directory for columnar snapshots of daily costs and usages (see
+# scrooge_export_snapshots command)
+SNAPSHOTS_PATH = ''
+
 TESTING = 'test' in sys.argv
 
 PRICING_OBJECTS_COSTS_TABLE_SCHEMA = {
@@ -388,6 +408,33 @@ USAGE_TYPE_UPLOAD_FREQ_MARGINS = {
     'monthly': 3,
 }
 
+# Settings of incremental (per usage type and service environment) usage
+# anomalies detection (see `ralph_scrooge.utils.usage_anomalies`).
+# Weight of the newest usage in moving average (and variance) of usages.
+USAGE_ANOMALY_EWMA_ALPHA = 0.1
+# Usage is reported as anomaly when it differs from moving average by more
+# than this number of standard deviations.
+USAGE_ANOMALY_THRESHOLD = 3
+# Minimal number of processed days before anomalies are reported.
+USAGE_ANOMALY_MIN_OBSERVATIONS = 7
+# Number of days (before the last processed one) checked for new usages.
+USAGE_ANOMALY_LOOKBACK_DAYS = 7
+# Number of days processed when there are no statistics yet.
+USAGE_ANOMALY_INITIAL_DAYS = 30
+
+# Number of seconds for which responses of costs endpoints are cached (keyed
+# by costs version, see `ralph_scrooge.rest_api.conditional`). Set to 0 to
+# disable caching (ETag and conditional requests are still supported).
+# Version doesn't cover details of pricing objects (ex. presented in
+# components), so they could be stale for that long.
+COSTS_RESPONSE_CACHE_TIMEOUT = 60 * 60
+# Number of seconds for which tables of allocation admin (of single month)
+# are cached - cache is invalidated when allocations of the month are saved.
+# Cache has to be shared by all processes (ex. redis or memcached configured
+# as `scrooge_allocation_admin` or `default` cache), otherwise saves are not
+# visible in other processes - that's why caching is disabled (0) by default.
+ALLOCATION_ADMIN_CACHE_TIMEOUT = 0
+
 # Swagger/OpenAPI schema related stuff.
 API_SCHEMA_FILE = os.path.join(BASE_DIR, 'media', 'api_schema.yaml')
 
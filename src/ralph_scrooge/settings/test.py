@@ -67,6 +67,11 @@ INSTALLED_APPS += [
     'ralph_scrooge.tests'
 ]
 
+# responses of costs endpoints and allocation admin are not cached between
+# tests
+COSTS_RESPONSE_CACHE_TIMEOUT = 0
+ALLOCATION_ADMIN_CACHE_TIMEOUT = 0
+
 # Redis & RQ
 for queue in RQ_QUEUE_LIST + ('default',):
     RQ_QUEUES[queue]['ASYNC'] = False
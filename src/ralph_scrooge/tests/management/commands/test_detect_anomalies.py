@@ -9,20 +9,33 @@ import datetime
 import mock
 
 from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 from ralph_scrooge.management.commands.detect_usage_anomalies import (
+    _add_service_environment_anomalies,
     _detect_missing_values,
+    _detect_service_environment_anomalies,
+    _detect_unusual_changes,
+    _filter_out_ack,
     _get_max_expected_date,
+    _get_usage_values_for_month,
     UnknownUsageTypeUploadFreqError,
 )
 from ralph_scrooge.models import (
     PricingServicePlugin,
+    ServiceEnvironmentUsageAnomaly,
     ServiceUsageTypes,
+    UsageAnomalyAck,
+    UsageAnomalyStats,
     UsageTypeUploadFreq,
 )
 from ralph_scrooge.tests import ScroogeTestCase
 from ralph_scrooge.tests.utils.factory import (
+    DailyUsageFactory,
     PricingServiceFactory,
+    ServiceEnvironmentFactory,
     UsageTypeFactory,
 )
 
@@ -58,6 +71,153 @@ class TestDetectMissingValues(ScroogeTestCase):
         # 30 days taken into account minus 9 days ("hole") == 21 expected here.
         self.assertEqual(len(missing_values.values()[0]), 21)
 
+    def test_missing_values_of_monthly_usage_type_since_start_of_month(self):
+        ut = UsageTypeFactory(upload_freq=UsageTypeUploadFreq.monthly.id)
+        ps = PricingServiceFactory(plugin_type=FIXED_PRICE_PLUGIN)
+        ServiceUsageTypes.objects.create(
+            usage_type=ut,
+            pricing_service=ps,
+            start=datetime.date.min,
+            end=datetime.date.max,
+        )
+        end_date = datetime.date(2017, 1, 9)
+        usage_values = {ut: {
+            datetime.date(2016, 12, 1) + datetime.timedelta(days=i): 1
+            for i in range(25)
+        }}
+        missing_values = _detect_missing_values(usage_values, end_date)
+        # values are expected until the end of the previous month
+        self.assertEqual(missing_values, {ut: [
+            datetime.date(2016, 12, d) for d in range(26, 32)
+        ]})
+
+
+class TestUsageValues(ScroogeTestCase):
+    def setUp(self):
+        self.end_date = datetime.date(2017, 1, 9)
+        self.ut1, self.ut2, self.ut3 = UsageTypeFactory.create_batch(
+            3, change_tolerance=0.5,
+        )
+        for day, value in [(1, 10), (2, 10), (3, 30), (5, 30), (6, 10)]:
+            DailyUsageFactory(
+                type=self.ut1, date=datetime.date(2017, 1, day), value=value
+            )
+        DailyUsageFactory(
+            type=self.ut2, date=datetime.date(2017, 1, 1), value=5
+        )
+        DailyUsageFactory(
+            type=self.ut2, date=datetime.date(2017, 1, 1), value=5
+        )
+
+    def test_get_usage_values_for_month(self):
+        with CaptureQueriesContext(connection) as queries:
+            usage_values = _get_usage_values_for_month(
+                [self.ut1, self.ut2], self.end_date
+            )
+        self.assertEqual(len(queries.captured_queries), 1)
+        self.assertEqual(usage_values.start_date, datetime.date(2016, 12, 1))
+        self.assertEqual(len(usage_values.days), 40)
+        self.assertEqual(usage_values.values[0][-9:], [
+            10, 10, 30, None, 30, 10, None, None, None
+        ])
+        self.assertEqual(usage_values.values[1][-9:], [10] + [None] * 8)
+
+    def test_detect_unusual_changes(self):
+        usage_values = _get_usage_values_for_month(
+            [self.ut1, self.ut2, self.ut3], self.end_date
+        )
+        self.assertEqual(
+            _detect_unusual_changes(usage_values, self.end_date),
+            {self.ut1: [
+                (datetime.date(2017, 1, 2), datetime.date(2017, 1, 3),
+                 10, 30, 2.0),
+                (datetime.date(2017, 1, 5), datetime.date(2017, 1, 6),
+                 30, 10, -0.67),
+            ]}
+        )
+
+    def test_filter_out_ack(self):
+        user = get_user_model().objects.create_user('test')
+        UsageAnomalyAck.objects.create(
+            type=self.ut1,
+            anomaly_date=datetime.date(2017, 1, 2),
+            acknowledged_by=user,
+        )
+        changes = [
+            (datetime.date(2017, 1, 2), datetime.date(2017, 1, 3), 1, 2, 1.0),
+            (datetime.date(2017, 1, 5), datetime.date(2017, 1, 6), 2, 1, -0.5),
+        ]
+        self.assertEqual(
+            _filter_out_ack({self.ut1: changes, self.ut2: changes[:1]}),
+            {self.ut1: changes[1:], self.ut2: changes[:1]}
+        )
+
+
+class TestServiceEnvironmentAnomalies(ScroogeTestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('test')
+        self.ut1, self.ut2 = UsageTypeFactory.create_batch(2)
+        self.ut1.owners.add(self.user)
+        self.se = ServiceEnvironmentFactory()
+        self.end_date = datetime.date(2017, 1, 20)
+        for i in range(20):
+            day = datetime.date(2017, 1, 1) + datetime.timedelta(days=i)
+            for ut in (self.ut1, self.ut2):
+                DailyUsageFactory(
+                    date=day, type=ut, service_environment=self.se,
+                    value=1000 if day.day in (15, 18) else 10,
+                )
+
+    def test_detect_service_environment_anomalies(self):
+        UsageAnomalyAck.objects.create(
+            type=self.ut1,
+            anomaly_date=datetime.date(2017, 1, 15),
+            acknowledged_by=self.user,
+        )
+        anomalies = _detect_service_environment_anomalies(
+            [self.ut1], self.end_date
+        )
+        self.assertEqual(anomalies.keys(), [self.ut1])
+        self.assertEqual(
+            [(a.service_environment, a.date, a.value)
+             for a in anomalies[self.ut1]],
+            [(self.se, datetime.date(2017, 1, 18), 1000)]
+        )
+
+    def test_detect_service_environment_anomalies_dry_run(self):
+        anomalies = _detect_service_environment_anomalies(
+            [self.ut1], self.end_date, dry_run=True
+        )
+        self.assertEqual(
+            [(a.service_environment, a.date, a.value)
+             for a in anomalies[self.ut1]],
+            [
+                (self.se, datetime.date(2017, 1, 15), 1000),
+                (self.se, datetime.date(2017, 1, 18), 1000),
+            ]
+        )
+        self.assertFalse(UsageAnomalyStats.objects.exists())
+        self.assertFalse(ServiceEnvironmentUsageAnomaly.objects.exists())
+
+    def test_add_service_environment_anomalies(self):
+        anomalies = _add_service_environment_anomalies(
+            {}, _detect_service_environment_anomalies(
+                [self.ut1, self.ut2], self.end_date
+            )
+        )
+        # ut2 doesn't have any owners
+        self.assertEqual(anomalies.keys(), [self.user])
+        self.assertEqual(
+            [a[:4] for a in anomalies[self.user][
+                'service_environment_anomalies'
+            ]],
+            [
+                (datetime.date(2017, 1, 15), self.ut1, self.se, 1000),
+                (datetime.date(2017, 1, 18), self.ut1, self.se, 1000),
+            ]
+        )
+
 
 class TestGetMaxExpectedDate(ScroogeTestCase):
 
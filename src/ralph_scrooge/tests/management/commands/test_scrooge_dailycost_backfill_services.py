@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from datetime import date
+
+from django.core.management import call_command
+from django.utils.six import StringIO
+
+from ralph_scrooge.models import DailyCost
+from ralph_scrooge.tests import ScroogeTestCase
+from ralph_scrooge.tests.utils.factory import (
+    DailyCostFactory,
+    ServiceEnvironmentFactory,
+    UsageTypeFactory,
+)
+
+
+class TestScroogeDailyCostBackfillServicesCommand(ScroogeTestCase):
+    def setUp(self):
+        self.se1, self.se2 = ServiceEnvironmentFactory.create_batch(2)
+        usage_type = UsageTypeFactory()
+        for day, se, forecast in [
+            (date(2017, 1, 1), self.se1, False),
+            (date(2017, 1, 1), self.se2, True),
+            (date(2017, 1, 3), self.se2, False),
+            (date(2017, 2, 1), self.se1, False),
+        ]:
+            DailyCostFactory(
+                date=day,
+                service_environment=se,
+                forecast=forecast,
+                type=usage_type,
+            )
+        # costs saved before service and environment were introduced
+        DailyCost.objects_tree.update(service=None, environment=None)
+
+    def _call_command(self, **kwargs):
+        out = StringIO()
+        call_command(
+            'scrooge_dailycost_backfill_services', stdout=out, **kwargs
+        )
+        return out.getvalue()
+
+    def _get_services_and_environments(self):
+        return set(DailyCost.objects_tree.values_list(
+            'date', 'service_environment', 'service', 'environment'
+        ))
+
+    def test_backfill(self):
+        self.assertIn('4 costs updated', self._call_command())
+        self.assertEqual(self._get_services_and_environments(), {
+            (
+                date(2017, 1, 1), self.se1.id, self.se1.service_id,
+                self.se1.environment_id,
+            ),
+            (
+                date(2017, 1, 1), self.se2.id, self.se2.service_id,
+                self.se2.environment_id,
+            ),
+            (
+                date(2017, 1, 3), self.se2.id, self.se2.service_id,
+                self.se2.environment_id,
+            ),
+            (
+                date(2017, 2, 1), self.se1.id, self.se1.service_id,
+                self.se1.environment_id,
+            ),
+        })
+        self.assertIn('0 costs updated', self._call_command())
+
+    def test_backfill_dates_range(self):
+        self.assertIn('3 costs updated', self._call_command(
+            date_start=date(2017, 1, 1), date_end=date(2017, 1, 31),
+        ))
+        self.assertEqual(
+            DailyCost.objects_tree.filter(service=None).get().date,
+            date(2017, 2, 1),
+        )
+
+    def test_backfill_in_chunks(self):
+        # cost of service environment which no longer exists
+        DailyCost.objects_tree.filter(service_environment=self.se1).update(
+            service_environment_id=self.se2.id + 1000
+        )
+        self.assertIn('2 costs updated', self._call_command(chunk_size=1))
+        self.assertEqual(
+            DailyCost.objects_tree.filter(service=None).count(), 2
+        )
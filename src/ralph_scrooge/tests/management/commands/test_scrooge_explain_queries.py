@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from django.core.management import call_command
+from django.utils.six import StringIO
+
+from ralph_scrooge.management.commands.scrooge_explain_queries import explain
+from ralph_scrooge.models import DailyUsage
+from ralph_scrooge.tests import ScroogeTestCase
+
+
+class TestScroogeExplainQueriesCommand(ScroogeTestCase):
+    def test_hot_queries_use_indexes(self):
+        out = StringIO()
+        call_command('scrooge_explain_queries', stdout=out)
+        self.assertNotIn('FULL SCAN', out.getvalue())
+
+    def test_full_scan_is_reported(self):
+        plan, full_scans = explain(DailyUsage.objects.filter(value=1))
+        self.assertTrue(plan)
+        self.assertEqual(full_scans, [DailyUsage._meta.db_table])
@@ -5,10 +5,37 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import json
+from collections import OrderedDict
+from datetime import date
+
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils.six import StringIO
+
+from ralph_scrooge.management.commands.scrooge_statistics import Command
 from ralph_scrooge.tests import ScroogeTestCase
+from ralph_scrooge.tests.utils.factory import (
+    DailyUsageFactory,
+    UsageTypeFactory,
+)
 
 
 class TestScroogeStatisticsCommand(ScroogeTestCase):
+    def setUp(self):
+        self.command = Command()
+        self.ut1 = UsageTypeFactory(name='ut1')
+        self.ut2 = UsageTypeFactory(name='ut2')
+        self.ut3 = UsageTypeFactory(name='ut3')
+        for day, ut, count in [
+            (date(2017, 1, 1), self.ut1, 3),
+            (date(2017, 1, 1), self.ut2, 2),
+            (date(2017, 1, 2), self.ut1, 3),
+            (date(2017, 1, 3), self.ut1, 1),
+            (date(2017, 1, 3), self.ut3, 1),
+        ]:
+            DailyUsageFactory.create_batch(count, date=day, type=ut, value=2)
 
     def test_draw_statistics_when_only_base(self):
         # TODO
@@ -31,8 +58,29 @@ class TestScroogeStatisticsCommand(ScroogeTestCase):
         pass
 
     def test_get_statistics(self):
-        # TODO
-        pass
+        self.assertEqual(
+            self.command.get_statistics(date(2017, 1, 1)),
+            OrderedDict([('ut1', 3), ('ut2', 2), ('ut3', 0)])
+        )
+
+    def test_get_ranges_statistics(self):
+        with CaptureQueriesContext(connection) as queries:
+            result = self.command.get_ranges_statistics([
+                (date(2017, 1, 2), date(2017, 1, 3)),
+                (date(2017, 1, 1), date(2017, 1, 2)),
+            ])
+        # usage types and grouped usages
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(result, [
+            (
+                OrderedDict([('ut1', 4), ('ut2', 0), ('ut3', 1)]),
+                OrderedDict([('ut1', 8), ('ut2', 0), ('ut3', 2)]),
+            ),
+            (
+                OrderedDict([('ut1', 6), ('ut2', 2), ('ut3', 0)]),
+                OrderedDict([('ut1', 12), ('ut2', 4), ('ut3', 0)]),
+            ),
+        ])
 
     def test_compare_data(self):
         # TODO
@@ -55,5 +103,34 @@ class TestScroogeStatisticsCommand(ScroogeTestCase):
         pass
 
     def test_compare_days(self):
-        # TODO
-        pass
+        result = self.command.compare_days(date(2017, 1, 3), date(2017, 1, 1))
+        self.assertEqual(result['base'], {'ut1': 1, 'ut2': 0, 'ut3': 1})
+        self.assertEqual(result['compare'], {'ut1': 3, 'ut2': 2, 'ut3': 0})
+        self.assertEqual(
+            result['differences'], {'ut1': -2, 'ut2': -2, 'ut3': 1}
+        )
+        self.assertEqual(result['errors'], {'ut2': -2})
+        self.assertEqual(result['warnings'], {'ut1': -2, 'ut2': -2, 'ut3': 1})
+
+    def test_compare_days_skips_inactive_usage_types(self):
+        inactive = UsageTypeFactory(name='inactive', active=False)
+        DailyUsageFactory(date=date(2017, 1, 3), type=inactive, value=2)
+        result = self.command.compare_days(date(2017, 1, 3), date(2017, 1, 1))
+        self.assertEqual(result['base'], {'ut1': 1, 'ut2': 0, 'ut3': 1})
+
+    def test_json_output(self):
+        out = StringIO()
+        call_command(
+            'scrooge_statistics',
+            base='2017-01-02',
+            base_end='2017-01-03',
+            compare='2017-01-01',
+            json=True,
+            stdout=out,
+        )
+        result = json.loads(out.getvalue())
+        self.assertEqual(result['base_range'], ['2017-01-02', '2017-01-03'])
+        self.assertEqual(result['compare_range'], ['2017-01-01', '2017-01-01'])
+        self.assertEqual(result['base'], {'ut1': 4, 'ut2': 0, 'ut3': 1})
+        self.assertEqual(result['base_sums'], {'ut1': 8, 'ut2': 0, 'ut3': 2})
+        self.assertEqual(result['errors'], {'ut2': -2})
@@ -99,6 +99,19 @@ class TestScroogeSync(ScroogeTestCase):
         call_command(COMMAND_NAME)
         run_plugins_mock.assert_called_with(today, COLLECT_PLUGINS)
 
+    @override_settings(COLLECT_PLUGINS=COLLECT_PLUGINS)
+    @patch(
+        'ralph_scrooge.management.commands.scrooge_sync.'
+        'refresh_usage_anomaly_stats'
+    )
+    @patch('ralph_scrooge.management.commands.scrooge_sync.run_plugins')
+    def test_command_refreshes_usage_anomaly_stats(
+        self, run_plugins_mock, refresh_mock
+    ):
+        run_plugins_mock.return_value = iter([('warehouse', True)])
+        call_command(COMMAND_NAME, today='2013-10-10')
+        refresh_mock.assert_called_once_with(datetime.date(2013, 10, 10))
+
     @override_settings(COLLECT_PLUGINS=COLLECT_PLUGINS)
     @patch('ralph_scrooge.management.commands.scrooge_sync.run_plugins')
     def test_command_today(self, run_plugins_mock):
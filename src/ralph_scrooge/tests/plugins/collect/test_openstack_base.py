@@ -189,6 +189,13 @@ class TestOpenStackBasePlugin(ScroogeTestCase):
         self.plugin.clear_previous_usages(self.today)
         self.assertEquals(DailyUsage.objects.count(), 10)
 
+    def test_clear_previous_usages_of_inactive_usage_type(self):
+        daily_usage = OpenstackDailyUsageTypeFactory(date=self.today)
+        daily_usage.type.active = False
+        daily_usage.type.save()
+        self.plugin.clear_previous_usages(self.today)
+        self.assertEquals(DailyUsage.objects.count(), 0)
+
     @mock.patch('ralph_scrooge.plugins.collect._openstack_base.OpenStackBasePlugin.get_usages')  # noqa
     @mock.patch('ralph_scrooge.plugins.collect._openstack_base.OpenStackBasePlugin.clear_previous_usages')  # noqa
     @mock.patch('ralph_scrooge.plugins.collect._openstack_base.OpenStackBasePlugin.save_usages')  # noqa
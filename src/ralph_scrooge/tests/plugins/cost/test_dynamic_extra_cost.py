@@ -10,8 +10,8 @@ from decimal import Decimal as D
 
 from ralph_scrooge import models
 from ralph_scrooge.tests import ScroogeTestCase
+from ralph_scrooge.plugins.cost.base import NoPriceCostError
 from ralph_scrooge.plugins.cost.dynamic_extra_cost import (
-    NoPriceCostError,
     DynamicExtraCostPlugin,
 )
 from ralph_scrooge.tests.utils.factory import (
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from collections import namedtuple
+from datetime import date
+
+import mock
+
+from ralph_scrooge.plugins.cost.base import (
+    MultiplePriceCostError,
+    NoPriceCostError,
+)
+from ralph_scrooge.plugins.cost.intervals import IntervalIndex
+from ralph_scrooge.tests import ScroogeTestCase
+
+Interval = namedtuple('Interval', ['key', 'start', 'end'])
+
+
+class TestIntervalIndex(ScroogeTestCase):
+    def setUp(self):
+        self.i1 = Interval(1, date(2016, 1, 1), date(2016, 1, 31))
+        self.i2 = Interval(1, date(2016, 2, 1), date(2016, 2, 29))
+        self.i3 = Interval(1, date(2016, 2, 15), date.max)
+        self.i4 = Interval(2, date(2016, 1, 10), date(2016, 1, 10))
+        self.index = IntervalIndex(
+            [self.i1, self.i2, self.i3, self.i4], key=lambda i: i.key
+        )
+
+    def test_find(self):
+        self.assertEquals(self.index.find(1, date(2015, 12, 31)), [])
+        self.assertEquals(self.index.find(1, date(2016, 1, 1)), [self.i1])
+        self.assertEquals(self.index.find(1, date(2016, 1, 31)), [self.i1])
+        self.assertEquals(self.index.find(1, date(2016, 2, 1)), [self.i2])
+        self.assertEquals(
+            self.index.find(1, date(2016, 2, 15)), [self.i2, self.i3]
+        )
+        self.assertEquals(self.index.find(1, date(2016, 3, 1)), [self.i3])
+        self.assertEquals(self.index.find(1, date.max), [self.i3])
+        self.assertEquals(self.index.find(2, date(2016, 1, 10)), [self.i4])
+        self.assertEquals(self.index.find(2, date(2016, 1, 11)), [])
+        self.assertEquals(self.index.find(3, date(2016, 1, 10)), [])
+
+    def test_get(self):
+        self.assertEquals(self.index.get(1, date(2016, 1, 5)), self.i1)
+        with self.assertRaises(NoPriceCostError):
+            self.index.get(2, date(2016, 1, 11))
+        with self.assertRaises(MultiplePriceCostError):
+            self.index.get(1, date(2016, 2, 20))
+
+    def test_overlapping_keys(self):
+        self.assertEquals(self.index.overlapping_keys, {1})
+
+    def test_get_from_unique_index(self):
+        with mock.patch(
+            'ralph_scrooge.plugins.cost.intervals.logger'
+        ) as logger_mock:
+            index = IntervalIndex(
+                [self.i3, self.i1, self.i2, self.i4],
+                key=lambda i: i.key,
+                unique=True,
+            )
+        # overlaps are reported once, while building the index
+        self.assertEquals(logger_mock.warning.call_count, 1)
+        self.assertEquals(index.overlaps, {1: [self.i2, self.i3]})
+        for _ in range(2):
+            self.assertEquals(index.get(1, date(2016, 2, 20)), self.i3)
+        self.assertEquals(index.get(1, date(2016, 2, 1)), self.i2)
+
+    def test_intervals_without_dates_are_skipped(self):
+        index = IntervalIndex(
+            [Interval(1, None, date(2016, 1, 1))], key=lambda i: i.key
+        )
+        self.assertEquals(index.keys(), [])
@@ -4,15 +4,21 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import threading
 from datetime import date
 from dateutil import rrule
 from decimal import Decimal as D
 import mock
 
-from django.test.utils import override_settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
 
 from ralph_scrooge import models
-from ralph_scrooge.plugins.cost.pricing_service import PricingServicePlugin
+from ralph_scrooge.plugins.cost.pricing_service import (
+    PricingServicePlugin,
+    PricingServicesCostsTable,
+    pricing_services_costs_table,
+)
 from ralph_scrooge.plugins.cost.pricing_service_fixed_price import (
     PricingServiceFixedPricePlugin
 )
@@ -802,62 +808,49 @@ class TestPricingServiceDependency(ScroogeTestCase):
 
     def test_distribute_costs_with_excluded_services(self):
         self._init_one()
-        usage_orig = PricingServicePlugin._get_usages_per_pricing_object
-        total_orig = PricingServicePlugin._get_total_usage
-        with mock.patch('ralph_scrooge.plugins.cost.pricing_service.PricingServiceBasePlugin._get_usages_per_pricing_object') as usage_mock:  # noqa
-            with mock.patch('ralph_scrooge.plugins.cost.pricing_service.PricingServiceBasePlugin._get_total_usage') as total_mock:  # noqa
-                usage_mock.side_effect = usage_orig
-                total_mock.side_effect = total_orig
-                PricingServicePlugin._distribute_costs(
-                    self.today,
-                    pricing_service=self.ps1,
-                    costs_hierarchy={},
-                    service_usage_types=self.ps1.serviceusagetypes_set.all(),
-                    excluded_services=set([
-                        self.se4.service,
-                        self.se1.service,
-                        self.se2.service,
-                    ])
-                )
-
-                total_mock.assert_any_call(
-                    usage_type=self.service_usage_types[0],
-                    date=self.today,
-                    excluded_services=set([
-                        self.se4.service,
-                        self.se1.service,
-                        self.se2.service,
-                        self.se3.service,
-                    ])
-                )
-                total_mock.assert_any_call(
-                    usage_type=self.service_usage_types[1],
-                    date=self.today,
-                    excluded_services=set([
-                        self.se4.service,
-                        self.se1.service,
-                        self.se2.service,
-                    ])
-                )
-                usage_mock.assert_any_call(
-                    usage_type=self.service_usage_types[0],
-                    date=self.today,
-                    excluded_services=set([
-                        self.se4.service,
-                        self.se1.service,
-                        self.se2.service,
-                        self.se3.service,
-                    ]),
-                )
-                usage_mock.assert_any_call(
-                    usage_type=self.service_usage_types[1],
-                    date=self.today,
-                    excluded_services=set([
-                        self.se4.service,
-                        self.se1.service,
-                        self.se2.service,
-                    ]),
-                )
+        excluded_services = set([
+            self.se4.service,
+            self.se1.service,
+            self.se2.service,
+        ])
+        self.assertEquals(
+            PricingServicePlugin._get_excluded_service_environments(
+                [ut.id for ut in self.service_usage_types],
+                excluded_services,
+            ),
+            {
+                self.service_usage_types[0].id: set([
+                    self.se1.id, self.se2.id, self.se3.id, self.se4.id,
+                ]),
+                self.service_usage_types[1].id: set([
+                    self.se1.id, self.se2.id, self.se4.id,
+                ]),
+            }
+        )
+        service_usage_types = list(self.ps1.serviceusagetypes_set.all())
+        # excluded services of usage types, their service environments and
+        # usages of all usage types
+        with CaptureQueriesContext(connection) as queries:
+            result = PricingServicePlugin._distribute_costs(
+                self.today,
+                pricing_service=self.ps1,
+                costs_hierarchy={self.ps1.id: (D(100), {})},
+                service_usage_types=service_usage_types,
+                excluded_services=excluded_services,
+            )
+        self.assertEquals(len(queries), 3)
+        self.assertEquals(result, {
+            self.dpo1.service_environment.id: [{
+                'type_id': self.ps1.id,
+                'pricing_object_id': self.dpo1.pricing_object.id,
+                'cost': D(50),  # 100 * (10 / 20 * 0.7 + 20 / 40 * 0.3)
+            }],
+            self.dpo2.service_environment.id: [{
+                'type_id': self.ps1.id,
+                'pricing_object_id': self.dpo2.pricing_object.id,
+                'cost': D(50),
+            }],
+        })
 
     def test_pricing_dependent_services(self):
         """
@@ -933,6 +926,71 @@ class TestPricingServiceDependency(ScroogeTestCase):
                 ):
                     self.assertEquals(str(expected_call), str(actual_call))
 
+    def test_pricing_dependent_services_costs_table(self):
+        """
+        Within costs table every pricing service costs are calculated once,
+        in order of dependencies (PS3, then PS2, then PS1).
+        """
+        self._init()
+
+        def dependent_services(self1, date, exclude=None):
+            if self1 == self.ps1:
+                return [self.ps2]
+            elif self1 == self.ps2:
+                return [self.ps3]
+            return []
+
+        calculate_orig = PricingServicePlugin._calculate_pricing_service_costs
+        graph = {self.ps2: [self.ps1], self.ps3: [self.ps2]}
+        with mock.patch.object(models.service.PricingService, 'get_dependent_services', dependent_services), mock.patch('ralph_scrooge.plugins.cost.pricing_service._get_pricing_services_graph', return_value=graph):  # noqa
+            with mock.patch('ralph_scrooge.plugins.cost.pricing_service.PricingServiceBasePlugin._calculate_pricing_service_costs') as calculate_mock:  # noqa
+                calculate_mock.side_effect = calculate_orig
+                with pricing_services_costs_table(self.today, False):
+                    for ps in (self.ps1, self.ps2, self.ps3):
+                        PricingServicePlugin.costs(
+                            pricing_service=ps,
+                            date=self.today,
+                            forecast=False,
+                        )
+        self.assertEquals(
+            [c[0][1] for c in calculate_mock.call_args_list],
+            [self.ps3, self.ps2, self.ps1],
+        )
+
+    def test_pricing_services_costs_table_is_active_only_in_its_thread(self):
+        tables = []
+        with pricing_services_costs_table(
+            self.today, False, evaluate=False
+        ) as table:
+            thread = threading.Thread(target=lambda: tables.append(
+                PricingServicesCostsTable.get_active(self.today, False)
+            ))
+            thread.start()
+            thread.join()
+            self.assertIs(
+                PricingServicesCostsTable.get_active(self.today, False), table
+            )
+        self.assertEquals(tables, [None])
+        self.assertIsNone(
+            PricingServicesCostsTable.get_active(self.today, False)
+        )
+
+    @mock.patch('ralph_scrooge.plugins.cost.pricing_service.PricingServiceBasePlugin._calculate_costs')  # noqa
+    def test_pricing_services_costs_table_key_contains_params(
+        self, calculate_mock
+    ):
+        self._init()
+        calculate_mock.side_effect = lambda *args: {}
+        with pricing_services_costs_table(self.today, False, evaluate=False):
+            for params in ({}, {'param': 1}, {'param': 1}):
+                PricingServicePlugin._costs(
+                    pricing_service=self.ps1,
+                    date=self.today,
+                    forecast=False,
+                    **params
+                )
+        self.assertEquals(calculate_mock.call_count, 2)
+
 
 class TestPricingServiceDiffCharging(ScroogeTestCase):
 
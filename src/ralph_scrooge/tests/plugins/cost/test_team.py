@@ -13,6 +13,8 @@ from ralph_scrooge.tests import ScroogeTestCase
 from ralph_scrooge.plugins.cost.team import TeamPlugin
 from ralph_scrooge.plugins.cost.base import NoPriceCostError
 from ralph_scrooge.tests.utils.factory import (
+    DailyPricingObjectFactory,
+    DailyUsageFactory,
     ServiceEnvironmentFactory,
     TeamCostFactory,
     TeamFactory,
@@ -648,4 +650,138 @@ class TestTeamPlugin(ScroogeTestCase):
                 forecast=False,
             )
 
+    # =========================================================================
+    # RESOURCES COUNT INDEX
+    # =========================================================================
+    def _create_resources(self):
+        cores_usage_type = TeamPlugin._get_cores_usage_type()
+        for se, assets_count, cores in (
+            (self.service_environment1, 1, 4),
+            (self.service_environment2, 2, 8),
+            (self.service_environment3, 3, 16),
+        ):
+            for i in range(assets_count):
+                DailyPricingObjectFactory(
+                    date=self.today,
+                    service_environment=se,
+                    pricing_object__type_id=models.PRICING_OBJECT_TYPES.ASSET,
+                )
+            DailyUsageFactory(
+                date=self.today,
+                service_environment=se,
+                type=cores_usage_type,
+                value=cores,
+            )
+
+    def test_assets_and_cores_count(self):
+        self._create_resources()
+        excluded = [self.service_environment1, self.service_environment3.id]
+        self.assertEquals(
+            TeamPlugin._get_assets_count_by_service_environment(
+                self.today, excluded_service_environments=[]
+            ),
+            {
+                self.service_environment1.id: 1,
+                self.service_environment2.id: 2,
+                self.service_environment3.id: 3,
+            }
+        )
+        self.assertEquals(TeamPlugin._get_total_assets_count(
+            self.today, excluded_service_environments=[]
+        ), 6)
+        self.assertEquals(
+            TeamPlugin._get_assets_count_by_service_environment(
+                self.today, excluded_service_environments=excluded
+            ),
+            {self.service_environment2.id: 2}
+        )
+        self.assertEquals(TeamPlugin._get_total_assets_count(
+            self.today, excluded_service_environments=excluded
+        ), 2)
+        self.assertEquals(
+            TeamPlugin._get_cores_count_by_service_environment(
+                self.today, excluded_service_environments=excluded
+            ),
+            {self.service_environment2.id: 8}
+        )
+        self.assertEquals(TeamPlugin._get_total_cores_count(
+            self.today, excluded_service_environments=excluded
+        ), 8)
+        self.assertEquals(TeamPlugin._get_total_cores_count(
+            self.date_out_of_range, excluded_service_environments=excluded
+        ), 0)
+
+    def test_teams_excluded_service_environments(self):
+        self.team_assets.excluded_services.add(
+            self.service_environment1.service,
+            self.service_environment2.service,
+        )
+        self.assertEquals(
+            TeamPlugin._get_teams_excluded_service_environments(),
+            {self.team_assets.id: frozenset([
+                self.service_environment1.id,
+                self.service_environment2.id,
+            ])}
+        )
+
+    def test_team_assets_costs_with_excluded_services(self):
+        self._create_resources()
+        self.team_assets.excluded_services.add(
+            self.service_environment1.service,
+        )
+        costs = TeamPlugin.costs(
+            date=self.today,
+            service_environments=self.service_environments,
+            team=self.team_assets,
+            forecast=False,
+        )
+        # daily cost: 30, se1 excluded
+        self.assertEquals(costs, {
+            self.service_environment2.id: [{
+                'cost': D('12'),  # 2 / 5 * 30
+                'type': self.team_assets,
+                'percent': D('0.4'),
+            }],
+            self.service_environment3.id: [{
+                'cost': D('18'),  # 3 / 5 * 30
+                'type': self.team_assets,
+                'percent': D('0.6'),
+            }],
+        })
+
+    # =========================================================================
+    # SHARES
+    # =========================================================================
+    def test_team_shares(self):
+        shares = TeamPlugin._get_team_shares(
+            team=self.team_time,
+            date=self.today,
+        )
+        self.assertEquals(shares, {
+            self.service_environment1.id: D('0.3'),
+            self.service_environment2.id: D('0.4'),
+            self.service_environment3.id: D('0.3'),
+        })
+
+    def test_team_costs_are_scaled_shares(self):
+        costs = TeamPlugin.costs(
+            date=self.today,
+            service_environments=self.service_environments_subset,
+            team=self.team_time,
+            forecast=False,
+            daily_cost=50,
+        )
+        self.assertEquals(costs, {
+            self.service_environment1.id: [{
+                'cost': D('15'),
+                'type': self.team_time,
+                'percent': D('0.3'),
+            }],
+            self.service_environment2.id: [{
+                'cost': D('20'),
+                'type': self.team_time,
+                'percent': D('0.4'),
+            }],
+        })
+
     # TODO: test other methods
@@ -7,7 +7,8 @@ from __future__ import unicode_literals
 
 import datetime
 
-from django.test.utils import override_settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
 
 from ralph_scrooge.models import (
     PricingServicePlugin,
@@ -15,7 +16,11 @@ from ralph_scrooge.models import (
     UsageType,
     Warehouse,
 )
-from ralph_scrooge.plugins.validations import DataForReportValidator
+from ralph_scrooge.plugins.validations import (
+    DataForReportRangeValidator,
+    DataForReportValidationError,
+    DataForReportValidator,
+)
 from ralph_scrooge.tests import ScroogeTestCase
 from ralph_scrooge.tests.utils.factory import (
     CostDateStatusFactory,
@@ -490,3 +495,132 @@ class TestDataForReportValidationsWithForecastOn(TestDataForReportValidations):
     def setUp(self):
         self.forecast = True
         self.setup_helper()
+
+
+class TestDataForReportRangeValidator(ScroogeTestCase):
+    def setUp(self):
+        self.start = datetime.date(2017, 3, 27)
+        self.end = datetime.date(2017, 3, 31)
+        self.change = datetime.date(2017, 3, 29)
+        before = {'start': self.start, 'end': self.change}
+        after = {
+            'start': self.change + datetime.timedelta(days=1),
+            'end': self.end,
+        }
+
+        ut1, ut2 = UsageTypeFactory.create_batch(2, usage_type='BU')
+        ut3 = UsageTypeFactory(usage_type='BU', by_warehouse=True)
+        DailyUsageFactory(type=ut1, date=self.start)
+        DailyUsageFactory(type=ut2, date=self.end)
+        UsagePriceFactory(type=ut3, warehouse=WarehouseFactory(), **before)
+
+        ps1 = PricingServiceFactory(plugin_type=FIXED_PRICE_PLUGIN)
+        ServiceUsageTypes.objects.create(
+            usage_type=ut1, pricing_service=ps1, **after
+        )
+        UsagePriceFactory(type=ut1, cost=10, **before)
+        ps2 = PricingServiceFactory(plugin_type=UNIVERSAL_PLUGIN)
+        ut4 = UsageTypeFactory(usage_type='SU')
+        ServiceUsageTypes.objects.create(
+            usage_type=ut4, pricing_service=ps2, percent=70, **before
+        )
+        ServiceUsageTypes.objects.create(
+            usage_type=ut4, pricing_service=ps2, percent=100, **after
+        )
+        DailyUsageFactory(type=ut4, date=self.change)
+
+        t1, t2 = TeamFactory.create_batch(2)
+        TeamCostFactory(team=t1, cost=10, forecast_cost=10, **after)
+        TeamCostFactory(team=t2, cost=0, forecast_cost=10, **before)
+
+        dect = DynamicExtraCostTypeFactory()
+        DynamicExtraCostFactory(
+            dynamic_extra_cost_type=dect, cost=10, forecast_cost=0, **before
+        )
+        DynamicExtraCostDivisionFactory(
+            dynamic_extra_cost_type=dect, percent=100, usage_type=ut2,
+        )
+
+        CostDateStatusFactory(date=self.change, accepted=True)
+
+    def _get_daily_errors(self, forecast):
+        result = {}
+        day = self.start
+        while day <= self.end:
+            try:
+                DataForReportValidator(day, forecast=forecast).validate()
+            except DataForReportValidationError as e:
+                result[day] = e.errors
+            else:
+                result[day] = []
+            day += datetime.timedelta(days=1)
+        return result
+
+    def test_errors_are_the_same_as_for_single_days(self):
+        for forecast in (False, True):
+            errors = DataForReportRangeValidator(
+                self.start, self.end, forecast=forecast
+            ).get_errors()
+            self.assertEqual(dict(errors), self._get_daily_errors(forecast))
+            self.assertEqual(list(errors.keys()), sorted(errors.keys()))
+
+    def test_validate(self):
+        with self.assertRaises(DataForReportValidationError) as cm:
+            DataForReportRangeValidator(self.start, self.end).validate()
+        self.assertEqual(
+            set(cm.exception.errors.keys()),
+            set(day for day, e in self._get_daily_errors(False).items() if e)
+        )
+
+    def test_number_of_queries_does_not_depend_on_range(self):
+        with CaptureQueriesContext(connection) as day_queries:
+            DataForReportRangeValidator(self.start, self.start).get_errors()
+        with CaptureQueriesContext(connection) as range_queries:
+            DataForReportRangeValidator(self.start, self.end).get_errors()
+        self.assertEqual(
+            len(range_queries.captured_queries),
+            len(day_queries.captured_queries),
+        )
+
+    def test_active_usage_types_are_the_same_as_for_single_day(self):
+        ut1, ut2 = UsageTypeFactory.create_batch(2, usage_type='SU')
+        # division for the day of active pricing service
+        ServiceUsageTypes.objects.create(
+            usage_type=ut1,
+            pricing_service=PricingServiceFactory(active=True),
+            start=self.start,
+            end=self.end,
+        )
+        # active pricing service with division only for the first day and
+        # division for the other days of inactive pricing service
+        ServiceUsageTypes.objects.create(
+            usage_type=ut2,
+            pricing_service=PricingServiceFactory(active=True),
+            start=self.start - datetime.timedelta(days=10),
+            end=self.start,
+        )
+        ServiceUsageTypes.objects.create(
+            usage_type=ut2,
+            pricing_service=PricingServiceFactory(active=False),
+            start=self.start + datetime.timedelta(days=1),
+            end=self.end,
+        )
+        range_validator = DataForReportRangeValidator(self.start, self.end)
+        for day in (self.start, self.end):
+            expected = set(DataForReportValidator(day).active_usage_types)
+            self.assertEqual(
+                set(DataForReportRangeValidator(
+                    day, day
+                )._get_active_usage_types(day)),
+                expected,
+            )
+            self.assertEqual(
+                set(range_validator._get_active_usage_types(day)), expected
+            )
+            self.assertIn(ut1, expected)
+        self.assertIn(
+            ut2, range_validator._get_active_usage_types(self.start)
+        )
+        self.assertNotIn(
+            ut2, range_validator._get_active_usage_types(self.end)
+        )
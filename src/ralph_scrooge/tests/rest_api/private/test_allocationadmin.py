@@ -7,8 +7,15 @@ from __future__ import unicode_literals
 
 import json
 import datetime
+import os
+import time
+from unittest import skipUnless
 
 from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
 from rest_framework.test import APIClient
 
 from ralph_scrooge import models
@@ -20,6 +27,10 @@ from ralph_scrooge.rest_api.private.allocationadmin import (
     ServiceEnvironmentDoesNotExistError,
     TeamDoesNotExistError,
 )
+from ralph_scrooge.rest_api.private.allocation_bulk import (
+    ALLOCATION_ADMIN_CACHE_NAME,
+    BulkUpsert,
+)
 from ralph_scrooge.rest_api.common import get_dates
 from ralph_scrooge.tests import ScroogeTestCase
 from ralph_scrooge.tests.utils import factory
@@ -1055,3 +1066,347 @@ class TestAllocationAdmin(ScroogeTestCase):
         self.assertEquals(team_cost.start, first_day)
         self.assertEquals(team_cost.end, last_day)
         self.assertEquals(team_cost.team, team)
+
+    def _get_allocation_admin(self):
+        return json.loads(self.client.get(
+            '/scrooge/rest/allocationadmin/{0}/{1}/'.format(
+                self.date.year,
+                self.date.month,
+            )
+        ).content)
+
+    def _create_allocations(self, count):
+        first_day, last_day, days_in_month = get_dates(
+            self.date.year,
+            self.date.month,
+        )
+        warehouse = factory.WarehouseFactory(show_in_report=True)
+        for i in range(count):
+            for by_warehouse in (False, True):
+                factory.UsagePriceFactory(
+                    type=factory.UsageTypeFactory(
+                        is_manually_type=True,
+                        usage_type='BU',
+                        by_warehouse=by_warehouse,
+                    ),
+                    start=first_day,
+                    end=last_day,
+                    warehouse=warehouse if by_warehouse else None,
+                    cost=10,
+                )
+            factory.TeamCostFactory(start=first_day, end=last_day)
+            factory.DynamicExtraCostFactory(start=first_day, end=last_day)
+            factory.ExtraCostFactory(start=first_day, end=last_day)
+
+    def test_get_allocation_admin_query_count_does_not_depend_on_types(self):
+        def count_queries():
+            with CaptureQueriesContext(connection) as queries:
+                self._get_allocation_admin()
+            return len(queries)
+        self._create_allocations(1)
+        queries_count = count_queries()
+        self._create_allocations(5)
+        self.assertEqual(count_queries(), queries_count)
+        content = self._get_allocation_admin()
+        self.assertEqual(len(content['teamcosts']['rows']), 6)
+        self.assertEqual(
+            len([r for r in content['baseusages']['rows'] if r['cost']]),
+            12
+        )
+        self.assertEqual(
+            sum(
+                len(r['extra_costs'])
+                for r in content['extracosts']['rows']
+            ),
+            6
+        )
+
+    @override_settings(ALLOCATION_ADMIN_CACHE_TIMEOUT=60)
+    def test_get_allocation_admin_is_cached_until_post(self):
+        caches[ALLOCATION_ADMIN_CACHE_NAME].clear()
+        team = factory.TeamFactory()
+        self._get_allocation_admin()
+        with CaptureQueriesContext(connection) as queries:
+            content = self._get_allocation_admin()
+        self.assertFalse([
+            q for q in queries
+            if models.Team._meta.db_table in q['sql']
+        ])
+        self.assertEqual(content['teamcosts']['rows'][0]['cost'], 0)
+        self.client.post(
+            '/scrooge/rest/allocationadmin/{0}/{1}/teamcosts/save'.format(
+                self.date.year,
+                self.date.month,
+            ),
+            {
+                "rows": [{
+                    'team': {'id': team.id, 'name': team.name},
+                    'cost': 100.0,
+                    'forecast_cost': 0.0,
+                    'members': 1,
+                }],
+            },
+            format='json'
+        )
+        content = self._get_allocation_admin()
+        self.assertEqual(content['teamcosts']['rows'][0]['cost'], 100)
+
+    @override_settings(ALLOCATION_ADMIN_CACHE_TIMEOUT=60)
+    def test_get_allocation_admin_is_invalidated_by_client_extra_cost(self):
+        caches[ALLOCATION_ADMIN_CACHE_NAME].clear()
+        service_environment = factory.ServiceEnvironmentFactory()
+        self._get_allocation_admin()
+        self.client.post(
+            '/scrooge/rest/allocationclient/{0}/{1}/{2}/{3}/{4}/save/'.format(
+                service_environment.service.id,
+                service_environment.environment.id,
+                self.date.year,
+                self.date.month,
+                'serviceextracost'
+            ),
+            {'rows': [{'value': 100, 'remarks': ''}]},
+            format='json'
+        )
+        content = self._get_allocation_admin()
+        self.assertEqual(
+            [
+                ec['cost'] for r in content['extracosts']['rows']
+                for ec in r['extra_costs']
+            ],
+            [100],
+        )
+
+    @override_settings(ALLOCATION_ADMIN_CACHE_TIMEOUT=60)
+    def test_get_allocation_admin_is_invalidated_by_model_changes(self):
+        caches[ALLOCATION_ADMIN_CACHE_NAME].clear()
+        first_day, last_day, days_in_month = get_dates(
+            self.date.year,
+            self.date.month,
+        )
+        team = factory.TeamFactory()
+        self._get_allocation_admin()
+        # ex. changes made in Django admin
+        team.name = 'renamed team'
+        team.save()
+        content = self._get_allocation_admin()
+        self.assertEqual(
+            content['teamcosts']['rows'][0]['team']['name'], 'renamed team'
+        )
+        team_cost = models.TeamCost.objects.create(
+            team=team, start=first_day, end=last_day, cost=100,
+            forecast_cost=0, members_count=1,
+        )
+        content = self._get_allocation_admin()
+        self.assertEqual(content['teamcosts']['rows'][0]['cost'], 100)
+        team_cost.delete()
+        content = self._get_allocation_admin()
+        self.assertEqual(content['teamcosts']['rows'][0]['cost'], 0)
+
+    def test_save_price_not_starting_at_first_day_of_month(self):
+        caches[ALLOCATION_ADMIN_CACHE_NAME].clear()
+        usage_type = factory.UsageTypeFactory(usage_type='BU')
+        # ex. prices valid "forever" saved by ralph3_asset plugin
+        models.UsagePrice.objects.create(
+            type=usage_type,
+            start=datetime.date.min,
+            end=datetime.date.max,
+            price=1,
+            forecast_price=1,
+        )
+        self.assertEqual(models.UsagePrice.objects.count(), 1)
+
+    def _upload_extra_costs(self, extra_cost_type, lines):
+        return self.client.post(
+            '/scrooge/rest/allocationadmin/{0}/{1}/extracosts/save'.format(
+                self.date.year,
+                self.date.month,
+            ),
+            {
+                'extra_cost_type_id': extra_cost_type.id,
+                'file': SimpleUploadedFile('costs.csv', '\n'.join(
+                    ['service_env_id;cost;forecast_cost'] + lines
+                ).encode('utf-8')),
+            },
+        )
+
+    def test_upload_extra_costs(self):
+        first_day, last_day, days_in_month = get_dates(
+            self.date.year,
+            self.date.month,
+        )
+        extra_cost_type = factory.ExtraCostTypeFactory()
+        other_extra_cost_type = factory.ExtraCostTypeFactory()
+        se1, se2 = factory.ServiceEnvironmentFactory.create_batch(2)
+        for ect in (extra_cost_type, other_extra_cost_type):
+            models.ExtraCost.objects.create(
+                cost=50.0,
+                service_environment=se1,
+                extra_cost_type=ect,
+                start=first_day,
+                end=last_day,
+            )
+        response = self._upload_extra_costs(extra_cost_type, [
+            '{};10.5;'.format(se1.id),
+            '{};20;30'.format(se2.id),
+            '{};40;'.format(se2.id),
+        ])
+        self.assertEqual(json.loads(response.content), {'status': True})
+        self.assertEqual(
+            set(models.ExtraCost.objects.filter(
+                extra_cost_type=extra_cost_type,
+            ).values_list('service_environment', 'cost', 'forecast_cost')),
+            {(se1.id, 10.5, 0), (se2.id, 20, 30), (se2.id, 40, 0)},
+        )
+        # extra costs of other types are left untouched
+        self.assertEqual(models.ExtraCost.objects.filter(
+            extra_cost_type=other_extra_cost_type
+        ).count(), 1)
+
+    def test_upload_extra_costs_reports_all_row_errors(self):
+        extra_cost_type = factory.ExtraCostTypeFactory()
+        service_environment = factory.ServiceEnvironmentFactory()
+        response = self._upload_extra_costs(extra_cost_type, [
+            '{};10;'.format(service_environment.id),
+            '999999;10;',
+            '{};abc;'.format(service_environment.id),
+            'xyz;10;',
+        ])
+        content = json.loads(response.content)
+        self.assertFalse(content['status'])
+        self.assertEqual(content['errors'][0], (
+            'Row 2: Service environment not found for ID: 999999'
+        ))
+        self.assertEqual(
+            content['errors'][1], 'Row 4: Service environment not found for '
+            'ID: xyz'
+        )
+        self.assertEqual(len(content['errors']), 2)
+
+        response = self._upload_extra_costs(extra_cost_type, [
+            '{};10;'.format(service_environment.id),
+            '{};abc;'.format(service_environment.id),
+            '{};20;x'.format(service_environment.id),
+        ])
+        content = json.loads(response.content)
+        self.assertFalse(content['status'])
+        self.assertEqual(len(content['errors']), 2)
+        self.assertTrue(content['errors'][0].startswith('Row 2: cost: '))
+        self.assertTrue(
+            content['errors'][1].startswith('Row 3: forecast_cost: ')
+        )
+        self.assertEqual(models.ExtraCost.objects.count(), 0)
+
+    def test_upload_extra_costs_query_count_does_not_depend_on_rows(self):
+        service_environments = factory.ServiceEnvironmentFactory.create_batch(
+            10
+        )
+
+        def count_queries(rows_count):
+            extra_cost_type = factory.ExtraCostTypeFactory()
+            with CaptureQueriesContext(connection) as queries:
+                self._upload_extra_costs(extra_cost_type, [
+                    '{};{};'.format(se.id, i)
+                    for i, se in enumerate(service_environments[:rows_count])
+                ])
+            self.assertEqual(
+                extra_cost_type.extracost_set.count(), rows_count
+            )
+            return len(queries)
+        self.assertEqual(count_queries(1), count_queries(10))
+
+    def test_save_team_costs_reports_all_row_errors(self):
+        team = factory.TeamFactory()
+        with self.assertRaises(TeamDoesNotExistError) as cm:
+            self.client.post(
+                '/scrooge/rest/allocationadmin/{0}/{1}/teamcosts/save'.format(
+                    self.date.year,
+                    self.date.month,
+                ),
+                {
+                    "rows": [{
+                        'team': {'id': 0, 'name': 'abc'},
+                        'cost': 0.0,
+                        'forecast_cost': 0.0,
+                        'members': 0,
+                    }, {
+                        'team': {'id': team.id, 'name': team.name},
+                        'cost': 'abc',
+                        'forecast_cost': 0.0,
+                        'members': 0,
+                    }],
+                },
+                format='json'
+            )
+        self.assertEqual(len(cm.exception.errors), 2)
+        self.assertEqual(
+            cm.exception.errors[0], 'Row 1: Team with id 0 does not exist'
+        )
+        self.assertTrue(cm.exception.errors[1].startswith('Row 2: cost: '))
+        self.assertEqual(models.TeamCost.objects.count(), 0)
+
+    def test_bulk_upsert(self):
+        first_day, last_day, days_in_month = get_dates(
+            self.date.year,
+            self.date.month,
+        )
+        unchanged, changed, deleted = [
+            factory.TeamCostFactory(
+                start=first_day, end=last_day, cost=10, members_count=1,
+            ) for i in range(3)
+        ]
+        new_team = factory.TeamFactory()
+        upsert = BulkUpsert(
+            models.TeamCost, ('team_id',), ('cost', 'members_count')
+        )
+        upsert.load(
+            models.TeamCost.objects.filter(start=first_day, end=last_day),
+            delete_missing=True,
+        )
+        for team, cost in [
+            (unchanged.team, '10.00'), (changed.team, 20), (new_team, 30),
+        ]:
+            upsert.add(
+                (team.id,),
+                upsert.clean(cost=cost, members_count='1'),
+                start=first_day,
+                end=last_day,
+            )
+        with CaptureQueriesContext(connection) as queries:
+            result = upsert.save()
+        self.assertEqual(
+            result, {'created': 1, 'updated': 1, 'deleted': 1}
+        )
+        # insert, update, select and delete of deleted team cost (with its
+        # percents)
+        self.assertEqual(len(queries), 5)
+        self.assertEqual(
+            set(models.TeamCost.objects.values_list('team', 'cost')),
+            {(unchanged.team_id, 10), (changed.team_id, 20), (new_team.id, 30)}
+        )
+
+    @skipUnless(
+        os.environ.get('SCROOGE_BENCHMARKS'),
+        'set SCROOGE_BENCHMARKS env variable to run benchmarks'
+    )
+    def test_benchmark_upload_extra_costs(self):
+        rows_count, service_environments_count = 10000, 1000
+        extra_cost_type = factory.ExtraCostTypeFactory()
+        service_environments = (
+            factory.ServiceEnvironmentFactory.create_batch(
+                service_environments_count
+            )
+        )
+        lines = [
+            '{};{}.5;{}'.format(
+                service_environments[i % service_environments_count].id, i, i
+            ) for i in range(rows_count)
+        ]
+        for action in ('create', 'replace'):
+            start = time.time()
+            response = self._upload_extra_costs(extra_cost_type, lines)
+            duration = time.time() - start
+            self.assertEqual(json.loads(response.content), {'status': True})
+            self.assertEqual(models.ExtraCost.objects.count(), rows_count)
+            print('\nExtra costs upload ({}): {} rows in {:.2f}s'.format(
+                action, rows_count, duration
+            ))
@@ -11,6 +11,8 @@ from datetime import timedelta
 from dateutil.relativedelta import relativedelta
 
 from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from rest_framework.test import APIClient
 
 from ralph_scrooge.tests import ScroogeTestCase
@@ -435,3 +437,146 @@ class TestAllocationClient(ScroogeTestCase):
                 "template": "taballocationclientdivision.html",
             }
         )
+
+    def _save_service_division(self, service_environment_base, rows):
+        return self.client.post(
+            '/scrooge/rest/allocationclient/{0}/{1}/{2}/{3}/{4}/save/'.format(
+                service_environment_base.service.id,
+                service_environment_base.environment.id,
+                self.date.year,
+                self.date.month,
+                'servicedivision'
+            ),
+            {
+                'rows': [{
+                    "service": se.service.id,
+                    "env": se.environment.id,
+                    "value": value,
+                } for se, value in rows]
+            },
+            format='json'
+        )
+
+    def test_save_service_division_replaces_usages_of_month(self):
+        service_environment_base = factory.ServiceEnvironmentFactory()
+        service_environments = factory.ServiceEnvironmentFactory.create_batch(
+            3
+        )
+        self._save_service_division(
+            service_environment_base,
+            [(se, 10) for se in service_environments],
+        )
+        self.assertEqual(models.DailyUsage.objects.count(), 3 * 31)
+        response = self._save_service_division(
+            service_environment_base, [(service_environments[0], 20)]
+        )
+        self.assertEqual(json.loads(response.content), {'status': True})
+        self.assertEqual(
+            set(models.DailyUsage.objects.values_list(
+                'service_environment', 'value',
+            )),
+            {(service_environments[0].id, 20)},
+        )
+        self.assertEqual(
+            set(models.DailyUsage.objects.values_list('date', flat=True)),
+            set(self.date + timedelta(days=i) for i in range(31)),
+        )
+        # daily pricing objects are reused
+        self.assertEqual(
+            models.DailyPricingObject.objects.filter(
+                pricing_object__type_id=models.PRICING_OBJECT_TYPES.DUMMY,
+                service_environment__in=service_environments,
+            ).count(),
+            3 * 31
+        )
+        for du in models.DailyUsage.objects.select_related(
+            'daily_pricing_object__pricing_object'
+        ):
+            self.assertEqual(du.daily_pricing_object.date, du.date)
+            self.assertEqual(
+                du.daily_pricing_object.pricing_object,
+                service_environments[0].dummy_pricing_object,
+            )
+
+    def test_save_service_division_query_count_does_not_depend_on_rows(self):
+        def count_queries(rows_count):
+            service_environment_base = factory.ServiceEnvironmentFactory()
+            rows = [
+                (se, 10) for se in
+                factory.ServiceEnvironmentFactory.create_batch(rows_count)
+            ]
+            with CaptureQueriesContext(connection) as queries:
+                self._save_service_division(service_environment_base, rows)
+            self.assertEqual(
+                models.DailyUsage.objects.filter(
+                    service_environment__in=[r[0] for r in rows]
+                ).count(),
+                rows_count * 31
+            )
+            # inserts are done in batches (limited by database backend)
+            return len([
+                q for q in queries if not q['sql'].startswith('INSERT')
+            ])
+        self.assertEqual(count_queries(1), count_queries(10))
+
+    def test_save_service_division_when_service_environment_not_found(self):
+        service_environment_base = factory.ServiceEnvironmentFactory()
+        service_environment = factory.ServiceEnvironmentFactory()
+        response = self.client.post(
+            '/scrooge/rest/allocationclient/{0}/{1}/{2}/{3}/{4}/save/'.format(
+                service_environment_base.service.id,
+                service_environment_base.environment.id,
+                self.date.year,
+                self.date.month,
+                'servicedivision'
+            ),
+            {
+                'rows': [{
+                    "service": service_environment.service.id,
+                    "env": service_environment.environment.id + 100,
+                    "value": 100,
+                }]
+            },
+            format='json'
+        )
+        self.assertEqual(json.loads(response.content), {
+            'status': False,
+            'errors': [
+                'Service environment not found for service: {}, '
+                'environment: {}'.format(
+                    service_environment.service.id,
+                    service_environment.environment.id + 100,
+                )
+            ],
+        })
+        self.assertEqual(models.DailyUsage.objects.count(), 0)
+
+    def test_save_team_division_replaces_percents_of_month(self):
+        team = factory.TeamFactory()
+        se1, se2 = factory.ServiceEnvironmentFactory.create_batch(2)
+        url = '/scrooge/rest/allocationclient/{0}/{1}/{2}/{3}/save/'.format(
+            team.id, self.date.year, self.date.month, 'teamdivision'
+        )
+        self.client.post(url, {'rows': [
+            {"service": se1.service.id, "env": se1.environment.id,
+             "value": 40},
+            {"service": se2.service.id, "env": se2.environment.id,
+             "value": 60},
+        ]}, format='json')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(url, {'rows': [
+                {"service": se2.service.id, "env": se2.environment.id,
+                 "value": 50},
+                {"service": se2.service.id, "env": se2.environment.id,
+                 "value": 100},
+            ]}, format='json')
+        self.assertEqual(json.loads(response.content), {'status': True})
+        self.assertEqual(
+            list(models.TeamServiceEnvironmentPercent.objects.values_list(
+                'service_environment', 'percent'
+            )),
+            [(se2.id, 100)],
+        )
+        self.assertEqual(len([
+            q for q in queries if q['sql'].startswith('INSERT')
+        ]), 1)
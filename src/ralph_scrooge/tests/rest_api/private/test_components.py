@@ -178,6 +178,7 @@ class TestComponents(ScroogeTestCase):
                 '2': 'Serv',
             },
             'color': asset_type.color,
+            'next': None,
         })
 
     def test_api_view_returns_data_from_pricing_objects(self):
@@ -195,3 +196,56 @@ class TestComponents(ScroogeTestCase):
         ))
         data = json.loads(resp.content)
         self.assertEqual(len(data[0]['value']), 2)
+
+    def _get_components(self, **params):
+        if not get_user_model().objects.filter(username='test').exists():
+            get_user_model().objects.create_superuser(
+                'test', 'test@test.test', 'test'
+            )
+        client = APIClient()
+        client.login(username='test', password='test')
+        resp = client.get(
+            '/scrooge/rest/components/{}/{}/{}/{}/'.format(
+                self.se1.service.id,
+                self.today.year,
+                self.today.month,
+                self.today.day,
+            ),
+            params,
+        )
+        return resp.status_code, json.loads(resp.content)
+
+    def test_api_view_returns_counts(self):
+        _, data = self._get_components(counts=1)
+        assets = [d for d in data if d['slug'] == 'asset'][0]
+        self.assertEqual(assets['count'], 3)
+        self.assertNotIn('value', assets)
+        self.assertEqual(assets['schema']['1'], 'Name')
+
+    def test_api_view_pagination(self):
+        _, data = self._get_components(type='asset', limit=2)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(
+            [v['0'] for v in data[0]['value']],
+            [self.dpo1.pricing_object.id, self.dpo2.pricing_object.id],
+        )
+        self.assertEqual(data[0]['next'], self.dpo2.id)
+        _, data = self._get_components(
+            type='asset', limit=2, after=data[0]['next']
+        )
+        self.assertEqual(len(data[0]['value']), 1)
+        self.assertIsNone(data[0]['next'])
+
+    def test_api_view_filters(self):
+        self.dpo2.pricing_object.name = 'Filtered Asset'
+        self.dpo2.pricing_object.save()
+        _, data = self._get_components(type='asset', filter_1='filtered')
+        self.assertEqual(
+            [v['0'] for v in data[0]['value']], [self.dpo2.pricing_object.id]
+        )
+        _, data = self._get_components(counts=1, filter_99='x')
+        self.assertEqual(set(d['count'] for d in data), {0})
+
+    def test_api_view_invalid_limit(self):
+        status_code, _ = self._get_components(limit='a')
+        self.assertEqual(status_code, 400)
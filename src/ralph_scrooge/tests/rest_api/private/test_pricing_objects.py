@@ -11,7 +11,10 @@ from decimal import Decimal
 
 from django.contrib.auth import get_user_model
 from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
+from ralph_scrooge.models import DailyCost
 from ralph_scrooge.rest_api.private.components import ComponentsContent
 from ralph_scrooge.tests import ScroogeTestCase
 from ralph_scrooge.tests.utils.factory import (
@@ -160,3 +163,71 @@ class TestPricingObjects(ScroogeTestCase):
                 }
             }
         )
+
+    def _get_pricing_object_costs(self, **params):
+        if not get_user_model().objects.filter(username='test').exists():
+            get_user_model().objects.create_superuser(
+                'test', 'test@test.test', 'test'
+            )
+        client = APIClient()
+        client.login(username='test', password='test')
+        resp = client.get(
+            reverse(
+                'pricing_object_costs',
+                args=[
+                    self.se1.service.id,
+                    self.se1.environment.id,
+                    self.today.strftime('%Y-%m-%d'),
+                    self.today.strftime('%Y-%m-%d')
+                ]
+            ),
+            params,
+        )
+        return resp.status_code, json.loads(resp.content)
+
+    def test_pricing_objects_view_pagination(self):
+        _, data = self._get_pricing_object_costs(limit=1)
+        assets = data[0]
+        self.assertEqual(assets['slug'], 'asset')
+        self.assertEqual(
+            [v['0'] for v in assets['value']], [self.dpo1.pricing_object.id]
+        )
+        self.assertEqual(assets['next'], self.dpo1.pricing_object.id)
+        self.assertEqual(data[-1]['name'], 'Other')
+
+        _, data = self._get_pricing_object_costs(
+            limit=1, type='asset', after=assets['next']
+        )
+        self.assertEqual(len(data), 1)
+        self.assertEqual(
+            [v['0'] for v in data[0]['value']], [self.dpo2.pricing_object.id]
+        )
+        self.assertEqual(data[0]['value'][0]['__nested'], [])
+        self.assertIsNone(data[0]['next'])
+
+    def test_pricing_objects_view_lazy_nested_costs(self):
+        _, data = self._get_pricing_object_costs(nested=0)
+        self.assertNotIn('__nested', data[0]['value'][0])
+        _, nested = self._get_pricing_object_costs(
+            pricing_object=self.dpo1.pricing_object.id
+        )
+        self.assertEqual(
+            {(n['0'], Decimal(n['2'])) for n in nested},
+            {(self.ut1.name, Decimal('50.0')), (self.ut2.name, Decimal('35'))}
+        )
+
+    def test_pricing_objects_view_invalid_limit(self):
+        status_code, _ = self._get_pricing_object_costs(limit=0)
+        self.assertEqual(status_code, 400)
+
+    def test_pricing_objects_view_costs_are_fetched_in_single_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            self._get_pricing_object_costs()
+        # nested costs and other costs
+        self.assertEqual(
+            len([
+                q for q in queries
+                if 'FROM "{}"'.format(DailyCost._meta.db_table) in q['sql']
+            ]),
+            2
+        )
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import datetime
+import json
+
+import mock
+from django.contrib.auth import get_user_model
+from django.core.urlresolvers import reverse
+from django.db import IntegrityError, transaction
+from django.test.utils import override_settings
+from rest_framework.test import APIClient
+
+from ralph_scrooge.models import (
+    DailyUsage,
+    ServiceUsageTypes,
+    UsagesUpload,
+    UsagesUploadStatus,
+)
+from ralph_scrooge.rest_api.public.v0_9.async_pricing_service_usages import (
+    get_payload_hash,
+)
+from ralph_scrooge.tests import ScroogeTestCase
+from ralph_scrooge.tests.utils.factory import (
+    PricingObjectFactory,
+    PricingServiceFactory,
+    UsageTypeFactory,
+)
+
+
+class TestAsyncPricingServiceUsages(ScroogeTestCase):
+    def setUp(self):
+        self.date = datetime.date(2016, 9, 8)
+        self.pricing_service = PricingServiceFactory()
+        self.pricing_object = PricingObjectFactory()
+        self.usage_type = UsageTypeFactory()
+        ServiceUsageTypes.objects.create(
+            usage_type=self.usage_type,
+            pricing_service=self.pricing_service,
+            start=datetime.date(2016, 9, 1),
+            end=datetime.date.max,
+        )
+        superuser = get_user_model().objects.create_superuser(
+            'test', 'test@test.test', 'test'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(superuser)
+        self.payload = {
+            "pricing_service": self.pricing_service.name,
+            "date": self.date.strftime("%Y-%m-%d"),
+            "usages": [{
+                "pricing_object": self.pricing_object.name,
+                "usages": [{"symbol": self.usage_type.symbol, "value": 40}],
+            }],
+        }
+
+    def _post(self, payload):
+        return self.client.post(
+            reverse('create_pricing_service_usages_async_v10'),
+            json.dumps(payload),
+            content_type='application/json',
+        )
+
+    def test_payload_hash_does_not_depend_on_keys_order(self):
+        self.assertEqual(
+            get_payload_hash({'a': 1, 'b': [1, 2]}),
+            get_payload_hash({'b': [1, 2], 'a': 1}),
+        )
+        self.assertNotEqual(
+            get_payload_hash({'a': 1, 'b': [1, 2]}),
+            get_payload_hash({'a': 1, 'b': [2, 1]}),
+        )
+
+    def test_upload_usages(self):
+        resp = self._post(self.payload)
+        self.assertEqual(resp.status_code, 202)
+        upload = UsagesUpload.objects.get()
+        self.assertEqual(json.loads(resp.content), {
+            'id': upload.id,
+            'status': 'finished',
+            'status_url': reverse(
+                'pricing_service_usages_upload_status_v10',
+                kwargs={'upload_id': upload.id}
+            ),
+            'result': {'saved': 1, 'ignored': []},
+        })
+        self.assertNotEqual(upload.job_id, '')
+        self.assertEqual(DailyUsage.objects.get().value, 40)
+
+        resp = self.client.get(json.loads(resp.content)['status_url'])
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.content)['status'], 'finished')
+
+    def test_identical_payloads_are_coalesced_while_in_progress(self):
+        upload = UsagesUpload.objects.create(
+            payload=json.dumps(self.payload),
+            payload_hash=get_payload_hash(self.payload),
+            status=UsagesUploadStatus.running.id,
+        )
+        # the same content, different order of keys
+        payload = dict(reversed(list(self.payload.items())))
+        resp = self._post(payload)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.content)['id'], upload.id)
+        self.assertEqual(UsagesUpload.objects.count(), 1)
+        self.assertEqual(DailyUsage.objects.count(), 0)
+
+    def test_concurrent_identical_uploads_are_coalesced(self):
+        uploads = []
+
+        def get_payload_hash_with_concurrent_upload(payload):
+            # identical upload is created (and committed) by another request
+            # while this one is processed
+            payload_hash = get_payload_hash(payload)
+            uploads.append(UsagesUpload.objects.create(
+                payload=json.dumps(payload), payload_hash=payload_hash,
+            ))
+            return payload_hash
+
+        with mock.patch(
+            'ralph_scrooge.rest_api.public.v0_9.async_pricing_service_usages.'
+            'get_payload_hash',
+            side_effect=get_payload_hash_with_concurrent_upload,
+        ), mock.patch(
+            'ralph_scrooge.rest_api.public.v0_9.async_pricing_service_usages.'
+            'UsagesUploadJob.run_on_worker'
+        ) as run_on_worker_mock:
+            resp = self._post(self.payload)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.content)['id'], uploads[0].id)
+        self.assertEqual(UsagesUpload.objects.count(), 1)
+        self.assertFalse(run_on_worker_mock.called)
+
+    def test_only_one_identical_upload_is_in_progress(self):
+        for upload_status in (
+            UsagesUploadStatus.finished, UsagesUploadStatus.failed,
+            UsagesUploadStatus.queued,
+        ):
+            UsagesUpload.objects.create(
+                payload='{}', payload_hash='abc', status=upload_status.id,
+            )
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            UsagesUpload.objects.create(
+                payload='{}',
+                payload_hash='abc',
+                status=UsagesUploadStatus.running.id,
+            )
+
+    def test_processed_payload_is_applied_again(self):
+        self.payload['overwrite'] = 'values_only'
+        payload_b = json.loads(json.dumps(self.payload))
+        payload_b['usages'][0]['usages'][0]['value'] = 50
+        for payload, value in [
+            (self.payload, 40), (payload_b, 50), (self.payload, 40)
+        ]:
+            resp = self._post(payload)
+            self.assertEqual(resp.status_code, 202)
+            self.assertEqual(json.loads(resp.content)['status'], 'finished')
+            self.assertEqual(DailyUsage.objects.get().value, value)
+        self.assertEqual(UsagesUpload.objects.count(), 3)
+
+    @override_settings(CACHES={
+        'default': {
+            'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+        },
+    })
+    def test_upload_usages_with_dummy_cache(self):
+        # job is run inline (without RQ)
+        resp = self._post(self.payload)
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(json.loads(resp.content)['status'], 'finished')
+        self.assertEqual(UsagesUpload.objects.get().job_id, '')
+        self.assertEqual(DailyUsage.objects.get().value, 40)
+
+    def test_upload_invalid_usages(self):
+        self.payload['usages'][0]['pricing_object'] = 'unknown'
+        resp = self._post(self.payload)
+        self.assertEqual(resp.status_code, 202)
+        content = json.loads(resp.content)
+        self.assertEqual(content['status'], 'failed')
+        self.assertEqual(content['result'], {'errors': {'usages': [{
+            'row': 0, 'errors': ['pricing_object unknown does not exist'],
+        }]}})
+        self.assertEqual(DailyUsage.objects.count(), 0)
+
+    def test_failed_upload_is_processed_again(self):
+        with mock.patch(
+            'ralph_scrooge.rest_api.public.v0_9.async_pricing_service_usages.'
+            '_recalculate_costs'
+        ) as recalculate_mock:
+            recalculate_mock.side_effect = ValueError('error')
+            resp = self._post(self.payload)
+        self.assertEqual(json.loads(resp.content)['status'], 'failed')
+        # usages are saved in transaction with recalculation
+        self.assertEqual(DailyUsage.objects.count(), 0)
+
+        resp = self._post(self.payload)
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(json.loads(resp.content)['status'], 'finished')
+        self.assertEqual(
+            list(UsagesUpload.objects.order_by('id').values_list(
+                'status', flat=True
+            )),
+            [UsagesUploadStatus.failed.id, UsagesUploadStatus.finished.id]
+        )
+        self.assertEqual(DailyUsage.objects.count(), 1)
+
+    def test_status_of_not_existing_upload(self):
+        resp = self.client.get(reverse(
+            'pricing_service_usages_upload_status_v10',
+            kwargs={'upload_id': 1234}
+        ))
+        self.assertEqual(resp.status_code, 404)
+
+    def test_status_when_job_does_not_exist(self):
+        upload = UsagesUpload.objects.create(
+            payload='{}',
+            payload_hash='abc',
+            status=UsagesUploadStatus.running.id,
+            job_id='not-existing-job',
+        )
+        resp = self.client.get(reverse(
+            'pricing_service_usages_upload_status_v10',
+            kwargs={'upload_id': upload.id}
+        ))
+        self.assertEqual(json.loads(resp.content)['status'], 'failed')
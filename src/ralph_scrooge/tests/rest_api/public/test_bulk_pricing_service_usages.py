@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import datetime
+import json
+import os
+import time
+from unittest import skipUnless
+
+import mock
+from django.contrib.auth import get_user_model
+from django.core.urlresolvers import reverse
+from rest_framework.test import APIClient
+
+from ralph_scrooge.models import (
+    DailyAssetInfo,
+    DailyPricingObject,
+    DailyUsage,
+    PricingObject,
+    ServiceUsageTypes,
+    UsageAnomalyStats,
+)
+from ralph_scrooge.rest_api.public.v0_9.bulk_pricing_service_usages import (
+    BulkUsagesLoader,
+)
+from ralph_scrooge.tests import ScroogeTestCase
+from ralph_scrooge.tests.utils.factory import (
+    AssetInfoFactory,
+    DailyUsageFactory,
+    PricingObjectFactory,
+    PricingServiceFactory,
+    ServiceEnvironmentFactory,
+    UsageTypeFactory,
+)
+
+
+class TestBulkPricingServiceUsages(ScroogeTestCase):
+    def setUp(self):
+        self.date = datetime.date(2016, 9, 8)
+        self.date_as_str = self.date.strftime("%Y-%m-%d")
+        self.pricing_service = PricingServiceFactory()
+        self.pricing_object1 = PricingObjectFactory()
+        self.pricing_object2 = PricingObjectFactory()
+        self.service_environment1 = self.pricing_object1.service_environment
+        self.service_environment2 = self.pricing_object2.service_environment
+        self.usage_type = UsageTypeFactory()
+        ServiceUsageTypes.objects.create(
+            usage_type=self.usage_type,
+            pricing_service=self.pricing_service,
+            start=datetime.date(2016, 9, 1),
+            end=datetime.date.max,
+        )
+        superuser = get_user_model().objects.create_superuser(
+            'test', 'test@test.test', 'test'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(superuser)
+
+    def _post(self, usages, **kwargs):
+        pricing_service_usage = {
+            "pricing_service": self.pricing_service.name,
+            "date": self.date_as_str,
+            "usages": usages,
+        }
+        pricing_service_usage.update(kwargs)
+        return self.client.post(
+            reverse('create_pricing_service_usages_bulk_v10'),
+            json.dumps(pricing_service_usage),
+            content_type='application/json',
+        )
+
+    def _usages(self, value, symbol=None, **kwargs):
+        kwargs['usages'] = [{
+            'symbol': symbol or self.usage_type.symbol,
+            'value': value,
+        }]
+        return kwargs
+
+    def test_save_usages(self):
+        se2 = self.service_environment2
+        resp = self._post([
+            self._usages(10, pricing_object=self.pricing_object1.name),
+            self._usages(
+                20,
+                service=se2.service.name,
+                environment=se2.environment.name,
+            ),
+            self._usages(
+                30,
+                service_id=se2.service.id,
+                environment=se2.environment.name,
+            ),
+            self._usages(
+                40,
+                service_uid=se2.service.ci_uid,
+                environment=se2.environment.name,
+            ),
+        ])
+        self.assertEquals(resp.status_code, 201)
+        self.assertEquals(json.loads(resp.content), {
+            'saved': 4, 'ignored': []
+        })
+        self.assertEquals(
+            list(DailyUsage.objects.order_by('id').values_list(
+                'date',
+                'type_id',
+                'value',
+                'service_environment_id',
+                'daily_pricing_object__pricing_object_id',
+            )),
+            [
+                (
+                    self.date, self.usage_type.id, 10,
+                    self.service_environment1.id, self.pricing_object1.id
+                ),
+            ] + [
+                (
+                    self.date, self.usage_type.id, value, se2.id,
+                    se2.dummy_pricing_object.id
+                ) for value in (20, 30, 40)
+            ]
+        )
+        # single daily pricing object for dummy pricing object
+        self.assertEquals(
+            DailyPricingObject.objects.filter(
+                pricing_object=se2.dummy_pricing_object
+            ).count(),
+            1
+        )
+
+    # statistics are updated after commit (which never happens in TestCase)
+    @mock.patch(
+        'ralph_scrooge.utils.usage_anomalies.transaction.on_commit',
+        lambda func: func()
+    )
+    def test_save_usages_updates_usage_anomaly_stats(self):
+        resp = self._post([
+            self._usages(10, pricing_object=self.pricing_object1.name),
+        ])
+        self.assertEquals(resp.status_code, 201)
+        stats = UsageAnomalyStats.objects.get()
+        self.assertEquals(stats.type, self.usage_type)
+        self.assertEquals(
+            stats.service_environment, self.service_environment1
+        )
+        self.assertEquals(stats.last_date, self.date)
+
+    def test_save_usages_creates_daily_pricing_objects_with_details(self):
+        asset_info = AssetInfoFactory()
+        resp = self._post([self._usages(10, pricing_object=asset_info.name)])
+        self.assertEquals(resp.status_code, 201)
+        daily_asset_info = DailyAssetInfo.objects.get(asset_info=asset_info)
+        self.assertEquals(daily_asset_info.date, self.date)
+        self.assertEquals(
+            DailyUsage.objects.get().daily_pricing_object_id,
+            daily_asset_info.id
+        )
+
+    def test_save_usages_reuses_existing_daily_pricing_object(self):
+        dpo = self.pricing_object1.get_daily_pricing_object(self.date)
+        resp = self._post([
+            self._usages(10, pricing_object=self.pricing_object1.name)
+        ])
+        self.assertEquals(resp.status_code, 201)
+        self.assertEquals(DailyUsage.objects.get().daily_pricing_object, dpo)
+
+    def test_errors_are_reported_per_row(self):
+        se2 = self.service_environment2
+        resp = self._post([
+            self._usages(10, pricing_object=self.pricing_object1.name),
+            self._usages(10, pricing_object='unknown'),
+            self._usages(10, symbol='unknown', pricing_object='unknown'),
+            self._usages(
+                10,
+                pricing_object=self.pricing_object1.name,
+                service=se2.service.name,
+            ),
+            self._usages(
+                10,
+                service=se2.service.name,
+                environment='unknown',
+            ),
+            self._usages('abc', pricing_object=self.pricing_object1.name),
+            {'pricing_object': self.pricing_object1.name, 'usages': []},
+        ])
+        self.assertEquals(resp.status_code, 400)
+        self.assertEquals(json.loads(resp.content), {'usages': [
+            {
+                'row': 1,
+                'errors': ['pricing_object unknown does not exist'],
+            },
+            {
+                'row': 2,
+                'errors': [
+                    'usage type for symbol "unknown" does not exist',
+                    'pricing_object unknown does not exist',
+                ],
+            },
+            {
+                'row': 3,
+                'errors': [
+                    "Invalid combination of fields: pricing_object shouldn't "
+                    "be used with any of: service, service_id, service_uid, "
+                    "environment."
+                ],
+            },
+            {
+                'row': 4,
+                'errors': [
+                    'service environment does not exist (service={}, '
+                    'environment=unknown)'.format(se2.service.name)
+                ],
+            },
+            {
+                'row': 5,
+                'errors': ['usages: invalid value for symbol "{}"'.format(
+                    self.usage_type.symbol
+                )],
+            },
+            {
+                'row': 6,
+                'errors': ['usages: This field cannot be empty.'],
+            },
+        ]})
+        self.assertEquals(DailyUsage.objects.count(), 0)
+
+    def test_ignore_unknown_services(self):
+        resp = self._post(
+            [
+                self._usages(10, pricing_object=self.pricing_object1.name),
+                self._usages(10, service='unknown', environment='unknown'),
+            ],
+            ignore_unknown_services=True,
+        )
+        self.assertEquals(resp.status_code, 201)
+        self.assertEquals(json.loads(resp.content), {
+            'saved': 1,
+            'ignored': [{
+                'row': 1,
+                'error': (
+                    'service environment does not exist (service=unknown, '
+                    'environment=unknown)'
+                ),
+            }],
+        })
+
+    def test_unknown_symbols_of_unknown_services_are_not_ignored(self):
+        resp = self._post(
+            [
+                self._usages(10, pricing_object=self.pricing_object1.name),
+                self._usages(
+                    10, symbol='unknown', service='unknown',
+                    environment='unknown',
+                ),
+            ],
+            ignore_unknown_services=True,
+        )
+        self.assertEquals(resp.status_code, 400)
+        self.assertEquals(json.loads(resp.content), {'usages': [{
+            'row': 1,
+            'errors': [
+                'usage type for symbol "unknown" does not exist',
+                'service environment does not exist (service=unknown, '
+                'environment=unknown)',
+            ],
+        }]})
+        self.assertEquals(DailyUsage.objects.count(), 0)
+
+    def test_overwrite_values_only(self):
+        for po in (self.pricing_object1, self.pricing_object2):
+            DailyUsageFactory(
+                date=self.date,
+                type=self.usage_type,
+                daily_pricing_object=po.get_daily_pricing_object(self.date),
+                value=1,
+            )
+        resp = self._post(
+            [self._usages(10, pricing_object=self.pricing_object1.name)],
+            overwrite='values_only',
+        )
+        self.assertEquals(resp.status_code, 201)
+        self.assertEquals(
+            sorted(DailyUsage.objects.values_list('value', flat=True)),
+            [1, 10]
+        )
+
+    @skipUnless(
+        os.environ.get('SCROOGE_BENCHMARKS'),
+        'set SCROOGE_BENCHMARKS env variable to run benchmarks'
+    )
+    def test_benchmark(self):
+        rows_count, usage_types_count = 2000, 25
+        for i in range(usage_types_count):
+            UsageTypeFactory(symbol='bench{}'.format(i))
+        service_environments = ServiceEnvironmentFactory.create_batch(20)
+        PricingObject.objects.bulk_create([
+            PricingObject(
+                name='bench{}'.format(i),
+                service_environment=service_environments[i % 20],
+                type_id=1,
+            ) for i in range(rows_count)
+        ])
+        ps_usage = {
+            'pricing_service': self.pricing_service.name,
+            'date': self.date,
+            'overwrite': 'values_only',
+            'usages': [{
+                'pricing_object': 'bench{}'.format(i),
+                'usages': [
+                    {'symbol': 'bench{}'.format(j), 'value': i * j}
+                    for j in range(usage_types_count)
+                ],
+            } for i in range(rows_count)],
+        }
+        start = time.time()
+        loader = BulkUsagesLoader(ps_usage)
+        self.assertTrue(loader.validate())
+        saved = loader.save()
+        duration = time.time() - start
+        self.assertEquals(saved, rows_count * usage_types_count)
+        print('\nBulk usages upload: {} usages in {:.2f}s ({:.0f}/s)'.format(
+            saved, duration, saved / duration
+        ))
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import datetime
+import json
+
+import mock
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.test import APIClient
+
+from ralph_scrooge.models import (
+    OwnershipType,
+    ScroogeUser,
+    ServiceOwnership,
+    ServiceUsageTypes,
+)
+from ralph_scrooge.rest_api.public.v0_10.bulk_service_environment_costs import (  # noqa
+    BulkServiceEnvironmentCosts,
+)
+from ralph_scrooge.tests import ScroogeTestCase
+from ralph_scrooge.tests.utils.factory import (
+    CostDateStatusFactory,
+    DailyCostFactory,
+    EnvironmentFactory,
+    PricingObjectFactory,
+    PricingServiceFactory,
+    ServiceEnvironmentFactory,
+    UsageTypeFactory,
+)
+
+
+class TestBulkServiceEnvironmentCosts(ScroogeTestCase):
+
+    def setUp(self):
+        self.date1 = datetime.date(2016, 10, 1)
+        self.date2 = datetime.date(2016, 10, 2)
+        self.pricing_service = PricingServiceFactory()
+        self.usage_type1, self.usage_type2 = UsageTypeFactory.create_batch(2)
+        for usage_type in (self.usage_type1, self.usage_type2):
+            ServiceUsageTypes.objects.create(
+                usage_type=usage_type,
+                pricing_service=self.pricing_service,
+                start=datetime.date.min,
+                end=datetime.date.max,
+            )
+        self.se1 = PricingObjectFactory().service_environment
+        self.se2 = PricingObjectFactory().service_environment
+        # second environment of the first service
+        self.se3 = ServiceEnvironmentFactory(
+            service=self.se1.service, environment=EnvironmentFactory(),
+        )
+        for n, se in enumerate((self.se1, self.se2, self.se3), 1):
+            for date in (self.date1, self.date2):
+                self.create_daily_costs(se, date, n)
+        CostDateStatusFactory(date=self.date1, accepted=True)
+        CostDateStatusFactory(date=self.date2, accepted=False)
+        self.superuser = ScroogeUser.objects.create_superuser(
+            'username0', 'username0@test.test', 'pass0'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.superuser)
+
+    def create_daily_costs(self, service_environment, date, multiplier):
+        """Creates pricing service cost (with two subcosts) and usage type
+        cost for given service environment and date.
+        """
+        for type_, depth, path, value, cost in (
+            (self.pricing_service, 0, '0', 3, 30),
+            (self.usage_type1, 1, '0/0', 1, 10),
+            (self.usage_type2, 1, '0/1', 2, 20),
+            (self.usage_type1, 0, '1', 5, 7),
+        ):
+            DailyCostFactory(
+                type=type_,
+                service_environment=service_environment,
+                pricing_object=PricingObjectFactory(
+                    service_environment=service_environment
+                ),
+                date=date,
+                depth=depth,
+                path=path,
+                value=value * multiplier,
+                cost=cost * multiplier,
+            )
+
+    def _get_services(self):
+        return [
+            {
+                'service_uid': self.se1.service.ci_uid,
+                'environment': self.se1.environment.name,
+            },
+            {'service_uid': self.se1.service.ci_uid},
+            {
+                'service_uid': self.se2.service.ci_uid,
+                'environment': self.se2.environment.name,
+            },
+            {'service_uid': self.se2.service.ci_uid, 'environment': 'none'},
+            {'service_uid': 'unknown-uid'},
+        ]
+
+    def _get_payload(self, **kwargs):
+        payload = {
+            'date_from': '2016-10-01',
+            'date_to': '2016-10-02',
+            'group_by': 'day',
+            'accepted_only': False,
+        }
+        payload.update(kwargs)
+        return payload
+
+    def send_post_request(self, payload):
+        response = self.client.post(
+            reverse('bulk_service_environment_costs'),
+            json.dumps(payload),
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 200)
+        return json.loads(b''.join(response.streaming_content))['results']
+
+    def send_single_post_request(self, payload):
+        response = self.client.post(
+            reverse('service_environment_costs'),
+            json.dumps(payload),
+            content_type='application/json',
+        )
+        return response.status_code, json.loads(response.content)
+
+    def _test_results_are_the_same_as_for_single_service(self, **kwargs):
+        services = self._get_services()
+        results = self.send_post_request(
+            self._get_payload(services=services, **kwargs)
+        )
+        self.assertEqual(len(results), len(services))
+        for service, result in zip(services, results):
+            payload = self._get_payload(**kwargs)
+            payload.update(service)
+            status_code, single_result = self.send_single_post_request(
+                payload
+            )
+            self.assertEqual(result['service_uid'], service['service_uid'])
+            self.assertEqual(result['environment'], service.get('environment'))
+            if status_code == 200:
+                self.assertEqual(
+                    result['service_environment_costs'],
+                    single_result['service_environment_costs']
+                )
+            else:
+                self.assertEqual(
+                    result['errors'], single_result['non_field_errors']
+                )
+
+    def test_results_are_the_same_as_for_single_service(self):
+        self._test_results_are_the_same_as_for_single_service()
+
+    def test_results_are_the_same_as_for_single_service_by_month(self):
+        self._test_results_are_the_same_as_for_single_service(
+            group_by='month'
+        )
+
+    def test_results_are_the_same_as_for_single_service_accepted_only(self):
+        self._test_results_are_the_same_as_for_single_service(
+            accepted_only=True, types=[self.pricing_service.symbol],
+        )
+
+    def test_costs_of_all_environments_are_summed(self):
+        results = self.send_post_request(self._get_payload(
+            services=[{'service_uid': self.se1.service.ci_uid}],
+            date_to='2016-10-01',
+        ))
+        costs = results[0]['service_environment_costs'][0]
+        # se1 and se3 (multiplied by 1 and 3)
+        self.assertEqual(costs['total_cost'], 37 * 4)
+        ps_costs = costs['costs'][self.pricing_service.symbol]
+        self.assertEqual(ps_costs['cost'], 30 * 4)
+        self.assertEqual(
+            ps_costs['subcosts'][self.usage_type2.symbol]['usage_value'], 2 * 4
+        )
+
+    def test_services_not_owned_are_rejected_individually(self):
+        user = ScroogeUser.objects.create_user(
+            'username1', 'username1@test.test', 'pass1'
+        )
+        ServiceOwnership.objects.create(
+            service=self.se2.service,
+            type=OwnershipType.business,
+            owner=user
+        )
+        self.client.force_authenticate(user)
+        results = self.send_post_request(
+            self._get_payload(services=self._get_services())
+        )
+        self.assertEqual(
+            [r.get('errors') for r in results],
+            [
+                ['You do not have permission to perform this action.'],
+                ['You do not have permission to perform this action.'],
+                None,
+                [
+                    'service environment for service with UID "{}" and '
+                    'environment "none" does not exist.'.format(
+                        self.se2.service.ci_uid
+                    )
+                ],
+                ['You do not have permission to perform this action.'],
+            ]
+        )
+        self.assertEqual(
+            results[2]['service_environment_costs'][0]['total_cost'], 37 * 2
+        )
+
+    def test_services_not_owned_are_rejected_without_owner_permission(self):
+        user = ScroogeUser.objects.create_user(
+            'username1', 'username1@test.test', 'pass1'
+        )
+        self.client.force_authenticate(user)
+        with mock.patch.object(
+            BulkServiceEnvironmentCosts,
+            'permission_classes',
+            (IsAuthenticated,),
+        ):
+            results = self.send_post_request(
+                self._get_payload(services=self._get_services()[:1])
+            )
+        self.assertEqual(
+            [r.get('errors') for r in results],
+            [['You do not have permission to perform this action.']],
+        )
+
+    def test_number_of_queries_does_not_depend_on_number_of_services(self):
+        def count_queries(services):
+            with CaptureQueriesContext(connection) as queries:
+                self.send_post_request(self._get_payload(services=services))
+            return len(queries)
+
+        self.assertEqual(
+            count_queries(self._get_services()[:1]),
+            count_queries(self._get_services()),
+        )
+
+    def test_for_error_when_services_list_is_empty(self):
+        response = self.client.post(
+            reverse('bulk_service_environment_costs'),
+            json.dumps(self._get_payload(services=[])),
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('services', json.loads(response.content))
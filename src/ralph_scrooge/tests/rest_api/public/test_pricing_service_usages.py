@@ -8,6 +8,7 @@ from __future__ import unicode_literals
 import datetime
 import json
 
+import mock
 from django.contrib.auth import get_user_model
 from django.core.urlresolvers import reverse
 from rest_framework.test import APIClient
@@ -18,6 +19,7 @@ from ralph_scrooge.models import (
     PricingService,
     Service,
     ServiceUsageTypes,
+    UsageAnomalyStats,
     UsageType,
 )
 from ralph_scrooge.tests import ScroogeTestCase
@@ -86,6 +88,33 @@ class TestPricingServiceUsages(ScroogeTestCase):
         self.assertEquals(daily_usages[0].type, self.usage_type)
         self.assertEquals(daily_usages[0].value, 40)
 
+    # statistics are updated after commit (which never happens in TestCase)
+    @mock.patch(
+        'ralph_scrooge.utils.usage_anomalies.transaction.on_commit',
+        lambda func: func()
+    )
+    def test_save_usages_updates_usage_anomaly_stats(self):
+        pricing_service_usage = {
+            "pricing_service": self.pricing_service.name,
+            "date": self.date_as_str,
+            "usages": [{
+                "pricing_object": self.pricing_object1.name,
+                "usages": [{"symbol": self.usage_type.symbol, "value": 40}],
+            }],
+        }
+        resp = self.client.post(
+            reverse('create_pricing_service_usages'),
+            json.dumps(pricing_service_usage),
+            content_type='application/json',
+        )
+        self.assertEquals(resp.status_code, 201)
+        stats = UsageAnomalyStats.objects.get()
+        self.assertEquals(stats.type, self.usage_type)
+        self.assertEquals(
+            stats.service_environment, self.service_environment1
+        )
+        self.assertEquals(stats.mean, 40)
+
     def test_save_usages_successfully_when_service_and_environment_is_given(self):  # noqa
         service_name = self.pricing_object1.service_environment.service.name
         environment_name = (
@@ -1295,3 +1324,81 @@ class TestPricingServiceUsages(ScroogeTestCase):
             content_type='application/json',
         )
         self.assertEquals(resp.status_code, 201)
+
+    def _create_usages_for_listing(self, count):
+        pricing_objects = [
+            PricingObjectFactory(
+                service_environment=self.service_environment1
+            ) for i in range(count)
+        ]
+        for i, po in enumerate(pricing_objects):
+            DailyUsageFactory(
+                daily_pricing_object=po.get_daily_pricing_object(self.date),
+                service_environment=self.service_environment1,
+                type=self.usage_type,
+                date=self.date,
+                value=i,
+            )
+        return pricing_objects
+
+    def _get_list_url(self):
+        return reverse(
+            'list_pricing_service_usages',
+            kwargs={
+                'pricing_service_id': self.pricing_service.id,
+                'usages_date': self.date_as_str,
+            }
+        )
+
+    def test_pricing_service_usages_keyset_pagination(self):
+        pricing_objects = self._create_usages_for_listing(5)
+        url = self._get_list_url()
+        received = []
+        resp = self.client.get(url, {'limit': 2})
+        pages = 1
+        while True:
+            self.assertEquals(resp.status_code, 200)
+            content = json.loads(resp.content)
+            received.extend(u['pricing_object'] for u in content['usages'])
+            if content['next'] is None:
+                break
+            pages += 1
+            resp = self.client.get(
+                url, {'limit': 2, 'after': content['next']}
+            )
+        self.assertEqual(pages, 3)
+        self.assertEqual(received, [po.name for po in pricing_objects])
+
+    def test_pricing_service_usages_invalid_limit(self):
+        resp = self.client.get(self._get_list_url(), {'limit': 0})
+        self.assertEquals(resp.status_code, 400)
+        self.assertEquals(
+            json.loads(resp.content), {'error': 'Invalid limit: 0.'}
+        )
+
+    @mock.patch(
+        'ralph_scrooge.rest_api.public.v0_9.pricing_service_usages.'
+        'USAGES_CHUNK_SIZE',
+        2
+    )
+    def test_pricing_service_usages_ndjson_stream(self):
+        pricing_objects = self._create_usages_for_listing(3)
+        resp = self.client.get(self._get_list_url(), {'stream': 1})
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(resp['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(resp.streaming_content).splitlines()
+        self.assertEqual(
+            [json.loads(line) for line in lines],
+            [{
+                'service': self.service_environment1.service.name,
+                'service_id': self.service_environment1.service.id,
+                'service_uid': self.service_environment1.service.ci_uid,
+                'environment': self.service_environment1.environment.name,
+                'pricing_object': po.name,
+                'usages': [{
+                    'symbol': self.usage_type.symbol,
+                    'value': float(i),
+                    'remarks': '',
+                }],
+            } for i, po in enumerate(pricing_objects)]
+        )
@@ -7,9 +7,15 @@ from __future__ import unicode_literals
 
 import datetime
 import json
+import os
+import time
+from decimal import Decimal
+from unittest import skipUnless
 
 from ddt import ddt, data
+from django.core.cache import caches
 from django.core.urlresolvers import reverse
+from django.test.utils import override_settings
 from rest_framework.test import APIClient
 
 from ralph_scrooge.models import (
@@ -24,11 +30,14 @@ from ralph_scrooge.models import (
     ServiceUsageTypes,
     UsageType,
 )
+from ralph_scrooge.rest_api.conditional import CACHE_NAME
 from ralph_scrooge.rest_api.public.v0_10.service_environment_costs import (
     USAGE_COST_NUM_DIGITS,
     USAGE_VALUE_NUM_DIGITS,
+    _build_cost_trees,
     date_range,
 )
+from ralph_scrooge.utils.tasks import backfill_dailycosts_services
 from ralph_scrooge.tests import ScroogeTestCase
 from ralph_scrooge.tests.utils.factory import (
     CostDateStatusFactory,
@@ -864,6 +873,67 @@ class TestServiceEnvironmentCosts(ScroogeTestCase):
             usage_value1 + usage_value2
         )
 
+    @override_settings(COSTS_RESPONSE_CACHE_TIMEOUT=60)
+    def test_cached_costs_are_not_returned_after_rename(self):
+        caches[CACHE_NAME].clear()
+        self.create_daily_costs(
+            ((self.usage_type1, self.date1, 1, 10),),
+            parent=(self.pricing_service, self.date1),
+        )
+        CostDateStatusFactory(date=self.date1_as_str, accepted=True)
+        self.payload = {
+            "service_uid": self.service_uid1,
+            "date_from": self.date1_as_str,
+            "date_to": self.date1_as_str,
+            "group_by": "day",
+            "types": [self.pricing_service.symbol]
+        }
+
+        def get_costs():
+            resp = self.send_post_request()
+            self.assertEquals(resp.status_code, 200)
+            costs = json.loads(resp.content)['service_environment_costs']
+            return costs[0]['costs'][self.pricing_service.symbol]
+
+        self.assertEquals(get_costs()['cost'], 10)
+        # costs changed without recalculation - response is cached
+        DailyCost.objects_tree.update(cost=20)
+        self.assertEquals(get_costs()['cost'], 10)
+        self.usage_type1.name = 'renamed'
+        self.usage_type1.save()
+        costs = get_costs()
+        self.assertEquals(costs['cost'], 20)
+        self.assertEquals(
+            costs['subcosts'][self.usage_type1.symbol]['type'], 'renamed'
+        )
+
+    def test_costs_saved_before_service_was_denormalized(self):
+        self.create_daily_costs(
+            ((self.usage_type1, self.date1, 1, 10),),
+            parent=(self.pricing_service, self.date1),
+        )
+        DailyCost.objects_tree.update(service=None, environment=None)
+        CostDateStatusFactory(date=self.date1_as_str, accepted=True)
+        self.payload = {
+            "service_uid": self.service_uid1,
+            "date_from": self.date1_as_str,
+            "date_to": self.date1_as_str,
+            "group_by": "day",
+            "types": [self.pricing_service.symbol]
+        }
+
+        def get_total_cost():
+            resp = self.send_post_request()
+            self.assertEquals(resp.status_code, 200)
+            costs = json.loads(resp.content)['service_environment_costs']
+            return costs[0]['total_cost']
+
+        self.assertEquals(get_total_cost(), 10)
+        with override_settings(DAILY_COST_FILTER_BY_SERVICE=True):
+            self.assertEquals(get_total_cost(), 0)
+            backfill_dailycosts_services()
+            self.assertEquals(get_total_cost(), 10)
+
     @data(False, True)  # `forecast` param
     def test_if_only_accepted_costs_are_returned_when_accept_only_param_given(self, forecast):  # noqa: E501
         cost1 = 20
@@ -1111,3 +1181,88 @@ class TestServiceEnvironmentCosts(ScroogeTestCase):
         self.assertEqual(
             costs['service_environment_costs'][2]['total_cost'], 0
         )
+
+
+class TestBuildCostTrees(ScroogeTestCase):
+
+    def _row(self, date, depth, path, symbol, cost, value):
+        return {
+            'date': date,
+            'depth': depth,
+            'path': path,
+            'type__symbol': symbol,
+            'type__name': symbol.upper(),
+            'cost_sum': cost,
+            'value_sum': value,
+        }
+
+    def test_build_cost_trees(self):
+        date1 = datetime.date(2016, 10, 1)
+        date2 = datetime.date(2016, 10, 2)
+        rows = [
+            self._row(date1, 0, '1', 'ps1', Decimal('10.123'), 1.1234567),
+            self._row(date1, 0, '2', 'ps2', Decimal('20'), 2),
+            self._row(date2, 0, '1', 'ps1', 30, 3),
+            self._row(date1, 1, '1/3', 'ut1', 4, 0.4),
+            self._row(date1, 1, '2/3', 'ut1', 5, 0.5),
+            self._row(date2, 1, '1/4', 'ut2', 6, 0.6),
+        ]
+        total_costs, cost_trees = _build_cost_trees(
+            rows, 'date', [BaseUsage(symbol='ps1')]
+        )
+        self.assertEqual(total_costs, {date1: Decimal('30.123'), date2: 30})
+        self.assertEqual(cost_trees, {
+            date1: {
+                'ps1': {
+                    'cost': 10.12,
+                    'usage_value': 1.12346,
+                    'type': 'PS1',
+                    'subcosts': {
+                        'ut1': {'cost': 4, 'usage_value': 0.4, 'type': 'UT1'},
+                    },
+                },
+            },
+            date2: {
+                'ps1': {
+                    'cost': 30,
+                    'usage_value': 3,
+                    'type': 'PS1',
+                    'subcosts': {
+                        'ut2': {'cost': 6, 'usage_value': 0.6, 'type': 'UT2'},
+                    },
+                },
+            },
+        })
+
+    @skipUnless(
+        os.environ.get('SCROOGE_BENCHMARKS'),
+        'set SCROOGE_BENCHMARKS env variable to run benchmarks'
+    )
+    def test_benchmark(self):
+        # a year of daily costs of a service with 40 pricing services (10
+        # subcosts of every one of them), 20 pricing services selected
+        days, pricing_services, usage_types = 365, 40, 10
+        start = datetime.date(2016, 1, 1)
+        rows = []
+        for depth in (0, 1):
+            for i in range(days):
+                date = start + datetime.timedelta(days=i)
+                for ps in range(pricing_services):
+                    for ut in range(usage_types if depth else 1):
+                        if depth:
+                            path = '{}/{}'.format(ps, pricing_services + ut)
+                            symbol = 'ut{}'.format(ut)
+                        else:
+                            path, symbol = str(ps), 'ps{}'.format(ps)
+                        rows.append(self._row(
+                            date, depth, path, symbol,
+                            Decimal('123.456789'), 1.23456789,
+                        ))
+        types = [BaseUsage(symbol='ps{}'.format(i)) for i in range(20)]
+        start_time = time.time()
+        total_costs, cost_trees = _build_cost_trees(rows, 'date', types)
+        duration = time.time() - start_time
+        self.assertEqual(len(cost_trees), days)
+        print('\nBuild cost trees: {} aggregated costs in {:.2f}s'.format(
+            len(rows), duration
+        ))
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import datetime
+import json
+
+from django.core.cache import caches
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.test import APIClient
+
+from ralph_scrooge.models import CostDateStatus, DailyCost, ScroogeUser
+from ralph_scrooge.plugins.cost.collector import Collector
+from ralph_scrooge.rest_api.conditional import CACHE_NAME
+from ralph_scrooge.tests import ScroogeTestCase
+from ralph_scrooge.tests.utils.factory import (
+    CostDateStatusFactory,
+    DailyCostFactory,
+    PricingObjectFactory,
+    PricingServiceFactory,
+)
+
+
+class TestConditionalCostsResponses(ScroogeTestCase):
+
+    def setUp(self):
+        self.date = datetime.date(2016, 10, 1)
+        self.service_environment = PricingObjectFactory().service_environment
+        self.pricing_service = PricingServiceFactory()
+        DailyCostFactory(
+            type=self.pricing_service,
+            service_environment=self.service_environment,
+            date=self.date,
+            depth=0,
+            path='0',
+            cost=10,
+            value=1,
+        )
+        CostDateStatusFactory(date=self.date, calculated=True)
+        ScroogeUser.objects.create_superuser(
+            'username0', 'username0@test.test', 'pass0'
+        )
+        self.client = APIClient()
+        # private (costcard) API uses session authentication
+        self.client.login(username='username0', password='pass0')
+        caches[CACHE_NAME].clear()
+
+    def _get_costs(self, **headers):
+        self.client.force_authenticate(
+            ScroogeUser.objects.get(username='username0')
+        )
+        return self.client.post(
+            reverse('service_environment_costs'),
+            json.dumps({
+                'service_uid': self.service_environment.service.ci_uid,
+                'environment': self.service_environment.environment.name,
+                'date_from': '2016-10-01',
+                'date_to': '2016-10-01',
+                'group_by': 'day',
+            }),
+            content_type='application/json',
+            **headers
+        )
+
+    def _get_costcard(self, **headers):
+        return self.client.get(
+            '/scrooge/rest/costcard/{}/{}/2016/10/'.format(
+                self.service_environment.service_id,
+                self.service_environment.environment_id,
+            ),
+            **headers
+        )
+
+    def _count_daily_costs_queries(self, queries):
+        return len([
+            q for q in queries if DailyCost._meta.db_table in q['sql']
+        ])
+
+    def test_not_modified_when_etag_matches(self):
+        response = self._get_costcard()
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        with CaptureQueriesContext(connection) as queries:
+            response = self._get_costcard(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(self._count_daily_costs_queries(queries), 0)
+
+    def test_weak_and_multiple_etags_are_matched(self):
+        etag = self._get_costcard()['ETag']
+        response = self._get_costcard(
+            HTTP_IF_NONE_MATCH='"other", W/{}'.format(etag)
+        )
+        self.assertEqual(response.status_code, 304)
+
+    def test_post_is_not_conditional(self):
+        response = self._get_costs()
+        etag = response['ETag']
+        response = self._get_costs(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_etag_changes_when_usage_type_is_renamed(self):
+        etag = self._get_costcard()['ETag']
+        self.pricing_service.name = 'renamed'
+        self.pricing_service.save()
+        response = self._get_costcard(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_etag_changes_when_costs_are_recalculated(self):
+        etag = self._get_costcard()['ETag']
+        Collector()._update_status(self.date, forecast=False)
+        self.assertEqual(
+            CostDateStatus.objects.get(date=self.date).generation, 1
+        )
+        response = self._get_costcard(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_etag_changes_when_costs_are_accepted(self):
+        etag = self._get_costcard()['ETag']
+        CostDateStatus.objects.filter(date=self.date).update(accepted=True)
+        response = self._get_costcard(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertTrue(json.loads(response.content)['status'])
+
+    def test_etag_differs_between_requests(self):
+        self.assertNotEqual(
+            self._get_costs()['ETag'], self._get_costcard()['ETag']
+        )
+
+    @override_settings(COSTS_RESPONSE_CACHE_TIMEOUT=60)
+    def test_response_is_cached_until_costs_change(self):
+        response = self._get_costs()
+        with CaptureQueriesContext(connection) as queries:
+            cached_response = self._get_costs()
+        self.assertEqual(self._count_daily_costs_queries(queries), 0)
+        self.assertEqual(cached_response.content, response.content)
+        Collector()._update_status(self.date, forecast=False)
+        with CaptureQueriesContext(connection) as queries:
+            self._get_costs()
+        self.assertNotEqual(self._count_daily_costs_queries(queries), 0)
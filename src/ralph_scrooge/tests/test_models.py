@@ -13,6 +13,7 @@ from ralph_scrooge import models
 from ralph_scrooge.tests import ScroogeTestCase
 from ralph_scrooge.tests.models import History, HistoricalHistory
 from ralph_scrooge.tests.utils.factory import (
+    DailyCostFactory,
     DailyPricingObjectFactory,
     DynamicExtraCostFactory,
     ExtraCostFactory,
@@ -298,6 +299,25 @@ class TestDailyCost(ScroogeTestCase):
         for t in map(daily_cost2dict, result):
             self.assertIn(t, daily_costs_dicts)
 
+    def test_build_tree_sets_service_and_environment(self):
+        models.DailyCost.build_tree(
+            self._sample_tree(), **self._sample_global_params()
+        )
+        for se in (self.se1, self.se2):
+            self.assertEqual(
+                set(models.DailyCost.objects_tree.filter(
+                    service_environment=se
+                ).values_list('service_id', 'environment_id')),
+                {(se.service_id, se.environment_id)}
+            )
+
+    def test_save_sets_service_and_environment(self):
+        daily_cost = DailyCostFactory(
+            service_environment=self.se1, date=datetime.date(2014, 10, 11),
+        )
+        self.assertEqual(daily_cost.service_id, self.se1.service_id)
+        self.assertEqual(daily_cost.environment_id, self.se1.environment_id)
+
     def test_parse_path(self):
         data = {'type_id': 'abc'}
         result = models.DailyCost._parse_path('', data)
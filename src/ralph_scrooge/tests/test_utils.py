@@ -5,9 +5,24 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
-from datetime import date
+import os
+import shutil
+import tempfile
+from datetime import date, timedelta
 
-from ralph_scrooge.models import ServiceUsageTypes
+import mock
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from ralph_scrooge.models import (
+    CostDateStatus,
+    DailyCost,
+    DailyUsage,
+    ServiceEnvironmentUsageAnomaly,
+    ServiceUsageTypes,
+    SyncStatus,
+    UsageAnomalyStats,
+)
 from ralph_scrooge.tests import ScroogeTestCase
 from ralph_scrooge.tests.utils.factory import (
     DailyUsageFactory,
@@ -15,7 +30,14 @@ from ralph_scrooge.tests.utils.factory import (
     ServiceEnvironmentFactory,
     UsageTypeFactory
 )
-from ralph_scrooge.utils import common, cycle_detector
+from ralph_scrooge.utils import (
+    common,
+    cycle_detector,
+    daily_usages,
+    snapshots,
+    tasks,
+    usage_anomalies,
+)
 
 
 class TestRangesOverlap(ScroogeTestCase):
@@ -145,6 +167,437 @@ class TestCyclesDetector(ScroogeTestCase):
 
     def test_detect_cycle_when_there_is_cycle(self):
         self._make_cycle()
-        graph = cycle_detector._get_pricing_services_graph(self.today)
-        cycles = cycle_detector._detect_cycles(self.ps1, graph, set(), [])
+        cycles = cycle_detector.detect_cycles(self.today)
         self.assertEqual(cycles, [[self.ps1, self.ps2, self.ps3, self.ps1]])
+
+    def test_detect_cycle_in_date_range(self):
+        DailyUsageFactory(
+            type=self.usage_type4,
+            service_environment=self.se1,
+            date=date(2017, 3, 5),
+        )
+        self.assertEqual(cycle_detector.detect_cycles(self.today), [])
+        self.assertEqual(
+            cycle_detector.detect_cycles(self.today, date(2017, 3, 5)),
+            [[self.ps1, self.ps2, self.ps3, self.ps1]]
+        )
+
+    def test_get_pricing_services_graph_with_excluded_service(self):
+        self.ps2.excluded_services.add(self.se3.service)
+        graph = cycle_detector._get_pricing_services_graph(self.today)
+        self.assertEqual(graph, {self.ps1: [self.ps2]})
+
+    def test_get_pricing_services_graph_is_equal_to_dependent_services(self):
+        self._make_cycle()
+        graph = cycle_detector._get_pricing_services_graph(self.today)
+        for ps in (self.ps1, self.ps2, self.ps3):
+            self.assertEqual(
+                [dep for dep, charged in graph.items() if ps in charged],
+                list(ps.get_dependent_services(self.today)),
+            )
+
+    def test_get_strongly_connected_components(self):
+        self._make_cycle()
+        graph = cycle_detector._get_pricing_services_graph(self.today)
+        ps4 = PricingServiceFactory()
+        graph[self.ps3].append(ps4)
+        components = cycle_detector._get_strongly_connected_components(graph)
+        self.assertEqual(
+            sorted(
+                [sorted(c, key=lambda ps: ps.id) for c in components],
+                key=lambda c: c[0].id
+            ),
+            [[self.ps1, self.ps2, self.ps3], [ps4]]
+        )
+
+    def test_get_topological_order(self):
+        graph = cycle_detector._get_pricing_services_graph(self.today)
+        self.assertEqual(
+            cycle_detector.get_topological_order(graph),
+            ([self.ps1, self.ps2, self.ps3], [])
+        )
+
+    def test_get_topological_order_when_there_is_cycle(self):
+        self._make_cycle()
+        graph = cycle_detector._get_pricing_services_graph(self.today)
+        self.assertEqual(
+            cycle_detector.get_topological_order(graph),
+            ([], [self.ps1, self.ps2, self.ps3])
+        )
+
+
+class TestSnapshots(ScroogeTestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.date1 = date(2016, 9, 1)
+        self.date2 = date(2016, 9, 2)
+        self.month = date(2016, 9, 1)
+        self.se = ServiceEnvironmentFactory()
+        self.ut1 = UsageTypeFactory(symbol='ut1')
+        self.ut2 = UsageTypeFactory(symbol='ut2')
+
+    def _create_costs(self, date):
+        DailyCost.build_tree(
+            date=date,
+            service_environment_id=self.se.id,
+            tree=[{
+                'type_id': self.ut1.id,
+                'forecast': False,
+                'cost': 10,
+                'value': 2,
+                '_children': [{
+                    'type_id': self.ut2.id,
+                    'forecast': False,
+                    'cost': 4,
+                    'value': 1,
+                }]
+            }],
+        )
+        CostDateStatus.objects.create(date=date, calculated=True)
+
+    def _create_usage(self, date, value):
+        DailyUsageFactory(
+            date=date,
+            service_environment=self.se,
+            type=self.ut1,
+            value=value,
+        )
+        SyncStatus.objects.update_or_create(
+            date=date, plugin='ut1', defaults=dict(
+                success=True, modified=timezone.now()
+            )
+        )
+
+    def test_export_daily_costs(self):
+        self._create_costs(self.date1)
+        self.assertEqual(
+            snapshots.export_snapshot('dailycost', path=self.path), 2
+        )
+        self.assertEqual(
+            snapshots.list_snapshots('dailycost', path=self.path),
+            [self.month]
+        )
+        with snapshots.open_snapshot(
+            'dailycost', self.month, path=self.path
+        ) as snapshot:
+            self.assertEqual(snapshot.dates, [self.date1])
+            self.assertEqual(snapshot.symbols['type'], ['ut1', 'ut2'])
+            self.assertEqual(
+                sorted(snapshot.rows(['type', 'parent_type', 'cost'])),
+                [('ut1', None, 10.0), ('ut2', 'ut1', 4.0)]
+            )
+            self.assertEqual(
+                snapshot.sum('cost', by=['depth']), {(0,): 10.0, (1,): 4.0}
+            )
+
+    def test_export_daily_costs_is_incremental(self):
+        self._create_costs(self.date1)
+        snapshots.export_snapshot('dailycost', path=self.path)
+        self._create_costs(self.date2)
+        # costs for not calculated dates are not exported
+        CostDateStatus.objects.filter(date=self.date2).update(
+            calculated=False
+        )
+        self.assertEqual(
+            snapshots.export_snapshot('dailycost', path=self.path), 0
+        )
+        CostDateStatus.objects.filter(date=self.date2).update(
+            calculated=True
+        )
+        self.assertEqual(
+            snapshots.export_snapshot('dailycost', path=self.path), 2
+        )
+        snapshot = snapshots.open_snapshot(
+            'dailycost', self.month, path=self.path
+        )
+        self.assertEqual(len(snapshot), 4)
+        self.assertEqual(snapshot.dates, [self.date1, self.date2])
+        self.assertEqual(
+            snapshot.sum('cost', by=['date']),
+            {(self.date1,): 14.0, (self.date2,): 14.0}
+        )
+        snapshot.close()
+
+    def test_export_daily_costs_rebuild_month_when_recalculated(self):
+        self._create_costs(self.date1)
+        self._create_costs(self.date2)
+        self.assertEqual(
+            snapshots.export_snapshot('dailycost', path=self.path), 4
+        )
+        DailyCost.objects_tree.filter(date=self.date1).update(cost=1)
+        CostDateStatus.objects.filter(date=self.date1).update(generation=1)
+        self.assertEqual(
+            snapshots.export_snapshot('dailycost', path=self.path), 4
+        )
+        with snapshots.open_snapshot(
+            'dailycost', self.month, path=self.path
+        ) as snapshot:
+            self.assertEqual(len(snapshot), 4)
+            self.assertEqual(
+                snapshot.sum('cost', by=['date']),
+                {(self.date1,): 2.0, (self.date2,): 14.0}
+            )
+        # not changed anymore
+        self.assertEqual(
+            snapshots.export_snapshot('dailycost', path=self.path), 0
+        )
+
+    def test_export_daily_costs_rebuild_month_without_not_ready_dates(self):
+        self._create_costs(self.date1)
+        self._create_costs(self.date2)
+        snapshots.export_snapshot('dailycost', path=self.path)
+        CostDateStatus.objects.filter(date=self.date1).update(generation=1)
+        CostDateStatus.objects.filter(date=self.date2).update(
+            calculated=False
+        )
+        self.assertEqual(
+            snapshots.export_snapshot('dailycost', path=self.path), 2
+        )
+        with snapshots.open_snapshot(
+            'dailycost', self.month, path=self.path
+        ) as snapshot:
+            self.assertEqual(snapshot.dates, [self.date1])
+            self.assertEqual(len(snapshot), 2)
+
+    def test_export_snapshots_task(self):
+        self._create_costs(self.date1)
+        with override_settings(SNAPSHOTS_PATH=''):
+            # not configured - nothing to do
+            tasks.export_snapshots()
+        with override_settings(SNAPSHOTS_PATH=self.path):
+            tasks.export_snapshots()
+        self.assertEqual(
+            snapshots.list_snapshots('dailycost', path=self.path),
+            [self.month]
+        )
+
+    def test_export_after_interrupted_export(self):
+        self._create_costs(self.date1)
+        snapshots.export_snapshot('dailycost', path=self.path)
+        # columns appended by export interrupted before writing meta
+        month_path = os.path.join(self.path, 'dailycost', '2016-09')
+        for name in ('date', 'cost'):
+            with open(os.path.join(month_path, name), 'ab') as f:
+                f.write(b'\x01' * 12)
+        self._create_costs(self.date2)
+        self.assertEqual(
+            snapshots.export_snapshot('dailycost', path=self.path), 2
+        )
+        with snapshots.open_snapshot(
+            'dailycost', self.month, path=self.path
+        ) as snapshot:
+            self.assertEqual(
+                snapshot.sum('cost', by=['date']),
+                {(self.date1,): 14.0, (self.date2,): 14.0}
+            )
+            self.assertEqual(
+                os.path.getsize(os.path.join(month_path, 'cost')), 4 * 8
+            )
+
+    def test_export_daily_usages_rebuild_month_when_resynced(self):
+        self._create_usage(self.date1, 10)
+        self._create_usage(self.date2, 20)
+        self.assertEqual(
+            snapshots.export_snapshot('dailyusage', path=self.path), 2
+        )
+        self._create_usage(self.date1, 5)
+        self.assertEqual(
+            snapshots.export_snapshot('dailyusage', path=self.path), 3
+        )
+        with snapshots.open_snapshot(
+            'dailyusage', self.month, path=self.path
+        ) as snapshot:
+            self.assertEqual(len(snapshot), 3)
+            self.assertEqual(snapshot.sum('value'), {(): 35.0})
+
+    def test_open_not_existing_snapshot(self):
+        with self.assertRaises(snapshots.SnapshotError):
+            snapshots.open_snapshot('dailycost', self.month, path=self.path)
+
+
+class TestDeleteDailyUsages(ScroogeTestCase):
+    def setUp(self):
+        self.ut1, self.ut2 = UsageTypeFactory.create_batch(2)
+        self.dates = [date(2016, 9, 1), date(2016, 9, 2), date(2016, 9, 3)]
+        self.usages = [
+            DailyUsageFactory(date=d, type=ut)
+            for d in self.dates
+            for ut in (self.ut1, self.ut2)
+            for _ in range(3)
+        ]
+
+    def _remaining(self):
+        return set(DailyUsage.objects.values_list('id', flat=True))
+
+    def test_delete_daily_usages(self):
+        deleted = daily_usages.delete_daily_usages(
+            self.dates[0], self.dates[1], [self.ut1]
+        )
+        self.assertEqual(deleted, 6)
+        self.assertEqual(self._remaining(), set(
+            du.id for du in self.usages
+            if du.type == self.ut2 or du.date == self.dates[2]
+        ))
+
+    def _test_delete_daily_usages_by_keys(self):
+        to_delete = self.usages[::2]
+        deleted = daily_usages.delete_daily_usages_by_keys([
+            (du.date, du.type, du.daily_pricing_object_id)
+            for du in to_delete
+        ])
+        self.assertEqual(deleted, len(to_delete))
+        self.assertEqual(
+            self._remaining(),
+            set(du.id for du in self.usages) - set(du.id for du in to_delete)
+        )
+
+    @override_settings(DAILY_USAGE_DELETE_BATCH_SIZE=1)
+    def test_delete_daily_usages_by_keys(self):
+        self._test_delete_daily_usages_by_keys()
+
+    @override_settings(DAILY_USAGE_DELETE_TEMP_TABLE_THRESHOLD=1)
+    def test_delete_daily_usages_by_keys_using_temp_table(self):
+        self._test_delete_daily_usages_by_keys()
+
+    def test_delete_daily_usages_without_keys(self):
+        self.assertEqual(daily_usages.delete_daily_usages_by_keys([]), 0)
+        self.assertEqual(len(self._remaining()), len(self.usages))
+
+
+class TestUsageAnomalies(ScroogeTestCase):
+    def setUp(self):
+        self.ut = UsageTypeFactory()
+        self.se1, self.se2 = ServiceEnvironmentFactory.create_batch(2)
+        self.start = date(2016, 1, 1)
+        for i in range(10):
+            day = self.start + timedelta(days=i)
+            DailyUsageFactory(
+                date=day, type=self.ut, service_environment=self.se1,
+                value=100 + (i % 2) * 5,
+            )
+            DailyUsageFactory(
+                date=day, type=self.ut, service_environment=self.se2,
+                value=50,
+            )
+        self.spike_date = date(2016, 1, 11)
+        DailyUsageFactory(
+            date=self.spike_date, type=self.ut, service_environment=self.se1,
+            value=500,
+        )
+        DailyUsageFactory(
+            date=self.spike_date, type=self.ut, service_environment=self.se2,
+            value=50,
+        )
+
+    def _get_stats(self):
+        return {
+            s.service_environment_id: s
+            for s in UsageAnomalyStats.objects.all()
+        }
+
+    def test_update_usage_anomaly_stats(self):
+        anomalies = usage_anomalies.update_usage_anomaly_stats(
+            self.spike_date
+        )
+        self.assertEqual(len(anomalies), 1)
+        anomaly = ServiceEnvironmentUsageAnomaly.objects.get()
+        self.assertEqual(anomaly.service_environment, self.se1)
+        self.assertEqual(anomaly.type, self.ut)
+        self.assertEqual(anomaly.date, self.spike_date)
+        self.assertEqual(anomaly.value, 500)
+        self.assertTrue(100 < anomaly.expected < 105)
+        self.assertTrue(anomaly.deviation > 3)
+        stats = self._get_stats()
+        self.assertEqual(stats[self.se1.id].count, 11)
+        self.assertEqual(stats[self.se2.id].count, 11)
+        self.assertEqual(stats[self.se2.id].mean, 50)
+        self.assertEqual(stats[self.se2.id].last_date, self.spike_date)
+
+    def test_update_usage_anomaly_stats_incrementally(self):
+        usage_anomalies.update_usage_anomaly_stats(date(2016, 1, 10))
+        self.assertFalse(ServiceEnvironmentUsageAnomaly.objects.exists())
+        self.assertEqual(self._get_stats()[self.se1.id].count, 10)
+
+        anomalies = usage_anomalies.update_usage_anomaly_stats(
+            self.spike_date
+        )
+        self.assertEqual(
+            [(a.service_environment_id, a.date) for a in anomalies],
+            [(self.se1.id, self.spike_date)]
+        )
+        # already processed days are skipped
+        self.assertEqual(
+            usage_anomalies.update_usage_anomaly_stats(self.spike_date), []
+        )
+        self.assertEqual(self._get_stats()[self.se1.id].count, 11)
+        self.assertEqual(ServiceEnvironmentUsageAnomaly.objects.count(), 1)
+
+    def test_update_usage_anomaly_stats_for_other_usage_type(self):
+        anomalies = usage_anomalies.update_usage_anomaly_stats(
+            self.spike_date, [UsageTypeFactory()]
+        )
+        self.assertEqual(anomalies, [])
+        self.assertFalse(UsageAnomalyStats.objects.exists())
+
+    def test_update_usage_anomaly_stats_in_place(self):
+        usage_anomalies.update_usage_anomaly_stats(date(2016, 1, 10))
+        ids = set(UsageAnomalyStats.objects.values_list('id', flat=True))
+        usage_anomalies.update_usage_anomaly_stats(self.spike_date)
+        self.assertEqual(
+            set(UsageAnomalyStats.objects.values_list('id', flat=True)), ids
+        )
+        stats = self._get_stats()
+        self.assertEqual(stats[self.se1.id].count, 11)
+        self.assertEqual(stats[self.se1.id].last_date, self.spike_date)
+
+    def test_update_usage_anomaly_stats_skips_existing_anomalies(self):
+        # ex. saved by concurrent update of statistics
+        ServiceEnvironmentUsageAnomaly.objects.create(
+            type=self.ut, service_environment=self.se1, date=self.spike_date,
+            value=500, expected=100, deviation=10,
+        )
+        anomalies = usage_anomalies.update_usage_anomaly_stats(
+            self.spike_date
+        )
+        self.assertEqual(len(anomalies), 1)
+        self.assertEqual(ServiceEnvironmentUsageAnomaly.objects.count(), 1)
+        self.assertEqual(self._get_stats()[self.se1.id].count, 11)
+
+    def test_update_usage_anomaly_stats_dry_run(self):
+        anomalies = usage_anomalies.update_usage_anomaly_stats(
+            self.spike_date, dry_run=True
+        )
+        self.assertEqual(
+            [(a.service_environment_id, a.date) for a in anomalies],
+            [(self.se1.id, self.spike_date)]
+        )
+        self.assertFalse(UsageAnomalyStats.objects.exists())
+        self.assertFalse(ServiceEnvironmentUsageAnomaly.objects.exists())
+
+    @mock.patch('ralph_scrooge.utils.usage_anomalies.transaction.on_commit')
+    def test_refresh_usage_anomaly_stats_after_commit(self, on_commit_mock):
+        usage_anomalies.refresh_usage_anomaly_stats(
+            self.spike_date, [self.ut]
+        )
+        self.assertFalse(UsageAnomalyStats.objects.exists())
+        with mock.patch.object(
+            usage_anomalies.UsageAnomalyStatsJob,
+            'run_on_worker',
+            wraps=usage_anomalies.UsageAnomalyStatsJob().run_on_worker,
+        ) as run_on_worker_mock:
+            # commit
+            on_commit_mock.call_args[0][0]()
+        run_on_worker_mock.assert_called_once_with(
+            end_date=self.spike_date, usage_types=[self.ut.id]
+        )
+        self.assertEqual(self._get_stats()[self.se1.id].count, 11)
+        self.assertEqual(ServiceEnvironmentUsageAnomaly.objects.count(), 1)
+
+    def test_changes_within_change_tolerance_are_not_reported(self):
+        self.ut.change_tolerance = 5
+        self.ut.save()
+        anomalies = usage_anomalies.update_usage_anomaly_stats(
+            self.spike_date
+        )
+        self.assertEqual(anomalies, [])
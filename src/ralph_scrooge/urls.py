@@ -14,11 +14,21 @@ from rest_framework.authtoken import views
 
 import ralph_scrooge.plugins.subscribers  # noqa: F401
 from ralph_scrooge import models as scrooge_models
+from ralph_scrooge.rest_api.public.v0_9.async_pricing_service_usages import (
+    create_pricing_service_usages_async,
+    pricing_service_usages_upload_status,
+)
+from ralph_scrooge.rest_api.public.v0_9.bulk_pricing_service_usages import (
+    create_pricing_service_usages_bulk,
+)
 from ralph_scrooge.rest_api.public.v0_9.pricing_service_usages import (
     create_pricing_service_usages,
     list_pricing_service_usages,
 )
 from ralph_scrooge.rest_api.public.swagger import APISchema, BootstrapSwagger
+from ralph_scrooge.rest_api.public.v0_10.bulk_service_environment_costs import (  # noqa: E501
+    BulkServiceEnvironmentCosts,
+)
 from ralph_scrooge.rest_api.public.v0_10.service_environment_costs import (
     ServiceEnvironmentCosts,
 )
@@ -102,6 +112,11 @@ urlpatterns = [
         ServiceEnvironmentCosts.as_view(),
         name='service_environment_costs',
     ),
+    url(
+        r'^scrooge/api/v0.10/service-environment-costs/bulk/$',
+        BulkServiceEnvironmentCosts.as_view(),
+        name='bulk_service_environment_costs',
+    ),
     url(
         r'^scrooge/api/v0.10/api-token-auth/',
         views.obtain_auth_token,
@@ -116,6 +131,21 @@ urlpatterns = [
         create_pricing_service_usages,
         name='create_pricing_service_usages_v10',
     ),
+    url(
+        r'^scrooge/api/v0.10/pricing-service-usages/bulk/?$',
+        create_pricing_service_usages_bulk,
+        name='create_pricing_service_usages_bulk_v10',
+    ),
+    url(
+        r'^scrooge/api/v0.10/pricing-service-usages/async/?$',
+        create_pricing_service_usages_async,
+        name='create_pricing_service_usages_async_v10',
+    ),
+    url(
+        r'^scrooge/api/v0.10/pricing-service-usages/async/(?P<upload_id>\d+)/$',  # noqa: E501
+        pricing_service_usages_upload_status,
+        name='pricing_service_usages_upload_status_v10',
+    ),
     url(
         r'^scrooge/api/v0.10/pricing-service-usages/(?P<pricing_service_id>\d+)/(?P<usages_date>\d{4}-\d{2}-\d{2})/$',  # noqa: E501
         list_pricing_service_usages,
@@ -1,65 +1,211 @@
-from collections import defaultdict
+from collections import defaultdict, deque
 
-from ralph_scrooge.models import PricingService, PricingServicePlugin
+from ralph_scrooge.models import (
+    DailyUsage,
+    PricingService,
+    PricingServicePlugin,
+    Service,
+    ServiceUsageTypes,
+)
 
 
-def _get_pricing_services_graph(date):
+def _get_pricing_services_graph(start, end=None):
     """
     Edge in graph from A to B means that A charges B (in other words, some cost
     of A is allocated on services assigned to B)
+
+    Graph is built for every day between start and end (inclusive; only start
+    day if end is not passed) - edge exists if A charges B on any of them.
+    This is equivalent of calling `PricingService.get_dependent_services` for
+    every pricing service (and every day), but the whole graph is built using
+    single grouped query of service usages (and few queries for pricing
+    services definitions).
     """
-    graph = defaultdict(list)
-    for ps in PricingService.objects.all():
-        if ps.plugin_type == PricingServicePlugin.pricing_service_fixed_price_plugin:  # noqa: E501
+    end = end or start
+    pricing_services = list(PricingService.objects.all())
+    pricing_services_by_id = {ps.id: ps for ps in pricing_services}
+
+    # services of every pricing service
+    pricing_service_by_service = {}
+    services_by_pricing_service = defaultdict(set)
+    for service_id, ps_id in Service.objects.filter(
+        pricing_service__isnull=False,
+    ).values_list('id', 'pricing_service_id'):
+        pricing_service_by_service[service_id] = ps_id
+        services_by_pricing_service[ps_id].add(service_id)
+
+    # pricing services providing usage type
+    pricing_services_by_usage_type = defaultdict(set)
+    for usage_type_id, ps_id in ServiceUsageTypes.objects.values_list(
+        'usage_type_id', 'pricing_service_id',
+    ).distinct():
+        pricing_services_by_usage_type[usage_type_id].add(ps_id)
+
+    excluded_services = defaultdict(set)
+    for ps_id, service_id in PricingService.excluded_services.through.objects.values_list(  # noqa: E501
+        'pricingservice_id', 'service_id',
+    ):
+        excluded_services[ps_id].add(service_id)
+
+    edges = defaultdict(set)
+    for service_id, usage_type_id in DailyUsage.objects.filter(
+        type__usage_type='SU',
+        date__gte=start,
+        date__lte=end,
+    ).values_list(
+        'service_environment__service_id', 'type_id',
+    ).distinct():
+        ps = pricing_services_by_id.get(
+            pricing_service_by_service.get(service_id)
+        )
+        if ps is None or ps.plugin_type == PricingServicePlugin.pricing_service_fixed_price_plugin:  # noqa: E501
             continue
-        for dep in ps.get_dependent_services(date):
-            graph[dep].append(ps)
-    return dict(graph)
+        for dep_id in pricing_services_by_usage_type[usage_type_id]:
+            if (
+                dep_id == ps.id or
+                dep_id not in pricing_services_by_id or
+                excluded_services[dep_id] & services_by_pricing_service[ps.id]
+            ):
+                continue
+            edges[dep_id].add(ps.id)
 
+    # keep order of pricing services (by name) in graph
+    return {
+        pricing_services_by_id[dep_id]: [
+            ps for ps in pricing_services if ps.id in charged
+        ] for dep_id, charged in edges.items()
+    }
 
-def _detect_cycles(node, graph, visited, ps_stack):
+
+def _get_strongly_connected_components(graph):
     """
-    Perform DFS on PricingServices dependecy graph looking for cycles
+    Find strongly connected components of PricingServices dependency graph
+    using (iterative) Tarjan's algorithm.
 
     Params:
-        node: PricingService
         graph: dict with adjacency list of PricingServices
-        visited: set of already visited PricingServices during graph traversal
-        ps_stack: stack of PricingServices in current traversal (top->down)
     Returns:
-        list of lists of PricingServices (or empty list if there's no cycle)
+        list of lists of PricingServices (every PricingService is in exactly
+        one component)
     """
-    try:
-        index = ps_stack.index(node)
-        cycle = ps_stack[index:] + [node]
-        return [cycle]
-    except ValueError:
-        pass
-    if node in visited:
-        return []
-    visited.add(node)
-    ps_stack.append(node)
-    cycles = []
-    for dep in graph.get(node, []):
-        dep_cycles = _detect_cycles(dep, graph, visited, ps_stack)
-        cycles.extend(dep_cycles)
-    ps_stack.pop()
-    return cycles
+    nodes = []
+    for node, charged in graph.items():
+        nodes.append(node)
+        nodes.extend(charged)
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    components = []
+    for root in sorted(set(nodes), key=lambda ps: ps.id):
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(graph.get(root, [])))]
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if child not in index:
+                    index[child] = lowlink[child] = len(index)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(graph.get(child, []))))
+                    break
+                elif child in on_stack:
+                    lowlink[node] = min(lowlink[node], index[child])
+            else:
+                # all children of node visited
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        ps = stack.pop()
+                        on_stack.discard(ps)
+                        component.append(ps)
+                        if ps == node:
+                            break
+                    components.append(component)
+    return components
 
 
-def detect_cycles(date):
+def _get_cycle(component, graph):
+    """
+    Returns (the shortest) cycle starting and ending at the first (by id)
+    PricingService of strongly connected component.
+    """
+    members = set(component)
+    start = min(component, key=lambda ps: ps.id)
+    parents = {start: None}
+    queue = deque([start])
+    while queue:
+        node = queue.popleft()
+        for child in graph.get(node, []):
+            if child == start:
+                path = []
+                while node is not None:
+                    path.append(node)
+                    node = parents[node]
+                return list(reversed(path)) + [start]
+            if child in members and child not in parents:
+                parents[child] = node
+                queue.append(child)
+    return []
+
+
+def detect_cycles(start, end=None):
     """
     Detect if there is cycle in charging between PricingServices for given date
+    (or any day between start and end, if end is passed).
 
     Loop means, that PricingService A charges PricingService B (one or more)
     which, at the end, charge back PricingService A (precisely services from
     PricingService A).
+
+    Every strongly connected component of dependency graph (with more than one
+    PricingService) contains at least one cycle - single (shortest) cycle is
+    returned for every component.
     """
-    graph = _get_pricing_services_graph(date)
-    visited = set()
-    ps_stack = []
+    graph = _get_pricing_services_graph(start, end)
     cycles = []
-    # try to detect loop starting from every PricingService
-    for node in graph.keys():
-        cycles.extend(_detect_cycles(node, graph, visited, ps_stack))
-    return cycles
+    for component in _get_strongly_connected_components(graph):
+        if len(component) > 1:
+            cycles.append(_get_cycle(component, graph))
+    return sorted(cycles, key=lambda c: c[0].id)
+
+
+def get_topological_order(graph):
+    """
+    Returns PricingServices from graph in topological order - every
+    PricingService is placed after all PricingServices charging it (so costs
+    of PricingServices could be calculated in this order without recursion).
+
+    Returns:
+        tuple of two lists: ordered PricingServices and PricingServices which
+        could not be ordered (they are part of cycle or are charged by
+        PricingService from cycle)
+    """
+    nodes = set(graph.keys())
+    in_degree = defaultdict(int)
+    for node, charged in graph.items():
+        nodes.update(charged)
+        for ps in charged:
+            in_degree[ps] += 1
+    queue = deque(sorted(
+        [node for node in nodes if not in_degree[node]],
+        key=lambda ps: ps.id
+    ))
+    ordered = []
+    while queue:
+        node = queue.popleft()
+        ordered.append(node)
+        for ps in sorted(graph.get(node, []), key=lambda ps: ps.id):
+            in_degree[ps] -= 1
+            if not in_degree[ps]:
+                queue.append(ps)
+    unordered = sorted(nodes - set(ordered), key=lambda ps: ps.id)
+    return ordered, unordered
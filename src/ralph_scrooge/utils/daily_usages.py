@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Set-based removal of daily usages.
+
+Usages are deleted using plain DELETE statements (without fetching them
+first, as ORM `delete` does), keyed by (date, type_id,
+daily_pricing_object_id). Large sets of keys are loaded into temporary table
+and deleted using single join instead of (huge number of) IN clauses.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import logging
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection
+from django.db import models as db
+
+from ralph_scrooge.models import DailyUsage
+
+logger = logging.getLogger(__name__)
+
+TEMP_TABLE_NAME = 'ralph_scrooge_tmp_dailyusage_keys'
+
+
+def _chunks(values, size):
+    for i in xrange(0, len(values), size):
+        yield values[i:i + size]
+
+
+def _get_id(obj):
+    return obj.pk if isinstance(obj, db.Model) else obj
+
+
+def _get_columns():
+    return [
+        DailyUsage._meta.get_field(f).column
+        for f in ('date', 'type', 'daily_pricing_object')
+    ]
+
+
+def _execute(sql, params=None):
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    return max(cursor.rowcount, 0)
+
+
+def delete_daily_usages(start, end, usage_types):
+    """
+    Delete all daily usages of passed usage types (instances or ids) between
+    start and end (inclusive). Returns number of deleted usages.
+    """
+    qn = connection.ops.quote_name
+    date_col, type_col, _ = _get_columns()
+    type_ids = sorted(set(_get_id(ut) for ut in usage_types))
+    deleted = 0
+    for chunk in _chunks(type_ids, settings.DAILY_USAGE_DELETE_BATCH_SIZE):
+        deleted += _execute(
+            'DELETE FROM {0} WHERE {1} >= %s AND {1} <= %s AND {2} IN ({3})'
+            .format(
+                qn(DailyUsage._meta.db_table),
+                qn(date_col),
+                qn(type_col),
+                ', '.join(['%s'] * len(chunk)),
+            ),
+            [
+                connection.ops.adapt_datefield_value(start),
+                connection.ops.adapt_datefield_value(end),
+            ] + chunk
+        )
+    logger.debug('{} daily usages deleted ({} - {})'.format(
+        deleted, start, end
+    ))
+    return deleted
+
+
+def delete_daily_usages_by_keys(keys):
+    """
+    Delete daily usages matching passed keys - tuples of (date, usage type,
+    daily pricing object), where usage type and daily pricing object could be
+    passed as instances or ids. Returns number of deleted usages.
+    """
+    keys = set(
+        (date, _get_id(usage_type), _get_id(dpo))
+        for date, usage_type, dpo in keys
+    )
+    if not keys:
+        return 0
+    if len(keys) > settings.DAILY_USAGE_DELETE_TEMP_TABLE_THRESHOLD:
+        deleted = _delete_using_temp_table(keys)
+    else:
+        deleted = _delete_in_chunks(keys)
+    logger.debug('{} daily usages deleted ({} keys)'.format(
+        deleted, len(keys)
+    ))
+    return deleted
+
+
+def _delete_in_chunks(keys):
+    """
+    Delete usages using one DELETE per (date, type) and chunk of daily
+    pricing objects ids.
+    """
+    qn = connection.ops.quote_name
+    date_col, type_col, dpo_col = _get_columns()
+    dpo_ids_by_date_and_type = defaultdict(list)
+    for date, type_id, dpo_id in keys:
+        dpo_ids_by_date_and_type[(date, type_id)].append(dpo_id)
+
+    deleted = 0
+    for (date, type_id), dpo_ids in dpo_ids_by_date_and_type.iteritems():
+        for chunk in _chunks(
+            sorted(dpo_ids), settings.DAILY_USAGE_DELETE_BATCH_SIZE
+        ):
+            deleted += _execute(
+                'DELETE FROM {} WHERE {} = %s AND {} = %s AND {} IN ({})'
+                .format(
+                    qn(DailyUsage._meta.db_table),
+                    qn(date_col),
+                    qn(type_col),
+                    qn(dpo_col),
+                    ', '.join(['%s'] * len(chunk)),
+                ),
+                [connection.ops.adapt_datefield_value(date), type_id] + chunk
+            )
+    return deleted
+
+
+def _delete_using_temp_table(keys):
+    """
+    Load keys into temporary table and delete matching usages using single
+    DELETE with join (syntax of which depends on database vendor).
+    """
+    qn = connection.ops.quote_name
+    columns = _get_columns()
+    table = qn(DailyUsage._meta.db_table)
+    temp_table = qn(TEMP_TABLE_NAME)
+    join_condition = ' AND '.join(
+        'k.{0} = du.{0}'.format(qn(col)) for col in columns
+    )
+    if connection.vendor == 'mysql':
+        delete_sql = 'DELETE du FROM {} du INNER JOIN {} k ON {}'
+        drop_sql = 'DROP TEMPORARY TABLE IF EXISTS {}'
+    elif connection.vendor == 'postgresql':
+        delete_sql = 'DELETE FROM {} du USING {} k WHERE {}'
+        drop_sql = 'DROP TABLE IF EXISTS {}'
+    else:
+        delete_sql = (
+            'DELETE FROM {} WHERE EXISTS (SELECT 1 FROM {} k WHERE {})'
+        )
+        # no alias for table in DELETE in SQLite
+        join_condition = join_condition.replace('du.', table + '.')
+        drop_sql = 'DROP TABLE IF EXISTS {}'
+
+    _execute(drop_sql.format(temp_table))
+    _execute(
+        'CREATE TEMPORARY TABLE {} ({} DATE, {} INTEGER, {} INTEGER)'.format(
+            temp_table, *[qn(col) for col in columns]
+        )
+    )
+    try:
+        cursor = connection.cursor()
+        for chunk in _chunks(
+            sorted(keys), settings.DAILY_USAGE_CREATE_BATCH_SIZE
+        ):
+            cursor.executemany(
+                'INSERT INTO {} VALUES (%s, %s, %s)'.format(temp_table),
+                [
+                    (connection.ops.adapt_datefield_value(date), t, dpo)
+                    for date, t, dpo in chunk
+                ]
+            )
+        return _execute(delete_sql.format(table, temp_table, join_condition))
+    finally:
+        _execute(drop_sql.format(temp_table))
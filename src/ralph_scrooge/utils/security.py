@@ -69,6 +69,20 @@ def has_permission_to_service(user, service, check_by_uid=False):
     ).exists()
 
 
+def get_owned_services_uids(user, services_uids):
+    """
+    Returns subset of `services_uids` (UIDs of services), which user has
+    permission to (using single query).
+    """
+    services_uids = set(services_uids)
+    if user.is_superuser:
+        return services_uids
+    return set(ServiceOwnership.objects.filter(
+        service__ci_uid__in=services_uids,
+        owner=user,
+    ).values_list('service__ci_uid', flat=True))
+
+
 # TODO(xor-xor): Make it "private" again, once this module get merged into
 # ralph_scrooge.rest_api.public.auth.
 def has_permission_to_team(user, team):
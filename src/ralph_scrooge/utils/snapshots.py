@@ -0,0 +1,541 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar snapshots of DailyCost and DailyUsage for offline analytics.
+
+Every month of data is kept in separate directory
+(`<SNAPSHOTS_PATH>/<kind>/<YYYY-MM>/`) with one raw, fixed-width binary file
+per column and `meta.json` file describing the snapshot. Symbols (ex. usage
+types) are dictionary-encoded - column contains only index of the symbol in
+dictionary stored in meta. Thanks to that column files could be
+memory-mapped by the reader (and used directly as numpy arrays, if numpy is
+available) without loading (or decompressing) the whole file. Columns are
+not compressed on purpose - compressed formats (ex. Parquet or npz) would
+take less disk space, but would have to be read and decompressed as a whole
+(and Parquet would require additional dependency).
+
+New dates are appended to existing columns, so snapshots could be refreshed
+incrementally (daily) - dates which are ready to export are determined using
+CostDateStatus (for costs) and SyncStatus (for usages). Meta is written after
+columns, so columns longer than number of rows in meta (left by interrupted
+export) are truncated before next append. Months with dates changed since
+export (recalculated costs - see `CostDateStatus.generation`, resynced
+usages) are rebuilt.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import array
+import datetime
+import json
+import logging
+import mmap
+import os
+import shutil
+import sys
+from collections import defaultdict, OrderedDict
+
+from django.conf import settings
+from django.utils import timezone
+
+from ralph_scrooge.models import (
+    BaseUsage,
+    CostDateStatus,
+    DailyCost,
+    DailyUsage,
+    SyncStatus,
+)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+META_FILE = 'meta.json'
+MONTH_FORMAT = '%Y-%m'
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+NULL = -1
+
+# column types
+DATE = 'date'
+INT = 'int'
+BOOL = 'bool'
+FLOAT = 'float'
+SYMBOL = 'symbol'
+
+TYPECODES = {
+    DATE: 'i',
+    INT: 'i',
+    BOOL: 'b',
+    FLOAT: 'd',
+    SYMBOL: 'i',
+}
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _get_usage_types_symbols():
+    return dict(BaseUsage.objects.values_list('id', 'symbol'))
+
+
+def _daily_costs_rows(dates):
+    symbols = _get_usage_types_symbols()
+    link = DailyCost._path_link
+    for (
+        date, service_environment_id, type_id, path, depth, pricing_object_id,
+        warehouse_id, forecast, value, cost
+    ) in DailyCost.objects_tree.filter(
+        date__in=dates,
+        depth__lte=1,
+    ).values_list(
+        'date',
+        'service_environment_id',
+        'type_id',
+        'path',
+        'depth',
+        'pricing_object_id',
+        'warehouse_id',
+        'forecast',
+        'value',
+        'cost',
+    ).order_by('date').iterator():
+        if depth:
+            parent_type = symbols.get(int(path.split(link, 1)[0]))
+        else:
+            parent_type = None
+        yield (
+            date, service_environment_id, symbols.get(type_id), parent_type,
+            depth, pricing_object_id, warehouse_id, forecast, value, cost
+        )
+
+
+def _daily_usages_rows(dates):
+    return DailyUsage.objects.filter(
+        date__in=dates,
+    ).values_list(
+        'date',
+        'service_environment_id',
+        'type__symbol',
+        'daily_pricing_object__pricing_object_id',
+        'warehouse_id',
+        'value',
+    ).order_by('date').iterator()
+
+
+def _get_calculated_costs_dates():
+    return set(CostDateStatus.objects.filter(
+        calculated=True,
+    ).values_list('date', flat=True))
+
+
+def _get_costs_generations():
+    return {
+        date.isoformat(): generation
+        for date, generation in CostDateStatus.objects.filter(
+            calculated=True,
+        ).values_list('date', 'generation')
+    }
+
+
+def _get_synced_usages_dates():
+    return set(SyncStatus.objects.filter(
+        success=True,
+    ).values_list('date', flat=True))
+
+
+def _get_resynced_usages_dates(since):
+    return set(SyncStatus.objects.filter(
+        success=True,
+        modified__gt=since,
+    ).values_list('date', flat=True))
+
+
+SNAPSHOTS = OrderedDict([
+    ('dailycost', {
+        'columns': [
+            ('date', DATE),
+            ('service_environment_id', INT),
+            ('type', SYMBOL),
+            ('parent_type', SYMBOL),
+            ('depth', INT),
+            ('pricing_object_id', INT),
+            ('warehouse_id', INT),
+            ('forecast', BOOL),
+            ('value', FLOAT),
+            ('cost', FLOAT),
+        ],
+        'rows': _daily_costs_rows,
+        'ready_dates': _get_calculated_costs_dates,
+        # recalculated dates are found by generations of exported dates
+        'generations': _get_costs_generations,
+        'changed_dates': None,
+    }),
+    ('dailyusage', {
+        'columns': [
+            ('date', DATE),
+            ('service_environment_id', INT),
+            ('type', SYMBOL),
+            ('pricing_object_id', INT),
+            ('warehouse_id', INT),
+            ('value', FLOAT),
+        ],
+        'rows': _daily_usages_rows,
+        'ready_dates': _get_synced_usages_dates,
+        'generations': None,
+        'changed_dates': _get_resynced_usages_dates,
+    }),
+])
+
+
+def _get_snapshots_path(path=None):
+    path = path or settings.SNAPSHOTS_PATH
+    if not path:
+        raise SnapshotError('Snapshots path (SNAPSHOTS_PATH) not configured')
+    return path
+
+
+def _get_month_path(path, kind, month):
+    return os.path.join(path, kind, month.strftime(MONTH_FORMAT))
+
+
+def _read_meta(month_path):
+    with open(os.path.join(month_path, META_FILE)) as f:
+        return json.load(f)
+
+
+def _write_meta(month_path, meta):
+    # write to temporary file first to not leave broken meta on failure
+    meta_path = os.path.join(month_path, META_FILE)
+    with open(meta_path + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.rename(meta_path + '.tmp', meta_path)
+
+
+def _new_meta(columns):
+    return {
+        'columns': [[name, kind, TYPECODES[kind]] for name, kind in columns],
+        'symbols': {name: [] for name, kind in columns if kind == SYMBOL},
+        'byteorder': sys.byteorder,
+        'dates': [],
+        'generations': {},
+        'rows': 0,
+        'exported_at': None,
+    }
+
+
+def _encode_rows(rows, columns, meta):
+    """
+    Encode rows into typed arrays (one per column). Symbols are replaced by
+    their index in (extended if needed) meta dictionary.
+    """
+    encoders = []
+    for name, kind in columns:
+        if kind == SYMBOL:
+            symbols = meta['symbols'][name]
+            codes = {s: i for (i, s) in enumerate(symbols)}
+
+            def encode(value, symbols=symbols, codes=codes):
+                if value is None:
+                    return NULL
+                if value not in codes:
+                    codes[value] = len(symbols)
+                    symbols.append(value)
+                return codes[value]
+        elif kind == DATE:
+            encode = datetime.date.toordinal
+        elif kind == INT:
+            def encode(value):
+                return NULL if value is None else value
+        elif kind == BOOL:
+            encode = int
+        else:
+            encode = float
+        encoders.append(encode)
+    arrays = [array.array(str(TYPECODES[kind])) for name, kind in columns]
+    count = 0
+    for row in rows:
+        for arr, encode, value in zip(arrays, encoders, row):
+            arr.append(encode(value))
+        count += 1
+    return arrays, count
+
+
+def _truncate_columns(month_path, meta):
+    """
+    Truncate columns to number of rows in meta (data appended by interrupted
+    export, which didn't write meta, is dropped).
+    """
+    for name, kind, typecode in meta['columns']:
+        column_path = os.path.join(month_path, name)
+        size = meta['rows'] * array.array(str(typecode)).itemsize
+        if os.path.exists(column_path) and (
+            os.path.getsize(column_path) != size
+        ):
+            with open(column_path, 'r+b') as f:
+                f.truncate(size)
+
+
+def _export_month(
+    path, kind, month, dates, rebuild=False, generations=None
+):
+    """
+    Append data for dates to month snapshot (or create it from scratch when
+    rebuild is True). Generations of exported dates (if passed) are saved in
+    meta.
+    """
+    snapshot = SNAPSHOTS[kind]
+    columns = snapshot['columns']
+    month_path = _get_month_path(path, kind, month)
+    if rebuild and os.path.exists(month_path):
+        shutil.rmtree(month_path)
+    if os.path.exists(os.path.join(month_path, META_FILE)):
+        meta = _read_meta(month_path)
+    else:
+        if not os.path.exists(month_path):
+            os.makedirs(month_path)
+        meta = _new_meta(columns)
+    _truncate_columns(month_path, meta)
+    arrays, count = _encode_rows(snapshot['rows'](dates), columns, meta)
+    for (name, _), arr in zip(columns, arrays):
+        with open(os.path.join(month_path, name), 'ab') as f:
+            arr.tofile(f)
+    meta['dates'] = sorted(
+        set(meta['dates']) | set(d.isoformat() for d in dates)
+    )
+    if generations is not None:
+        meta.setdefault('generations', {}).update(
+            (d.isoformat(), generations.get(d.isoformat())) for d in dates
+        )
+    meta['rows'] += count
+    exported_at = timezone.now()
+    if settings.USE_TZ:
+        exported_at = timezone.make_naive(exported_at, timezone.utc)
+    meta['exported_at'] = exported_at.strftime(DATETIME_FORMAT)
+    _write_meta(month_path, meta)
+    logger.info('{} rows exported to {}'.format(count, month_path))
+    return count
+
+
+def export_snapshot(kind, path=None, start=None, end=None, rebuild=False):
+    """
+    Export (incrementally) all ready (calculated / synced) dates between start
+    and end to monthly snapshots of given kind. Months, for which any of
+    exported dates changed since last export, are rebuilt.
+
+    Returns number of exported rows.
+    """
+    path = _get_snapshots_path(path)
+    snapshot = SNAPSHOTS[kind]
+    # fetched before exported data, so dates recalculated in the meantime
+    # are rebuilt by next export
+    generations = snapshot['generations'] and snapshot['generations']()
+    ready_dates = set(snapshot['ready_dates']())
+    dates_per_month = defaultdict(set)
+    for date in ready_dates:
+        if (start and date < start) or (end and date > end):
+            continue
+        dates_per_month[date.replace(day=1)].add(date)
+
+    total = 0
+    for month, dates in sorted(dates_per_month.items()):
+        month_path = _get_month_path(path, kind, month)
+        rebuild_month = rebuild
+        if not rebuild and os.path.exists(os.path.join(month_path, META_FILE)):
+            meta = _read_meta(month_path)
+            exported = set(meta['dates'])
+            if snapshot['changed_dates'] and meta['exported_at']:
+                changed = snapshot['changed_dates'](
+                    _parse_datetime(meta['exported_at'])
+                )
+                rebuild_month = any(
+                    d.isoformat() in exported for d in changed
+                )
+            if generations is not None:
+                exported_generations = meta.get('generations', {})
+                rebuild_month = rebuild_month or any(
+                    exported_generations.get(d) != generations.get(d)
+                    for d in exported
+                )
+            if not rebuild_month:
+                dates = set(
+                    d for d in dates if d.isoformat() not in exported
+                )
+        if rebuild_month:
+            # keep previously exported dates in rebuilt snapshot (if they
+            # are still ready - ex. costs were not removed in the meantime)
+            dates |= _get_exported_dates(month_path) & ready_dates
+        if not dates:
+            continue
+        total += _export_month(
+            path, kind, month, sorted(dates), rebuild=rebuild_month,
+            generations=generations,
+        )
+    return total
+
+
+def export_snapshots(path=None, start=None, end=None, rebuild=False):
+    """
+    Export all kinds of snapshots. Should be executed periodically (ex. daily,
+    after costs calculation).
+    """
+    return {
+        kind: export_snapshot(kind, path, start, end, rebuild)
+        for kind in SNAPSHOTS
+    }
+
+
+def _get_exported_dates(month_path):
+    if not os.path.exists(os.path.join(month_path, META_FILE)):
+        return set()
+    return set(_parse_date(d) for d in _read_meta(month_path)['dates'])
+
+
+def _parse_date(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def _parse_datetime(value):
+    dt = datetime.datetime.strptime(value, DATETIME_FORMAT)
+    if settings.USE_TZ:
+        dt = timezone.make_aware(dt, timezone.utc)
+    return dt
+
+
+# =============================================================================
+# Reader
+# =============================================================================
+def list_snapshots(kind, path=None):
+    """
+    Returns list of months (as dates - first day of month) for which
+    snapshot of given kind exists.
+    """
+    kind_path = os.path.join(_get_snapshots_path(path), kind)
+    if not os.path.exists(kind_path):
+        return []
+    return sorted(
+        datetime.datetime.strptime(month, MONTH_FORMAT).date()
+        for month in os.listdir(kind_path)
+        if os.path.exists(os.path.join(kind_path, month, META_FILE))
+    )
+
+
+def open_snapshot(kind, month, path=None):
+    month_path = _get_month_path(_get_snapshots_path(path), kind, month)
+    if not os.path.exists(os.path.join(month_path, META_FILE)):
+        raise SnapshotError('Snapshot {} not found'.format(month_path))
+    return SnapshotReader(month_path)
+
+
+class SnapshotReader(object):
+    """
+    Read access to single (monthly) snapshot. Columns are memory-mapped -
+    when numpy is available, column is returned as (read-only) numpy array
+    backed directly by mapped file, otherwise as `array.array`.
+
+    Example - total cost per type in September 2016:
+
+        with open_snapshot('dailycost', date(2016, 9, 1)) as snapshot:
+            costs = snapshot.sum('cost', by=['type'])
+    """
+    def __init__(self, path):
+        self.path = path
+        self.meta = _read_meta(path)
+        self.columns = OrderedDict(
+            (name, (kind, typecode))
+            for name, kind, typecode in self.meta['columns']
+        )
+        self.symbols = self.meta['symbols']
+        self._mmaps = {}
+
+    def __len__(self):
+        return self.meta['rows']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def dates(self):
+        return [_parse_date(d) for d in self.meta['dates']]
+
+    def close(self):
+        for mm in self._mmaps.values():
+            mm.close()
+        self._mmaps = {}
+
+    def _mmap(self, name):
+        if name not in self._mmaps:
+            with open(os.path.join(self.path, name), 'rb') as f:
+                self._mmaps[name] = mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ
+                )
+        return self._mmaps[name]
+
+    def column(self, name):
+        """
+        Returns raw (encoded) values of column (dates as ordinals, symbols
+        as indexes in `symbols[name]`, nulls as -1).
+        """
+        kind, typecode = self.columns[name]
+        swap = self.meta['byteorder'] != sys.byteorder
+        if not len(self):
+            if np is not None:
+                return np.array([], typecode)
+            return array.array(str(typecode))
+        mm = self._mmap(name)
+        if np is not None:
+            arr = np.frombuffer(mm, dtype=typecode, count=len(self))
+            return arr.byteswap() if swap else arr
+        arr = array.array(str(typecode))
+        arr.fromstring(mm[:len(self) * arr.itemsize])
+        if swap:
+            arr.byteswap()
+        return arr
+
+    def decode(self, name, value):
+        kind, _ = self.columns[name]
+        if kind == SYMBOL:
+            return None if value == NULL else self.symbols[name][value]
+        if kind == DATE:
+            return datetime.date.fromordinal(value)
+        if kind == INT:
+            return None if value == NULL else int(value)
+        if kind == BOOL:
+            return bool(value)
+        return float(value)
+
+    def rows(self, columns=None):
+        """
+        Iterate over (decoded) rows - every row is a tuple of values of
+        requested columns (all columns by default).
+        """
+        columns = columns or list(self.columns)
+        values = [self.column(name) for name in columns]
+        for row in zip(*values):
+            yield tuple(
+                self.decode(name, value) for name, value in zip(columns, row)
+            )
+
+    def sum(self, column, by=()):
+        """
+        Sum values of column grouped by (decoded) values of columns in `by`.
+        """
+        by = list(by)
+        keys = [self.column(name) for name in by]
+        result = defaultdict(float)
+        if keys:
+            for key, value in zip(zip(*keys), self.column(column)):
+                result[key] += value
+        elif len(self):
+            result[()] = sum(self.column(column))
+        return {
+            tuple(self.decode(name, v) for name, v in zip(by, key)): value
+            for key, value in result.items()
+        }
@@ -8,10 +8,12 @@ from __future__ import unicode_literals
 
 import logging
 from datetime import date
+from dateutil import rrule
 from dateutil.relativedelta import relativedelta
 
 from django.conf import settings
 from django.db import connection
+from django.utils.dateparse import parse_date
 
 logger = logging.getLogger(__name__)
 
@@ -70,3 +72,98 @@ PARTITION p_max VALUES LESS THAN (MAXVALUE) (
 ALTER TABLE ralph_scrooge_dailycost REORGANIZE PARTITION p_max INTO (%s)
 """ % (",".join(sql_parts))
     cursor.execute(sql)
+
+
+def backfill_dailycosts_services(start=None, end=None, chunk_size=None):
+    """
+    Set (denormalized) service and environment of daily costs which don't
+    have it set (ex. saved before they were introduced), according to their
+    service environment. When start or end is not given, it's taken from the
+    range of costs to backfill.
+
+    Costs are updated day by day, separately for forecast and not forecast
+    costs, in chunks of (at most) chunk_size costs (defaults to
+    DAILY_COST_BACKFILL_CHUNK_SIZE), so every update touches only single
+    (sub)partition of dailycost table and doesn't lock it for a long time.
+
+    Returns number of updated costs.
+    """
+    chunk_size = chunk_size or settings.DAILY_COST_BACKFILL_CHUNK_SIZE
+    cursor = connection.cursor()
+    if start is None or end is None:
+        cursor.execute("""
+            SELECT MIN(date), MAX(date)
+            FROM ralph_scrooge_dailycost
+            WHERE service_id IS NULL
+        """)
+        min_date, max_date = cursor.fetchone()
+        if min_date is None:
+            logger.info('No daily costs to backfill')
+            return 0
+        # sqlite returns dates of aggregates as strings
+        start = start or parse_date(str(min_date))
+        end = end or parse_date(str(max_date))
+    select_sql = """
+        SELECT id
+        FROM ralph_scrooge_dailycost
+        WHERE date = %s AND forecast = %s AND service_id IS NULL AND id > %s
+        ORDER BY id
+        LIMIT %s
+    """
+    update_sql = """
+        UPDATE ralph_scrooge_dailycost SET
+            service_id = (
+                SELECT se.service_id
+                FROM ralph_scrooge_serviceenvironment se
+                WHERE se.id = ralph_scrooge_dailycost.service_environment_id
+            ),
+            environment_id = (
+                SELECT se.environment_id
+                FROM ralph_scrooge_serviceenvironment se
+                WHERE se.id = ralph_scrooge_dailycost.service_environment_id
+            )
+        WHERE date = %s AND forecast = %s AND id IN ({}) AND EXISTS (
+            SELECT 1
+            FROM ralph_scrooge_serviceenvironment se
+            WHERE se.id = ralph_scrooge_dailycost.service_environment_id
+        )
+    """
+    updated = 0
+    for day in rrule.rrule(rrule.DAILY, dtstart=start, until=end):
+        for forecast in (False, True):
+            # costs are iterated by id, because costs of service
+            # environments which no longer exist are not backfilled
+            last_id = 0
+            while True:
+                cursor.execute(
+                    select_sql, [day.date(), forecast, last_id, chunk_size]
+                )
+                ids = [row[0] for row in cursor.fetchall()]
+                if not ids:
+                    break
+                cursor.execute(
+                    update_sql.format(', '.join(['%s'] * len(ids))),
+                    [day.date(), forecast] + ids
+                )
+                updated += cursor.rowcount
+                last_id = ids[-1]
+        logger.info('Daily costs of {:%Y-%m-%d} backfilled'.format(day))
+    return updated
+
+
+def export_snapshots():
+    """
+    Export daily costs and usages calculated (synced) since last export to
+    columnar snapshots (see `ralph_scrooge.utils.snapshots`).
+
+    Executed after costs calculation - does nothing when SNAPSHOTS_PATH is
+    not configured.
+    """
+    if not settings.SNAPSHOTS_PATH:
+        logger.debug('SNAPSHOTS_PATH not configured, snapshots not exported')
+        return
+    # imported here to not load models when importing this module (it's used
+    # in migrations)
+    from ralph_scrooge.utils.snapshots import export_snapshots as _export
+    for kind, count in _export().items():
+        logger.info('{} new rows exported to {} snapshots'.format(count, kind))
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental detection of usage anomalies per usage type and service
+environment.
+
+For every (usage type, service environment) pair rolling statistics
+(exponentially weighted moving average and variance) of daily usages are kept
+in `UsageAnomalyStats`. Every day of usages is processed once (in order of
+days) - its value is compared with statistics of previous days (and saved as
+`ServiceEnvironmentUsageAnomaly` if it's an outlier) and then statistics are
+updated with it. Thanks to that, only new usages have to be fetched, instead
+of the whole month of usages of every service environment.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import datetime
+import logging
+import math
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db import models as db
+from django.db.models import Case, Sum, Value, When
+
+from ralph_scrooge.models import (
+    DailyUsage,
+    ServiceEnvironmentUsageAnomaly,
+    UsageAnomalyStats,
+    UsageType,
+)
+from ralph_scrooge.utils.common import get_cache_name, get_queue_name
+from ralph_scrooge.utils.worker_job import WorkerJob
+
+logger = logging.getLogger(__name__)
+
+# number of statistics updated by single UPDATE (every one adds two params
+# per field - SQLite limits number of variables in single query to 999)
+UPDATE_BATCH_SIZE = 100
+STATS_FIELDS = ('last_date', 'mean', 'variance', 'count')
+
+
+def _get_id(obj):
+    return obj.pk if isinstance(obj, db.Model) else obj
+
+
+def _get_start_date(end_date, stats):
+    """
+    Returns first day of usages to fetch - usages of some days before the
+    last processed one are fetched too, to catch usages uploaded late.
+    """
+    if not stats:
+        days = settings.USAGE_ANOMALY_INITIAL_DAYS
+        return end_date - datetime.timedelta(days=days)
+    last_date = max(s.last_date for s in stats)
+    return min(
+        last_date - datetime.timedelta(
+            days=settings.USAGE_ANOMALY_LOOKBACK_DAYS
+        ),
+        end_date
+    )
+
+
+def _get_deviation(stats, value, change_tolerance):
+    """
+    Returns difference between value and mean of stats in (effective)
+    standard deviations. Standard deviation is not less than
+    `change_tolerance` (relative to mean) divided by threshold, so change
+    smaller than `change_tolerance` is never reported. Returns None if
+    deviation could not be calculated (when there's no variability at all).
+    """
+    std = max(
+        math.sqrt(stats.variance),
+        change_tolerance * abs(stats.mean) / settings.USAGE_ANOMALY_THRESHOLD,
+    )
+    if not std:
+        return None
+    return (value - stats.mean) / std
+
+
+def _update_stats(stats, date, value):
+    alpha = settings.USAGE_ANOMALY_EWMA_ALPHA
+    diff = value - stats.mean
+    increment = alpha * diff
+    stats.mean += increment
+    stats.variance = (1 - alpha) * (stats.variance + diff * increment)
+    stats.count += 1
+    stats.last_date = date
+
+
+def _load_stats(type_ids, lock):
+    stats = UsageAnomalyStats.objects.all()
+    if type_ids is not None:
+        stats = stats.filter(type__in=type_ids)
+    if lock:
+        # concurrent updates of the same statistics wait for each other
+        stats = stats.select_for_update()
+    return list(stats)
+
+
+def update_usage_anomaly_stats(end_date, usage_types=None, dry_run=False):
+    """
+    Update rolling statistics with daily usages (summed per usage type,
+    service environment and day) up to `end_date`, which were not processed
+    yet (optionally only for usage types passed as instances or ids).
+    Outliers are saved as `ServiceEnvironmentUsageAnomaly` (and returned).
+    If `dry_run` is True, nothing is saved (anomalies are only returned).
+    """
+    with transaction.atomic():
+        return _update_usage_anomaly_stats(end_date, usage_types, dry_run)
+
+
+def _update_usage_anomaly_stats(end_date, usage_types, dry_run):
+    usages = DailyUsage.objects.all()
+    type_ids = None
+    if usage_types is not None:
+        type_ids = set(_get_id(ut) for ut in usage_types)
+        usages = usages.filter(type__in=type_ids)
+    stats = _load_stats(type_ids, lock=not dry_run)
+    start_date = _get_start_date(end_date, stats)
+    usages = usages.filter(
+        date__gte=start_date,
+        date__lte=end_date,
+    ).values_list(
+        'type_id', 'service_environment_id', 'date'
+    ).annotate(Sum('value')).order_by('date')
+
+    stats_by_key = {(s.type_id, s.service_environment_id): s for s in stats}
+    change_tolerances = dict(UsageType.objects_admin.values_list(
+        'id', 'change_tolerance'
+    ))
+    changed = {}
+    anomalies = []
+    for type_id, se_id, date, value in usages:
+        key = (type_id, se_id)
+        se_stats = stats_by_key.get(key)
+        if se_stats is None:
+            stats_by_key[key] = changed[key] = UsageAnomalyStats(
+                type_id=type_id,
+                service_environment_id=se_id,
+                last_date=date,
+                mean=value,
+                count=1,
+            )
+            continue
+        if date <= se_stats.last_date:
+            # already processed
+            continue
+        if se_stats.count >= settings.USAGE_ANOMALY_MIN_OBSERVATIONS:
+            deviation = _get_deviation(
+                se_stats, value, change_tolerances[type_id]
+            )
+            if (
+                deviation is not None and
+                abs(deviation) > settings.USAGE_ANOMALY_THRESHOLD
+            ):
+                anomalies.append(ServiceEnvironmentUsageAnomaly(
+                    type_id=type_id,
+                    service_environment_id=se_id,
+                    date=date,
+                    value=value,
+                    expected=se_stats.mean,
+                    deviation=deviation,
+                ))
+        _update_stats(se_stats, date, value)
+        changed[key] = se_stats
+
+    if dry_run:
+        return anomalies
+    _save(changed.values(), anomalies)
+    logger.info(
+        '{} usage anomaly statistics updated, {} anomalies detected'.format(
+            len(changed), len(anomalies)
+        )
+    )
+    return anomalies
+
+
+class UsageAnomalyStatsJob(WorkerJob):
+    """
+    Update usage anomaly statistics on worker.
+    """
+    queue_name = get_queue_name('scrooge_usage_anomalies', 'default')
+    cache_name = get_cache_name('scrooge_usage_anomalies', 'default')
+    cache_section = 'scrooge_usage_anomalies'
+
+    @classmethod
+    def run(cls, end_date, usage_types=None):
+        try:
+            update_usage_anomaly_stats(end_date, usage_types)
+        except Exception as e:
+            logger.exception(e)
+        yield 100, None
+
+
+def refresh_usage_anomaly_stats(end_date, usage_types=None):
+    """
+    Update usage anomaly statistics after saving usages (by API or collect
+    plugins) - update is scheduled on worker after commit of current
+    transaction, so it doesn't block saving usages (concurrent updates of
+    statistics wait for each other). Failure is only logged (statistics will
+    be updated on the next save or anomalies detection).
+    """
+    kwargs = {'end_date': end_date}
+    if usage_types is not None:
+        kwargs['usage_types'] = sorted(_get_id(ut) for ut in usage_types)
+
+    def enqueue():
+        try:
+            # previous update (with the same params) could be already done
+            # (before these usages were saved) - schedule a new one
+            UsageAnomalyStatsJob._clear_cache(**kwargs)
+            UsageAnomalyStatsJob().run_on_worker(**kwargs)
+        except Exception as e:
+            logger.exception(e)
+
+    transaction.on_commit(enqueue)
+
+
+def _update(stats):
+    """
+    Update existing statistics in place, using single UPDATE (with CASE) per
+    chunk of them.
+    """
+    fields = [
+        UsageAnomalyStats._meta.get_field(field_name)
+        for field_name in STATS_FIELDS
+    ]
+    for i in xrange(0, len(stats), UPDATE_BATCH_SIZE):
+        chunk = stats[i:i + UPDATE_BATCH_SIZE]
+        UsageAnomalyStats.objects.filter(
+            id__in=[s.id for s in chunk]
+        ).update(**{
+            field.name: Case(
+                *[When(id=s.id, then=Value(
+                    getattr(s, field.name), output_field=field
+                )) for s in chunk],
+                output_field=field
+            ) for field in fields
+        })
+
+
+def _create_missing(objs):
+    """
+    Create objects (all of the same model) skipping ones which violate
+    unique constraint (ex. created in the meantime by concurrent update).
+    """
+    if not objs:
+        return
+    model = type(objs[0])
+    try:
+        with transaction.atomic():
+            model.objects.bulk_create(objs)
+    except IntegrityError:
+        for obj in objs:
+            try:
+                with transaction.atomic():
+                    obj.save(force_insert=True)
+            except IntegrityError:
+                logger.debug('{} already exists: {}'.format(
+                    model.__name__, obj.__dict__
+                ))
+
+
+def _save(stats, anomalies):
+    _update([s for s in stats if s.id is not None])
+    _create_missing([s for s in stats if s.id is None])
+    _create_missing(anomalies)